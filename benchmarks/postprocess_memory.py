@@ -0,0 +1,69 @@
+"""
+Peak memory of SynthSeg postprocessing, before and after it was made to work in place, in float32, and on slabs.
+
+Runs predict_synthseg.postprocess and the previous implementation (tests/test_postprocess.py) on synthetic
+posteriors, and prints the peak memory traced by tracemalloc (NumPy arrays included) in every configuration:
+old, new, new without the full-FOV posteriors (no --post), and the latter on slabs.
+
+Usage (from the root of the repository, with lamar installed or on PYTHONPATH):
+-----
+python benchmarks/postprocess_memory.py [--patch 96x112x96] [--shape 116x136x106] [--labels 33] [--parc-labels 61]
+"""
+
+import os
+import sys
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+from test_postprocess import reference_postprocess, random_posteriors, traced_peak  # noqa: E402
+from lamar.SynthSeg.predict_synthseg import postprocess  # noqa: E402
+
+
+def parse_shape(value):
+    return [int(size) for size in value.lower().split('x')]
+
+
+def get_inputs(patch_shape, shape, n_labels, n_labels_parc, parcellation, seed=0):
+    """Synthetic posteriors of a patch padded by 2 voxels on each side, in an image of the given shape, and the other
+    arguments of postprocess (without fast and topology_classes)."""
+    rng = np.random.default_rng(seed)
+    patch_shape, shape = np.array(patch_shape), np.array(shape)
+    pad_idx = np.array([2, 2, 2, *(patch_shape - 2)])
+    crop_start = (shape - (patch_shape - 4)) // 2
+    crop_idx = np.array([*crop_start, *(crop_start + patch_shape - 4)])
+    labels_segmentation = np.array([0, 2, 3, 41, 42, *range(100, 100 + n_labels - 5)])
+    labels_parcellation = np.array([0, *range(1001, 1001 + (n_labels_parc - 1) // 2),
+                                    *range(2001, 2001 + n_labels_parc - 1 - (n_labels_parc - 1) // 2)])
+    post_seg = random_posteriors(rng, tuple(patch_shape), n_labels, background=1.)
+    post_parc = random_posteriors(rng, tuple(patch_shape), n_labels_parc) if parcellation else None
+    args = (list(shape), pad_idx, crop_idx, labels_segmentation, labels_parcellation if parcellation else None,
+            np.diag([-1., 1., 1., 1.]), np.array([1., 1., 1.]))
+    return post_seg, post_parc, args
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--patch', type=parse_shape, default=[96, 112, 96], help='shape of the network output')
+    parser.add_argument('--shape', type=parse_shape, default=[116, 136, 106], help='shape of the input image')
+    parser.add_argument('--labels', type=int, default=33, help='number of segmentation labels')
+    parser.add_argument('--parc-labels', type=int, default=61, help='number of parcellation labels')
+    args = parser.parse_args()
+
+    topology_classes = np.arange(args.labels)
+    mib = 1024 ** 2
+    print(f"{'':<20}{'old':>12}{'new':>12}{'no --post':>12}{'no --post, slabs':>18}")
+    for name, fast, parcellation in [('topology + parc', False, True), ('fast + parc', True, True),
+                                     ('topology', False, False), ('fast', True, False)]:
+        post_seg, post_parc, inputs = get_inputs(args.patch, args.shape, args.labels, args.parc_labels, parcellation)
+        inputs = (*inputs, fast, topology_classes, False)
+        old = traced_peak(reference_postprocess, post_seg, post_parc, *inputs)
+        new = traced_peak(postprocess, post_seg, post_parc, *inputs, slab_size=None)
+        no_post = traced_peak(postprocess, post_seg, post_parc, *inputs, keep_posteriors=False, slab_size=None)
+        slabs = traced_peak(postprocess, post_seg, post_parc, *inputs, keep_posteriors=False)
+        print(f"{name:<20}{old / mib:>8.0f} MiB{new / mib:>8.0f} MiB{no_post / mib:>8.0f} MiB{slabs / mib:>14.0f} MiB")
+
+
+if __name__ == '__main__':
+    main()
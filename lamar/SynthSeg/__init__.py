@@ -1,9 +1,6 @@
-from . import brain_generator
-from . import estimate_priors
-from . import evaluate
-from . import labels_to_image_model
-from . import metrics_model
-from . import model_inputs
-from . import predict
-from . import training_supervised
-from . import training
+from lamar.lazy import lazy_submodules
+
+_SUBMODULES = ['brain_generator', 'estimate_priors', 'evaluate', 'labels_to_image_model', 'metrics_model',
+               'model_inputs', 'predict', 'predict_onnx', 'predict_synthseg', 'training_supervised', 'training']
+
+__getattr__ = lazy_submodules(__name__, _SUBMODULES)
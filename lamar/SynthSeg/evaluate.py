@@ -303,10 +303,10 @@ def evaluation(gt_dir,
                 loop_info.update(idx)
 
             # load gt labels and segmentation
-            gt_labels = utils.load_volume(path_gt, dtype='int', aff_ref=np.eye(4))
-            seg = utils.load_volume(path_seg, dtype='int', aff_ref=np.eye(4))
+            gt_labels = utils.load_volume(path_gt, dtype='int', aff_ref=np.eye(4), mode='native')
+            seg = utils.load_volume(path_seg, dtype='int', aff_ref=np.eye(4), mode='native')
             if path_mask is not None:
-                mask = utils.load_volume(path_mask, dtype='bool', aff_ref=np.eye(4))
+                mask = utils.load_volume(path_mask, dtype='bool', aff_ref=np.eye(4), mode='native')
                 gt_labels[mask] = max_label
                 seg[mask] = max_label
 
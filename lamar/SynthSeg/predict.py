@@ -18,19 +18,13 @@ License.
 import os
 import csv
 import numpy as np
-import tensorflow as tf
-import keras.layers as KL
-import keras.backend as K
-from keras.models import Model
 
 # project imports
 from lamar.SynthSeg import evaluate
 
 # third-party imports
 from lamar.ext.lab2im import utils
-from lamar.ext.lab2im import layers
 from lamar.ext.lab2im import edit_volumes
-from lamar.ext.neuron import models as nrn_models
 
 
 def predict(path_images,
@@ -440,6 +434,13 @@ def build_model(path_model,
                 flip_indices,
                 gradients):
 
+    import tensorflow as tf
+    import keras.layers as KL
+    import keras.backend as K
+    from keras.models import Model
+    from lamar.ext.lab2im import layers
+    from lamar.ext.neuron import models as nrn_models
+
     assert os.path.isfile(path_model), "The provided model path does not exist."
 
     # get labels
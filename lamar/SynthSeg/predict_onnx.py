@@ -0,0 +1,300 @@
+"""
+predict_onnx - SynthSeg networks exported to ONNX, and run with ONNX Runtime
+
+Part of the LaMAR processing pipeline.
+
+`lamar synthseg compile --backend onnxruntime` exports the UNets of a SynthSeg
+configuration (segmentation UNet, or the three UNets of the robust cascade,
+parcellation UNet) and the QC regressor as separate ONNX graphs. The layers
+that link them in build_model are not exported: the argmax/one-hot transitions,
+the label conversions, the Gaussian smoothing of the posteriors, the left/right
+flip averaging and the cropping of the QC input are reproduced in NumPy by
+OnnxModel. `lamar synthseg --backend onnxruntime` then runs SynthSeg with
+onnxruntime only: TensorFlow is never imported, which saves its import time
+and memory, and ONNX Runtime's CPU kernels are often faster than TensorFlow's
+for these 3D convolutions.
+
+Exporting needs TensorFlow and tf2onnx; running needs onnxruntime.
+
+Command-line Usage:
+-----------------
+lamar synthseg compile --backend onnxruntime [--parc] [--robust] [--fast] [--v1] [--qc] [--all]
+    [--check <image>]
+lamar synthseg --i <image> --o <segmentation> --backend onnxruntime
+
+Python Usage:
+-----------
+>>> from lamar.SynthSeg.predict_onnx import export_onnx_model, load_onnx_model
+>>> path = export_onnx_model(model_config)  # see predict_synthseg.get_model_config
+>>> net = load_onnx_model(path, threads=4)
+>>> posteriors = net.predict(image)  # same outputs as the Keras network of build_model
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from lamar.ext.lab2im import utils
+from lamar.SynthSeg.predict_synthseg import get_compiled_model_path
+
+# opset of the exported graphs, part of the name of their directory
+ONNX_OPSET = 17
+
+BACKENDS = ['tensorflow', 'onnxruntime']
+
+
+def get_onnx_model_path(model_config, model_dir=None):
+    """Directory of the ONNX graphs of a configuration (see predict_synthseg.get_model_config). Like the SavedModels,
+    it is named after a hash of the configuration and weight files, but not of the TensorFlow version, so that it can
+    be found without importing TensorFlow. The graphs always compute in float32."""
+    return get_compiled_model_path(dict(model_config, precision='float32'), model_dir, prefix='onnx',
+                                   versions=['onnx', ONNX_OPSET])
+
+
+def build_networks(model_config):
+    """Standalone Keras models of the networks of a configuration, built with the same layers (and layer names) as in
+    build_model and loaded with the same weights, as {name: model}."""
+    import tensorflow as tf
+    import keras.layers as KL
+    from keras.models import Model
+    from lamar.ext.neuron import models as nrn_models
+
+    unet_kwargs = dict(nb_levels=5, nb_conv_per_level=2, conv_size=3, nb_features=24, feat_mult=2, activation='elu',
+                       batch_norm=-1)
+    n_labels_seg = len(model_config['labels_segmentation'])
+    nets = dict()
+    if model_config['robust']:
+        n_groups = len(model_config['labels_denoiser'])
+        n_channels_unet2 = 1 + (n_groups - 1 if n_groups <= 2 else n_groups)
+        nets['unet'] = nrn_models.unet(input_shape=[None, None, None, 1], nb_labels=n_groups, name='unet',
+                                       **unet_kwargs)
+        nets['l2l'] = nrn_models.unet(input_shape=[None, None, None, n_groups], nb_labels=n_groups, nb_levels=5,
+                                      nb_conv_per_level=2, conv_size=5, nb_features=16, feat_mult=2, activation='elu',
+                                      batch_norm=-1, skip_n_concatenations=2, name='l2l')
+        nets['unet2'] = nrn_models.unet(input_shape=[None, None, None, n_channels_unet2], nb_labels=n_labels_seg,
+                                        name='unet2', **unet_kwargs)
+    else:
+        nets['unet'] = nrn_models.unet(input_shape=[None, None, None, 1], nb_labels=n_labels_seg, name='unet',
+                                       **unet_kwargs)
+    for net in nets.values():
+        net.load_weights(model_config['path_model_segmentation'], by_name=True)
+
+    if model_config['do_parcellation']:
+        nets['unet_parc'] = nrn_models.unet(input_shape=[None, None, None, 3],
+                                            nb_labels=len(model_config['labels_parcellation']), name='unet_parc',
+                                            **unet_kwargs)
+        nets['unet_parc'].load_weights(model_config['path_model_parcellation'], by_name=True)
+
+    if model_config['do_qc']:
+        n_labels_qc = len(np.unique(model_config['labels_qc']))
+        net = nrn_models.conv_enc(input_shape=[None, None, None, n_labels_qc], nb_levels=4, nb_conv_per_level=2,
+                                  conv_size=5, nb_features=24, feat_mult=2, activation='relu', batch_norm=-1,
+                                  use_residuals=True, name='qc')
+        last_tensor = net.outputs[0]
+        conv_kwargs = {'padding': 'same', 'activation': 'relu', 'data_format': 'channels_last'}
+        last_tensor = KL.MaxPool3D(pool_size=(2, 2, 2), name='qc_maxpool_3', padding='same')(last_tensor)
+        last_tensor = KL.Conv3D(n_labels_qc, kernel_size=5, **conv_kwargs, name='qc_final_conv_0')(last_tensor)
+        last_tensor = KL.Conv3D(n_labels_qc, kernel_size=5, **conv_kwargs, name='qc_final_conv_1')(last_tensor)
+        last_tensor = KL.Lambda(lambda x: tf.reduce_mean(x, axis=[1, 2, 3]), name='qc_final_pred')(last_tensor)
+        nets['qc'] = Model(inputs=net.inputs, outputs=last_tensor)
+        nets['qc'].load_weights(model_config['path_model_qc'], by_name=True)
+
+    return nets
+
+
+def export_onnx_model(model_config, model_dir=None, overwrite=False):
+    """Export the networks of a configuration (see predict_synthseg.get_model_config) as ONNX graphs, with a
+    description of the configuration used by OnnxModel to link them. Returns the path of the exported directory."""
+    import tensorflow as tf
+    import tf2onnx
+
+    path = get_onnx_model_path(model_config, model_dir)
+    if os.path.isdir(path) and not overwrite:
+        return path
+    nets = build_networks(model_config)
+
+    # export to a temporary directory then rename it, so that predict never loads partially written graphs
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        for name, net in nets.items():
+            n_channels = net.inputs[0].shape[-1]
+            input_signature = [tf.TensorSpec([None, None, None, None, n_channels], tf.float32, name='input')]
+            function = tf.function(lambda x, net=net: net(x, training=False))
+            tf2onnx.convert.from_function(function, input_signature=input_signature, opset=ONNX_OPSET,
+                                          output_path=os.path.join(tmp_path, name + '.onnx'))
+        description = {name: value.tolist() if isinstance(value, np.ndarray) else value
+                       for name, value in dict(model_config, precision='float32').items()}
+        with open(os.path.join(tmp_path, 'lamar_model.json'), 'w') as f:
+            json.dump(dict(description, networks=list(nets), opset=ONNX_OPSET,
+                           created=time.strftime('%Y-%m-%dT%H:%M:%S')), f, indent=2)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process exported the same graphs in the meantime
+        if not os.path.isdir(path):
+            raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+    return path
+
+
+def one_hot(indices, depth):
+    """NumPy tf.one_hot: float32 one-hot encoding along a new last axis (all zeros for indices out of range)."""
+    return (indices[..., np.newaxis] == np.arange(depth)).astype('float32')
+
+
+def gaussian_blur(posteriors, sigma):
+    """NumPy layers.GaussianBlur with a fixed sigma: channel-wise convolution of a batch of volumes with the same
+    normalised Gaussian kernel, zero-padded to the input shape."""
+    from scipy.ndimage import correlate1d
+    n_dims = posteriors.ndim - 2
+    for axis, s in enumerate(utils.reformat_to_list(sigma, length=n_dims)):
+        window_size = int(np.int32(np.ceil(2.5 * s) / 2) * 2 + 1)
+        if s <= 0 or window_size <= 1:
+            continue
+        locations = np.arange(window_size, dtype='float32') - (window_size - 1) / 2
+        kernel = np.exp(-locations ** 2 / (2 * s ** 2))
+        posteriors = correlate1d(posteriors, (kernel / kernel.sum()).astype('float32'), axis=axis + 1,
+                                 mode='constant', cval=0.)
+    return posteriors
+
+
+def make_shape(label_map, shape, target_shape):
+    """NumPy layers.MakeShape for one label map (of network output indices): crop the map around its foreground
+    (indices other than 0 and 24) and pad it to target_shape, keeping the foreground centred."""
+    n_dims = label_map.ndim
+    target_shape = np.array(utils.reformat_to_list(target_shape, length=n_dims))
+    shape = np.array(shape)
+    indices = np.argwhere((label_map != 0) & (label_map != 24))
+    if len(indices) == 0:
+        min_idx = np.zeros(n_dims, dtype='int64')
+        max_idx = np.minimum(shape, target_shape)
+    else:
+        min_idx = np.maximum(indices.min(axis=0), 0)
+        max_idx = np.minimum(indices.max(axis=0) + 1, shape)
+
+    # expand/retract (depending on the desired shape) the cropping region around the centre
+    size = max_idx - min_idx
+    min_idx = min_idx - np.ceil((target_shape - size) / 2).astype('int64')
+    max_idx = max_idx + np.floor((target_shape - size) / 2).astype('int64')
+    label_map = label_map[tuple(slice(max(a, 0), min(b, s)) for a, b, s in zip(min_idx, max_idx, shape))]
+    padding = [(max(-a, 0), max(b - s, 0)) for a, b, s in zip(min_idx, max_idx, shape)]
+    return np.pad(label_map, padding)
+
+
+class OnnxModel:
+    """Networks of a configuration exported by export_onnx_model, run with ONNX Runtime and linked in NumPy as in
+    build_model, with the predict method of the Keras model used by run_network."""
+
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+        self.path = path
+        with open(os.path.join(path, 'lamar_model.json')) as f:
+            config = json.load(f)
+        self.labels_segmentation = np.array(config['labels_segmentation'])
+        self.n_groups = len(config['labels_denoiser'])
+        self.robust = config['robust']
+        self.do_parcellation = config['do_parcellation']
+        self.do_qc = config['do_qc']
+        self.sigma_smoothing = config['sigma_smoothing']
+        self.flip_indices = np.array(config['flip_indices']) if config['flip_indices'] is not None else None
+        self.input_shape_qc = config['input_shape_qc']
+        if self.do_parcellation:
+            self.parcellation_mask = np.isin(self.labels_segmentation, [3, 42]).astype('int32')
+        if self.do_qc:
+            self.labels_qc = np.array(config['labels_qc'])
+            self.n_labels_qc = len(np.unique(self.labels_qc))
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if threads:
+            options.intra_op_num_threads = int(threads)
+            options.inter_op_num_threads = 1
+        self.sessions = {name: ort.InferenceSession(os.path.join(path, name + '.onnx'), options,
+                                                    providers=['CPUExecutionProvider'])
+                         for name in config['networks']}
+
+    def run(self, name, inputs):
+        """Output of one exported network."""
+        session = self.sessions[name]
+        return session.run(None, {session.get_inputs()[0].name: np.ascontiguousarray(inputs, dtype='float32')})[0]
+
+    def predict(self, inputs):
+        if self.do_qc:
+            image, shapes = inputs
+        else:
+            image, shapes = inputs, None
+
+        if self.robust:
+            # transitions between the networks: one_hot -> argmax -> one_hot, then concatenate input image and labels
+            groups = one_hot(np.argmax(self.run('unet', image), axis=-1), self.n_groups)
+            groups = one_hot(np.argmax(self.run('l2l', groups), axis=-1), self.n_groups)
+            if self.n_groups <= 2:
+                groups = groups[..., 1:]
+            posteriors = prediction = self.run('unet2', np.concatenate([image, groups], axis=-1))
+
+        elif self.flip_indices is not None:
+            # segment the image and its flipped version in the same run, flip back and re-order channels, and average
+            n_images = image.shape[0]
+            both = self.run('unet', np.concatenate([image, np.flip(image, axis=1)], axis=0))
+            if self.sigma_smoothing > 0:
+                both = gaussian_blur(both, self.sigma_smoothing)
+            flipped = np.flip(both[n_images:], axis=1)[..., self.flip_indices]
+            posteriors = prediction = 0.5 * (both[:n_images] + flipped)
+
+        else:
+            # with parcellation or QC, the segmentation posteriors are the ones of the UNet, before smoothing
+            posteriors = prediction = self.run('unet', image)
+            if self.sigma_smoothing > 0:
+                posteriors = gaussian_blur(posteriors, self.sigma_smoothing)
+
+        outputs = [prediction if self.do_parcellation or self.do_qc else posteriors]
+
+        # parcellation of the cortex: input image, and one-hot map of 1 = cortex, 0 = other
+        if self.do_parcellation:
+            cortex = one_hot(self.parcellation_mask[np.argmax(posteriors, axis=-1)], 2)
+            parcellation = self.run('unet_parc', np.concatenate([image, cortex], axis=-1))
+            # as in build_model, the QC model outputs the parcellation posteriors of the UNet, before smoothing
+            outputs.append(parcellation if self.do_qc else gaussian_blur(parcellation, 0.5))
+
+        # QC regressor: segmentation cropped/padded to the QC input shape, converted to QC labels and one-hot encoded
+        # (as in build_model, of the smoothed posteriors without parcellation)
+        if self.do_qc:
+            indices = np.argmax(prediction if self.do_parcellation else posteriors, axis=-1)
+            qc_input = np.stack([make_shape(indices[n], shapes[n], self.input_shape_qc) for n in range(len(indices))])
+            outputs.append(self.run('qc', one_hot(self.labels_qc[qc_input], self.n_labels_qc)))
+
+        return outputs if len(outputs) > 1 else outputs[0]
+
+
+def load_onnx_model(path, threads=None):
+    return OnnxModel(path, threads)
+
+
+def compare_backends(model_config, onnx_path, path_image):
+    """Run the TensorFlow network of a configuration and its exported ONNX graphs on a preprocessed image, and compare
+    their outputs. Returns {output: (max absolute difference, fraction of voxels with the same argmax)}, with QC
+    scores compared as vectors."""
+    from lamar.SynthSeg.predict_synthseg import build_model, preprocess, run_network
+    image = preprocess(path_image=path_image, ct=False, min_pad=128)[0]
+    do_parcellation, do_qc = model_config['do_parcellation'], model_config['do_qc']
+    tf_outputs = run_network(build_model(**model_config), image, do_parcellation, do_qc)
+    onnx_outputs = run_network(load_onnx_model(onnx_path), image, do_parcellation, do_qc)
+    comparison = dict()
+    for name, tf_output, onnx_output in zip(['segmentation', 'parcellation', 'qc'], tf_outputs, onnx_outputs):
+        if tf_output is None:
+            continue
+        difference = float(np.max(np.abs(tf_output - onnx_output)))
+        if name == 'qc':
+            comparison[name] = (difference, None)
+        else:
+            agreement = float(np.mean(np.argmax(tf_output, axis=-1) == np.argmax(onnx_output, axis=-1)))
+            comparison[name] = (difference, agreement)
+    return comparison
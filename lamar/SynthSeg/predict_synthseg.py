@@ -17,12 +17,17 @@ License.
 # python imports
 import os
 import sys
+import json
+import time
+import queue
+import shutil
+import hashlib
+import tempfile
+import threading
 import traceback
 import numpy as np
-import tensorflow as tf
-import keras.layers as KL
-import keras.backend as K
-from keras.models import Model
+from contextlib import nullcontext, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # project imports
 from lamar.SynthSeg import evaluate
@@ -30,9 +35,36 @@ from lamar.SynthSeg.predict import write_csv, get_flip_indices
 
 # third-party imports
 from lamar.ext.lab2im import utils
-from lamar.ext.lab2im import layers
 from lamar.ext.lab2im import edit_volumes
-from lamar.ext.neuron import models as nrn_models
+
+# TensorFlow and Keras are imported by the functions that build and run the networks, so that the ONNX Runtime
+# backend (see predict_onnx) runs without them
+
+# rough peak memory of the cascaded SynthSeg networks (full-resolution feature maps and posteriors) per input voxel,
+# used to cap the number of images sent to the network at once, and to decide when to run it tile by tile with
+# tiling='auto'. This is a rough guess rather than a measurement: `lamar synthseg compile --benchmark` measures the
+# actual peak memory per voxel of a configuration
+NETWORK_BYTES_PER_VOXEL = 1024
+
+# smallest tile side of tiled inference, below which tiles lack the context the networks were trained with
+MIN_TILE_SIDE = 96
+
+# default sizes (per axis) that padded shapes are snapped to in the jit-compiled path, so that the networks compiled
+# for one image are reused for the next ones
+SHAPE_BUCKETS = [160, 192, 224, 256]
+
+# thickness (in voxels along the first axis) of the slabs on which postprocess thresholds, normalises and argmaxes the
+# posteriors, which bounds the size of its temporary arrays
+POSTPROCESS_SLAB_SIZE = 16
+
+# automatic region of interest (crop='auto', see get_head_roi): resolution (in mm) of the localisation pass, largest
+# extent (in mm) kept below the top of the head, and margin (in mm) added around the head
+ROI_RESOLUTION = 3.
+ROI_MAX_HEIGHT = 180.
+ROI_MARGIN = 10.
+
+# Keras dtype policies of the UNets for every precision of the networks (see build_model)
+PRECISION_POLICIES = {'float32': 'float32', 'bfloat16': 'mixed_bfloat16', 'float16': 'mixed_float16'}
 
 
 def predict(path_images,
@@ -68,7 +100,61 @@ def predict(path_images,
             list_correct_labels=None,
             compute_distances=False,
             recompute=True,
-            verbose=True):
+            verbose=True,
+            model_cache=None,
+            timer=None,
+            batch_size=1,
+            queue_depth=2,
+            tiling='off',
+            tile_memory=None,
+            tile_overlap=0.25,
+            tile_blending='gaussian',
+            use_compiled=True,
+            jit=False,
+            shape_buckets=None,
+            jit_warmup=None,
+            precision='float32',
+            backend='tensorflow',
+            threads=None,
+            compression=None):
+    """Segment (and optionally parcellate) one or several images with SynthSeg.
+    If model_cache (a ModelCache) is given, the network is taken from it, or built and stored in it, so that several
+    calls can share the same network. If timer (a detailed lamar.scripts.pipeline.StageTimer) is given, the building of
+    the network and the preprocessing, inference, postprocessing and saving of every image are recorded as sub-stages.
+    With batch_size > 1, preprocessed images with the same padded shape go through the network together, up to
+    batch_size images at a time (fewer if the batch would not fit in the available memory, see get_max_batch_size).
+    Images are grouped by exact shape, so the outputs are the same as with one image at a time.
+    queue_depth is the number of images that can wait between the loading, network and postprocessing stages (each
+    image waiting holds its preprocessed volume, or its posteriors, in memory), and for a full batch (beyond that, the
+    largest incomplete batch runs, see ShapeBatches).
+    With tiling='auto', images whose estimated network footprint exceeds tile_memory (default: 80% of the available
+    memory) are run through the network in overlapping tiles, whose posteriors are stitched with tile_blending weights
+    (see get_tile_shape and run_network_tiled), and a notice is printed. Tiling is off by default, as the footprint is
+    only estimated (see NETWORK_BYTES_PER_VOXEL). It is not used when QC scores are requested, as the QC network needs
+    the whole segmentation.
+    With cropping='auto', the network only runs on the bounding box of the head (see get_head_roi), found by a cheap
+    pass on a decimated image, instead of a centred patch of a fixed size. The segmentation is pasted back into the
+    field of view of the image, as with a fixed cropping.
+    If the network of this configuration was exported by `lamar synthseg compile` (see export_model), it is loaded from
+    the model directory instead of being built, unless use_compiled is False.
+    With jit=True, the network runs in an XLA-compiled function (see JitModel), which is compiled once per input shape.
+    Padded shapes are then snapped to shape_buckets (default: SHAPE_BUCKETS, see get_bucket_shape) so that images of
+    slightly different sizes share the same compiled network, and the padded shapes listed in jit_warmup are compiled
+    while the first images load. shape_buckets can also be used without jit, e.g. to batch more images together.
+    The number of traces and the compiled shapes are recorded in the timer.
+    precision='bfloat16' or 'float16' runs the UNets in mixed precision (see build_model). It is not checked here:
+    lamar.scripts.precision only enables it for configurations validated against float32.
+    With backend='onnxruntime', the networks exported by `lamar synthseg compile --backend onnxruntime` are run with
+    ONNX Runtime (see predict_onnx) on threads intra-op threads, without importing TensorFlow. jit and precision only
+    apply to the TensorFlow backend.
+    With a single image to segment, it is resampled (see edit_volumes.resample_volume), its topology is cleaned (see
+    clean_topology), and its outputs are compressed (see utils.write_gzip) on threads threads. compression is the gzip
+    level of the nii.gz and mgz outputs (None for nibabel's default).
+    Returns a list with one dictionary per segmented image, giving the output paths, the estimated volumes (in mm3) and
+    the QC scores (None if QC was not requested)."""
+
+    def substage(name, **info):
+        return timer.stage(name, **info) if timer is not None else nullcontext()
 
     # prepare input/output filepaths
     outputs = prepare_output_files(path_images, path_segmentations, path_posteriors, path_resampled,
@@ -83,22 +169,34 @@ def predict(path_images,
     unique_qc_file = outputs[7]
     compute = outputs[8]
 
-    # get label lists
-    labels_segmentation, _ = utils.get_list_labels(label_list=labels_segmentation)
-    if (n_neutral_labels is not None) & (not fast) & (not robust):
-        labels_segmentation, flip_indices, unique_idx = get_flip_indices(labels_segmentation, n_neutral_labels)
-    else:
-        labels_segmentation, unique_idx = np.unique(labels_segmentation, return_index=True)
-        flip_indices = None
+    # get label lists, sorted as the outputs of the network
+    do_qc = True if path_qc_scores[0] is not None else False
+    model_config, unique_idx, unique_i_parc = get_model_config(path_model_segmentation=path_model_segmentation,
+                                                               labels_segmentation=labels_segmentation,
+                                                               robust=robust,
+                                                               fast=fast,
+                                                               n_neutral_labels=n_neutral_labels,
+                                                               labels_denoiser=labels_denoiser,
+                                                               do_parcellation=do_parcellation,
+                                                               path_model_parcellation=path_model_parcellation,
+                                                               labels_parcellation=labels_parcellation,
+                                                               do_qc=do_qc,
+                                                               path_model_qc=path_model_qc,
+                                                               labels_qc=labels_qc,
+                                                               sigma_smoothing=sigma_smoothing,
+                                                               input_shape_qc=input_shape_qc,
+                                                               precision=precision)
+    labels_segmentation = model_config['labels_segmentation']
+    labels_parcellation = model_config['labels_parcellation']
+    labels_qc = model_config['labels_qc']
+    flip_indices = model_config['flip_indices']
 
     # prepare other labels list
     if names_segmentation is not None:
         names_segmentation = utils.load_array_if_path(names_segmentation)[unique_idx]
     if topology_classes is not None:
         topology_classes = utils.load_array_if_path(topology_classes, load_as_numpy=True)[unique_idx]
-    labels_denoiser = np.unique(utils.get_list_labels(labels_denoiser)[0])
     if do_parcellation:
-        labels_parcellation, unique_i_parc = np.unique(utils.get_list_labels(labels_parcellation)[0], return_index=True)
         labels_volumes = np.concatenate([labels_segmentation, labels_parcellation[1:]])
         if (names_parcellation is not None) & (names_segmentation is not None):
             names_parcellation = utils.load_array_if_path(names_parcellation)[unique_i_parc][1:]
@@ -112,9 +210,7 @@ def predict(path_images,
         labels_volumes = np.concatenate([labels_volumes, np.array([np.max(labels_volumes + 1)])])
         if names_segmentation is not None:
             names_volumes = np.concatenate([names_volumes, np.array(['total intracranial'])])
-    do_qc = True if path_qc_scores[0] is not None else False
     if do_qc:
-        labels_qc = utils.get_list_labels(labels_qc)[0][unique_idx]
         if names_qc is not None:
             names_qc = utils.load_array_if_path(names_qc)[unique_idx]
 
@@ -124,100 +220,274 @@ def predict(path_images,
     if unique_qc_file & do_qc:
         write_csv(path_qc_scores[0], None, True, labels_qc, names_qc)
 
-    # build network
-    net = build_model(path_model_segmentation=path_model_segmentation,
-                      path_model_parcellation=path_model_parcellation,
-                      path_model_qc=path_model_qc,
-                      input_shape_qc=input_shape_qc,
-                      labels_segmentation=labels_segmentation,
-                      labels_denoiser=labels_denoiser,
-                      labels_parcellation=labels_parcellation,
-                      labels_qc=labels_qc,
-                      sigma_smoothing=sigma_smoothing,
-                      flip_indices=flip_indices,
-                      robust=robust,
-                      do_parcellation=do_parcellation,
-                      do_qc=do_qc)
+    # labels in the same order as the estimated volumes
+    volume_labels = np.unique(labels_volumes)[1:]
+    if not v1:
+        volume_labels = np.concatenate([volume_labels[-1:], volume_labels[:-1]])
+
+    # build network, or load it if it was exported by `lamar synthseg compile`
+    if backend == 'onnxruntime':
+        from lamar.SynthSeg.predict_onnx import get_onnx_model_path, load_onnx_model
+        compiled_path = get_onnx_model_path(model_config)
+        if not os.path.isdir(compiled_path):
+            raise FileNotFoundError('No ONNX export of this SynthSeg configuration in %s, run `lamar synthseg compile '
+                                    '--backend onnxruntime` with the same options first' % compiled_path)
+        compiled = True
+        jit = False
+    else:
+        compiled_path = get_compiled_model_path(model_config) if use_compiled else None
+        compiled = compiled_path is not None and os.path.isdir(compiled_path)
+    if jit and not shape_buckets:
+        shape_buckets = SHAPE_BUCKETS
+
+    def build_net():
+        if backend == 'onnxruntime':
+            return load_onnx_model(compiled_path, threads)
+        net = load_compiled_model(compiled_path) if compiled else build_model(**model_config)
+        return JitModel(net) if jit else net
+    if model_cache is not None:
+        model_key = (path_model_segmentation, robust, do_parcellation, do_qc, v1, flip_indices is not None, jit,
+                     precision, backend)
+        with substage('build network', cached=model_key in model_cache.keys(), compiled=compiled, backend=backend):
+            net = model_cache.get(model_key, build_net)
+    else:
+        with substage('build network', cached=False, compiled=compiled, backend=backend):
+            net = build_net()
 
     # set cropping/padding
-    if cropping is not None:
+    if cropping == 'auto':
+        min_pad = 128
+    elif cropping is not None:
         cropping = utils.reformat_to_list(cropping, length=3, dtype='int')
         min_pad = cropping
     else:
         min_pad = 128
 
-    # perform segmentation
+    # perform segmentation. Images go through the same network one after the other (or in batches of images with the
+    # same shape), in a three-stage pipeline: a loader thread preprocesses the next images and a saver thread
+    # postprocesses/saves the previous ones while the network runs on the current one. The stages are connected by
+    # queues of at most queue_depth images, which bound the memory used by images waiting for the next stage.
+    indices_to_compute = [i for i in range(len(path_images)) if compute[i]]
     if len(path_images) <= 10:
         loop_info = utils.LoopInfo(len(path_images), 1, 'predicting', True)
     else:
         loop_info = utils.LoopInfo(len(path_images), 10, 'predicting', True)
     list_errors = list()
-    for i in range(len(path_images)):
-        if verbose:
-            loop_info.update(i)
-
-        # compute segmentation only if needed
-        if compute[i]:
-
+    results = list()
+
+    # pre- and postprocessing run while the network runs on other images, unless there is only one image
+    image_threads = (threads or 1) if len(indices_to_compute) <= 1 else 1
+
+    def get_name(idx):
+        return os.path.basename(path_images[idx])
+
+    def preprocess_image(idx):
+        with substage('preprocess [%s]' % get_name(idx)) as record:
+            preprocessed = preprocess(path_image=path_images[idx],
+                                      ct=ct,
+                                      crop=cropping,
+                                      min_pad=min_pad,
+                                      path_resample=path_resampled[idx],
+                                      shape_buckets=shape_buckets,
+                                      threads=image_threads,
+                                      compression=compression)
+            if record is not None:
+                record.update(image_shape=[int(s) for s in preprocessed[4]],
+                              network_input_shape=[int(s) for s in preprocessed[0].shape[1:-1]])
+                if cropping == 'auto' and preprocessed[6] is not None:
+                    record.update(roi=[int(i) for i in preprocessed[6]])
+        return preprocessed
+
+    def postprocess_image(idx, preprocessed, predictions):
+        with substage('postprocess [%s]' % get_name(idx)):
+            seg, posteriors, volumes, qc_score = postprocess_predictions(preprocessed, predictions,
+                                                                         path_posteriors[idx] is not None)
+        with substage('save [%s]' % get_name(idx)):
+            save_outputs(idx, preprocessed, seg, posteriors, volumes, qc_score)
+
+    def postprocess_predictions(preprocessed, predictions, keep_posteriors=True):
+        _, aff, h, im_res, shape, pad_idx, crop_idx = preprocessed
+        post_patch_segmentation, post_patch_parcellation, qc_score = predictions
+
+        # postprocessing
+        seg, posteriors, volumes = postprocess(post_patch_seg=post_patch_segmentation,
+                                               post_patch_parc=post_patch_parcellation,
+                                               shape=shape,
+                                               pad_idx=pad_idx,
+                                               crop_idx=crop_idx,
+                                               labels_segmentation=labels_segmentation,
+                                               labels_parcellation=labels_parcellation,
+                                               aff=aff,
+                                               im_res=im_res,
+                                               fast=fast,
+                                               topology_classes=topology_classes,
+                                               v1=v1,
+                                               keep_posteriors=keep_posteriors,
+                                               threads=image_threads)
+        return seg, posteriors, volumes, qc_score
+
+    def save_outputs(idx, preprocessed, seg, posteriors, volumes, qc_score):
+        aff, h = preprocessed[1], preprocessed[2]
+
+        # write predictions to disc
+        utils.save_volume(seg, aff, h, path_segmentations[idx], dtype='int32', compression=compression,
+                          threads=image_threads)
+        if path_posteriors[idx] is not None:
+            utils.save_volume(posteriors, aff, h, path_posteriors[idx], dtype='float32', compression=compression,
+                              threads=image_threads)
+
+        # write volumes to disc if necessary
+        if path_volumes[idx] is not None:
+            row = [os.path.basename(path_images[idx]).replace('.nii.gz', '')] + [str(vol) for vol in volumes]
+            write_csv(path_volumes[idx], row, unique_vol_file, labels_volumes, names_volumes, last_first=(not v1))
+
+        # write QC scores to disc if necessary
+        if path_qc_scores[idx] is not None:
+            qc_score = np.around(np.clip(np.squeeze(qc_score)[1:], 0, 1), 4)
+            row = [os.path.basename(path_images[idx]).replace('.nii.gz', '')] + ['%.4f' % q for q in qc_score]
+            write_csv(path_qc_scores[idx], row, unique_qc_file, labels_qc, names_qc)
+
+        results.append({'image': path_images[idx],
+                        'segmentation': path_segmentations[idx],
+                        'posteriors': path_posteriors[idx],
+                        'resampled': path_resampled[idx],
+                        'volumes': {int(lab): float(vol) for lab, vol in zip(volume_labels, volumes)},
+                        'qc_scores': {int(lab): float(q) for lab, q in zip(np.unique(labels_qc)[1:], qc_score)}
+                        if path_qc_scores[idx] is not None else None})
+
+    def report_error(idx, error):
+        list_errors.append(path_images[idx])
+        print('\nthe following problem occurred with image %s :' % path_images[idx])
+        print(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+        print('resuming program execution\n')
+
+    stage_times = {'load': 0., 'network': 0., 'network waiting for input': 0., 'postprocess/save': 0.}
+    loaded = queue.Queue(maxsize=queue_depth)  # (index, preprocessed image, error), None when all are loaded
+    finished = queue.Queue(maxsize=queue_depth)  # (index, preprocessed image, predictions), None at the end
+    stopping = threading.Event()
+
+    def put_loaded(item):
+        # don't block forever on a full queue if the network stage stopped early
+        while not stopping.is_set():
             try:
-
-                # preprocessing
-                image, aff, h, im_res, shape, pad_idx, crop_idx = preprocess(path_image=path_images[i],
-                                                                             ct=ct,
-                                                                             crop=cropping,
-                                                                             min_pad=min_pad,
-                                                                             path_resample=path_resampled[i])
-
-                # prediction
-                shape_input = utils.add_axis(np.array(image.shape[1:-1]))
-                if do_parcellation & do_qc:
-                    post_patch_segmentation, post_patch_parcellation, qc_score = net.predict([image, shape_input])
-                elif do_parcellation & (not do_qc):
-                    post_patch_segmentation, post_patch_parcellation = net.predict(image)
-                    qc_score = None
-                elif (not do_parcellation) & do_qc:
-                    post_patch_segmentation, qc_score = net.predict([image, shape_input])
-                    post_patch_parcellation = None
-                else:
-                    post_patch_segmentation = net.predict(image)
-                    post_patch_parcellation = qc_score = None
-
-                # postprocessing
-                seg, posteriors, volumes = postprocess(post_patch_seg=post_patch_segmentation,
-                                                       post_patch_parc=post_patch_parcellation,
-                                                       shape=shape,
-                                                       pad_idx=pad_idx,
-                                                       crop_idx=crop_idx,
-                                                       labels_segmentation=labels_segmentation,
-                                                       labels_parcellation=labels_parcellation,
-                                                       aff=aff,
-                                                       im_res=im_res,
-                                                       fast=fast,
-                                                       topology_classes=topology_classes,
-                                                       v1=v1)
-
-                # write predictions to disc
-                utils.save_volume(seg, aff, h, path_segmentations[i], dtype='int32')
-                if path_posteriors[i] is not None:
-                    utils.save_volume(posteriors, aff, h, path_posteriors[i], dtype='float32')
-
-                # write volumes to disc if necessary
-                if path_volumes[i] is not None:
-                    row = [os.path.basename(path_images[i]).replace('.nii.gz', '')] + [str(vol) for vol in volumes]
-                    write_csv(path_volumes[i], row, unique_vol_file, labels_volumes, names_volumes, last_first=(not v1))
-
-                # write QC scores to disc if necessary
-                if path_qc_scores[i] is not None:
-                    qc_score = np.around(np.clip(np.squeeze(qc_score)[1:], 0, 1), 4)
-                    row = [os.path.basename(path_images[i]).replace('.nii.gz', '')] + ['%.4f' % q for q in qc_score]
-                    write_csv(path_qc_scores[i], row, unique_qc_file, labels_qc, names_qc)
-
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load_images():
+        for i in indices_to_compute:
+            start = time.perf_counter()
+            try:
+                item = (i, preprocess_image(i), None)
             except Exception as e:
-                list_errors.append(path_images[i])
-                print('\nthe following problem occurred with image %s :' % path_images[i])
-                print(traceback.format_exc())
-                print('resuming program execution\n')
+                item = (i, None, e)
+            stage_times['load'] += time.perf_counter() - start
+            if not put_loaded(item):
+                return
+        put_loaded(None)
+
+    def save_images():
+        while True:
+            item = finished.get()
+            if item is None:
+                return
+            i, preprocessed, predictions = item
+            start = time.perf_counter()
+            try:
+                postprocess_image(i, preprocessed, predictions)
+            except Exception as e:
+                report_error(i, e)
+            stage_times['postprocess/save'] += time.perf_counter() - start
+
+    def run_batch(batch, tile_shape=None):
+        """Run the network on a list of (index, preprocessed image) with the same shape (or on a single image, tile by
+        tile), and queue the postprocessing of every image."""
+        info = dict(voxels=int(sum(np.prod(preprocessed[0].shape[1:-1]) for _, preprocessed in batch)))
+        if len(batch) > 1:
+            info['batch_size'] = len(batch)
+        if tile_shape is not None:
+            info['tile_shape'] = [int(t) for t in tile_shape]
+        start = time.perf_counter()
+        try:
+            images = np.concatenate([preprocessed[0] for _, preprocessed in batch], axis=0)
+            with substage('network [%s]' % ', '.join(get_name(i) for i, _ in batch), **info):
+                if tile_shape is not None:
+                    predictions = run_network_tiled(net, images, do_parcellation, tile_shape,
+                                                    overlap=tile_overlap, blending=tile_blending)
+                else:
+                    predictions = run_network(net, images, do_parcellation, do_qc)
+        except Exception as e:
+            for i, _ in batch:
+                report_error(i, e)
+            return
+        finally:
+            stage_times['network'] += time.perf_counter() - start
+        for (i, preprocessed), image_predictions in zip(batch, split_predictions(predictions, len(batch))):
+            finished.put((i, preprocessed, image_predictions))
+
+    pending_batches = ShapeBatches(batch_size, queue_depth)
+    loader = threading.Thread(target=load_images, name='synthseg-load', daemon=True)
+    saver = threading.Thread(target=save_images, name='synthseg-save', daemon=True)
+    loader.start()
+    saver.start()
+    if jit:
+        traces, n_compiled_shapes = net.traces, len(net.compiled_shapes)
+    try:
+        # compile the network for the expected shapes while the loader prepares the first images
+        if jit and jit_warmup:
+            for warmup_shape in jit_warmup:
+                warmup_shape = get_bucket_shape(warmup_shape, shape_buckets)
+                with substage('jit warm-up [%s]' % 'x'.join(map(str, warmup_shape))):
+                    run_network(net, np.zeros([1, *warmup_shape, 1], dtype='float32'), do_parcellation, do_qc)
+
+        while True:
+            start = time.perf_counter()
+            item = loaded.get()
+            stage_times['network waiting for input'] += time.perf_counter() - start
+            if item is None:
+                break
+            i, preprocessed, error = item
+            if verbose:
+                loop_info.update(i)
+            if error is not None:
+                report_error(i, error)
+                continue
+            shape = tuple(preprocessed[0].shape[1:-1])
+            tile_shape = get_tile_shape(shape, tiling, tile_memory) if not do_qc else None
+            if tile_shape is not None:
+                print('\nrunning the network on %s in tiles of %s (estimated footprint of %.1f GiB, over the tiling '
+                      'memory budget)' % (get_name(i), 'x'.join(map(str, tile_shape)),
+                                          np.prod(shape) * NETWORK_BYTES_PER_VOXEL / 2 ** 30))
+                run_batch([(i, preprocessed)], tile_shape)
                 continue
+            for batch in pending_batches.add((i, preprocessed), shape):
+                run_batch(batch)
+
+        # incomplete batches
+        for batch in pending_batches.flush():
+            run_batch(batch)
+    finally:
+        stopping.set()
+        finished.put(None)
+        saver.join()
+        loader.join()
+
+    stage_times = {stage: round(duration, 3) for stage, duration in stage_times.items()}
+    if timer is not None:
+        timer.annotate(pipeline_times=stage_times)
+    if verbose and indices_to_compute:
+        print('\npipeline busy times: ' + ', '.join('%s %.1fs' % item for item in stage_times.items()))
+    if jit:
+        jit_info = dict(traces=net.traces - traces,
+                        compiled_shapes=[list(shape) for shape in net.compiled_shapes[n_compiled_shapes:]],
+                        shape_buckets=[int(b) for b in shape_buckets])
+        if timer is not None:
+            timer.annotate(jit=jit_info)
+        if verbose:
+            print('jit: %s trace(s), compiled for %s' % (jit_info['traces'], ', '.join(
+                'x'.join(map(str, shape)) for shape in jit_info['compiled_shapes']) or 'no new shape'))
 
     # print output info
     if len(path_segmentations) == 1:  # only one image is processed
@@ -241,6 +511,10 @@ def predict(path_images,
                 print('volumes saved in:          ' + path_volumes[0])
             if path_qc_scores[0] is not None:
                 print('QC scores saved in:        ' + path_qc_scores[0])
+        else:
+            print('\nsegmentations saved in:')
+            for path_segmentation in path_segmentations:
+                print('    ' + path_segmentation)
 
     if robust:
         print('\nIf you use the new robust version of SynthSeg in a publication, please cite:')
@@ -258,6 +532,8 @@ def predict(path_images,
             print(path_error_image)
         sys.exit(1)
 
+    results = sorted(results, key=lambda r: path_images.index(r['image']))
+
     # evaluate
     if gt_folder is not None:
 
@@ -290,6 +566,355 @@ def predict(path_images,
                             recompute=recompute,
                             verbose=verbose)
 
+    return results
+
+
+def _get_cgroup_memory_left():
+    """Memory left under the memory limit of the cgroup of the process (e.g. a job slot), or None if unlimited."""
+    for path_limit, path_usage in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(path_limit) as f:
+                limit = f.read().strip()
+            with open(path_usage) as f:
+                usage = int(f.read())
+        except (OSError, ValueError):
+            continue
+        # cgroup v1 reports "no limit" as a huge number
+        if limit != 'max' and int(limit) < 1 << 60:
+            return max(0, int(limit) - usage)
+    return None
+
+
+def get_available_memory():
+    """Memory available to new allocations, in bytes, taking the cgroup memory limit into account (None if it can't
+    be read)."""
+    available = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError):
+        pass
+    if available is None:
+        try:
+            available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        except (ValueError, OSError, AttributeError):
+            pass
+    cgroup_left = _get_cgroup_memory_left()
+    if cgroup_left is not None:
+        available = cgroup_left if available is None else min(available, cgroup_left)
+    return available
+
+
+def get_max_batch_size(network_input_shape, batch_size, available_memory=None):
+    """Number of images of the given (padded) shape that can go through the network together: at most batch_size, and
+    no more than fit in 80% of the available memory. At least one image is always allowed."""
+    if batch_size <= 1:
+        return 1
+    available_memory = available_memory if available_memory is not None else get_available_memory()
+    if available_memory is None:
+        return batch_size
+    image_memory = int(np.prod(network_input_shape)) * NETWORK_BYTES_PER_VOXEL
+    return int(max(1, min(batch_size, 0.8 * available_memory // image_memory)))
+
+
+class ShapeBatches:
+    """Preprocessed images waiting to go through the network together with other images of the same (padded) shape.
+    add returns the batches that are ready to run: the batch of the new image once it holds as many images as
+    get_max_batch_size allows, or else the largest waiting batch (in voxels) when more than max_waiting images wait,
+    since waiting images are held outside of the bounded queues of predict. flush returns the incomplete batches."""
+
+    def __init__(self, batch_size, max_waiting, available_memory=None):
+        self.batch_size = batch_size
+        self.max_waiting = max_waiting
+        self.available_memory = available_memory
+        self.batches = dict()  # padded shape -> items waiting for a full batch
+
+    def n_waiting(self):
+        return sum(len(batch) for batch in self.batches.values())
+
+    def add(self, item, shape):
+        batch = self.batches.setdefault(shape, [])
+        batch.append(item)
+        if len(batch) >= get_max_batch_size(shape, self.batch_size, self.available_memory):
+            return [self.batches.pop(shape)]
+        if self.n_waiting() > self.max_waiting:
+            return [self.batches.pop(max(self.batches, key=lambda s: len(self.batches[s]) * int(np.prod(s))))]
+        return []
+
+    def flush(self):
+        batches = list(self.batches.values())
+        self.batches.clear()
+        return batches
+
+
+def split_predictions(predictions, n_images):
+    """Split the outputs of run_network on a batch of images into the outputs of every image."""
+    return [[p[n:n + 1] if p is not None else None for p in predictions] for n in range(n_images)]
+
+
+def get_tile_shape(network_input_shape, tiling='off', memory_budget=None):
+    """Shape of the tiles used to run the network on an image of the given (padded) shape, or None to run it on the
+    whole image. With tiling='auto', the image is tiled when its estimated network footprint exceeds memory_budget
+    (default: 80% of the available memory), with the largest tiles that fit in it (sides multiple of 32, at least
+    MIN_TILE_SIDE). tiling='off' never tiles."""
+    if tiling == 'off':
+        return None
+    if memory_budget is None:
+        available_memory = get_available_memory()
+        if available_memory is None:
+            return None
+        memory_budget = 0.8 * available_memory
+    if int(np.prod(network_input_shape)) * NETWORK_BYTES_PER_VOXEL <= memory_budget:
+        return None
+    tile_shape = [min(s, MIN_TILE_SIDE) for s in network_input_shape]
+    for side in range(max(network_input_shape), MIN_TILE_SIDE - 1, -32):
+        candidate = [min(s, side) for s in network_input_shape]
+        if int(np.prod(candidate)) * NETWORK_BYTES_PER_VOXEL <= memory_budget:
+            tile_shape = candidate
+            break
+    return tile_shape if tile_shape != list(network_input_shape) else None
+
+
+def get_tile_starts(size, tile_size, overlap):
+    """Start indices along one axis of tiles of tile_size overlapping by (at least) the given fraction, covering
+    [0, size)."""
+    if tile_size >= size:
+        return [0]
+    step = max(1, int(tile_size * (1 - overlap)))
+    n_tiles = int(np.ceil((size - tile_size) / step)) + 1
+    return sorted(set(int(round(start)) for start in np.linspace(0, size - tile_size, n_tiles)))
+
+
+def get_blending_weights(tile_shape, blending='gaussian'):
+    """Weights of the voxels of a tile when stitching overlapping tiles: a Gaussian (sigma of 1/8 of the tile, as is
+    common for patch-based segmentation) or linear tent centred on the tile, so that tile borders, which see the least
+    context, count the least."""
+    weights = np.ones(tile_shape, dtype='float32')
+    for axis, size in enumerate(tile_shape):
+        distance = np.abs(np.arange(size, dtype='float32') - (size - 1) / 2)
+        if blending == 'gaussian':
+            profile = np.exp(-0.5 * (distance / (size / 8)) ** 2)
+        elif blending == 'linear':
+            profile = 1 - distance / (size / 2)
+        else:
+            raise ValueError('blending should be gaussian or linear, got %s' % blending)
+        shape = [1] * len(tile_shape)
+        shape[axis] = size
+        weights *= np.maximum(profile, 1e-3).reshape(shape)
+    return weights
+
+
+def run_network_tiled(net, image, do_parcellation, tile_shape, overlap=0.25, blending='gaussian'):
+    """Run the network on a preprocessed image tile by tile, and stitch the posteriors of the overlapping tiles with
+    blending weights (see get_blending_weights). Returns the same outputs as run_network, without QC scores."""
+    image_shape = image.shape[1:-1]
+    weights = get_blending_weights(tile_shape, blending)[..., np.newaxis]
+    weight_sum = np.zeros(tuple(image_shape) + (1,), dtype='float32')
+    posteriors = [None, None]
+    starts = [get_tile_starts(size, tile_size, overlap) for size, tile_size in zip(image_shape, tile_shape)]
+    for start in np.stack(np.meshgrid(*starts, indexing='ij'), axis=-1).reshape(-1, len(image_shape)):
+        tile_slice = tuple(slice(s, s + t) for s, t in zip(start, tile_shape))
+        tile_predictions = run_network(net, image[(slice(None),) + tile_slice], do_parcellation, False)[:2]
+        for n, tile_posteriors in enumerate(tile_predictions):
+            if tile_posteriors is None:
+                continue
+            if posteriors[n] is None:
+                posteriors[n] = np.zeros(tuple(image_shape) + (tile_posteriors.shape[-1],), dtype='float32')
+            posteriors[n][tile_slice] += tile_posteriors[0] * weights
+        weight_sum[tile_slice] += weights
+    for n in range(2):
+        if posteriors[n] is not None:
+            posteriors[n] /= weight_sum
+            posteriors[n] = posteriors[n][np.newaxis]
+    return posteriors[0], posteriors[1], None
+
+
+class ModelCache:
+    """Thread-safe store of built SynthSeg networks, so that several calls to predict can share them."""
+
+    def __init__(self):
+        self.models = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build_fn):
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = build_fn()
+            return self.models[key]
+
+    def keys(self):
+        with self.lock:
+            return list(self.models.keys())
+
+
+def get_model_config(path_model_segmentation,
+                     labels_segmentation,
+                     robust,
+                     fast,
+                     n_neutral_labels,
+                     labels_denoiser,
+                     do_parcellation,
+                     path_model_parcellation,
+                     labels_parcellation,
+                     do_qc,
+                     path_model_qc,
+                     labels_qc,
+                     sigma_smoothing=0.5,
+                     input_shape_qc=224,
+                     precision='float32'):
+    """Keyword arguments of build_model for a SynthSeg configuration, with the label lists sorted as the outputs of the
+    network. Also returns the indices of the sorted segmentation and parcellation labels in the given lists (None if
+    do_parcellation is False), to sort the corresponding names."""
+    labels_segmentation, _ = utils.get_list_labels(label_list=labels_segmentation)
+    if (n_neutral_labels is not None) & (not fast) & (not robust):
+        labels_segmentation, flip_indices, unique_idx = get_flip_indices(labels_segmentation, n_neutral_labels)
+    else:
+        labels_segmentation, unique_idx = np.unique(labels_segmentation, return_index=True)
+        flip_indices = None
+    labels_denoiser = np.unique(utils.get_list_labels(labels_denoiser)[0])
+    unique_i_parc = None
+    if do_parcellation:
+        labels_parcellation, unique_i_parc = np.unique(utils.get_list_labels(labels_parcellation)[0], return_index=True)
+    if do_qc:
+        labels_qc = utils.get_list_labels(labels_qc)[0][unique_idx]
+    model_config = dict(path_model_segmentation=path_model_segmentation,
+                        path_model_parcellation=path_model_parcellation,
+                        path_model_qc=path_model_qc,
+                        input_shape_qc=input_shape_qc,
+                        labels_segmentation=labels_segmentation,
+                        labels_denoiser=labels_denoiser,
+                        labels_parcellation=labels_parcellation,
+                        labels_qc=labels_qc,
+                        sigma_smoothing=sigma_smoothing,
+                        flip_indices=flip_indices,
+                        robust=robust,
+                        do_parcellation=do_parcellation,
+                        do_qc=do_qc,
+                        precision=precision)
+    return model_config, unique_idx, unique_i_parc
+
+
+def get_compiled_model_dir():
+    """Directory of the networks exported by `lamar synthseg compile` ($LAMAR_MODEL_DIR, default:
+    ~/.cache/lamar/models)."""
+    return os.environ.get('LAMAR_MODEL_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'lamar', 'models')
+
+
+def get_compiled_model_path(model_config, model_dir=None, prefix='synthseg', versions=None):
+    """Directory of the exported network of a configuration (see get_model_config). The name is a hash of everything
+    the network depends on: options, label lists, weight files (name, size and modification time), and the versions
+    the export is tied to (default: TensorFlow and Keras versions, since a SavedModel is only guaranteed to load with
+    the versions that wrote it)."""
+    if versions is None:
+        import keras
+        import tensorflow as tf
+        versions = [tf.__version__, keras.__version__]
+    key = dict()
+    for name, value in sorted(model_config.items()):
+        if name.startswith('path_model_') and value is not None and os.path.isfile(value):
+            stat = os.stat(value)
+            value = [os.path.basename(value), stat.st_size, stat.st_mtime_ns]
+        elif isinstance(value, np.ndarray):
+            value = value.tolist()
+        key[name] = value
+    key['versions'] = versions
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+    return os.path.join(model_dir or get_compiled_model_dir(), prefix + '-' + digest[:16])
+
+
+def export_model(model_config, model_dir=None, overwrite=False):
+    """Build the network of a configuration (see get_model_config) with its weights, and export it as a single
+    SavedModel, which predict then loads directly instead of wiring the UNets and loading every .h5 file again.
+    Returns the path of the exported network."""
+    path = get_compiled_model_path(model_config, model_dir)
+    if os.path.isdir(path) and not overwrite:
+        return path
+    net = build_model(**model_config)
+
+    # export to a temporary directory then rename it, so that predict never loads a partially written network
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        net.export(tmp_path, format='tf_saved_model')
+        description = {name: value.tolist() if isinstance(value, np.ndarray) else value
+                       for name, value in model_config.items()}
+        with open(os.path.join(tmp_path, 'lamar_model.json'), 'w') as f:
+            json.dump(dict(description, created=time.strftime('%Y-%m-%dT%H:%M:%S')), f, indent=2)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process exported the same network in the meantime
+        if not os.path.isdir(path):
+            raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+    return path
+
+
+class CompiledModel:
+    """Network exported by export_model, with the predict method of the Keras model used by run_network."""
+
+    def __init__(self, path):
+        import tensorflow as tf
+        self.path = path
+        self.model = tf.saved_model.load(path)
+
+    def __call__(self, inputs):
+        return self.model.serve(inputs)
+
+    def predict(self, inputs):
+        return _to_numpy(self(_to_tensors(inputs)))
+
+
+def load_compiled_model(path):
+    return CompiledModel(path)
+
+
+class JitModel:
+    """Network (Keras model or CompiledModel) run through an XLA-compiled tf.function, with the predict method of the
+    Keras model used by run_network. XLA compiles the function once per input shape: traces counts the traces of the
+    function, and compiled_shapes lists the input shapes it was compiled for, so that runs can check that shape buckets
+    keep recompilation in check."""
+
+    def __init__(self, net):
+        import tensorflow as tf
+        self.net = net
+        self.traces = 0
+        self.compiled_shapes = list()
+        self.function = tf.function(self._call, jit_compile=True)
+
+    def _call(self, inputs):
+        self.traces += 1  # only runs when the function is traced
+        if isinstance(self.net, CompiledModel):
+            return self.net(inputs)
+        return self.net(inputs, training=False)
+
+    def predict(self, inputs):
+        inputs = _to_tensors(inputs)
+        shape = tuple((inputs[0] if isinstance(inputs, list) else inputs).shape[:-1])
+        if shape not in self.compiled_shapes:
+            self.compiled_shapes.append(shape)
+        return _to_numpy(self.function(inputs))
+
+
+def _to_tensors(inputs):
+    import tensorflow as tf
+    # networks take float32 images and int32 shapes
+    def to_tensor(x):
+        return tf.constant(x, dtype='int32' if np.issubdtype(np.asarray(x).dtype, np.integer) else 'float32')
+    return [to_tensor(x) for x in inputs] if isinstance(inputs, (list, tuple)) else to_tensor(inputs)
+
+
+def _to_numpy(outputs):
+    return [output.numpy() for output in outputs] if isinstance(outputs, (list, tuple)) else outputs.numpy()
+
 
 def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, out_volumes, out_qc, recompute):
 
@@ -297,6 +922,11 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
     assert path_images is not None, 'please specify an input file/folder (--i)'
     assert out_seg is not None, 'please specify an output file/folder (--o)'
 
+    # path_images is a list of images
+    if isinstance(path_images, (list, tuple)):
+        return prepare_output_files_from_list(path_images, out_seg, out_posteriors, out_resampled, out_volumes,
+                                              out_qc, recompute)
+
     # convert path to absolute paths
     path_images = os.path.abspath(path_images)
     basename = os.path.basename(path_images)
@@ -423,10 +1053,103 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
            out_qc, unique_qc_file, recompute_list
 
 
-def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=None, path_resample=None):
+def prepare_output_files_from_list(path_images, out_seg, out_posteriors, out_resampled, out_volumes, out_qc,
+                                   recompute):
+    """Same as prepare_output_files, but for inputs given as a list of image paths. Image outputs (segmentations,
+    posteriors, resampled images) must then be lists of the same length. CSV outputs can either be such lists, or a
+    single path, in which case all subjects are written to the same file."""
+
+    # input images
+    path_images = [os.path.abspath(p) for p in path_images]
+    for path in path_images:
+        assert os.path.isfile(path), 'file does not exist: %s \n' \
+                                     'please make sure the path and the extension are correct' % path
+
+    def list_helper(path, name, file_type):
+        unique_file = False
+        if path is not None:
+            if isinstance(path, str):
+                assert file_type == 'csv', '%s must be a list when path_images is' % name
+                if path[-4:] != '.csv':
+                    print('%s provided without csv extension. Adding csv extension.' % name)
+                    path += '.csv'
+                path = [os.path.abspath(path)] * len(path_images)
+                recompute_files = [True] * len(path_images)
+                unique_file = True
+            else:
+                assert len(path) == len(path_images), '%s should have the same length as path_images' % name
+                path = [os.path.abspath(p) for p in path]
+                recompute_files = [True if file_type == 'csv' else not os.path.isfile(p) for p in path]
+            for p in path:
+                utils.mkdir(os.path.dirname(p))
+        else:
+            path = [None] * len(path_images)
+            recompute_files = [False] * len(path_images)
+        return path, recompute_files, unique_file
+
+    # use helper on all outputs
+    out_seg, recompute_seg, _ = list_helper(out_seg, 'path_segmentations', '')
+    out_posteriors, recompute_post, _ = list_helper(out_posteriors, 'path_posteriors', '')
+    out_resampled, recompute_resampled, _ = list_helper(out_resampled, 'path_resampled', '')
+    out_volumes, recompute_volume, unique_volume_file = list_helper(out_volumes, 'path_volumes', 'csv')
+    out_qc, recompute_qc, unique_qc_file = list_helper(out_qc, 'path_qc_scores', 'csv')
+
+    recompute_list = [recompute | re_seg | re_post | re_res | re_vol | re_qc
+                      for (re_seg, re_post, re_res, re_vol, re_qc)
+                      in zip(recompute_seg, recompute_post, recompute_resampled, recompute_volume, recompute_qc)]
+
+    return path_images, out_seg, out_posteriors, out_resampled, out_volumes, unique_volume_file, \
+           out_qc, unique_qc_file, recompute_list
+
+
+def get_bucket_shape(shape, shape_buckets, n_levels=5):
+    """Snap a padded shape to the smallest bucket at least as large on every axis. Buckets are rounded up to multiples
+    of 2 ** n_levels, and sizes larger than every bucket are kept."""
+    buckets = sorted(utils.find_closest_number_divisible_by_m(int(b), 2 ** n_levels, 'higher') for b in shape_buckets)
+    return [next((b for b in buckets if b >= s), int(s)) for s in shape]
+
+
+def get_head_roi(im, voxel_size=1., resolution=ROI_RESOLUTION, max_height=ROI_MAX_HEIGHT, margin=ROI_MARGIN):
+    """Bounding box of the head in an image aligned to RAS (see edit_volumes.align_volume_to_ref), as cropping indices
+    [lower bounds, upper bounds], or None if no head is found. The head is the largest connected component above an
+    Otsu threshold in the image decimated to a voxel size of about resolution mm. Its extent along the inferior-superior
+    axis is limited to max_height mm below the top of the head, which leaves out the neck of large-FOV acquisitions,
+    and the box is enlarged by margin mm on every side."""
+    from scipy.ndimage import binary_opening
+    step = max(1, int(round(resolution / voxel_size)))
+    decimated = im[::step, ::step, ::step]
+    if np.max(decimated) <= np.min(decimated):  # empty (or uniform) image, with no threshold to find
+        return None
+    foreground = decimated > get_otsu_threshold(decimated)
+    foreground = binary_opening(foreground)
+    if not np.any(foreground):
+        return None
+    foreground = edit_volumes.get_largest_connected_component(foreground)
+    indices = np.argwhere(foreground)
+    lower = indices.min(axis=0) * step
+    upper = (indices.max(axis=0) + 1) * step
+    lower[2] = max(lower[2], upper[2] - int(max_height / voxel_size))
+    lower = np.maximum(lower - int(margin / voxel_size), 0)
+    upper = np.minimum(upper + int(margin / voxel_size), im.shape[:3])
+    return np.concatenate([lower, upper])
+
+
+def get_otsu_threshold(volume, n_bins=256):
+    """Intensity threshold maximising the between-class variance of the histogram of a volume (Otsu's method)."""
+    counts, edges = np.histogram(volume, bins=n_bins)
+    centres = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(counts)
+    weight_high = weight_low[-1] - weight_low
+    mean_low = np.cumsum(counts * centres) / np.maximum(weight_low, 1)
+    mean_high = (np.sum(counts * centres) - np.cumsum(counts * centres)) / np.maximum(weight_high, 1)
+    return centres[np.argmax(weight_low * weight_high * (mean_low - mean_high) ** 2)]
+
+
+def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=None, path_resample=None,
+               shape_buckets=None, threads=1, compression=None):
 
     # read image and corresponding info
-    im, _, aff, n_dims, n_channels, h, im_res = utils.get_volume_info(path_image, True)
+    im, _, aff, n_dims, n_channels, h, im_res = utils.get_volume_info(path_image, True, mode='float32')
     if n_dims == 2 and 1 < n_channels < 4:
         raise Exception('either the input is 2D with several channels, or is 3D with at most 3 slices. '
                         'Either way, results are going to be poor...')
@@ -448,16 +1171,20 @@ def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=Non
     target_res = np.squeeze(utils.reformat_to_n_channels_array(target_res, n_dims))
     if np.any((im_res > target_res + 0.05) | (im_res < target_res - 0.05)):
         im_res = target_res
-        im, aff = edit_volumes.resample_volume(im, aff, im_res)
+        im, aff = edit_volumes.resample_volume(im, aff, im_res, threads=threads)
         if path_resample is not None:
-            utils.save_volume(im, aff, h, path_resample)
+            utils.save_volume(im, aff, h, path_resample, compression=compression, threads=threads)
 
     # align image
     im = edit_volumes.align_volume_to_ref(im, aff, aff_ref=np.eye(4), n_dims=n_dims, return_copy=False)
     shape = list(im.shape[:n_dims])
 
     # crop image if necessary
-    if crop is not None:
+    if crop == 'auto':
+        crop_idx = get_head_roi(im, voxel_size=float(np.mean(im_res)))
+        if crop_idx is not None:
+            im = edit_volumes.crop_volume_with_idx(im, crop_idx, n_dims=n_dims, return_copy=False)
+    elif crop is not None:
         crop = utils.reformat_to_list(crop, length=n_dims, dtype='int')
         crop_shape = [utils.find_closest_number_divisible_by_m(s, 2 ** n_levels, 'higher') for s in crop]
         im, crop_idx = edit_volumes.crop_volume(im, cropping_shape=crop_shape, return_crop_idx=True)
@@ -467,7 +1194,8 @@ def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=Non
     # normalise image
     if ct:
         im = np.clip(im, 0, 80)
-    im = edit_volumes.rescale_volume(im, new_min=0., new_max=1., min_percentile=0.5, max_percentile=99.5)
+    im = edit_volumes.rescale_volume(im, new_min=0., new_max=1., min_percentile=0.5, max_percentile=99.5,
+                                     dtype='float32', return_copy=False)
 
     # pad image
     input_shape = im.shape[:n_dims]
@@ -475,6 +1203,8 @@ def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=Non
     min_pad = utils.reformat_to_list(min_pad, length=n_dims, dtype='int')
     min_pad = [utils.find_closest_number_divisible_by_m(s, 2 ** n_levels, 'higher') for s in min_pad]
     pad_shape = np.maximum(pad_shape, min_pad)
+    if shape_buckets:
+        pad_shape = get_bucket_shape(pad_shape, shape_buckets, n_levels)
     im, pad_idx = edit_volumes.pad_volume(im, padding_shape=pad_shape, return_pad_idx=True)
 
     # add batch and channel axes
@@ -483,6 +1213,42 @@ def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=Non
     return im, aff, h, im_res, shape, pad_idx, crop_idx
 
 
+def run_network(net, image, do_parcellation, do_qc):
+    """Run the network on a preprocessed image (or a batch of preprocessed images with the same shape), and return the
+    segmentation posteriors, the parcellation posteriors (None if do_parcellation is False), and the QC scores (None if
+    do_qc is False), with one item per image along the first axis."""
+    shape_input = np.repeat(utils.add_axis(np.array(image.shape[1:-1])), image.shape[0], axis=0)
+    if do_parcellation & do_qc:
+        post_patch_segmentation, post_patch_parcellation, qc_score = net.predict([image, shape_input])
+    elif do_parcellation & (not do_qc):
+        post_patch_segmentation, post_patch_parcellation = net.predict(image)
+        qc_score = None
+    elif (not do_parcellation) & do_qc:
+        post_patch_segmentation, qc_score = net.predict([image, shape_input])
+        post_patch_parcellation = None
+    else:
+        post_patch_segmentation = net.predict(image)
+        post_patch_parcellation = qc_score = None
+
+    # networks run in mixed precision return half-precision posteriors
+    post_patch_segmentation, post_patch_parcellation = [p.astype('float32') if p is not None and p.dtype != 'float32'
+                                                        else p for p in [post_patch_segmentation,
+                                                                         post_patch_parcellation]]
+    return post_patch_segmentation, post_patch_parcellation, qc_score
+
+
+@contextmanager
+def dtype_policy(precision):
+    """Create the Keras layers of this context with the dtype policy of a precision (see PRECISION_POLICIES)."""
+    import keras
+    previous = keras.config.dtype_policy()
+    keras.config.set_dtype_policy(PRECISION_POLICIES[precision])
+    try:
+        yield
+    finally:
+        keras.config.set_dtype_policy(previous)
+
+
 def build_model(path_model_segmentation,
                 path_model_parcellation,
                 path_model_qc,
@@ -495,10 +1261,28 @@ def build_model(path_model_segmentation,
                 flip_indices,
                 robust,
                 do_parcellation,
-                do_qc):
+                do_qc,
+                precision='float32'):
+    """Build the SynthSeg network of a configuration (see get_model_config) and load its weights.
+    With precision='bfloat16' or 'float16', the UNets and the QC encoder compute in that precision with float32
+    weights (Keras mixed precision), which roughly halves their activation memory. The layers between them (label
+    conversions, blurring, flipping) keep computing in float32."""
+    import tensorflow as tf
+    import keras.layers as KL
+    from keras.models import Model
+    from lamar.ext.lab2im import layers
+    from lamar.ext.neuron import models as nrn_models
 
     assert os.path.isfile(path_model_segmentation), "The provided model path does not exist."
 
+    def unet(**kwargs):
+        with dtype_policy(precision):
+            return nrn_models.unet(**kwargs)
+
+    def conv_enc(**kwargs):
+        with dtype_policy(precision):
+            return nrn_models.conv_enc(**kwargs)
+
     # get labels
     n_labels_seg = len(labels_segmentation)
 
@@ -506,16 +1290,16 @@ def build_model(path_model_segmentation,
         n_groups = len(labels_denoiser)
 
         # build first UNet
-        net = nrn_models.unet(input_shape=[None, None, None, 1],
-                              nb_labels=n_groups,
-                              nb_levels=5,
-                              nb_conv_per_level=2,
-                              conv_size=3,
-                              nb_features=24,
-                              feat_mult=2,
-                              activation='elu',
-                              batch_norm=-1,
-                              name='unet')
+        net = unet(input_shape=[None, None, None, 1],
+                   nb_labels=n_groups,
+                   nb_levels=5,
+                   nb_conv_per_level=2,
+                   conv_size=3,
+                   nb_features=24,
+                   feat_mult=2,
+                   activation='elu',
+                   batch_norm=-1,
+                   name='unet')
 
         # transition between the two networks: one_hot -> argmax -> one_hot (it simulates how the network was trained)
         last_tensor = net.output
@@ -524,18 +1308,18 @@ def build_model(path_model_segmentation,
         net = Model(inputs=net.inputs, outputs=last_tensor)
 
         # build denoiser
-        net = nrn_models.unet(input_model=net,
-                              input_shape=[None, None, None, 1],
-                              nb_labels=n_groups,
-                              nb_levels=5,
-                              nb_conv_per_level=2,
-                              conv_size=5,
-                              nb_features=16,
-                              feat_mult=2,
-                              activation='elu',
-                              batch_norm=-1,
-                              skip_n_concatenations=2,
-                              name='l2l')
+        net = unet(input_model=net,
+                   input_shape=[None, None, None, 1],
+                   nb_labels=n_groups,
+                   nb_levels=5,
+                   nb_conv_per_level=2,
+                   conv_size=5,
+                   nb_features=16,
+                   feat_mult=2,
+                   activation='elu',
+                   batch_norm=-1,
+                   skip_n_concatenations=2,
+                   name='l2l')
 
         # transition between the two networks: one_hot -> argmax -> one_hot, and concatenate input image and labels
         input_image = net.inputs[0]
@@ -548,33 +1332,33 @@ def build_model(path_model_segmentation,
         net = Model(inputs=net.inputs, outputs=last_tensor)
 
         # build 2nd network
-        net = nrn_models.unet(input_model=net,
-                              input_shape=[None, None, None, 2],
-                              nb_labels=n_labels_seg,
-                              nb_levels=5,
-                              nb_conv_per_level=2,
-                              conv_size=3,
-                              nb_features=24,
-                              feat_mult=2,
-                              activation='elu',
-                              batch_norm=-1,
-                              name='unet2')
+        net = unet(input_model=net,
+                   input_shape=[None, None, None, 2],
+                   nb_labels=n_labels_seg,
+                   nb_levels=5,
+                   nb_conv_per_level=2,
+                   conv_size=3,
+                   nb_features=24,
+                   feat_mult=2,
+                   activation='elu',
+                   batch_norm=-1,
+                   name='unet2')
         net.load_weights(path_model_segmentation, by_name=True)
         name_segm_prediction_layer = 'unet2_prediction'
 
     else:
 
         # build UNet
-        net = nrn_models.unet(input_shape=[None, None, None, 1],
-                              nb_labels=n_labels_seg,
-                              nb_levels=5,
-                              nb_conv_per_level=2,
-                              conv_size=3,
-                              nb_features=24,
-                              feat_mult=2,
-                              activation='elu',
-                              batch_norm=-1,
-                              name='unet')
+        net = unet(input_shape=[None, None, None, 1],
+                   nb_labels=n_labels_seg,
+                   nb_levels=5,
+                   nb_conv_per_level=2,
+                   conv_size=3,
+                   nb_features=24,
+                   feat_mult=2,
+                   activation='elu',
+                   batch_norm=-1,
+                   name='unet')
         net.load_weights(path_model_segmentation, by_name=True)
         input_image = net.inputs[0]
         name_segm_prediction_layer = 'unet_prediction'
@@ -620,17 +1404,17 @@ def build_model(path_model_segmentation,
         net = Model(inputs=net.inputs, outputs=last_tensor)
 
         # build UNet
-        net = nrn_models.unet(input_model=net,
-                              input_shape=[None, None, None, 3],
-                              nb_labels=n_labels_parcellation,
-                              nb_levels=5,
-                              nb_conv_per_level=2,
-                              conv_size=3,
-                              nb_features=24,
-                              feat_mult=2,
-                              activation='elu',
-                              batch_norm=-1,
-                              name='unet_parc')
+        net = unet(input_model=net,
+                   input_shape=[None, None, None, 3],
+                   nb_labels=n_labels_parcellation,
+                   nb_levels=5,
+                   nb_conv_per_level=2,
+                   conv_size=3,
+                   nb_features=24,
+                   feat_mult=2,
+                   activation='elu',
+                   batch_norm=-1,
+                   name='unet_parc')
         net.load_weights(path_model_parcellation, by_name=True)
 
         # smooth predictions
@@ -650,24 +1434,24 @@ def build_model(path_model_segmentation,
             last_tensor = KL.Lambda(lambda x: tf.cast(tf.argmax(x[0], axis=-1), 'int32'))(net.outputs)
         else:
             last_tensor = KL.Lambda(lambda x: tf.cast(tf.argmax(x, axis=-1), 'int32'))(net.output)
-        last_tensor = MakeShape(input_shape_qc)([last_tensor, shape_prediction])
+        last_tensor = layers.MakeShape(input_shape_qc)([last_tensor, shape_prediction])
         last_tensor = layers.ConvertLabels(np.arange(n_labels_seg), labels_segmentation)(last_tensor)
         last_tensor = layers.ConvertLabels(labels_segmentation, labels_qc)(last_tensor)
         last_tensor = KL.Lambda(lambda x: tf.one_hot(tf.cast(x, 'int32'), depth=n_labels_qc, axis=-1))(last_tensor)
         net = Model(inputs=[*net.inputs, shape_prediction], outputs=last_tensor)
 
         # build QC regressor network
-        net = nrn_models.conv_enc(input_model=net,
-                                  input_shape=[None, None, None, 1],
-                                  nb_levels=4,
-                                  nb_conv_per_level=2,
-                                  conv_size=5,
-                                  nb_features=24,
-                                  feat_mult=2,
-                                  activation='relu',
-                                  batch_norm=-1,
-                                  use_residuals=True,
-                                  name='qc')
+        net = conv_enc(input_model=net,
+                       input_shape=[None, None, None, 1],
+                       nb_levels=4,
+                       nb_conv_per_level=2,
+                       conv_size=5,
+                       nb_features=24,
+                       feat_mult=2,
+                       activation='relu',
+                       batch_norm=-1,
+                       use_residuals=True,
+                       name='qc')
         last_tensor = net.outputs[0]
         conv_kwargs = {'padding': 'same', 'activation': 'relu', 'data_format': 'channels_last'}
         last_tensor = KL.MaxPool3D(pool_size=(2, 2, 2), name='qc_maxpool_3', padding='same')(last_tensor)
@@ -688,75 +1472,166 @@ def build_model(path_model_segmentation,
     return net
 
 
+def get_slabs(length, slab_size=None):
+    """Slices splitting an axis of the given length into slabs of at most slab_size (a single slab if None)."""
+    slab_size = length if not slab_size else int(slab_size)
+    return [slice(start, min(start + slab_size, length)) for start in range(0, length, slab_size)]
+
+
+def get_channel_bounding_boxes(volume, threshold, slab_size=None):
+    """Bounding box of the voxels above threshold in every channel of a multi-channel volume, as a list with a tuple of
+    slices per channel (None for channels with no voxel above threshold). All the channels are done in a single pass
+    over slabs of at most slab_size voxels along the first axis."""
+    n_dims = volume.ndim - 1
+    occupied = [np.zeros((size, volume.shape[-1]), dtype='bool') for size in volume.shape[:-1]]
+    for slab in get_slabs(volume.shape[0], slab_size):
+        above = volume[slab] > threshold
+        for axis in range(n_dims):
+            occupied_axis = np.any(above, axis=tuple(a for a in range(n_dims) if a != axis))
+            if axis == 0:
+                occupied[axis][slab] = occupied_axis
+            else:
+                occupied[axis] |= occupied_axis
+    boxes = list()
+    for channel in range(volume.shape[-1]):
+        indices = [np.flatnonzero(occupied[axis][:, channel]) for axis in range(n_dims)]
+        boxes.append(tuple(slice(idx[0], idx[-1] + 1) for idx in indices) if len(indices[0]) > 0 else None)
+    return boxes
+
+
+def clean_topology(posteriors, topology_classes, threshold=0.25, threads=1, slab_size=POSTPROCESS_SLAB_SIZE):
+    """Set the posteriors of every topological class (except class 0) to zero outside the largest connected component
+    of the voxels where one of its channels is above threshold. Modifies posteriors in place, and returns them.
+    Rather than labelling the whole volume for every class, the bounding boxes of all the channels are found in a
+    single pass (see get_channel_bounding_boxes), the channels of every class are set to zero outside the bounding box
+    of the class in a second pass, and connected components are only labelled within these bounding boxes. Classes
+    have disjoint channels, so they are labelled independently, on threads threads. The posteriors are the same as
+    when labelling the whole volume, since cropping keeps the order in which components are labelled."""
+    n_dims = posteriors.ndim - 1
+    n_channels = posteriors.shape[-1]
+    channel_boxes = get_channel_bounding_boxes(posteriors, threshold, slab_size)
+
+    # bounding box of every class (None if no voxel is above threshold), and whether each channel is inside the
+    # bounding box of its class along every axis
+    classes = [np.where(topology_classes == topology_class)[0] for topology_class in np.unique(topology_classes)[1:]]
+    class_boxes = list()
+    inside = [np.ones((size, n_channels), dtype='bool') for size in posteriors.shape[:-1]]
+    for indices in classes:
+        boxes = [channel_boxes[idx] for idx in indices if channel_boxes[idx] is not None]
+        box = tuple(slice(min(b[axis].start for b in boxes), max(b[axis].stop for b in boxes))
+                    for axis in range(n_dims)) if boxes else None
+        for axis in range(n_dims):
+            inside[axis][:, indices] = False
+            if box is not None:
+                inside[axis][box[axis], indices] = True
+        class_boxes.append(box)
+
+    # set the channels to zero outside the bounding box of their class, slab by slab
+    inside_slab = np.ones(posteriors.shape[1:], dtype='bool')
+    for axis in range(1, n_dims):
+        axis_shape = [1] * (n_dims - 1) + [n_channels]
+        axis_shape[axis - 1] = posteriors.shape[axis]
+        inside_slab = inside_slab & inside[axis].reshape(axis_shape)
+    for slab in get_slabs(posteriors.shape[0], slab_size):
+        posteriors[slab] *= inside_slab & inside[0][slab].reshape([-1] + [1] * (n_dims - 1) + [n_channels])
+
+    # keep the largest connected component of every class within its bounding box
+    def clean_class(indices, box):
+        if box is None:
+            return
+        mask = np.any(posteriors[box][..., indices] > threshold, axis=-1)
+        mask = edit_volumes.get_largest_connected_component(mask)
+        for idx in indices:
+            posteriors[box + (idx,)] *= mask
+
+    if threads > 1 and len(classes) > 1:
+        with ThreadPoolExecutor(max_workers=min(threads, len(classes))) as executor:
+            list(executor.map(clean_class, classes, class_boxes))
+    else:
+        for indices, box in zip(classes, class_boxes):
+            clean_class(indices, box)
+    return posteriors
+
+
 def postprocess(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
-                labels_segmentation, labels_parcellation, aff, im_res, fast, topology_classes, v1):
+                labels_segmentation, labels_parcellation, aff, im_res, fast, topology_classes, v1,
+                keep_posteriors=True, slab_size=POSTPROCESS_SLAB_SIZE, threads=1):
+    """Clean the posteriors of the network, and turn them into a segmentation (with the parcellation pasted in the
+    cortex if post_patch_parc is given) and volumes, in the space of the input image.
+    The posteriors are modified in place and kept in float32, and masks are broadcast over the channels rather than
+    copied for each of them. The posteriors of the whole image are only built if keep_posteriors is True (otherwise
+    None is returned instead), as the volumes are computed from the patch, in float64. The voxel-wise steps
+    (thresholding, normalisation, argmax) run on slabs of at most slab_size voxels along the first axis, to bound the
+    size of their temporary arrays (None for the whole patch at once). The topological classes are cleaned on threads
+    threads (see clean_topology)."""
 
     # get posteriors
-    post_patch_seg = np.squeeze(post_patch_seg)
+    post_patch_seg = np.asarray(np.squeeze(post_patch_seg), dtype='float32')
     if fast | (topology_classes is None):
         post_patch_seg = edit_volumes.crop_volume_with_idx(post_patch_seg, pad_idx, n_dims=3, return_copy=False)
 
     # keep biggest connected component
-    tmp_post_patch_seg = post_patch_seg[..., 1:]
-    post_patch_seg_mask = np.sum(tmp_post_patch_seg, axis=-1) > 0.25
+    post_patch_seg_mask = np.sum(post_patch_seg[..., 1:], axis=-1) > 0.25
     post_patch_seg_mask = edit_volumes.get_largest_connected_component(post_patch_seg_mask)
-    post_patch_seg_mask = np.stack([post_patch_seg_mask]*tmp_post_patch_seg.shape[-1], axis=-1)
-    tmp_post_patch_seg = edit_volumes.mask_volume(tmp_post_patch_seg, mask=post_patch_seg_mask, return_copy=False)
-    post_patch_seg[..., 1:] = tmp_post_patch_seg
+    post_patch_seg[..., 1:] *= post_patch_seg_mask[..., np.newaxis]
 
     # reset posteriors to zero outside the largest connected component of each topological class
     if (not fast) & (topology_classes is not None):
-        post_patch_seg_mask = post_patch_seg > 0.25
-        for topology_class in np.unique(topology_classes)[1:]:
-            tmp_topology_indices = np.where(topology_classes == topology_class)[0]
-            tmp_mask = np.any(post_patch_seg_mask[..., tmp_topology_indices], axis=-1)
-            tmp_mask = edit_volumes.get_largest_connected_component(tmp_mask)
-            for idx in tmp_topology_indices:
-                post_patch_seg[..., idx] *= tmp_mask
+        clean_topology(post_patch_seg, topology_classes, threshold=0.25, threads=threads, slab_size=slab_size)
         post_patch_seg = edit_volumes.crop_volume_with_idx(post_patch_seg, pad_idx, n_dims=3, return_copy=False)
+        threshold = None
     else:
-        post_patch_seg_mask = post_patch_seg > 0.2
-        post_patch_seg[..., 1:] *= post_patch_seg_mask[..., 1:]
+        threshold = 0.2
 
     # get hard segmentation
-    post_patch_seg /= np.sum(post_patch_seg, axis=-1)[..., np.newaxis]
-    seg_patch = labels_segmentation[post_patch_seg.argmax(-1).astype('int32')].astype('int32')
+    seg_patch = np.zeros(post_patch_seg.shape[:-1], dtype='int32')
+    for slab in get_slabs(post_patch_seg.shape[0], slab_size):
+        post_slab = post_patch_seg[slab]
+        if threshold is not None:
+            post_slab[..., 1:][post_slab[..., 1:] <= threshold] = 0
+        post_slab /= np.sum(post_slab, axis=-1, keepdims=True)
+        seg_patch[slab] = labels_segmentation[post_slab.argmax(-1)]
 
     # postprocess parcellation
     if post_patch_parc is not None:
-        post_patch_parc = np.squeeze(post_patch_parc)
+        post_patch_parc = np.asarray(np.squeeze(post_patch_parc), dtype='float32')
         post_patch_parc = edit_volumes.crop_volume_with_idx(post_patch_parc, pad_idx, n_dims=3, return_copy=False)
-        mask = (seg_patch == 3) | (seg_patch == 42)
-        post_patch_parc[..., 0] = np.ones_like(post_patch_parc[..., 0])
-        post_patch_parc[..., 0] = edit_volumes.mask_volume(post_patch_parc[..., 0], mask=mask < 0.1, return_copy=False)
-        post_patch_parc /= np.sum(post_patch_parc, axis=-1)[..., np.newaxis]
-        parc_patch = labels_parcellation[post_patch_parc.argmax(-1).astype('int32')].astype('int32')
-        seg_patch[mask] = parc_patch[mask]
+        for slab in get_slabs(post_patch_parc.shape[0], slab_size):
+            post_slab, seg_slab = post_patch_parc[slab], seg_patch[slab]
+            mask = (seg_slab == 3) | (seg_slab == 42)
+            post_slab[..., 0] = ~mask
+            post_slab /= np.sum(post_slab, axis=-1, keepdims=True)
+            seg_slab[mask] = labels_parcellation[post_slab.argmax(-1)[mask]]
 
     # paste patches back to matrix of original image size
     if crop_idx is not None:
-        # we need to go through this because of the posteriors of the background, otherwise pad_volume would work
+        crop = (slice(crop_idx[0], crop_idx[3]), slice(crop_idx[1], crop_idx[4]), slice(crop_idx[2], crop_idx[5]))
         seg = np.zeros(shape=shape, dtype='int32')
-        posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]])
-        posteriors[..., 0] = np.ones(shape)  # place background around patch
-        seg[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5]] = seg_patch
-        posteriors[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5], :] = post_patch_seg
+        seg[crop] = seg_patch
+        if keep_posteriors:
+            # we need to go through this because of the posteriors of the background, otherwise pad_volume would work
+            posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]], dtype='float32')
+            posteriors[..., 0] = 1  # place background around patch
+            posteriors[crop] = post_patch_seg
     else:
         seg = seg_patch
         posteriors = post_patch_seg
 
     # align prediction back to first orientation
     seg = edit_volumes.align_volume_to_ref(seg, aff=np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
-    posteriors = edit_volumes.align_volume_to_ref(posteriors, np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
+    if keep_posteriors:
+        posteriors = edit_volumes.align_volume_to_ref(posteriors, np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
+    else:
+        posteriors = None
 
-    # compute volumes
-    volumes = np.sum(posteriors[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)))
+    # compute volumes: outside the patch, the posteriors of every foreground label are zero
+    volumes = np.sum(post_patch_seg[..., 1:], axis=(0, 1, 2), dtype='float64')
     total_volume_cortex_left = np.sum(volumes[np.where(labels_segmentation == 3)[0] - 1])
     total_volume_cortex_right = np.sum(volumes[np.where(labels_segmentation == 42)[0] - 1])
     if not v1:
         volumes = np.concatenate([np.array([np.sum(volumes)]), volumes])
     if post_patch_parc is not None:
-        volumes_parc = np.sum(post_patch_parc[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)))
+        volumes_parc = np.sum(post_patch_parc[..., 1:], axis=(0, 1, 2), dtype='float64')
         volumes_parc_left = volumes_parc[:int(len(volumes_parc) / 2)]
         volumes_parc_right = volumes_parc[int(len(volumes_parc) / 2):]
         volumes_parc_left = volumes_parc_left / np.sum(volumes_parc_left) * total_volume_cortex_left
@@ -765,60 +1640,3 @@ def postprocess(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
     volumes = np.around(volumes * np.prod(im_res), 3)
 
     return seg, posteriors, volumes
-
-
-class MakeShape(KL.Layer):
-    """Expects one-hot encoding of the two input label maps."""
-
-    def __init__(self, target_shape, **kwargs):
-        self.n_dims = None
-        self.target_shape = target_shape
-        self.cropping_shape = None
-        super(MakeShape, self).__init__(**kwargs)
-
-    def get_config(self):
-        config = super().get_config()
-        config["target_shape"] = self.target_shape
-        return config
-
-    def build(self, input_shape):
-        self.n_dims = input_shape[1][1]
-        self.cropping_shape = np.array(utils.reformat_to_list(self.target_shape, length=self.n_dims))
-        self.built = True
-        super(MakeShape, self).build(input_shape)
-
-    def call(self, inputs, **kwargs):
-        return tf.map_fn(self._single_process, inputs, dtype=tf.int32)
-
-    def _single_process(self, inputs):
-
-        x = inputs[0]
-        shape = inputs[1]
-
-        # find cropping indices
-        mask = tf.logical_and(tf.not_equal(x, 0), tf.not_equal(x, 24))
-        indices = tf.cast(tf.where(mask), 'int32')
-
-        min_idx = K.switch(tf.equal(tf.shape(indices)[0], 0),
-                           tf.zeros(self.n_dims, dtype='int32'),
-                           tf.maximum(tf.reduce_min(indices, axis=0), 0))
-        max_idx = K.switch(tf.equal(tf.shape(indices)[0], 0),
-                           tf.minimum(shape, self.cropping_shape),
-                           tf.minimum(tf.reduce_max(indices, axis=0) + 1, shape))
-
-        # expand/retract (depending on the desired shape) the cropping region around the centre
-        intermediate_vol_shape = max_idx - min_idx
-        min_idx = min_idx - tf.cast(tf.math.ceil((self.cropping_shape - intermediate_vol_shape) / 2), 'int32')
-        max_idx = max_idx + tf.cast(tf.math.floor((self.cropping_shape - intermediate_vol_shape) / 2), 'int32')
-        tmp_min_idx = tf.maximum(min_idx, 0)
-        tmp_max_idx = tf.minimum(max_idx, shape)
-        x = tf.slice(x, begin=tmp_min_idx, size=tf.minimum(tmp_max_idx - tmp_min_idx, shape))
-
-        # pad if necessary
-        min_padding = tf.abs(tf.minimum(min_idx, 0))
-        max_padding = tf.maximum(max_idx - shape, 0)
-        x = K.switch(tf.reduce_any(tf.logical_or(tf.greater(min_padding, 0), tf.greater(max_padding, 0))),
-                     tf.pad(x, tf.stack([min_padding, max_padding], axis=1)),
-                     x)
-
-        return x
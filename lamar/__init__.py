@@ -2,4 +2,10 @@
 
 __version__ = "0.1.0"
 
-from lamar.scripts.lamar import lamareg
\ No newline at end of file
+
+def __getattr__(name):
+    # lamareg is imported on first use, so that importing lamar (e.g. for the CLI) stays fast
+    if name == "lamareg":
+        from lamar.scripts.lamar import lamareg
+        return lamareg
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,19 +2,22 @@
 """
 LaMAR: Label Augmented Modality Agnostic Registration
 Command-line interface
+
+Each subcommand is run by a handler of COMMANDS, which imports the modules of
+that command only: `lamar --help`, `lamar dice-compare` or `lamar cache` don't
+pay for importing ANTsPy or TensorFlow.
 """
 
 import argparse
 import sys
-import os
-from lamar.scripts.lamar import lamareg
-from lamar.scripts import synthseg, coregister, apply_warp
-from colorama import init, Fore, Style
-init()
+from lamar.scripts.checkpoint import STAGES as CHECKPOINT_STAGES
+from lamar.scripts.threads import parse_threads
 
 
 def print_cli_help():
     """Print a comprehensive help message for the LaMAR CLI."""
+    from colorama import init, Fore, Style
+    init()
     # ANSI color codes
     CYAN = Fore.CYAN
     GREEN = Fore.GREEN
@@ -48,12 +51,21 @@ def print_cli_help():
       Apply previously created warpfields to an input image:
       lamar {GREEN}apply-warpfield{RESET} [options]
       
-    {BLUE}4. DIRECT TOOL ACCESS{RESET}
+    {BLUE}4. BATCH REGISTRATION{RESET}
+      Register every row of a CSV/TSV/JSON manifest on a pool of workers:
+      lamar {GREEN}register-batch{RESET} [options]
+
+    {BLUE}5. DIRECT TOOL ACCESS{RESET}
       Run individual components directly:
       lamar {GREEN}synthseg{RESET} [options]     : Run SynthSeg brain parcellation
+      lamar {GREEN}synthseg compile{RESET} [--all] : Export SynthSeg networks, loaded instead of being rebuilt
+      lamar {GREEN}synthseg validate-precision{RESET} : Validate bfloat16/float16 SynthSeg against float32
       lamar {GREEN}coregister{RESET} [options]   : Run ANTs coregistration
       lamar {GREEN}apply-warp{RESET} [options]   : Apply transformations
       lamar {GREEN}dice-compare{RESET} [options] : Calculate Dice similarity coefficient
+      lamar {GREEN}serve{RESET} [options]        : Keep SynthSeg models loaded in a background daemon
+      lamar {GREEN}cache{RESET} stats|prune      : Inspect or prune the parcellation cache
+      lamar {GREEN}threads{RESET} show|calibrate : Show the core budget, or calibrate TensorFlow thread pools
 
     {CYAN}{BOLD}──────────────────── FULL REGISTRATION ────────────────────{RESET}
     
@@ -73,7 +85,22 @@ def print_cli_help():
       {YELLOW}--registration-method{RESET} STR : Registration method (default: SyNRA)
       {YELLOW}--synthseg-threads{RESET} N      : SynthSeg threads (default: 1)
       {YELLOW}--ants-threads{RESET} N          : ANTs threads (default: 1)
+      {YELLOW}--threads{RESET} N|auto          : Core budget split between SynthSeg and ANTs (overrides the above)
       {YELLOW}--qc-csv{RESET} PATH             : Path for QC Dice score CSV file
+      {YELLOW}--subprocess{RESET}              : Run each stage in its own lamar subprocess
+      {YELLOW}--parallel{RESET} N              : Moving images registered at the same time (default: 1)
+      {YELLOW}--report{RESET} PATH             : JSON report of the time and memory used by every stage
+      {YELLOW}--force-stage{RESET} STAGE       : Recompute synthseg|coregister|dice|apply-warp|all even if up to date
+
+    {BLUE}# Several moving images:{RESET}
+      {YELLOW}--moving{RESET} accepts several images, all registered to the same fixed image.
+      Per-moving paths then take one path per image, or a template where {{name}}
+      is replaced by the moving image name, e.g. {YELLOW}--output{RESET} "out/{{name}}_in_T1w.nii.gz"
+
+    {BLUE}# Resuming:{RESET}
+      Every stage writes a manifest (<output>.lamar.json) of its input hashes, parameters
+      and outputs. Re-running a command skips the stages whose manifest still matches,
+      and recomputes the others and everything downstream of them.
 
     {CYAN}{BOLD}────────────────── GENERATE WARPFIELD ────────────────────{RESET}
     
@@ -90,6 +117,22 @@ def print_cli_help():
       
     {BLUE}# Optional Arguments:{RESET}
       {YELLOW}--ants-threads{RESET} N   : ANTs threads (default: 1)
+      {YELLOW}--subprocess{RESET}       : Run the stage in its own lamar subprocess
+      {YELLOW}--parallel{RESET} N       : Moving images transformed at the same time (default: 1)
+      {YELLOW}--report{RESET} PATH      : JSON report of the time and memory used by every stage
+      {YELLOW}--force-stage{RESET} apply-warp : Transform again even if the output is up to date
+
+    {CYAN}{BOLD}─────────────────── REGISTER BATCH ───────────────────────{RESET}
+
+    {BLUE}# Required Arguments:{RESET}
+      {YELLOW}--manifest{RESET} PATH    : CSV/TSV/JSON with one registration per row (moving, fixed, ...)
+
+    {BLUE}# Optional Arguments:{RESET}
+      {YELLOW}--output-dir{RESET} PATH  : Directory for the outputs missing from the manifest
+      {YELLOW}--cores{RESET} N          : Total cores shared by all stages (default: all available)
+      {YELLOW}--memory{RESET} SIZE      : Total memory shared by all stages, e.g. 64G (default: 80% of RAM)
+      {YELLOW}--journal{RESET} PATH     : Journal used to resume the batch (default: <manifest>_journal.jsonl)
+      {YELLOW}--restart{RESET}          : Ignore the journal and run every subject again
 
     {CYAN}{BOLD}─────────────────── EXAMPLE USAGE ───────────────────────{RESET}
 
@@ -101,6 +144,14 @@ def print_cli_help():
       {YELLOW}--inverse-warpfield{RESET} T1w_to_dwi_warp.nii.gz {YELLOW}--inverse-affine{RESET} T1w_to_dwi_affine.mat \\
       {YELLOW}--synthseg-threads{RESET} 4 {YELLOW}--ants-threads{RESET} 8
 
+    {BLUE}# Register several modalities to the same T1w, two at a time:{RESET}
+    lamar {GREEN}register{RESET} {YELLOW}--moving{RESET} sub-001_dwi.nii.gz sub-001_FLAIR.nii.gz sub-001_T2w.nii.gz \\
+      {YELLOW}--fixed{RESET} sub-001_T1w.nii.gz {YELLOW}--fixed-parc{RESET} sub-001_T1w_parc.nii.gz \\
+      {YELLOW}--output{RESET} "out/{{name}}_in_T1w.nii.gz" {YELLOW}--moving-parc{RESET} "out/{{name}}_parc.nii.gz" \\
+      {YELLOW}--registered-parc{RESET} "out/{{name}}_reg_parc.nii.gz" {YELLOW}--affine{RESET} "out/{{name}}_affine.mat" \\
+      {YELLOW}--warpfield{RESET} "out/{{name}}_warp.nii.gz" {YELLOW}--inverse-warpfield{RESET} "out/{{name}}_inv_warp.nii.gz" \\
+      {YELLOW}--inverse-affine{RESET} "out/{{name}}_inv_affine.mat" {YELLOW}--parallel{RESET} 2
+
     {BLUE}# Generate parcellations separately:{RESET}
     lamar {GREEN}synthseg{RESET} {YELLOW}--i{RESET} subject_t1w.nii.gz {YELLOW}--o{RESET} t1w_parcellation.nii.gz {YELLOW}--parc{RESET}
     lamar {GREEN}synthseg{RESET} {YELLOW}--i{RESET} subject_flair.nii.gz {YELLOW}--o{RESET} flair_parcellation.nii.gz {YELLOW}--parc{RESET}
@@ -116,9 +167,253 @@ def print_cli_help():
     {MAGENTA}•{RESET} All output files need explicit paths to ensure deterministic behavior
     {MAGENTA}•{RESET} The transforms can be reused with the apply-warpfield command
     {MAGENTA}•{RESET} Use dice-compare to evaluate registration quality
+    {MAGENTA}•{RESET} SynthSeg jobs are sent to a running lamar serve daemon automatically
+    {MAGENTA}•{RESET} Set LAMAR_CACHE_DIR to reuse parcellations of identical images across runs
     """
     print(help_text)
 
+def run_synthseg_with_report(synthseg_args, report):
+    """Run SynthSeg in this process, and write a JSON report of the time and memory used by its sub-stages."""
+    from lamar.scripts.pipeline import StageTimer
+    from lamar.scripts.report import write_report, get_thread_settings
+    from lamar.scripts import synthseg
+    timer = StageTimer(detailed=True)
+    results, status = [], 'failed'
+    try:
+        with timer.stage("synthseg", synthseg_threads=int(synthseg_args['threads'])):
+            results = synthseg.main(synthseg_args, timer=timer)
+        status = 'ok'
+    finally:
+        timer.print_summary()
+        inputs = [result['image'] for result in results] or [synthseg_args['i']]
+        write_report(report, timer, inputs=inputs, status=status,
+                     settings=dict(get_thread_settings(synthseg_threads=int(synthseg_args['threads'])),
+                                   workflow='synthseg',
+                                   **{key: synthseg_args.get(key)
+                                      for key in ['parc', 'robust', 'fast', 'v1', 'crop', 'batch_size',
+                                                  'queue_depth', 'tiling', 'tile_memory', 'tile_blending', 'jit',
+                                                  'shape_buckets', 'jit_warmup', 'precision', 'backend',
+                                                  'compression']}))
+
+
+def run_register(args, unknown_args):
+    from lamar.scripts.lamar import lamareg
+    lamareg(
+        input_image=args.moving,
+        reference_image=args.fixed,
+        output_image=args.output,
+        input_parc=args.moving_parc,
+        reference_parc=args.fixed_parc, 
+        output_parc=args.registered_parc,
+        affine_file=args.affine,
+        warp_file=args.warpfield,
+        inverse_warp_file=args.inverse_warpfield,
+        inverse_affine_file=args.inverse_affine,
+        registration_method=args.registration_method,
+        synthseg_threads=args.synthseg_threads,
+        ants_threads=args.ants_threads,
+        qc_csv=args.qc_csv,
+        use_subprocess=args.subprocess,
+        parallel=args.parallel,
+        report=args.report,
+        force_stages=args.force_stage,
+        threads=args.threads
+    )
+
+
+def run_generate_warpfield(args, unknown_args):
+    from lamar.scripts.lamar import lamareg
+    lamareg(
+        input_image=args.moving,
+        reference_image=args.fixed,
+        output_image=None,  # No output image for generate-warpfield
+        input_parc=args.moving_parc,
+        reference_parc=args.fixed_parc,
+        output_parc=args.registered_parc,
+        affine_file=args.affine,
+        warp_file=args.warpfield,
+        inverse_warp_file=args.inverse_warpfield,
+        inverse_affine_file=args.inverse_affine,
+        generate_warpfield=True,
+        registration_method=args.registration_method,
+        synthseg_threads=args.synthseg_threads,
+        ants_threads=args.ants_threads,
+        qc_csv=args.qc_csv,
+        use_subprocess=args.subprocess,
+        parallel=args.parallel,
+        report=args.report,
+        force_stages=args.force_stage,
+        threads=args.threads
+    )
+
+
+def run_apply_warpfield(args, unknown_args):
+    from lamar.scripts.lamar import lamareg
+    lamareg(
+        input_image=args.moving,
+        reference_image=args.fixed,
+        output_image=args.output,
+        apply_warpfield=True,
+        affine_file=args.affine,
+        warp_file=args.warpfield,
+        ants_threads=args.ants_threads,
+        synthseg_threads=1,  # Not used in this workflow but needed for the function
+        use_subprocess=args.subprocess,
+        parallel=args.parallel,
+        report=args.report,
+        force_stages=args.force_stage,
+        threads=args.threads
+    )
+
+
+def run_register_batch(args, unknown_args):
+    from lamar.scripts import batch
+    batch.main(args)
+
+
+def run_synthseg(args, unknown_args):
+    from lamar.scripts import synthseg, serve
+    # `lamar synthseg compile` exports networks, with options of its own
+    if unknown_args[:1] == ["compile"]:
+        synthseg.compile_main(sys.argv[sys.argv.index("compile") + 1:])
+        return
+    # `lamar synthseg validate-precision` validates reduced-precision inference against float32
+    if unknown_args[:1] == ["validate-precision"]:
+        from lamar.scripts import precision
+        precision.main(sys.argv[sys.argv.index("validate-precision") + 1:])
+        return
+    if not args.i or not args.o:
+        print("lamar synthseg: the following arguments are required: --i, --o", file=sys.stderr)
+        sys.exit(2)
+    # Create a clean dictionary with the args provided by the parser
+    synthseg_args = {}
+    
+    # Add explicit arguments from argparse
+    if hasattr(args, 'i') and args.i:
+        synthseg_args['i'] = args.i
+    if hasattr(args, 'o') and args.o:
+        synthseg_args['o'] = args.o
+    
+    # Add flag arguments 
+    for flag in ['parc', 'cpu']:
+        if flag in unknown_args or f'--{flag}' in unknown_args:
+            synthseg_args[flag] = True
+    
+    # Parse remaining arguments from command line
+    i = 0
+    while i < len(unknown_args):
+        arg = unknown_args[i].lstrip('-')
+        if i + 1 < len(unknown_args) and not unknown_args[i+1].startswith('-'):
+            synthseg_args[arg] = unknown_args[i+1]
+            i += 2
+        else:
+            # It's a flag
+            synthseg_args[arg] = True
+            i += 1
+    
+    # Set ALL required defaults for SynthSeg
+    for key, value in synthseg.get_default_args().items():
+        synthseg_args.setdefault(key, value)
+
+    if args.batch_size < 1:
+        print(f"Invalid batch size: {args.batch_size}. Must be >= 1", file=sys.stderr)
+        sys.exit(1)
+    synthseg_args['batch_size'] = args.batch_size
+    if args.queue_depth < 1:
+        print(f"Invalid queue depth: {args.queue_depth}. Must be >= 1", file=sys.stderr)
+        sys.exit(1)
+    synthseg_args['queue_depth'] = args.queue_depth
+    synthseg_args.update(tiling=args.tiling, tile_memory=args.tile_memory, tile_blending=args.tile_blending)
+    synthseg_args.update(jit=args.jit, shape_buckets=args.shape_buckets, jit_warmup=args.jit_warmup)
+    synthseg_args['precision'] = args.precision
+    synthseg_args['backend'] = args.backend
+    synthseg_args['compression'] = args.compression
+    if args.crop:
+        synthseg_args['crop'] = synthseg.parse_crop(args.crop)
+
+    if args.threads == 'auto':
+        from lamar.scripts.threads import get_available_cores
+        synthseg_args['threads'] = str(get_available_cores())
+    elif hasattr(args, 'threads') and args.threads:
+        synthseg_args['threads'] = str(args.threads)
+    else:
+        synthseg_args['threads'] = '1'
+    
+    try:
+        if args.report:
+            # the sub-stages can only be measured in this process, so the daemon is not used
+            run_synthseg_with_report(synthseg_args, args.report)
+        else:
+            # Use the SynthSeg daemon (lamar serve) if one is running
+            serve.run_synthseg(synthseg_args)
+    except Exception as e:
+        print(f"SynthSeg error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+def run_serve(args, unknown_args):
+    from lamar.scripts import serve
+    serve.main(args)
+
+
+def run_cache(args, unknown_args):
+    from lamar.scripts import cache
+    cache.main(args)
+
+
+def run_threads(args, unknown_args):
+    from lamar.scripts import threads
+    threads.main(args)
+
+
+def run_coregister(args, unknown_args):
+    from lamar.scripts import coregister
+    # If no additional arguments are provided, print help
+    if not unknown_args:
+        coregister.print_help()
+        sys.exit(0)
+    # Forward arguments to coregister
+    sys.argv = [sys.argv[0]] + unknown_args
+    coregister.main()
+
+
+def run_apply_warp(args, unknown_args):
+    from lamar.scripts import apply_warp
+    # If no additional arguments are provided, print help
+    if not unknown_args:
+        apply_warp.print_help()
+        sys.exit(0)
+    # Forward arguments to apply_warp
+    sys.argv = [sys.argv[0]] + unknown_args
+    apply_warp.main()
+
+
+def run_dice_compare(args, unknown_args):
+    from lamar.scripts.dice_compare import compare_parcellations_dice, print_help
+    print("Dice compare")
+    if not hasattr(args, 'ref') or not args.ref:
+        print_help()
+        sys.exit(0)
+        
+    compare_parcellations_dice(args.ref, args.reg, args.out)
+
+
+# Handler of every subcommand, called with the parsed arguments and the arguments left for the subcommand
+COMMANDS = {
+    "register": run_register,
+    "generate-warpfield": run_generate_warpfield,
+    "apply-warpfield": run_apply_warpfield,
+    "register-batch": run_register_batch,
+    "synthseg": run_synthseg,
+    "serve": run_serve,
+    "cache": run_cache,
+    "threads": run_threads,
+    "coregister": run_coregister,
+    "apply-warp": run_apply_warp,
+    "dice-compare": run_dice_compare,
+}
+
+
 def main():
     """Main entry point for the LaMAR CLI."""
     parser = argparse.ArgumentParser(
@@ -133,69 +428,197 @@ def main():
         "register", 
         help="Perform full registration pipeline with SynthSeg parcellation"
     )
-    register_parser.add_argument("--moving", required=True, help="Input moving image to be registered")
+    register_parser.add_argument("--moving", required=True, nargs="+", help="Input moving image(s) to be registered")
     register_parser.add_argument("--fixed", required=True, help="Reference fixed image (target space)")
-    register_parser.add_argument("--output", required=True, help="Output registered image")
-    register_parser.add_argument("--moving-parc", required=True, help="Output path for moving image parcellation")
+    register_parser.add_argument("--output", required=True, nargs="+", help="Output registered image (one per moving image, or a {name} template)")
+    register_parser.add_argument("--moving-parc", required=True, nargs="+", help="Output path for moving image parcellation (one per moving image, or a {name} template)")
     register_parser.add_argument("--fixed-parc", required=True, help="Output path for fixed image parcellation")
-    register_parser.add_argument("--registered-parc", required=True, help="Output path for registered parcellation")
-    register_parser.add_argument("--affine", required=True, help="Output path for affine transformation")
-    register_parser.add_argument("--warpfield", required=True, help="Output path for warp field")
-    register_parser.add_argument("--inverse-warpfield", required=True, help="Output path for inverse warp field")
-    register_parser.add_argument("--inverse-affine", required=True, help="Output path for inverse affine transformation")
+    register_parser.add_argument("--registered-parc", required=True, nargs="+", help="Output path for registered parcellation (one per moving image, or a {name} template)")
+    register_parser.add_argument("--affine", required=True, nargs="+", help="Output path for affine transformation (one per moving image, or a {name} template)")
+    register_parser.add_argument("--warpfield", required=True, nargs="+", help="Output path for warp field (one per moving image, or a {name} template)")
+    register_parser.add_argument("--inverse-warpfield", required=True, nargs="+", help="Output path for inverse warp field (one per moving image, or a {name} template)")
+    register_parser.add_argument("--inverse-affine", required=True, nargs="+", help="Output path for inverse affine transformation (one per moving image, or a {name} template)")
     register_parser.add_argument("--registration-method", default="SyNRA", help="Registration method")
     register_parser.add_argument("--synthseg-threads", type=int, default=1, 
                                 help="Number of threads to use for SynthSeg segmentation (default: 1)")
     register_parser.add_argument("--ants-threads", type=int, default=1,
                                 help="Number of threads to use for ANTs registration (default: 1)")
-    register_parser.add_argument("--qc-csv", help="Path for quality control Dice score CSV file")
+    register_parser.add_argument("--threads", type=parse_threads,
+                                help="Core budget shared by all stages, or auto (overrides --synthseg-threads/--ants-threads)")
+    register_parser.add_argument("--qc-csv", nargs="+", help="Path for quality control Dice score CSV file (one per moving image, or a {name} template)")
+    register_parser.add_argument("--subprocess", action="store_true",
+                                help="Run each stage in a separate lamar subprocess instead of in-process")
+    register_parser.add_argument("--parallel", type=int, default=1,
+                                help="Number of moving images registered at the same time (default: 1)")
+    register_parser.add_argument("--report",
+                                help="Path for a JSON report of the time and memory used by every stage")
+    register_parser.add_argument("--force-stage", action="append", choices=CHECKPOINT_STAGES + ["all"],
+                                help="Recompute this stage even if its outputs are up to date (can be repeated)")
     
     # WORKFLOW 2: Generate warpfield only
     warpfield_parser = subparsers.add_parser(
         "generate-warpfield", 
         help="Generate registration warpfield without applying it"
     )
-    warpfield_parser.add_argument("--moving", required=True, help="Input moving image")
+    warpfield_parser.add_argument("--moving", required=True, nargs="+", help="Input moving image(s)")
     warpfield_parser.add_argument("--fixed", required=True, help="Reference fixed image")
-    warpfield_parser.add_argument("--moving-parc", required=True, help="Output path for moving image parcellation")
+    warpfield_parser.add_argument("--moving-parc", required=True, nargs="+", help="Output path for moving image parcellation (one per moving image, or a {name} template)")
     warpfield_parser.add_argument("--fixed-parc", required=True, help="Output path for fixed image parcellation")
-    warpfield_parser.add_argument("--registered-parc", required=True, help="Output path for registered parcellation")
-    warpfield_parser.add_argument("--affine", required=True, help="Output path for affine transformation")
-    warpfield_parser.add_argument("--warpfield", required=True, help="Output path for warp field")
-    warpfield_parser.add_argument("--inverse-warpfield", required=True, help="Output path for inverse warp field")
-    warpfield_parser.add_argument("--inverse-affine", required=True, help="Output path for inverse affine transformation")
+    warpfield_parser.add_argument("--registered-parc", required=True, nargs="+", help="Output path for registered parcellation (one per moving image, or a {name} template)")
+    warpfield_parser.add_argument("--affine", required=True, nargs="+", help="Output path for affine transformation (one per moving image, or a {name} template)")
+    warpfield_parser.add_argument("--warpfield", required=True, nargs="+", help="Output path for warp field (one per moving image, or a {name} template)")
+    warpfield_parser.add_argument("--inverse-warpfield", required=True, nargs="+", help="Output path for inverse warp field (one per moving image, or a {name} template)")
+    warpfield_parser.add_argument("--inverse-affine", required=True, nargs="+", help="Output path for inverse affine transformation (one per moving image, or a {name} template)")
     warpfield_parser.add_argument("--registration-method", default="SyNRA", help="Registration method")
     warpfield_parser.add_argument("--synthseg-threads", type=int, default=1, 
                                  help="Number of threads to use for SynthSeg segmentation (default: 1)")
     warpfield_parser.add_argument("--ants-threads", type=int, default=1,
                                  help="Number of threads to use for ANTs registration (default: 1)")
-    warpfield_parser.add_argument("--qc-csv", help="Path for quality control Dice score CSV file")
+    warpfield_parser.add_argument("--threads", type=parse_threads,
+                                 help="Core budget shared by all stages, or auto (overrides --synthseg-threads/--ants-threads)")
+    warpfield_parser.add_argument("--qc-csv", nargs="+", help="Path for quality control Dice score CSV file (one per moving image, or a {name} template)")
+    warpfield_parser.add_argument("--subprocess", action="store_true",
+                                 help="Run each stage in a separate lamar subprocess instead of in-process")
+    warpfield_parser.add_argument("--parallel", type=int, default=1,
+                                 help="Number of moving images registered at the same time (default: 1)")
+    warpfield_parser.add_argument("--report",
+                                 help="Path for a JSON report of the time and memory used by every stage")
+    warpfield_parser.add_argument("--force-stage", action="append", choices=CHECKPOINT_STAGES + ["all"],
+                                 help="Recompute this stage even if its outputs are up to date (can be repeated)")
     
     # WORKFLOW 3: Apply existing warpfield
     apply_parser = subparsers.add_parser(
         "apply-warpfield", 
         help="Apply existing warpfield to an image"
     )
-    apply_parser.add_argument("--moving", required=True, help="Input image to transform")
+    apply_parser.add_argument("--moving", required=True, nargs="+", help="Input image(s) to transform")
     apply_parser.add_argument("--fixed", required=True, help="Reference space image")
-    apply_parser.add_argument("--output", required=True, help="Output registered image")
-    apply_parser.add_argument("--warpfield", required=True, help="Path to warp field")
-    apply_parser.add_argument("--affine", required=True, help="Path to affine transformation")
+    apply_parser.add_argument("--output", required=True, nargs="+", help="Output registered image (one per moving image, or a {name} template)")
+    apply_parser.add_argument("--warpfield", required=True, nargs="+", help="Path to warp field (shared by all moving images, or one per moving image)")
+    apply_parser.add_argument("--affine", required=True, nargs="+", help="Path to affine transformation (shared by all moving images, or one per moving image)")
     apply_parser.add_argument("--ants-threads", type=int, default=1,
                              help="Number of threads to use for ANTs transformation (default: 1)")
+    apply_parser.add_argument("--threads", type=parse_threads,
+                             help="Core budget shared by all transformations, or auto (overrides --ants-threads)")
+    apply_parser.add_argument("--subprocess", action="store_true",
+                             help="Run the stage in a separate lamar subprocess instead of in-process")
+    apply_parser.add_argument("--parallel", type=int, default=1,
+                             help="Number of moving images transformed at the same time (default: 1)")
+    apply_parser.add_argument("--report",
+                             help="Path for a JSON report of the time and memory used by every stage")
+    apply_parser.add_argument("--force-stage", action="append", choices=CHECKPOINT_STAGES + ["all"],
+                             help="Recompute this stage even if its outputs are up to date (can be repeated)")
     
+    # Batch registration of a manifest of subjects
+    batch_parser = subparsers.add_parser(
+        "register-batch",
+        help="Register every row of a CSV/TSV/JSON manifest on a pool of worker processes"
+    )
+    batch_parser.add_argument("--manifest", required=True,
+                              help="CSV/TSV/JSON manifest with one registration per row")
+    batch_parser.add_argument("--output-dir", help="Directory for the output paths missing from the manifest")
+    batch_parser.add_argument("--cores", type=int, help="Total number of cores shared by all stages "
+                                                         "(default: all the cores allowed by affinity and cgroup quota)")
+    batch_parser.add_argument("--memory", help="Total memory shared by all stages, e.g. 64G (default: 80%% of RAM)")
+    batch_parser.add_argument("--registration-method", default="SyNRA", help="Registration method")
+    batch_parser.add_argument("--synthseg-threads", type=int, default=1,
+                              help="Number of threads of every SynthSeg stage (default: 1)")
+    batch_parser.add_argument("--ants-threads", type=int, default=1,
+                              help="Number of threads of every ANTs stage (default: 1)")
+    batch_parser.add_argument("--journal", help="Journal of finished stages, used to resume an interrupted batch "
+                                                "(default: <manifest>_journal.jsonl)")
+    batch_parser.add_argument("--restart", action="store_true", help="Ignore the journal and run every subject again")
+
     # DIRECT TOOL ACCESS: SynthSeg
     synthseg_parser = subparsers.add_parser(
         "synthseg",
-        help="Run SynthSeg brain MRI segmentation directly"
+        help="Run SynthSeg brain MRI segmentation directly",
+        description="Run SynthSeg brain MRI segmentation. `lamar synthseg compile [--parc] [--robust] [--fast] [--v1] "
+                    "[--qc] [--all] [--benchmark]` exports the networks once, so that they are loaded instead of "
+                    "being rebuilt by every run. `lamar synthseg validate-precision --i <images> "
+                    "[--precision bfloat16]` validates reduced-precision inference against float32. "
+                    "`lamar synthseg compile --backend onnxruntime` exports the networks as ONNX graphs, run with "
+                    "--backend onnxruntime."
     )
-    synthseg_parser.add_argument("--i", required=True, help="Input image")
-    synthseg_parser.add_argument("--o", required=True, help="Output segmentation")
+    synthseg_parser.add_argument("--i", help="Input image (required, except for `lamar synthseg compile`)")
+    synthseg_parser.add_argument("--o", help="Output segmentation (required, except for `lamar synthseg compile`)")
     synthseg_parser.add_argument("--parc", action="store_true", help="Output parcellation")
     synthseg_parser.add_argument("--cpu", action="store_true", help="Use CPU")
-    synthseg_parser.add_argument("--threads", type=int, default=1, help="Number of threads")
+    synthseg_parser.add_argument("--threads", type=parse_threads, default=1, help="Number of threads, or auto")
+    synthseg_parser.add_argument("--batch-size", type=int, default=1,
+                                 help="Number of images of the same shape run through the network together, capped "
+                                      "by the available memory (default: 1)")
+    synthseg_parser.add_argument("--queue-depth", type=int, default=2,
+                                 help="Number of images waiting between the load, network and save stages (default: 2)")
+    synthseg_parser.add_argument("--tiling", choices=["auto", "off"], default="off",
+                                 help="Run images too large for the memory budget through the network in overlapping "
+                                      "tiles (default: off)")
+    synthseg_parser.add_argument("--tile-memory",
+                                 help="Memory budget of the network, e.g. 4G (default: 80%% of the available memory)")
+    synthseg_parser.add_argument("--tile-blending", choices=["gaussian", "linear"], default="gaussian",
+                                 help="Weights used to stitch overlapping tiles (default: gaussian)")
+    synthseg_parser.add_argument("--jit", action="store_true",
+                                 help="Run the network in an XLA-compiled function, compiled once per padded shape")
+    synthseg_parser.add_argument("--shape-buckets",
+                                 help="Sizes padded shapes are snapped to, so that compiled networks are reused "
+                                      "(default with --jit: 160,192,224,256)")
+    synthseg_parser.add_argument("--jit-warmup", nargs="+", metavar="SHAPE",
+                                 help="Padded shapes (e.g. 192x224x192) compiled while the first images load")
+    synthseg_parser.add_argument("--precision", choices=["float32", "bfloat16", "float16"], default="float32",
+                                 help="Precision of the UNets. Reduced precisions are only used once validated by "
+                                      "`lamar synthseg validate-precision` (default: float32)")
+    synthseg_parser.add_argument("--backend", choices=["tensorflow", "onnxruntime"], default="tensorflow",
+                                 help="Run the networks with TensorFlow, or with ONNX Runtime (without TensorFlow) "
+                                      "once exported by `lamar synthseg compile --backend onnxruntime` "
+                                      "(default: tensorflow)")
+    synthseg_parser.add_argument("--crop", nargs="+", metavar="SIZE",
+                                 help="Run the network on a centred patch of this size (e.g. 192 or 160 192 160), or "
+                                      "auto to run it on the bounding box of the head only (default: whole image)")
+    synthseg_parser.add_argument("--compression", type=int, choices=range(10), metavar="{0..9}",
+                                 help="gzip level of .nii.gz and .mgz outputs, compressed on --threads threads "
+                                      "(default: nibabel's)")
+    synthseg_parser.add_argument("--report", help="Path for a JSON report of the time and memory used by every stage")
     # Add other SynthSeg arguments as needed
     
+    # SynthSeg daemon keeping the networks in memory between jobs
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run a persistent SynthSeg daemon used automatically by synthseg and register"
+    )
+    serve_parser.add_argument("--socket", help="Unix socket of the daemon (default: $LAMAR_SOCKET or a per-user "
+                                               "socket in the temporary directory)")
+    serve_parser.add_argument("--threads", type=int, default=1,
+                              help="Total number of threads shared by all running jobs (default: 1)")
+    serve_parser.add_argument("--max-jobs", type=int, default=1,
+                              help="Maximum number of jobs running at the same time (default: 1)")
+    serve_parser.add_argument("--queue-size", type=int, default=8,
+                              help="Maximum number of waiting jobs before new ones are refused (default: 8)")
+    serve_parser.add_argument("--status", action="store_true", help="Print the status of the running daemon")
+    serve_parser.add_argument("--stop", action="store_true", help="Gracefully stop the running daemon")
+    
+    # Parcellation cache maintenance
+    cache_parser = subparsers.add_parser(
+        "cache",
+        help="Inspect or prune the parcellation cache (LAMAR_CACHE_DIR)"
+    )
+    cache_parser.add_argument("action", choices=["stats", "prune"], help="Print cache statistics, or evict entries")
+    cache_parser.add_argument("--cache-dir", help="Cache directory (default: $LAMAR_CACHE_DIR)")
+    cache_parser.add_argument("--max-size", help="Prune down to this size, e.g. 5G (default: $LAMAR_CACHE_SIZE or 10G)")
+    cache_parser.add_argument("--all", action="store_true", help="Remove all entries")
+    
+    # Core budget and calibration of the TensorFlow thread pools
+    threads_parser = subparsers.add_parser(
+        "threads",
+        help="Show the cores available to LaMAR, or calibrate the TensorFlow thread pools of this machine"
+    )
+    threads_parser.add_argument("action", choices=["show", "calibrate"],
+                                help="Print the core budget, or time the candidate thread splits")
+    threads_parser.add_argument("--threads", type=parse_threads,
+                                help="Thread budget to calibrate (default: all the available cores)")
+    threads_parser.add_argument("--images", type=int, default=2,
+                                help="Images parcellated per run; with 2 or more, one core is kept for preprocessing (default: 2)")
+    threads_parser.add_argument("--repeats", type=int, default=3, help="Timed runs per candidate split (default: 3)")
+    
     # DIRECT TOOL ACCESS: Coregister
     coregister_parser = subparsers.add_parser(
         "coregister",
@@ -225,133 +648,12 @@ def main():
         print_cli_help()
         sys.exit(0)
     print(f"Command: {args.command}")
-    # Handle command routing
-    if args.command == "register":
-        lamareg(
-            input_image=args.moving,
-            reference_image=args.fixed,
-            output_image=args.output,
-            input_parc=args.moving_parc,
-            reference_parc=args.fixed_parc, 
-            output_parc=args.registered_parc,
-            affine_file=args.affine,
-            warp_file=args.warpfield,
-            inverse_warp_file=args.inverse_warpfield,
-            inverse_affine_file=args.inverse_affine,
-            registration_method=args.registration_method,
-            synthseg_threads=args.synthseg_threads,
-            ants_threads=args.ants_threads
-        )
-    elif args.command == "generate-warpfield":
-        lamareg(
-            input_image=args.moving,
-            reference_image=args.fixed,
-            output_image=None,  # No output image for generate-warpfield
-            input_parc=args.moving_parc,
-            reference_parc=args.fixed_parc,
-            output_parc=args.registered_parc,
-            affine_file=args.affine,
-            warp_file=args.warpfield,
-            inverse_warp_file=args.inverse_warpfield,
-            inverse_affine_file=args.inverse_affine,
-            generate_warpfield=True,
-            registration_method=args.registration_method,
-            synthseg_threads=args.synthseg_threads,
-            ants_threads=args.ants_threads
-        )
-    elif args.command == "apply-warpfield":
-        lamareg(
-            input_image=args.moving,
-            reference_image=args.fixed,
-            output_image=args.output,
-            apply_warpfield=True,
-            affine_file=args.affine,
-            warp_file=args.warpfield,
-            ants_threads=args.ants_threads,
-            synthseg_threads=1  # Not used in this workflow but needed for the function
-        )
-    elif args.command == "synthseg":
-        # Create a clean dictionary with the args provided by the parser
-        synthseg_args = {}
-        
-        # Add explicit arguments from argparse
-        if hasattr(args, 'i') and args.i:
-            synthseg_args['i'] = args.i
-        if hasattr(args, 'o') and args.o:
-            synthseg_args['o'] = args.o
-        
-        # Add flag arguments 
-        for flag in ['parc', 'cpu']:
-            if flag in unknown_args or f'--{flag}' in unknown_args:
-                synthseg_args[flag] = True
-        
-        # Parse remaining arguments from command line
-        i = 0
-        while i < len(unknown_args):
-            arg = unknown_args[i].lstrip('-')
-            if i + 1 < len(unknown_args) and not unknown_args[i+1].startswith('-'):
-                synthseg_args[arg] = unknown_args[i+1]
-                i += 2
-            else:
-                # It's a flag
-                synthseg_args[arg] = True
-                i += 1
-        
-        # Set ALL required defaults for SynthSeg
-        synthseg_args.setdefault('parc', True)
-        synthseg_args.setdefault('cpu', True)
-        synthseg_args.setdefault('robust', True)
-        synthseg_args.setdefault('v1', False)
-        synthseg_args.setdefault('fast', False)
-        synthseg_args.setdefault('post', None)
-        synthseg_args.setdefault('resample', None)
-        synthseg_args.setdefault('ct', None)
-        synthseg_args.setdefault('vol', None)
-        synthseg_args.setdefault('qc', None)
-        synthseg_args.setdefault('device', None)
-        synthseg_args.setdefault('crop', None)
-
-        if hasattr(args, 'threads') and args.threads:
-            synthseg_args['threads'] = str(args.threads)
-        else:
-            synthseg_args['threads'] = '1'
-        
-        try:
-            synthseg.main(synthseg_args)
-        except Exception as e:
-            print(f"SynthSeg error: {e}", file=sys.stderr)
-            sys.exit(1)
-    elif args.command == "coregister":
-        # If no additional arguments are provided, print help
-        if not unknown_args:
-            coregister.print_help()
-            sys.exit(0)
-        # Forward arguments to coregister
-        sys.argv = [sys.argv[0]] + unknown_args
-        coregister.main()
-    elif args.command == "apply-warp":
-        # If no additional arguments are provided, print help
-        if not unknown_args:
-            apply_warp.print_help()
-            sys.exit(0)
-        # Forward arguments to apply_warp
-        sys.argv = [sys.argv[0]] + unknown_args
-        apply_warp.main()
-    elif args.command == "dice-compare":
-        from lamar.scripts.dice_compare import compare_parcellations_dice, print_help
-        print("Dice compare")
-        if not hasattr(args, 'ref') or not args.ref:
-            print_help()
-            sys.exit(0)
-            
-        compare_parcellations_dice(args.ref, args.reg, args.out)
-    elif args.command is None:
-        parser.print_help()
-        sys.exit(0)
-    else:
+    handler = COMMANDS.get(args.command)
+    if handler is None:
         print(f"Unknown command: {args.command}")
         parser.print_help()
         sys.exit(1)
+    handler(args, unknown_args)
 
 
 if __name__ == "__main__":
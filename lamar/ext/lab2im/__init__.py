@@ -1,6 +1,5 @@
-from . import edit_tensors
-from . import edit_volumes
-from . import image_generator
-from . import lab2im_model
-from . import layers
-from . import utils
+from lamar.lazy import lazy_submodules
+
+_SUBMODULES = ['edit_tensors', 'edit_volumes', 'image_generator', 'lab2im_model', 'layers', 'utils']
+
+__getattr__ = lazy_submodules(__name__, _SUBMODULES)
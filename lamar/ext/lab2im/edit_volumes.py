@@ -4,6 +4,7 @@ These functions are sorted in five categories:
 1- volume editing: this can be applied to any volume (i.e. images or label maps). It contains:
         -mask_volume
         -rescale_volume
+        -get_robust_range
         -crop_volume
         -crop_volume_around_region
         -crop_volume_with_idx
@@ -11,6 +12,8 @@ These functions are sorted in five categories:
         -flip_volume
         -resample_volume
         -resample_volume_like
+        -get_interpolation_taps
+        -interpolate_axis
         -get_ras_axes
         -align_volume_to_ref
         -blur_volume
@@ -75,19 +78,24 @@ import os
 import csv
 import shutil
 import numpy as np
-import tensorflow as tf
-import keras.layers as KL
-from keras.models import Model
-from scipy.ndimage.filters import convolve
+from concurrent.futures import ThreadPoolExecutor
 from scipy.ndimage import label as scipy_label
-from scipy.interpolate import RegularGridInterpolator
 from scipy.ndimage.morphology import distance_transform_edt, binary_fill_holes
 from scipy.ndimage import binary_dilation, binary_erosion, gaussian_filter
 
 # project imports
 from lamar.ext.lab2im import utils
-from lamar.ext.lab2im.layers import GaussianBlur, ConvertLabels
-from lamar.ext.lab2im.edit_tensors import blurring_sigma_for_downsampling
+
+# number of output voxels interpolated at once by resample_volume and resample_volume_like
+RESAMPLE_CHUNK_SIZE = 2 ** 22
+
+# number of bins of the histograms used by get_robust_range to estimate percentiles, and number of intensities binned
+# at once (np.histogram makes float64 copies of what it bins)
+RESCALE_HISTOGRAM_BINS = 4096
+RESCALE_HISTOGRAM_CHUNK_SIZE = 2 ** 18
+
+# number of boundary voxels whose neighbours are counted at once by smooth_label_map
+SMOOTH_CHUNK_SIZE = 2 ** 18
 
 
 # ---------------------------------------------------- edit volume -----------------------------------------------------
@@ -145,7 +153,8 @@ def mask_volume(volume, mask=None, threshold=0.1, dilate=0, erode=0, fill_holes=
         return new_volume
 
 
-def rescale_volume(volume, new_min=0, new_max=255, min_percentile=2, max_percentile=98, use_positive_only=False):
+def rescale_volume(volume, new_min=0, new_max=255, min_percentile=2, max_percentile=98, use_positive_only=False,
+                   method='exact', stride=1, dtype=None, return_copy=True):
     """This function linearly rescales a volume between new_min and new_max.
     :param volume: a numpy array
     :param new_min: (optional) minimum value for the rescaled image.
@@ -155,25 +164,100 @@ def rescale_volume(volume, new_min=0, new_max=255, min_percentile=2, max_percent
     :param max_percentile: (optional) percentile for estimating robust maximum of volume (float in [0,...100]),
     where 100 = np.max
     :param use_positive_only: (optional) whether to use only positive values when estimating the min and max percentile
+    :param method: (optional) how to estimate the percentiles, 'exact' or 'histogram' (see get_robust_range).
+    :param stride: (optional) estimate the percentiles on one voxel out of stride only. Default is 1 (all voxels).
+    :param dtype: (optional) float dtype of the rescaled volume. Default is the dtype of volume if it is a float dtype,
+    and float64 otherwise.
+    :param return_copy: (optional) whether to return a new array. If False and volume already has the required dtype,
+    volume is rescaled in place. Default is True.
     :return: rescaled volume
     """
 
-    # select only positive intensities
-    new_volume = volume.copy()
-    intensities = new_volume[new_volume > 0] if use_positive_only else new_volume.flatten()
-
     # define min and max intensities in original image for normalisation
-    robust_min = np.min(intensities) if min_percentile == 0 else np.percentile(intensities, min_percentile)
-    robust_max = np.max(intensities) if max_percentile == 100 else np.percentile(intensities, max_percentile)
+    robust_min, robust_max = get_robust_range(volume, min_percentile, max_percentile, use_positive_only, method, stride)
 
-    # trim values outside range
-    new_volume = np.clip(new_volume, robust_min, robust_max)
+    if dtype is None:
+        dtype = volume.dtype if np.issubdtype(volume.dtype, np.floating) else np.float64
+    if not return_copy and volume.dtype == dtype:
+        new_volume = volume
+    else:
+        new_volume = np.empty(volume.shape, dtype=dtype)
 
-    # rescale image
+    # trim values outside range and rescale image
     if robust_min != robust_max:
-        return new_min + (new_volume - robust_min) / (robust_max - robust_min) * (new_max - new_min)
+        np.clip(volume, robust_min, robust_max, out=new_volume)
+        new_volume -= robust_min
+        new_volume /= robust_max - robust_min
+        new_volume *= new_max - new_min
+        new_volume += new_min
     else:  # avoid dividing by zero
-        return np.zeros_like(new_volume)
+        new_volume[...] = 0
+    return new_volume
+
+
+def get_robust_range(volume, min_percentile=2, max_percentile=98, use_positive_only=False, method='exact', stride=1,
+                     n_bins=RESCALE_HISTOGRAM_BINS):
+    """This function estimates two percentiles of the intensities of a volume in a single pass.
+    :param volume: a numpy array
+    :param min_percentile: (optional) lower percentile (float in [0,...100]), where 0 = np.min
+    :param max_percentile: (optional) upper percentile (float in [0,...100]), where 100 = np.max
+    :param use_positive_only: (optional) whether to use only positive values when estimating the percentiles
+    :param method: (optional) 'exact' computes both percentiles with a single partition of the intensities, and gives
+    the same values as np.percentile (up to the rounding of float32 volumes). 'histogram' interpolates them within a
+    histogram of n_bins bins, with an error of at most (max - min) / n_bins, and only copies the intensities (rather
+    than chunks of them) when the volume is not contiguous or use_positive_only is True. Default is 'exact'.
+    :param stride: (optional) only use one voxel out of stride (in memory order). Default is 1 (all voxels).
+    :param n_bins: (optional) number of bins of the histogram. Default is 4096.
+    :return: the two percentiles
+    """
+
+    # select the intensities. Flattening a non-contiguous volume copies them, and so does selecting the positive ones
+    # (from the volume itself when possible, so that they are not copied twice)
+    if use_positive_only:
+        intensities = volume if stride == 1 else volume.reshape(-1)[::stride]
+        intensities = intensities[intensities > 0]
+    else:
+        intensities = volume.reshape(-1)[::stride]
+    if method == 'exact' and np.shares_memory(intensities, volume):
+        # a copy, which can be partitioned in place
+        intensities = intensities.copy()
+
+    if method == 'exact':
+        robust_min, robust_max = np.percentile(intensities, [min_percentile, max_percentile], overwrite_input=True)
+    elif method == 'histogram':
+        low, high = np.min(intensities), np.max(intensities)
+        if low == high:
+            return low, high
+        counts = np.zeros(n_bins, dtype='int64')
+        for start in range(0, intensities.size, RESCALE_HISTOGRAM_CHUNK_SIZE):
+            chunk_counts, edges = np.histogram(intensities[start:start + RESCALE_HISTOGRAM_CHUNK_SIZE], bins=n_bins,
+                                               range=(float(low), float(high)))
+            counts += chunk_counts
+        cumulated_counts = np.concatenate([[0], np.cumsum(counts)])
+
+        def get_order_statistics(orders):
+            # estimate of the n-th smallest intensities, interpolated linearly between the edges of their bins
+            bins = np.clip(np.searchsorted(cumulated_counts, orders, side='right') - 1, 0, n_bins - 1)
+            fractions = (orders - cumulated_counts[bins]) / np.maximum(counts[bins], 1)
+            return edges[bins] + np.clip(fractions, 0, 1) * (edges[bins + 1] - edges[bins])
+
+        # like np.percentile, interpolate between the two intensities around the rank of every percentile. Both are
+        # estimated within their bins, which bounds the error by the width of a bin even where intensities are sparse
+        ranks = np.array([min_percentile, max_percentile]) / 100 * (intensities.size - 1)
+        orders = np.floor(ranks)
+        weights = ranks - orders
+        robust_min, robust_max = np.clip((1 - weights) * get_order_statistics(orders) +
+                                         weights * get_order_statistics(np.minimum(orders + 1, intensities.size - 1)),
+                                         low, high)
+        robust_min = low if min_percentile == 0 else robust_min
+        robust_max = high if max_percentile == 100 else robust_max
+    else:
+        raise ValueError("method should be 'exact' or 'histogram', had %s" % method)
+
+    # keep the precision of float volumes, so that they are rescaled in their own dtype
+    if np.issubdtype(volume.dtype, np.floating):
+        return volume.dtype.type(robust_min), volume.dtype.type(robust_max)
+    return robust_min, robust_max
 
 
 def crop_volume(volume, cropping_margin=None, cropping_shape=None, aff=None, return_crop_idx=False, mode='center'):
@@ -501,15 +585,82 @@ def flip_volume(volume, axis=None, direction=None, aff=None, return_copy=True):
     return np.flip(new_volume, axis=axis)
 
 
-def resample_volume(volume, aff, new_vox_size, interpolation='linear', blur=True):
+def get_interpolation_taps(coords, length, interpolation='linear', fill_outside=False):
+    """This function computes the 1d interpolation of a volume axis at given coordinates, as a list of taps: pairs of
+    indices along the axis and float32 weights, such that the interpolated values are sum(weight * volume[indices]).
+    :param coords: 1d numpy array of (voxel) coordinates along the axis
+    :param length: number of voxels along the axis
+    :param interpolation: (optional) type of interpolation. Can be 'linear' (2 taps) or 'nearest' (1 tap).
+    :param fill_outside: (optional) whether coordinates outside [0, length - 1] get zero weights (True), or are clipped
+    to the closest voxel (False). Default is False.
+    :return: list of (indices, weights) pairs
+    """
+    coords = np.asarray(coords, dtype='float64')
+    outside = (coords < 0) | (coords > length - 1)
+    coords = np.clip(coords, 0, length - 1)
+    idx = np.clip(np.floor(coords).astype('int64'), 0, max(length - 2, 0))
+    weights_high = coords - idx
+    if interpolation == 'nearest':
+        taps = [(np.where(weights_high <= .5, idx, np.minimum(idx + 1, length - 1)), np.ones_like(coords))]
+    elif interpolation == 'linear':
+        taps = [(idx, 1 - weights_high), (np.minimum(idx + 1, length - 1), weights_high)]
+    else:
+        raise ValueError("interpolation should be 'linear' or 'nearest', had %s" % interpolation)
+    if fill_outside:
+        for _, weights in taps:
+            weights[outside] = 0
+    return [(indices, weights.astype('float32')) for indices, weights in taps]
+
+
+def interpolate_axis(volume, taps, axis, threads=1, chunk_size=RESAMPLE_CHUNK_SIZE):
+    """This function interpolates a volume along a single axis (see get_interpolation_taps), in float32.
+    The output is computed in chunks of about chunk_size voxels along another axis, on threads threads.
+    :param volume: a numpy array, possibly with several channels
+    :param taps: list of (indices, weights) pairs, as given by get_interpolation_taps
+    :param axis: axis to interpolate
+    :param threads: (optional) number of threads to use. Default is 1.
+    :param chunk_size: (optional) approximate number of output voxels computed at once. Default is 2**22.
+    :return: float32 numpy array with the same shape as volume, except along axis where it has len(indices) voxels
+    """
+    shape = list(volume.shape)
+    shape[axis] = len(taps[0][0])
+    new_volume = np.empty(shape, dtype='float32')
+    weights_shape = [1] * volume.ndim
+    weights_shape[axis] = -1
+    taps = [(indices, weights.reshape(weights_shape)) for indices, weights in taps]
+
+    # split the output along the first axis that is not interpolated
+    chunk_axis = 1 if axis == 0 else 0
+    n_chunks = max(threads, int(np.ceil(new_volume.size / chunk_size)))
+    bounds = np.linspace(0, shape[chunk_axis], min(n_chunks, shape[chunk_axis]) + 1).astype('int')
+    chunks = [(slice(None),) * chunk_axis + (slice(start, stop),) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def interpolate_chunk(chunk):
+        result = new_volume[chunk]
+        np.multiply(np.take(volume[chunk], taps[0][0], axis=axis), taps[0][1], out=result)
+        for indices, weights in taps[1:]:
+            result += np.take(volume[chunk], indices, axis=axis) * weights
+
+    if threads > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=min(threads, len(chunks))) as executor:
+            list(executor.map(interpolate_chunk, chunks))
+    else:
+        for chunk in chunks:
+            interpolate_chunk(chunk)
+    return new_volume
+
+
+def resample_volume(volume, aff, new_vox_size, interpolation='linear', blur=True, threads=1):
     """This function resizes the voxels of a volume to a new provided size, while adjusting the header to keep the RAS
-    :param volume: a numpy array
+    The volume is interpolated separately along each axis, in float32 chunks (see interpolate_axis).
+    :param volume: a numpy array, possibly with several channels
     :param aff: affine matrix of the volume
     :param new_vox_size: new voxel size (3 - element numpy vector) in mm
     :param interpolation: (optional) type of interpolation. Can be 'linear' or 'nearest'. Default is 'linear'.
     :param blur: (optional) whether to blur before resampling to avoid aliasing effects.
     Only used if the input volume is downsampled. Default is True.
-    :return: new volume and affine matrix
+    :param threads: (optional) number of threads to use. Default is 1.
+    :return: new float32 volume and affine matrix
     """
 
     pixdim = np.sqrt(np.sum(aff * aff, axis=0))[:-1]
@@ -518,74 +669,95 @@ def resample_volume(volume, aff, new_vox_size, interpolation='linear', blur=True
     sigmas = 0.25 / factor
     sigmas[factor > 1] = 0  # don't blur if upsampling
 
-    volume_filt = gaussian_filter(volume, sigmas) if blur else volume
-
-    # volume2 = zoom(volume_filt, factor, order=1, mode='reflect', prefilter=False)
-    x = np.arange(0, volume_filt.shape[0])
-    y = np.arange(0, volume_filt.shape[1])
-    z = np.arange(0, volume_filt.shape[2])
-
-    my_interpolating_function = RegularGridInterpolator((x, y, z), volume_filt, method=interpolation)
+    # channels are not blurred
+    volume_filt = gaussian_filter(volume, list(sigmas) + [0] * (volume.ndim - 3)) if blur else volume
+    volume_filt = volume_filt.astype('float32', copy=False)
 
+    # coordinates of the new voxels, clipped to the volume
     start = - (factor - 1) / (2 * factor)
     step = 1.0 / factor
-    stop = start + step * np.ceil(volume_filt.shape * factor)
+    stop = start + step * np.ceil(volume_filt.shape[:3] * factor)
 
-    xi = np.arange(start=start[0], stop=stop[0], step=step[0])
-    yi = np.arange(start=start[1], stop=stop[1], step=step[1])
-    zi = np.arange(start=start[2], stop=stop[2], step=step[2])
-    xi[xi < 0] = 0
-    yi[yi < 0] = 0
-    zi[zi < 0] = 0
-    xi[xi > (volume_filt.shape[0] - 1)] = volume_filt.shape[0] - 1
-    yi[yi > (volume_filt.shape[1] - 1)] = volume_filt.shape[1] - 1
-    zi[zi > (volume_filt.shape[2] - 1)] = volume_filt.shape[2] - 1
-
-    xig, yig, zig = np.meshgrid(xi, yi, zi, indexing='ij', sparse=True)
-    volume2 = my_interpolating_function((xig, yig, zig))
+    # interpolate the axes that shrink the most first, to keep intermediate volumes small
+    volume2 = volume_filt
+    for axis in np.argsort(factor):
+        coords = np.arange(start=start[axis], stop=stop[axis], step=step[axis])
+        if len(coords) == volume_filt.shape[axis] and np.all(coords == np.arange(len(coords))):
+            continue
+        taps = get_interpolation_taps(coords, volume_filt.shape[axis], interpolation)
+        volume2 = interpolate_axis(volume2, taps, axis, threads=threads)
 
     aff2 = aff.copy()
     for c in range(3):
         aff2[:-1, c] = aff2[:-1, c] / factor[c]
     aff2[:-1, -1] = aff2[:-1, -1] - np.matmul(aff2[:-1, :-1], 0.5 * (factor - 1))
 
-    return volume2, aff2
+    return volume2 if volume2 is not volume else volume2.copy(), aff2
 
 
-def resample_volume_like(vol_ref, aff_ref, vol_flo, aff_flo, interpolation='linear'):
-    """This function reslices a floating image to the space of a reference image
+def resample_volume_like(vol_ref, aff_ref, vol_flo, aff_flo, interpolation='linear', threads=1,
+                         chunk_size=RESAMPLE_CHUNK_SIZE):
+    """This function reslices a floating image to the space of a reference image.
+    If the two volumes only differ by scalings, flips, translations, and permutations of their axes, the floating volume
+    is interpolated separately along each axis (see interpolate_axis). Otherwise, it is interpolated in slabs of about
+    chunk_size voxels, without building the coordinates of the whole reference volume at once.
+    Voxels that fall outside the floating volume are set to zero.
     :param vol_ref: a numpy array with the reference volume
     :param aff_ref: affine matrix of the reference volume
-    :param vol_flo: a numpy array with the floating volume
+    :param vol_flo: a numpy array with the floating volume, possibly with several channels
     :param aff_flo: affine matrix of the floating volume
     :param interpolation: (optional) type of interpolation. Can be 'linear' or 'nearest'. Default is 'linear'.
-    :return: resliced volume
+    :param threads: (optional) number of threads to use. Default is 1.
+    :param chunk_size: (optional) approximate number of voxels interpolated at once. Default is 2**22.
+    :return: resliced float32 volume
     """
 
     T = np.matmul(np.linalg.inv(aff_flo), aff_ref)
-
-    xf = np.arange(0, vol_flo.shape[0])
-    yf = np.arange(0, vol_flo.shape[1])
-    zf = np.arange(0, vol_flo.shape[2])
-
-    my_interpolating_function = RegularGridInterpolator((xf, yf, zf), vol_flo, bounds_error=False, fill_value=0.0,
-                                                        method=interpolation)
-
-    xr = np.arange(0, vol_ref.shape[0])
-    yr = np.arange(0, vol_ref.shape[1])
-    zr = np.arange(0, vol_ref.shape[2])
-
-    xrg, yrg, zrg = np.meshgrid(xr, yr, zr, indexing='ij', sparse=False)
-    n = xrg.size
-    xrg = xrg.reshape([n])
-    yrg = yrg.reshape([n])
-    zrg = zrg.reshape([n])
-    bottom = np.ones_like(xrg)
-    coords = np.stack([xrg, yrg, zrg, bottom])
-    coords_new = np.matmul(T, coords)[:-1, :]
-    result = my_interpolating_function((coords_new[0, :], coords_new[1, :], coords_new[2, :]))
-
-    return result.reshape(vol_ref.shape)
+    shape_ref = vol_ref.shape[:3]
+    shape_flo = vol_flo.shape[:3]
+    vol_flo = vol_flo.astype('float32', copy=False)
+
+    # separable case: each axis of the reference volume only depends on one axis of the floating volume
+    nonzero = T[:3, :3] != 0
+    if np.all(np.sum(nonzero, axis=0) == 1) and np.all(np.sum(nonzero, axis=1) == 1):
+        axes_flo = np.argmax(nonzero, axis=0)
+        result = np.transpose(vol_flo, list(axes_flo) + list(range(3, vol_flo.ndim)))
+        for axis in range(3):
+            coords = T[axes_flo[axis], axis] * np.arange(shape_ref[axis]) + T[axes_flo[axis], 3]
+            taps = get_interpolation_taps(coords, shape_flo[axes_flo[axis]], interpolation, fill_outside=True)
+            result = interpolate_axis(result, taps, axis, threads=threads, chunk_size=chunk_size)
+        return result
+
+    # general case: interpolate slabs of the reference volume
+    result = np.empty(shape_ref + vol_flo.shape[3:], dtype='float32')
+    flat_flo = vol_flo.reshape((-1,) + vol_flo.shape[3:])
+    strides = np.array([shape_flo[1] * shape_flo[2], shape_flo[2], 1])
+    yr, zr = np.meshgrid(np.arange(shape_ref[1]), np.arange(shape_ref[2]), indexing='ij')
+    slab_size = max(1, chunk_size // (shape_ref[1] * shape_ref[2]))
+
+    def interpolate_slab(start):
+        xr = np.arange(start, min(start + slab_size, shape_ref[0]))
+        coords = np.matmul(T[:3, :3], np.stack([np.repeat(xr, yr.size),
+                                                np.tile(yr.ravel(), len(xr)),
+                                                np.tile(zr.ravel(), len(xr))])) + T[:3, 3:]
+        taps = [get_interpolation_taps(coords[axis], shape_flo[axis], interpolation, fill_outside=True)
+                for axis in range(3)]
+        values = 0
+        for x_idx, x_weights in taps[0]:
+            for y_idx, y_weights in taps[1]:
+                for z_idx, z_weights in taps[2]:
+                    weights = (x_weights * y_weights * z_weights).reshape((-1,) + (1,) * (vol_flo.ndim - 3))
+                    values = values + flat_flo[x_idx * strides[0] + y_idx * strides[1] + z_idx * strides[2]] * weights
+        result[start:start + len(xr)] = values.reshape((len(xr),) + shape_ref[1:] + vol_flo.shape[3:])
+
+    starts = range(0, shape_ref[0], slab_size)
+    if threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=min(threads, len(starts))) as executor:
+            list(executor.map(interpolate_slab, starts))
+    else:
+        for start in starts:
+            interpolate_slab(start)
+    return result
 
 
 def get_ras_axes(aff, n_dims=3):
@@ -833,12 +1005,17 @@ def mask_label_map(labels, masking_values, masking_value=0, return_mask=False):
         return masked_labels
 
 
-def smooth_label_map(labels, kernel, labels_list=None, print_progress=0):
+def smooth_label_map(labels, kernel, labels_list=None, print_progress=0, threads=1, chunk_size=SMOOTH_CHUNK_SIZE):
     """This function smooth an input label map by replacing each voxel by the value of its most numerous neighbour.
+    Ties are broken in favour of the label that comes first in labels_list, and voxels without any neighbour to smooth
+    are set to zero. Voxels whose neighbours all have the same label directly take this label. The neighbours of the
+    other voxels (at the boundaries between labels) are counted in chunks of chunk_size voxels, on threads threads.
     :param labels: input label map
     :param kernel: kernel when counting neighbours. Must contain only zeros or ones.
     :param labels_list: list of label values to smooth. Defaults is None, where all labels are smoothed.
-    :param print_progress: (optional) If not 0, interval at which to print the number of processed labels.
+    :param print_progress: (optional) If not 0, interval at which to print the number of processed chunks.
+    :param threads: (optional) number of threads to use. Default is 1.
+    :param chunk_size: (optional) number of boundary voxels processed at once. Default is 2**18.
     :return: smoothed label map
     """
     # get info
@@ -850,24 +1027,70 @@ def smooth_label_map(labels, kernel, labels_list=None, print_progress=0):
     else:
         labels_to_keep = [lab for lab in unique_labels if lab not in labels_list]
         new_labels, mask_new_labels = mask_label_map(labels, labels_to_keep, return_mask=True)
-
-    # loop through label values
-    count = np.zeros(labels_shape)
-    labels_smoothed = np.zeros(labels_shape, dtype='int')
-    loop_info = utils.LoopInfo(len(labels_list), print_progress, 'smoothing')
-    for la, label in enumerate(labels_list):
-        if print_progress:
-            loop_info.update(la)
-
-        # count neighbours with same value
-        mask = (labels == label) * 1
-        n_neighbours = convolve(mask, kernel)
-
-        # update label map and maximum neighbour counts
-        idx = n_neighbours > count
-        count[idx] = n_neighbours[idx]
-        labels_smoothed[idx] = label
-        labels_smoothed = labels_smoothed.astype('int32')
+    labels_list = np.array(labels_list, dtype='int32').flatten()
+    n_labels = len(labels_list)
+    labels_smoothed = np.zeros(labels_shape, dtype='int32')
+
+    if n_labels > 0:
+
+        # rank of every voxel's label in labels_list (n_labels for labels that are not smoothed, which are not counted)
+        order = np.argsort(labels_list, kind='stable')
+        sorted_labels = labels_list[order]
+        idx = np.minimum(np.searchsorted(sorted_labels, labels), n_labels - 1)
+        ranks = np.where(sorted_labels[idx] == labels, order[idx], n_labels).astype(np.min_scalar_type(n_labels))
+        del idx
+
+        # neighbours of every voxel, padded like scipy.ndimage.convolve (whose kernel is flipped)
+        offsets = np.array(kernel.shape) // 2 - np.array(np.nonzero(kernel)).T
+        pad = [(max(0, -np.min(offsets[:, axis])), max(0, np.max(offsets[:, axis]))) for axis in range(labels.ndim)]
+        padded_ranks = np.pad(ranks, pad, mode='symmetric')
+        starts = offsets + np.array([before for before, _ in pad])
+        neighbours = [padded_ranks[tuple(slice(s, s + n) for s, n in zip(start, labels_shape))] for start in starts]
+
+        # voxels whose neighbours all have the same rank
+        min_ranks = neighbours[0].copy()
+        max_ranks = neighbours[0].copy()
+        for neighbour in neighbours[1:]:
+            np.minimum(min_ranks, neighbour, out=min_ranks)
+            np.maximum(max_ranks, neighbour, out=max_ranks)
+        uniform = (min_ranks == max_ranks) & (min_ranks < n_labels)
+        labels_smoothed[uniform] = labels_list[min_ranks[uniform]]
+        boundary = np.flatnonzero(min_ranks != max_ranks)
+        del min_ranks, max_ranks, uniform, neighbours
+
+        # count the ranks of the neighbours of boundary voxels: in the sorted ranks of a voxel, the position of every
+        # neighbour within its run of equal ranks gives its count so far, the first maximum is the most numerous rank
+        # (with the smallest rank winning ties), and non-smoothed labels (highest rank) are not counted.
+        padded_ranks_shape = padded_ranks.shape
+        flat_offsets = np.ravel_multi_index(starts.T, padded_ranks_shape)
+        padded_ranks = padded_ranks.ravel()
+        positions = np.arange(len(starts))
+        chunks = [boundary[i:i + chunk_size] for i in range(0, len(boundary), chunk_size)]
+        loop_info = utils.LoopInfo(len(chunks), print_progress, 'smoothing')
+        flat_smoothed = labels_smoothed.reshape(-1)
+
+        def smooth_chunk(chunk):
+            voxels = np.ravel_multi_index(np.unravel_index(chunk, labels_shape), padded_ranks_shape)
+            neighbour_ranks = np.sort(padded_ranks[voxels[:, np.newaxis] + flat_offsets], axis=1)
+            run_starts = np.ones(neighbour_ranks.shape, dtype='bool')
+            run_starts[:, 1:] = neighbour_ranks[:, 1:] != neighbour_ranks[:, :-1]
+            counts = positions - np.maximum.accumulate(np.where(run_starts, positions, 0), axis=1) + 1
+            counts[neighbour_ranks == n_labels] = 0
+            best = np.argmax(counts, axis=1)
+            best_ranks = neighbour_ranks[np.arange(len(chunk)), best]
+            flat_smoothed[chunk] = np.where(counts[np.arange(len(chunk)), best] > 0,
+                                            labels_list[np.minimum(best_ranks, n_labels - 1)], 0)
+
+        if threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(threads, len(chunks))) as executor:
+                for i, _ in enumerate(executor.map(smooth_chunk, chunks)):
+                    if print_progress:
+                        loop_info.update(i)
+        else:
+            for i, chunk in enumerate(chunks):
+                if print_progress:
+                    loop_info.update(i)
+                smooth_chunk(chunk)
 
     if new_labels is None:
         new_labels = labels_smoothed
@@ -890,6 +1113,9 @@ def erode_label_map(labels, labels_to_erode, erosion_factors=1., gpu=False, mode
     :param return_model: (optional) whether to return the gpu blurring model
     :return: eroded label map, and gpu blurring model is return_model is True.
     """
+    import keras.layers as KL
+    from keras.models import Model
+    from lamar.ext.lab2im.layers import GaussianBlur
     # reformat labels_to_erode and erode
     new_labels = labels.copy()
     labels_to_erode = utils.reformat_to_list(labels_to_erode)
@@ -1294,7 +1520,7 @@ def align_images_in_dir(image_dir, result_dir, aff_ref=None, path_ref=None, reco
         assert aff_ref is None, 'cannot provide aff_ref and path_ref together.'
         basename = os.path.basename(path_ref)
         if ('.nii.gz' in basename) | ('.nii' in basename) | ('.mgz' in basename) | ('.npz' in basename):
-            _, aff_ref, _ = utils.load_volume(path_ref, im_only=False)
+            _, aff_ref, _, _, _, _ = utils.get_volume_info(path_ref)
             path_refs = [None] * len(path_images)
         else:
             path_refs = utils.list_images_in_folder(path_ref)
@@ -1315,7 +1541,7 @@ def align_images_in_dir(image_dir, result_dir, aff_ref=None, path_ref=None, reco
         if (not os.path.isfile(path_result)) | recompute:
             im, aff, h = utils.load_volume(path_image, im_only=False)
             if path_ref is not None:
-                _, aff_ref, _ = utils.load_volume(path_ref, im_only=False)
+                _, aff_ref, _, _, _, _ = utils.get_volume_info(path_ref)
             im, aff = align_volume_to_ref(im, aff, aff_ref=aff_ref, return_aff=True)
             utils.save_volume(im, aff, h, path_result)
 
@@ -1354,6 +1580,9 @@ def blur_images_in_dir(image_dir, result_dir, sigma, mask_dir=None, gpu=False, r
     :param gpu: (optional) whether to use a fast gpu model for blurring
     :param recompute: (optional) whether to recompute result files even if they already exists
     """
+    import keras.layers as KL
+    from keras.models import Model
+    from lamar.ext.lab2im.layers import GaussianBlur
 
     # create result dir
     utils.mkdir(result_dir)
@@ -1478,7 +1707,7 @@ def convert_images_in_dir_to_nifty(image_dir, result_dir, aff=None, ref_aff_dir=
                 if aff is not None:
                     tmp_aff = aff
                 elif path_ref is not None:
-                    _, tmp_aff, h = utils.load_volume(path_ref, im_only=False)
+                    _, tmp_aff, _, _, h, _ = utils.get_volume_info(path_ref)
                 utils.save_volume(im, tmp_aff, h, path_result)
 
 
@@ -1830,6 +2059,10 @@ def simulate_upsampled_anisotropic_images(image_dir,
     :param gpu: (optional) whether to use a fast gpu model for blurring
     :param recompute: (optional) whether to recompute result files even if they already exists
     """
+    import keras.layers as KL
+    from keras.models import Model
+    from lamar.ext.lab2im.layers import GaussianBlur
+    from lamar.ext.lab2im.edit_tensors import blurring_sigma_for_downsampling
 
     # create result dir
     utils.mkdir(resample_image_result_dir)
@@ -2009,7 +2242,7 @@ def correct_labels_in_dir(labels_dir, results_dir, incorrect_labels, correct_lab
         # correct labels
         path_result = os.path.join(results_dir, os.path.basename(path_label))
         if (not os.path.isfile(path_result)) | recompute:
-            im, aff, h = utils.load_volume(path_label, im_only=False, dtype='int32')
+            im, aff, h = utils.load_volume(path_label, im_only=False, dtype='int32', mode='native')
             im = correct_label_map(im, incorrect_labels, correct_labels, use_nearest_label, remove_zero, smooth)
             utils.save_volume(im, aff, h, path_result)
 
@@ -2047,7 +2280,7 @@ def mask_labels_in_dir(labels_dir, result_dir, values_to_keep, masking_value=0,
         if (not os.path.isfile(path_result)) | \
                 (mask_result_dir is not None) & (not os.path.isfile(path_result_mask)) | \
                 recompute:
-            lab, aff, h = utils.load_volume(path_label, im_only=False)
+            lab, aff, h = utils.load_volume(path_label, im_only=False, mode='native')
             if mask_result_dir is not None:
                 labels, mask = mask_label_map(lab, values_to_keep, masking_value, return_mask=True)
                 path_result_mask = os.path.join(mask_result_dir, os.path.basename(path_label))
@@ -2057,7 +2290,8 @@ def mask_labels_in_dir(labels_dir, result_dir, values_to_keep, masking_value=0,
             utils.save_volume(labels, aff, h, path_result)
 
 
-def smooth_labels_in_dir(labels_dir, result_dir, gpu=False, labels_list=None, connectivity=1, recompute=True):
+def smooth_labels_in_dir(labels_dir, result_dir, gpu=False, labels_list=None, connectivity=1, recompute=True,
+                         threads=1):
     """Smooth all label maps in a folder by replacing each voxel by the value of its most numerous neighbours.
     :param labels_dir: path of directory with input label maps
     :param result_dir: path of directory where smoothed label maps will be writen
@@ -2066,6 +2300,7 @@ def smooth_labels_in_dir(labels_dir, result_dir, gpu=False, labels_list=None, co
     Automatically computed if not provided.
     :param connectivity: (optional) connectivity to use when smoothing the label maps
     :param recompute: (optional) whether to recompute result files even if they already exists
+    :param threads: (optional) if gpu is False, number of threads smoothing every label map (see smooth_label_map)
     """
 
     # create result dir
@@ -2119,8 +2354,8 @@ def smooth_labels_in_dir(labels_dir, result_dir, gpu=False, labels_list=None, co
             # smooth label map
             path_result = os.path.join(result_dir, os.path.basename(path))
             if (not os.path.isfile(path_result)) | recompute:
-                volume, aff, h = utils.load_volume(path, im_only=False)
-                new_volume = smooth_label_map(volume, kernel, labels_list)
+                volume, aff, h = utils.load_volume(path, im_only=False, mode='native')
+                new_volume = smooth_label_map(volume, kernel, labels_list, threads=threads)
                 utils.save_volume(new_volume, aff, h, path_result, dtype='int32')
 
 
@@ -2132,6 +2367,10 @@ def smoothing_gpu_model(label_shape, label_list, connectivity=1):
     :param connectivity: (optional) connectivity to use when smoothing the label maps
     :return: gpu smoothing model
     """
+    import tensorflow as tf
+    import keras.layers as KL
+    from keras.models import Model
+    from lamar.ext.lab2im.layers import ConvertLabels
 
     # convert labels so values are in [0, ..., N-1] and use one hot encoding
     n_labels = label_list.shape[0]
@@ -2178,7 +2417,7 @@ def erode_labels_in_dir(labels_dir, result_dir, labels_to_erode, erosion_factors
         loop_info.update(idx)
 
         # erode label map
-        labels, aff, h = utils.load_volume(path_label, im_only=False)
+        labels, aff, h = utils.load_volume(path_label, im_only=False, mode='native')
         path_result = os.path.join(result_dir, os.path.basename(path_label))
         if (not os.path.isfile(path_result)) | recompute:
             labels, model = erode_label_map(labels, labels_to_erode, erosion_factors, gpu, model, return_model=True)
@@ -2232,7 +2471,7 @@ def upsample_labels_in_dir(labels_dir,
         if (not os.path.isfile(path_result)) | recompute:
 
             # load volume
-            labels, aff, h = utils.load_volume(path_label, im_only=False)
+            labels, aff, h = utils.load_volume(path_label, im_only=False, mode='native')
             labels = lut[labels.astype('int')]
 
             # create individual folders for label map
@@ -2318,7 +2557,7 @@ def compute_hard_volumes_in_dir(labels_dir,
         loop_info.update(idx)
 
         # load segmentation, and compute unique labels
-        labels, _, _, _, _, _, subject_res = utils.get_volume_info(path_label, return_volume=True)
+        labels, _, _, _, _, _, subject_res = utils.get_volume_info(path_label, return_volume=True, mode='native')
         if voxel_volume is None:
             voxel_volume = float(np.prod(subject_res))
         subject_volumes = compute_hard_volumes(labels, voxel_volume, label_list, skip_background)
@@ -2383,7 +2622,7 @@ def build_atlas(labels_dir,
         loop_info.update(idx)
 
         # load label map and build mask
-        lab = utils.load_volume(path_label, dtype='int32', aff_ref=np.eye(4))
+        lab = utils.load_volume(path_label, dtype='int32', aff_ref=np.eye(4), mode='native')
         lab = correct_label_map(lab, [31, 63, 72], [4, 43, 0])
         lab = lut[lab.astype('int')]
         lab = pad_volume(lab, shape[:n_dims])
@@ -2433,9 +2672,11 @@ def check_images_and_labels(image_dir, labels_dir, verbose=True):
         if loop_info is not None:
             loop_info.update(idx)
 
-        # load images and labels
-        im, aff_im, h_im = utils.load_volume(path_image, im_only=False)
-        lab, aff_lab, h_lab = utils.load_volume(path_label, im_only=False)
+        # read the headers of images and labels, and their squeezed shapes
+        im, aff_im, h_im = utils.load_volume(path_image, im_only=False, mode='proxy')
+        lab, aff_lab, h_lab = utils.load_volume(path_label, im_only=False, mode='proxy')
+        im_shape = tuple(s for s in im.shape if s != 1)
+        lab_shape = tuple(s for s in lab.shape if s != 1)
         aff_im_list = np.round(aff_im, 2).tolist()
         aff_lab_list = np.round(aff_lab, 2).tolist()
 
@@ -2446,11 +2687,11 @@ def check_images_and_labels(image_dir, labels_dir, verbose=True):
             print(path_label)
             print(aff_lab_list)
             print('')
-        if lab.shape != im.shape:
+        if lab_shape != im_shape:
             print('shape mismatch :\n' + path_image)
-            print(im.shape)
+            print(im_shape)
             print('\n' + path_label)
-            print(lab.shape)
+            print(lab_shape)
             print('')
 
 
@@ -2488,7 +2729,7 @@ def crop_dataset_to_minimum_size(labels_dir, result_dir, image_dir=None, image_r
         loop_info.update(idx)
 
         # crop label maps and update maximum size of cropped map
-        label, aff, h = utils.load_volume(path_label, im_only=False)
+        label, aff, h = utils.load_volume(path_label, im_only=False, mode='native')
         label, cropping, aff = crop_volume_around_region(label, aff=aff)
         utils.save_volume(label, aff, h, os.path.join(result_dir, os.path.basename(path_label)))
         maximum_size = np.maximum(maximum_size, np.array(label.shape) + margin * 2)  # *2 to add margin on each side
@@ -2547,7 +2788,7 @@ def crop_dataset_around_region_of_same_size(labels_dir,
     max_crop_shape = np.zeros(n_dims)
     if recompute_labels:
         for path_label in path_labels:
-            label, aff, _ = utils.load_volume(path_label, im_only=False)
+            label, aff, _ = utils.load_volume(path_label, im_only=False, mode='native')
             label = align_volume_to_ref(label, aff, aff_ref=np.eye(4))
             label = get_largest_connected_component(label > 0, structure=np.ones((3, 3, 3)))
             _, cropping = crop_volume_around_region(label)
@@ -2563,7 +2804,7 @@ def crop_dataset_around_region_of_same_size(labels_dir,
 
         if (not os.path.isfile(path_image_result)) | (not os.path.isfile(path_label_result)) | recompute:
             # load labels
-            label, aff, h_la = utils.load_volume(path_label, im_only=False, dtype='int32')
+            label, aff, h_la = utils.load_volume(path_label, im_only=False, dtype='int32', mode='native')
             label, aff_new = align_volume_to_ref(label, aff, aff_ref=np.eye(4), return_aff=True)
             vol_shape = np.array(label.shape[:n_dims])
             if path_image is not None:
@@ -2644,7 +2885,7 @@ def crop_dataset_around_region(image_dir, labels_dir, image_result_dir, labels_r
         if (not os.path.isfile(path_label_result)) | (not os.path.isfile(path_image_result)) | recompute:
 
             image, aff, h_im = utils.load_volume(path_image, im_only=False)
-            label, _, h_lab = utils.load_volume(path_label, im_only=False)
+            label, _, h_lab = utils.load_volume(path_label, im_only=False, mode='native')
             mask = get_largest_connected_component(label > 0, structure=np.ones((3, 3, 3)))
             label[np.logical_not(mask)] = 0
             vol_shape = np.array(label.shape[:n_dims])
@@ -18,6 +18,7 @@ This file regroups several custom keras layers used in the generation model:
     - MaskEdges
     - ImageGradients
     - RandomDilationErosion
+    - MakeShape
 
 
 If you use this code, please cite the first SynthSeg paper:
@@ -2058,3 +2059,60 @@ class RandomDilationErosion(Layer):
 
     def compute_output_shape(self, input_shape):
         return input_shape
+
+
+class MakeShape(Layer):
+    """Expects one-hot encoding of the two input label maps."""
+
+    def __init__(self, target_shape, **kwargs):
+        self.n_dims = None
+        self.target_shape = target_shape
+        self.cropping_shape = None
+        super(MakeShape, self).__init__(**kwargs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["target_shape"] = self.target_shape
+        return config
+
+    def build(self, input_shape):
+        self.n_dims = input_shape[1][1]
+        self.cropping_shape = np.array(utils.reformat_to_list(self.target_shape, length=self.n_dims))
+        self.built = True
+        super(MakeShape, self).build(input_shape)
+
+    def call(self, inputs, **kwargs):
+        return tf.map_fn(self._single_process, inputs, dtype=tf.int32)
+
+    def _single_process(self, inputs):
+
+        x = inputs[0]
+        shape = inputs[1]
+
+        # find cropping indices
+        mask = tf.logical_and(tf.not_equal(x, 0), tf.not_equal(x, 24))
+        indices = tf.cast(tf.where(mask), 'int32')
+
+        min_idx = K.switch(tf.equal(tf.shape(indices)[0], 0),
+                           tf.zeros(self.n_dims, dtype='int32'),
+                           tf.maximum(tf.reduce_min(indices, axis=0), 0))
+        max_idx = K.switch(tf.equal(tf.shape(indices)[0], 0),
+                           tf.minimum(shape, self.cropping_shape),
+                           tf.minimum(tf.reduce_max(indices, axis=0) + 1, shape))
+
+        # expand/retract (depending on the desired shape) the cropping region around the centre
+        intermediate_vol_shape = max_idx - min_idx
+        min_idx = min_idx - tf.cast(tf.math.ceil((self.cropping_shape - intermediate_vol_shape) / 2), 'int32')
+        max_idx = max_idx + tf.cast(tf.math.floor((self.cropping_shape - intermediate_vol_shape) / 2), 'int32')
+        tmp_min_idx = tf.maximum(min_idx, 0)
+        tmp_max_idx = tf.minimum(max_idx, shape)
+        x = tf.slice(x, begin=tmp_min_idx, size=tf.minimum(tmp_max_idx - tmp_min_idx, shape))
+
+        # pad if necessary
+        min_padding = tf.abs(tf.minimum(min_idx, 0))
+        max_padding = tf.maximum(max_idx - shape, 0)
+        x = K.switch(tf.reduce_any(tf.logical_or(tf.greater(min_padding, 0), tf.greater(max_padding, 0))),
+                     tf.pad(x, tf.stack([min_padding, max_padding], axis=1)),
+                     x)
+
+        return x
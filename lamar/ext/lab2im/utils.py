@@ -3,6 +3,7 @@ This file contains all the utilities used in that project. They are classified i
 1- loading/saving functions:
     -load_volume
     -save_volume
+    -write_gzip
     -get_volume_info
     -get_list_labels
     -load_array_if_path
@@ -60,20 +61,27 @@ import os
 import glob
 import math
 import time
+import zlib
+import struct
 import pickle
 import numpy as np
 import nibabel as nib
-import tensorflow as tf
-import keras.layers as KL
-import keras.backend as K
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 from scipy.ndimage.morphology import distance_transform_edt
 
+# ways of reading the voxels of a volume (see load_volume)
+LOAD_MODES = ['float64', 'float32', 'native', 'mmap', 'proxy']
+
+# size of the blocks compressed independently by write_gzip, and size of the window each block is primed with
+GZIP_BLOCK_SIZE = 2 ** 20
+GZIP_WINDOW_SIZE = 2 ** 15
+
 
 # ---------------------------------------------- loading/saving functions ----------------------------------------------
 
 
-def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=None):
+def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=None, mode='float64'):
     """
     Load volume file.
     :param path_volume: path of the volume to load. Can either be a nii, nii.gz, mgz, or npz format.
@@ -84,32 +92,48 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
     :param dtype: (optional) if not None, convert the loaded volume to this numpy dtype.
     :param aff_ref: (optional) If not None, the loaded volume is aligned to this affine matrix.
     The returned affine matrix is also given in this new space. Must be a numpy array of dimension 4x4.
+    :param mode: (optional) how to read the voxels of nii, nii.gz, and mgz files:
+    'float64' (default) reads them as float64, 'float32' as float32, and 'native' in the dtype they are stored in (or
+    float if the file has scaling factors), always read into memory. 'mmap' is 'native', but memory-maps uncompressed
+    files (copy-on-write) rather than reading them. 'proxy' doesn't read any voxel: it returns nibabel's array proxy of
+    the volume, which reads the slabs it is indexed with (squeeze, dtype, and aff_ref are then ignored). npz files are
+    always read entirely. To only read the header of a volume, use get_volume_info.
     :return: the volume, with corresponding affine matrix and header if im_only is False.
     """
     assert path_volume.endswith(('.nii', '.nii.gz', '.mgz', '.npz')), 'Unknown data file: %s' % path_volume
+    assert mode in LOAD_MODES, 'mode should be in %s, had %s' % (LOAD_MODES, mode)
 
     if path_volume.endswith(('.nii', '.nii.gz', '.mgz')):
-        x = nib.load(path_volume)
-        if squeeze:
-            volume = np.squeeze(x.get_fdata())
+        # nibabel memory-maps uncompressed files by default, so 'native' has to ask it to read them
+        x = nib.load(path_volume, mmap={'mmap': 'c', 'native': False}.get(mode, True))
+        if mode == 'proxy':
+            return x.dataobj if im_only else (x.dataobj, x.affine, x.header)
+        elif mode in ['float64', 'float32']:
+            volume = x.get_fdata(dtype=mode)
         else:
-            volume = x.get_fdata()
+            volume = np.asanyarray(x.dataobj)
+            if not volume.dtype.isnative:  # e.g. mgz files, which are big-endian
+                volume = volume.astype(volume.dtype.newbyteorder('='))
+        if squeeze:
+            volume = np.squeeze(volume)
         aff = x.affine
         header = x.header
     else:  # npz
         volume = np.load(path_volume)['vol_data']
+        if mode == 'float32':
+            volume = volume.astype('float32')
         if squeeze:
             volume = np.squeeze(volume)
         aff = np.eye(4)
         header = nib.Nifti1Header()
     if dtype is not None:
-        if 'int' in dtype:
+        if 'int' in dtype and not np.issubdtype(volume.dtype, np.integer):
             volume = np.round(volume)
         volume = volume.astype(dtype=dtype)
 
     # align image to reference affine matrix
     if aff_ref is not None:
-        from ext.lab2im import edit_volumes  # the import is done here to avoid import loops
+        from lamar.ext.lab2im import edit_volumes  # the import is done here to avoid import loops
         n_dims, _ = get_dims(list(volume.shape), max_channels=10)
         volume, aff = edit_volumes.align_volume_to_ref(volume, aff, aff_ref=aff_ref, return_aff=True, n_dims=n_dims)
 
@@ -119,7 +143,7 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
         return volume, aff, header
 
 
-def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3):
+def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3, compression=None, threads=1):
     """
     Save a volume.
     :param volume: volume to save
@@ -131,9 +155,16 @@ def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3):
     :param dtype: (optional) numpy dtype for the saved volume.
     :param n_dims: (optional) number of dimensions, to avoid confusion in multi-channel case. Default is None, where
     n_dims is automatically inferred.
+    :param compression: (optional) gzip compression level (0 to 9) of nii.gz and mgz files. 0 writes a valid gzip file
+    without compressing the data. Default is None, where nibabel's default level is used.
+    :param threads: (optional) number of threads compressing nii.gz and mgz files (see write_gzip). Default is 1.
+    To write uncompressed intermediates, e.g. files read back by the pipeline, give a nii path instead.
     """
 
     mkdir(os.path.dirname(path))
+    # never write through a hard link, e.g. a parcellation linked from the LaMAR cache
+    if os.path.isfile(path) and os.stat(path).st_nlink > 1:
+        os.remove(path)
     if '.npz' in path:
         np.savez_compressed(path, vol_data=volume)
     else:
@@ -157,25 +188,75 @@ def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3):
                 n_dims, _ = get_dims(volume.shape)
             res = reformat_to_list(res, length=n_dims, dtype=None)
             nifty.header.set_zooms(res)
-        nib.save(nifty, path)
+        if path.endswith(('.nii.gz', '.mgz')) and (compression is not None or threads > 1):
+            image = nib.MGHImage.from_image(nifty) if path.endswith('.mgz') else nifty
+            if compression is None:
+                compression = nib.openers.Opener.default_compresslevel
+            write_gzip(image.to_bytes(), path, compression=compression, threads=threads)
+        else:
+            nib.save(nifty, path)
 
 
-def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels=10):
+def write_gzip(data, path, compression=6, threads=1, block_size=GZIP_BLOCK_SIZE):
+    """
+    Write data to a standard gzip file (a single gzip member), compressing blocks of data in parallel as pigz does.
+    Every block is compressed independently, primed with the end of the previous block so that the compression ratio is
+    almost that of a single stream, and flushed to a byte boundary so that the compressed blocks can be concatenated.
+    :param data: bytes-like object to compress.
+    :param path: path of the gzip file.
+    :param compression: (optional) gzip compression level, from 0 (no compression) to 9. Default is 6.
+    :param threads: (optional) number of threads compressing blocks. Default is 1.
+    :param block_size: (optional) size of the blocks in bytes. Default is 1 MiB.
+    """
+    data = memoryview(data).cast('B')
+    starts = list(range(0, len(data), block_size)) or [0]
+
+    def compress_block(start):
+        if start > 0:
+            compressor = zlib.compressobj(compression, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                          zdict=data[max(start - GZIP_WINDOW_SIZE, 0):start])
+        else:
+            compressor = zlib.compressobj(compression, zlib.DEFLATED, -zlib.MAX_WBITS)
+        block = compressor.compress(data[start:start + block_size])
+        return block + compressor.flush(zlib.Z_FINISH if start == starts[-1] else zlib.Z_SYNC_FLUSH)
+
+    # header: deflate method, no flags, modification time, maximum compression flag if level 9, unknown OS
+    header = struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time.time()), 2 if compression == 9 else 0, 255)
+    with open(path, 'wb') as f:
+        f.write(header)
+        if threads > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for block in executor.map(compress_block, starts):
+                    f.write(block)
+        else:
+            for start in starts:
+                f.write(compress_block(start))
+        f.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff))
+
+
+def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels=10, mode='float64'):
     """
     Gather information about a volume: shape, affine matrix, number of dimensions and channels, header, and resolution.
     :param path_volume: path of the volume to get information form.
-    :param return_volume: (optional) whether to return the volume along with the information.
+    :param return_volume: (optional) whether to return the volume along with the information. If False, only the header
+    of nii, nii.gz, and mgz files is read.
     :param aff_ref: (optional) If not None, the loaded volume is aligned to this affine matrix.
     All info relative to the volume is then given in this new space. Must be a numpy array of dimension 4x4.
     :param max_channels: maximum possible number of channels for the input volume.
+    :param mode: (optional) how to read the voxels of the returned volume (see load_volume). Default is 'float64'.
     :return: volume (if return_volume is true), and corresponding info. If aff_ref is not None, the returned aff is
     the original one, i.e. the affine of the image before being aligned to aff_ref.
     """
-    # read image
-    im, aff, header = load_volume(path_volume, im_only=False)
+    # read image, or only its header (the shape of the proxy is that of the volume before squeezing)
+    if return_volume:
+        im, aff, header = load_volume(path_volume, im_only=False, mode=mode)
+        im_shape = list(im.shape)
+    else:
+        im = None
+        proxy, aff, header = load_volume(path_volume, im_only=False, mode='proxy')
+        im_shape = [int(s) for s in proxy.shape if s != 1]
 
     # understand if image is multichannel
-    im_shape = list(im.shape)
     n_dims, n_channels = get_dims(im_shape, max_channels=max_channels)
     im_shape = im_shape[:n_dims]
 
@@ -189,10 +270,11 @@ def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels
 
     # align to given affine matrix
     if aff_ref is not None:
-        from ext.lab2im import edit_volumes  # the import is done here to avoid import loops
+        from lamar.ext.lab2im import edit_volumes  # the import is done here to avoid import loops
         ras_axes = edit_volumes.get_ras_axes(aff, n_dims=n_dims)
         ras_axes_ref = edit_volumes.get_ras_axes(aff_ref, n_dims=n_dims)
-        im = edit_volumes.align_volume_to_ref(im, aff, aff_ref=aff_ref, n_dims=n_dims)
+        if return_volume:
+            im = edit_volumes.align_volume_to_ref(im, aff, aff_ref=aff_ref, n_dims=n_dims)
         im_shape = np.array(im_shape)
         data_res = np.array(data_res)
         im_shape[ras_axes_ref] = im_shape[ras_axes]
@@ -681,6 +763,7 @@ def sample_affine_transform(batchsize,
                             enable_90_rotations=False):
     """build batchsize x 4 x 4 tensor representing an affine transformation in homogeneous coordinates.
     If return_inv is True, also returns the inverse of the created affine matrix."""
+    import tensorflow as tf
 
     if (rotation_bounds is not False) | (enable_90_rotations is not False):
         if n_dims == 2:
@@ -754,6 +837,7 @@ def sample_affine_transform(batchsize,
 
 def create_rotation_transform(rotation, n_dims):
     """build rotation transform from 3d or 2d rotation coefficients. Angles are given in degrees."""
+    import tensorflow as tf
     rotation = rotation * np.pi / 180
     if n_dims == 3:
         shape = tf.shape(tf.expand_dims(rotation[..., 0], -1))
@@ -796,6 +880,7 @@ def create_rotation_transform(rotation, n_dims):
 
 def create_shearing_transform(shearing, n_dims):
     """build shearing transform from 2d/3d shearing coefficients"""
+    import tensorflow as tf
     shape = tf.shape(tf.expand_dims(shearing[..., 0], -1))
     if n_dims == 3:
         shearing_row0 = tf.stack([tf.ones(shape), tf.expand_dims(shearing[..., 0], -1),
@@ -992,6 +1077,9 @@ def draw_value_from_distribution(hyperparameter,
     :return: a float, or a numpy 1d array if size > 1, or hyperparameter is itself a numpy array.
     Returns None if hyperparameter is False.
     """
+    import tensorflow as tf
+    import keras.layers as KL
+    import keras.backend as K
 
     # return False is hyperparameter is False
     if hyperparameter is False:
@@ -1,3 +1,5 @@
-from . import layers
-from . import models
-from . import utils
+from lamar.lazy import lazy_submodules
+
+_SUBMODULES = ['layers', 'models', 'utils']
+
+__getattr__ = lazy_submodules(__name__, _SUBMODULES)
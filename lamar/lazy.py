@@ -0,0 +1,23 @@
+"""
+lazy - Submodules imported on first use
+
+Part of the LaMAR processing pipeline.
+
+The SynthSeg, lab2im and neuron packages import their submodules on first
+use, and their modules import TensorFlow and Keras in the functions that use
+them, so that reading and editing volumes, the CLI, or the ONNX Runtime
+backend don't import TensorFlow through the modules that need it.
+"""
+
+import importlib
+
+
+def lazy_submodules(package, submodules):
+    """Module-level __getattr__ of a package (PEP 562) that imports the given submodules when they are first accessed."""
+
+    def __getattr__(name):
+        if name in submodules:
+            return importlib.import_module('.' + name, package)
+        raise AttributeError(f"module {package!r} has no attribute {name!r}")
+
+    return __getattr__
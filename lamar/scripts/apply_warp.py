@@ -44,6 +44,7 @@ References:
 import ants
 import argparse
 import sys
+from contextlib import nullcontext
 from colorama import init, Fore, Style
 
 init()
@@ -91,7 +92,7 @@ def print_help():
     print(help_text)
 
 
-def apply_warp(moving_img, reference_img, affine_file, warp_file, out_file):
+def apply_warp(moving_img, reference_img, affine_file, warp_file, out_file, timer=None):
     """Apply an affine transform and a warp field to a moving image.
     
     This function takes a moving image and applies both an affine transformation 
@@ -111,6 +112,9 @@ def apply_warp(moving_img, reference_img, affine_file, warp_file, out_file):
         Path to the nonlinear warp field (.nii.gz).
     out_file : str
         Path where the transformed image will be saved.
+    timer : pipeline.StageTimer, optional
+        Detailed timer of the running stage, in which the resampling and the
+        writing of the output are recorded as sub-stages.
         
     Returns
     -------
@@ -125,14 +129,19 @@ def apply_warp(moving_img, reference_img, affine_file, warp_file, out_file):
     composite transformations.
     """
 
+    def substage(name):
+        return timer.stage(name) if timer is not None else nullcontext()
+
     # The order of transforms in transformlist matters (last Transform will be applied first).
     # Usually you put the nonlinear warp first, then the affine:
-    transformed = ants.apply_transforms(
-        fixed=reference_img, moving=moving_img, transformlist=[warp_file, affine_file]
-    )
+    with substage("apply transforms"):
+        transformed = ants.apply_transforms(
+            fixed=reference_img, moving=moving_img, transformlist=[warp_file, affine_file]
+        )
 
     # Save the transformed image
-    ants.image_write(transformed, out_file)
+    with substage("write output"):
+        ants.image_write(transformed, out_file)
     print(f"Saved warped image as {out_file}")
 
 
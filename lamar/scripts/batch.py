@@ -0,0 +1,424 @@
+"""
+batch - Manifest-driven registration of whole cohorts
+
+Part of the LaMAR processing pipeline.
+
+`lamar register` handles one moving/fixed pair per invocation. `lamar
+register-batch` reads a manifest with one registration per row and schedules
+the stages of all rows (SynthSeg parcellation, coregistration, Dice QC and
+application of the warp) on a pool of worker processes:
+
+- Every stage asks for a number of cores (--synthseg-threads for SynthSeg,
+  --ants-threads for the ANTs stages, 1 for Dice) and an estimated amount of
+  memory. A stage only starts when both fit in what is left of the global core
+  budget (--cores) and memory budget (--memory), so the machine is neither
+  oversubscribed nor left idle.
+- Stages of subjects that are already under way are started first, so that
+  subjects complete (and free their intermediate files) as early as possible.
+- Worker processes are reused between stages, so every worker imports
+  TensorFlow/ANTsPy and builds the SynthSeg networks only once. As a worker
+  keeps them in memory whatever stage it runs next, their footprint is
+  reserved out of the memory budget for every worker, and there are only as
+  many workers as leave at least half of the budget to the stages.
+- Every finished or failed stage is appended to a JSON-lines journal. When a
+  batch is restarted with the same journal, stages that completed and whose
+  outputs still exist are skipped.
+- The output of every subject goes to its own log file, and a status line is
+  printed whenever a stage finishes. A throughput summary (subjects/hour and
+  per-stage duration percentiles) is printed at the end.
+
+Manifest:
+--------
+CSV, TSV or JSON (a list of objects, or {"subjects": [...]}). Columns/keys are
+the `lamar register` option names, with or without dashes: id, moving, fixed,
+output, moving-parc, fixed-parc, registered-parc, affine, warpfield,
+inverse-warpfield, inverse-affine, qc-csv. Only moving and fixed are required
+when --output-dir is given: missing paths are then derived from the subject
+id (default: the moving image name) as <output-dir>/<id>/<id>_<name>. Rows
+without an output path only generate the warpfield.
+
+API Usage:
+---------
+lamar register-batch
+    --manifest <path/to/manifest.csv|.tsv|.json>
+    [--output-dir <path/to/output_dir>]
+    [--cores <num_cores>]
+    [--memory <size, e.g. 64G>]
+    [--synthseg-threads <num_threads>]
+    [--ants-threads <num_threads>]
+    [--registration-method <method>]
+    [--journal <path/to/journal.jsonl>]
+    [--restart]
+
+Python Usage:
+-----------
+>>> from lamar.scripts.batch import load_manifest, BatchScheduler
+>>> subjects = load_manifest("cohort.csv", output_dir="derivatives/lamar")
+>>> BatchScheduler(subjects, cores=32, memory="96G", synthseg_threads=4, ants_threads=4).run()
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from lamar.scripts.cache import parse_size, format_size
+from lamar.scripts.pipeline import get_image_name
+
+# Stages of a registration, in execution order, with the stages they depend on
+STAGES = ['synthseg', 'coregister', 'dice', 'apply-warp']
+STAGE_DEPENDENCIES = {'synthseg': [], 'coregister': ['synthseg'], 'dice': ['coregister'],
+                      'apply-warp': ['coregister']}
+
+# Stages whose failure is only a warning, as in `lamar register`
+OPTIONAL_STAGES = ['dice']
+
+# Peak resident memory of every stage on a 1mm whole-brain image, used for admission
+STAGE_MEMORY = {'synthseg': '6G', 'coregister': '3G', 'dice': '1G', 'apply-warp': '2G'}
+
+# Memory a worker keeps between stages once it has run SynthSeg (TensorFlow and the networks), reserved for every worker
+WORKER_MEMORY = '2G'
+
+# Manifest fields holding output paths, and the file name they get under --output-dir
+OUTPUT_FIELDS = {'moving_parc': 'moving_parc.nii.gz',
+                 'fixed_parc': 'fixed_parc.nii.gz',
+                 'registered_parc': 'registered_parc.nii.gz',
+                 'affine': 'affine.mat',
+                 'warpfield': 'warp.nii.gz',
+                 'inverse_warpfield': 'inverse_warp.nii.gz',
+                 'inverse_affine': 'inverse_affine.mat',
+                 'qc_csv': 'dice_scores.csv',
+                 'output': 'registered.nii.gz'}
+
+
+def load_manifest(path, output_dir=None):
+    """Read a CSV/TSV/JSON manifest into a list of subjects, i.e. dictionaries of paths keyed by manifest field."""
+    if path.endswith('.json'):
+        with open(path) as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows['subjects']
+    else:
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f, delimiter='\t' if path.endswith('.tsv') else ','))
+
+    subjects = []
+    for n_row, row in enumerate(rows, start=1):
+        subject = {key.strip().replace('-', '_'): value.strip() for key, value in row.items()
+                   if key and isinstance(value, str) and value.strip()}
+        for field in ['moving', 'fixed']:
+            if field not in subject:
+                raise ValueError(f"{path}, row {n_row}: missing '{field}'")
+        subject.setdefault('id', get_image_name(subject['moving']))
+        for field, name in OUTPUT_FIELDS.items():
+            if field not in subject and output_dir is not None:
+                if field == 'output' and subject.get('generate_warpfield', '').lower() in ['1', 'true', 'yes']:
+                    continue
+                subject[field] = os.path.join(output_dir, subject['id'], f"{subject['id']}_{name}")
+        for field in ['moving_parc', 'fixed_parc', 'registered_parc', 'affine', 'warpfield']:
+            if field not in subject:
+                raise ValueError(f"{path}, row {n_row}: missing '{field}' (or use --output-dir)")
+        subject.setdefault('qc_csv', os.path.splitext(subject['registered_parc'])[0] + '_dice_scores.csv')
+        subjects.append(subject)
+
+    ids = [subject['id'] for subject in subjects]
+    duplicates = sorted({subject_id for subject_id in ids if ids.count(subject_id) > 1})
+    if duplicates:
+        raise ValueError(f"{path}: duplicate subject ids {', '.join(duplicates)}")
+    return subjects
+
+
+def get_stage_outputs(subject, stage):
+    """Files written by a stage of a subject, which must all exist for the stage to count as done."""
+    fields = {'synthseg': ['moving_parc', 'fixed_parc'],
+              'coregister': ['registered_parc', 'affine', 'warpfield', 'inverse_warpfield', 'inverse_affine'],
+              'dice': ['qc_csv'],
+              'apply-warp': ['output']}[stage]
+    return [subject[field] for field in fields if subject.get(field)]
+
+
+def get_total_memory():
+    """Physical memory of the machine, in bytes."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return parse_size('16G')
+
+
+class Journal:
+    """Append-only JSON-lines record of the stages run by a batch, used to resume it after a restart."""
+
+    def __init__(self, path=None, restart=False):
+        self.path = path
+        self.done = set()
+        if path is None:
+            return
+        if restart and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # last line cut short by a crash
+                        continue
+                    if entry.get('status') == 'done':
+                        self.done.add((entry['subject'], entry['stage']))
+                    else:
+                        self.done.discard((entry['subject'], entry['stage']))
+
+    def is_done(self, subject, stage):
+        return (subject['id'], stage) in self.done and all(os.path.exists(p) for p in get_stage_outputs(subject, stage))
+
+    def record(self, subject_id, stage, status, duration=None, error=None):
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'subject': subject_id, 'stage': stage, 'status': status}
+        if duration is not None:
+            entry['duration'] = round(duration, 3)
+        if error is not None:
+            entry['error'] = error
+        if status == 'done':
+            self.done.add((subject_id, stage))
+        if self.path is None:
+            return
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# Engine of the current worker process, kept between stages so that the SynthSeg networks are only built once
+_engine = None
+
+
+def _init_worker(synthseg_threads, ants_threads):
+    global _engine
+    from lamar.scripts.pipeline import InProcessEngine
+    _engine = InProcessEngine(synthseg_threads=synthseg_threads, ants_threads=ants_threads)
+
+
+def _run_stage(stage, subject, registration_method, log_file):
+    """Run one stage of one subject in a worker process, and return its wall time."""
+    from lamar.scripts.cache import parcellate_with_cache
+    start = time.perf_counter()
+    with open(log_file, 'a') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        print(f"\n--- {stage} ({time.strftime('%Y-%m-%d %H:%M:%S')}) ---")
+        try:
+            if stage == 'synthseg':
+                parcellate_with_cache(_engine, [subject['moving'], subject['fixed']],
+                                      [subject['moving_parc'], subject['fixed_parc']], stage_name=stage)
+            elif stage == 'coregister':
+                _engine.coregister(subject['fixed_parc'], subject['moving_parc'], subject['registered_parc'],
+                                   registration_method=registration_method,
+                                   affine_file=subject['affine'],
+                                   warp_file=subject['warpfield'],
+                                   inverse_warp_file=subject.get('inverse_warpfield'),
+                                   inverse_affine_file=subject.get('inverse_affine'))
+            elif stage == 'dice':
+                _engine.dice(subject['fixed_parc'], subject['registered_parc'], subject['qc_csv'])
+            elif stage == 'apply-warp':
+                _engine.apply_warp(subject['moving'], subject['fixed'], subject['output'],
+                                   affine_file=subject['affine'], warp_file=subject['warpfield'])
+        finally:
+            # images are not shared between subjects, don't let them pile up in a long-lived worker
+            _engine.images.clear()
+            _engine.timer.stages.clear()
+    return time.perf_counter() - start
+
+
+class BatchScheduler:
+    """Run the stages of many registrations on a process pool, under a global core and memory budget."""
+
+    def __init__(self, subjects, cores=None, memory=None, synthseg_threads=1, ants_threads=1,
+                 registration_method="SyNRA", journal=None, log_dir=None):
+        self.subjects = subjects
+        if not cores:
+            from lamar.scripts.threads import get_available_cores
+            cores = get_available_cores()
+        self.cores = cores
+        self.memory = parse_size(memory) if memory else int(0.8 * get_total_memory())
+        self.synthseg_threads = synthseg_threads
+        self.ants_threads = ants_threads
+        self.workers = self.get_pool_size()
+        # what the workers keep between stages is not available to the stages (a single worker on a small budget still
+        # leaves half of it to them)
+        self.stage_memory = max(self.memory - self.workers * parse_size(WORKER_MEMORY), self.memory // 2)
+        self.registration_method = registration_method
+        self.journal = journal if journal is not None else Journal()
+        self.log_dir = log_dir or os.path.join(os.getcwd(), 'lamar_logs')
+
+        self.durations = {stage: [] for stage in STAGES}
+        self.status = {}  # subject id -> pending, running, done or failed
+        self.errors = {}
+        self.warnings = []
+
+    def get_pool_size(self):
+        """Number of worker processes: no more than the stages that can run at the same time on the core budget (a stage
+        takes at least one core), and no more than leave half of the memory budget to the stages once the memory kept
+        by every worker (WORKER_MEMORY) is reserved. There is always at least one worker."""
+        max_workers = self.memory // 2 // parse_size(WORKER_MEMORY)
+        return int(max(1, min(self.cores, max_workers)))
+
+    def get_cost(self, stage):
+        """Cores and memory (in bytes) reserved while a stage runs, clamped to the budgets so that it can always start."""
+        cores = {'synthseg': self.synthseg_threads, 'dice': 1}.get(stage, self.ants_threads)
+        return min(cores, self.cores), min(parse_size(STAGE_MEMORY[stage]), self.stage_memory)
+
+    def _get_stages(self, subject):
+        return [stage for stage in STAGES if stage != 'apply-warp' or subject.get('output')]
+
+    def _print_status(self, subject_id, stage, message):
+        n_done = sum(status == 'done' for status in self.status.values())
+        n_failed = sum(status == 'failed' for status in self.status.values())
+        print(f"[{time.strftime('%H:%M:%S')}] {subject_id:<20} {stage:<11} {message:<28} "
+              f"({n_done}/{len(self.subjects)} subjects done, {n_failed} failed)")
+        sys.stdout.flush()
+
+    def _new_pool(self):
+        # spawned workers don't inherit TensorFlow/ITK thread pools from the parent
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(self.synthseg_threads, self.ants_threads))
+
+    def run(self):
+        """Run all subjects, and return the number of subjects that failed."""
+        os.makedirs(self.log_dir, exist_ok=True)
+        for subject in self.subjects:
+            for path in [subject[field] for field in OUTPUT_FIELDS if subject.get(field)]:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        # stages left to run, per subject, and stages already completed
+        remaining = {}
+        completed = {}
+        for subject in self.subjects:
+            stages = self._get_stages(subject)
+            completed[subject['id']] = {stage for stage in stages if self.journal.is_done(subject, stage)}
+            remaining[subject['id']] = [stage for stage in stages if stage not in completed[subject['id']]]
+            self.status[subject['id']] = 'done' if not remaining[subject['id']] else 'pending'
+        n_resumed = sum(status == 'done' for status in self.status.values())
+        if n_resumed:
+            print(f"Resuming batch: {n_resumed} subject(s) already done according to the journal")
+        print(f"Scheduling {len(self.subjects) - n_resumed} subject(s) on {self.cores} core(s) and "
+              f"{format_size(self.memory)} of memory, with {self.workers} worker(s) keeping up to "
+              f"{format_size(self.memory - self.stage_memory)} between stages")
+
+        order = {subject['id']: n for n, subject in enumerate(self.subjects)}
+        subjects = {subject['id']: subject for subject in self.subjects}
+        free_cores, free_memory = self.cores, self.stage_memory
+        running = {}  # future -> (subject id, stage, cores, memory)
+        start = time.perf_counter()
+        pool = self._new_pool()
+        try:
+            while True:
+                # stages whose dependencies are done, later stages (and earlier subjects) first
+                ready = [(subject_id, stage) for subject_id, stages in remaining.items()
+                         if self.status[subject_id] in ['pending', 'running'] for stage in stages
+                         if all(dep in completed[subject_id] for dep in STAGE_DEPENDENCIES[stage])]
+                ready.sort(key=lambda task: (-STAGES.index(task[1]), order[task[0]]))
+                for subject_id, stage in ready:
+                    cores, memory = self.get_cost(stage)
+                    if cores > free_cores or memory > free_memory:
+                        continue
+                    log_file = os.path.join(self.log_dir, f"{subject_id}.log")
+                    future = pool.submit(_run_stage, stage, subjects[subject_id], self.registration_method, log_file)
+                    running[future] = (subject_id, stage, cores, memory)
+                    remaining[subject_id].remove(stage)
+                    free_cores -= cores
+                    free_memory -= memory
+                    self.status[subject_id] = 'running'
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                # when a worker dies, every stage left on the pool fails with it: only the first (in submission order)
+                # counts as failed, the others are run again on a new pool
+                broken = [future for future in running
+                          if future in finished and isinstance(future.exception(), BrokenProcessPool)]
+                for future in finished:
+                    if future in broken:
+                        continue
+                    subject_id, stage, cores, memory = running.pop(future)
+                    free_cores += cores
+                    free_memory += memory
+                    try:
+                        duration = future.result()
+                    except BaseException as e:
+                        self._fail(subject_id, stage, f"{type(e).__name__}: {e}", remaining, running)
+                        continue
+                    self.durations[stage].append(duration)
+                    completed[subject_id].add(stage)
+                    self.journal.record(subject_id, stage, 'done', duration=duration)
+                    self._update_status(subject_id, remaining, running)
+                    self._print_status(subject_id, stage, f"done in {duration:.1f} s")
+                if broken:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    for future in list(running):
+                        subject_id, stage, cores, memory = running.pop(future)
+                        free_cores += cores
+                        free_memory += memory
+                        if future is broken[0]:
+                            self._fail(subject_id, stage, 'worker process died (out of memory?)', remaining, running)
+                        elif self.status[subject_id] != 'failed':
+                            remaining[subject_id] = sorted(remaining[subject_id] + [stage], key=STAGES.index)
+                            self._print_status(subject_id, stage, "requeued (worker died)")
+                    pool = self._new_pool()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        self.print_summary(time.perf_counter() - start, n_resumed)
+        return sum(status == 'failed' for status in self.status.values())
+
+    def _update_status(self, subject_id, remaining, running):
+        if not remaining[subject_id] and not any(task[0] == subject_id for task in running.values()):
+            self.status[subject_id] = 'done'
+
+    def _fail(self, subject_id, stage, error, remaining, running):
+        self.journal.record(subject_id, stage, 'failed', error=error)
+        if stage in OPTIONAL_STAGES:
+            self.warnings.append(f"{subject_id}: {stage}: {error}")
+            self._update_status(subject_id, remaining, running)
+            self._print_status(subject_id, stage, "failed (warning only)")
+            return
+        self.status[subject_id] = 'failed'
+        self.errors[subject_id] = f"{stage}: {error}"
+        remaining[subject_id] = []  # don't start the stages that depend on the failed one
+        self._print_status(subject_id, stage, "FAILED")
+
+    def print_summary(self, wall_time, n_resumed=0):
+        import numpy as np
+        n_done = sum(status == 'done' for status in self.status.values()) - n_resumed
+        n_failed = sum(status == 'failed' for status in self.status.values())
+        hours = wall_time / 3600
+        print(f"\nBatch summary: {n_done} subject(s) done, {n_failed} failed, {n_resumed} resumed "
+              f"in {wall_time / 60:.1f} min ({n_done / hours if hours > 0 else 0:.1f} subjects/hour)")
+        print(f"  {'stage':<12}{'runs':>6}{'p50 (s)':>10}{'p90 (s)':>10}{'max (s)':>10}")
+        for stage in STAGES:
+            durations = self.durations[stage]
+            if durations:
+                p50, p90 = np.percentile(durations, [50, 90])
+                print(f"  {stage:<12}{len(durations):>6}{p50:>10.1f}{p90:>10.1f}{max(durations):>10.1f}")
+        for warning in self.warnings:
+            print(f"  Warning: {warning}")
+        for subject_id, error in self.errors.items():
+            print(f"  FAILED {subject_id}: {error} (see {os.path.join(self.log_dir, subject_id + '.log')})")
+
+
+def main(args):
+    """Entry point of `lamar register-batch`, given the parsed arguments."""
+    subjects = load_manifest(args.manifest, output_dir=args.output_dir)
+    journal_path = args.journal or os.path.splitext(args.manifest)[0] + '_journal.jsonl'
+    log_dir = os.path.join(args.output_dir or os.path.dirname(os.path.abspath(args.manifest)), 'logs')
+    scheduler = BatchScheduler(subjects,
+                               cores=args.cores,
+                               memory=args.memory,
+                               synthseg_threads=args.synthseg_threads,
+                               ants_threads=args.ants_threads,
+                               registration_method=args.registration_method,
+                               journal=Journal(journal_path, restart=args.restart),
+                               log_dir=log_dir)
+    n_failed = scheduler.run()
+    if n_failed:
+        sys.exit(1)
@@ -0,0 +1,249 @@
+"""
+cache - Content-addressed cache of SynthSeg parcellations
+
+Part of the LaMAR processing pipeline.
+
+Sessions often register several modalities (dwi b0, func mean, FLAIR, T2w) to
+the same T1w image, which used to be re-parcellated for every registration.
+When LAMAR_CACHE_DIR is set, the parcellations produced by `lamar register`
+and `lamar generate-warpfield` are stored in that directory, keyed by a hash
+of the image voxel data and affine together with the SynthSeg configuration
+(version, robust/fast/parc flags, cropping). Renaming or copying an image
+therefore still hits the cache, while any change to its content or to the
+SynthSeg options misses it.
+
+Cache hits are hard-linked into the requested output path when possible (and
+copied otherwise). LaMAR breaks such links before writing a volume, so a later
+run cannot modify a cached entry through a linked output. The last use of an
+entry is recorded in a separate file (<key>.used) rather than in the
+modification time of the entry, which is shared with every linked output.
+
+The cache is bounded in size (LAMAR_CACHE_SIZE, default 10G): whenever an
+entry is added, the least recently used entries are evicted until the cache
+fits again.
+
+API Usage:
+---------
+lamar cache stats [--cache-dir <path>]
+lamar cache prune [--cache-dir <path>] [--max-size <size, e.g. 5G>] [--all]
+
+Python Usage:
+-----------
+>>> from lamar.scripts.cache import ParcellationCache
+>>> cache = ParcellationCache("/scratch/lamar_cache", max_size="20G")
+>>> key = cache.get_key("sub-001_T1w.nii.gz", {"robust": True, "parc": True})
+>>> if not cache.fetch(key, "sub-001_T1w_parc.nii.gz"):
+...     ...  # run SynthSeg, then
+...     cache.store(key, "sub-001_T1w_parc.nii.gz")
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+DEFAULT_MAX_SIZE = "10G"
+
+# SynthSeg options that change the parcellation, and thus belong in the cache key
+KEY_OPTIONS = ['robust', 'fast', 'parc', 'v1', 'crop', 'ct']
+
+
+def parse_size(size):
+    """Convert a size such as 500M, 10G or 1048576 to a number of bytes."""
+    if isinstance(size, (int, float)):
+        return int(size)
+    size = size.strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(n_bytes):
+    for unit in ['B', 'K', 'M', 'G']:
+        if n_bytes < 1024:
+            return f"{n_bytes:.1f}{unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f}T"
+
+
+def hash_image(path):
+    """Hash of the voxel data (after intensity scaling), shape and affine of an image, independent of its file name,
+    compression and header padding."""
+    import numpy as np
+    import nibabel as nib
+    image = nib.load(path)
+    data = np.ascontiguousarray(np.asanyarray(image.dataobj))
+    digest = hashlib.sha256()
+    digest.update(str((data.dtype.str, data.shape)).encode())
+    digest.update(np.asarray(image.affine, dtype='float64').tobytes())
+    digest.update(memoryview(data).cast('B'))
+    return digest.hexdigest()
+
+
+def get_synthseg_config(args):
+    """The part of a set of SynthSeg options (see synthseg.get_default_args) that determines its output."""
+    from lamar import __version__
+    config = {key: args.get(key) for key in KEY_OPTIONS}
+    if config['robust']:
+        config['fast'] = True
+    config['lamar_version'] = __version__
+    return config
+
+
+class ParcellationCache:
+    """Size-bounded, least-recently-used store of parcellations, addressed by image content and SynthSeg options."""
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = parse_size(max_size)
+
+    @classmethod
+    def from_env(cls):
+        """Cache configured by LAMAR_CACHE_DIR/LAMAR_CACHE_SIZE, or None if LAMAR_CACHE_DIR is not set."""
+        cache_dir = os.environ.get('LAMAR_CACHE_DIR')
+        if not cache_dir:
+            return None
+        return cls(cache_dir, os.environ.get('LAMAR_CACHE_SIZE', DEFAULT_MAX_SIZE))
+
+    def get_key(self, path_image, config):
+        digest = hashlib.sha256(hash_image(path_image).encode())
+        digest.update(json.dumps(config, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, 'parc', key[:2], key + '.nii.gz')
+
+    @staticmethod
+    def _sidecars(entry):
+        """Metadata and last use files of an entry."""
+        return [entry.replace('.nii.gz', '.json'), entry.replace('.nii.gz', '.used')]
+
+    def entries(self):
+        """List (path, size, last use time) of all entries."""
+        entries = []
+        parc_dir = os.path.join(self.cache_dir, 'parc')
+        if not os.path.isdir(parc_dir):
+            return entries
+        for sub_dir in os.listdir(parc_dir):
+            for name in os.listdir(os.path.join(parc_dir, sub_dir)):
+                if name.endswith('.nii.gz'):
+                    path = os.path.join(parc_dir, sub_dir, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:  # evicted by a concurrent run
+                        continue
+                    try:
+                        used = os.stat(self._sidecars(path)[1]).st_mtime
+                    except FileNotFoundError:  # never fetched
+                        used = stat.st_mtime
+                    entries.append((path, stat.st_size, max(used, stat.st_mtime)))
+        return entries
+
+    def fetch(self, key, path_output):
+        """Place the cached parcellation in path_output. Returns False on a cache miss."""
+        entry = self._entry(key)
+        if not os.path.isfile(entry):
+            return False
+        os.makedirs(os.path.dirname(os.path.abspath(path_output)), exist_ok=True)
+        if os.path.lexists(path_output):
+            os.remove(path_output)
+        try:
+            os.link(entry, path_output)
+        except OSError:  # different file system, or links not supported
+            shutil.copyfile(entry, path_output)
+        # mark as recently used, without touching the entry (and the outputs linked to it)
+        with open(self._sidecars(entry)[1], 'a'):
+            pass
+        os.utime(self._sidecars(entry)[1])
+        return True
+
+    def store(self, key, path_parc, metadata=None):
+        """Add a parcellation to the cache, then evict old entries if the cache got too big."""
+        entry = self._entry(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # copy then rename, so that concurrent runs never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry), suffix='.tmp')
+        os.close(fd)
+        shutil.copyfile(path_parc, tmp_path)
+        os.replace(tmp_path, entry)
+        if metadata is not None:
+            with open(self._sidecars(entry)[0], 'w') as f:
+                json.dump(metadata, f, indent=2)
+        self.prune()
+
+    def stats(self):
+        entries = self.entries()
+        return {'cache_dir': self.cache_dir,
+                'entries': len(entries),
+                'size': sum(size for _, size, _ in entries),
+                'max_size': self.max_size,
+                'oldest_use': min((used for _, _, used in entries), default=None),
+                'newest_use': max((used for _, _, used in entries), default=None)}
+
+    def prune(self, max_size=None):
+        """Evict the least recently used entries until the cache is smaller than max_size (default: the cache limit).
+        Returns the number of evicted entries."""
+        max_size = self.max_size if max_size is None else parse_size(max_size)
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total_size = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for path, size, _ in entries:
+            if total_size <= max_size:
+                break
+            for path_to_remove in [path, *self._sidecars(path)]:
+                if os.path.exists(path_to_remove):
+                    os.remove(path_to_remove)
+            total_size -= size
+            n_evicted += 1
+        return n_evicted
+
+
+def parcellate_with_cache(engine, images, parcs, stage_name="synthseg", cache=None):
+    """Parcellate images with the given pipeline engine, taking the parcellations from the cache when possible and
+    adding the new ones to it. Without a cache (LAMAR_CACHE_DIR unset), this simply calls engine.parcellate."""
+    cache = cache if cache is not None else ParcellationCache.from_env()
+    if cache is None:
+        return engine.parcellate(images, parcs, stage_name=stage_name)
+
+    from lamar.scripts.synthseg import get_default_args
+    config = get_synthseg_config(dict(get_default_args(), parc=True))
+    misses = []
+    for image, parc in zip(images, parcs):
+        key = cache.get_key(image, config)
+        if cache.fetch(key, parc):
+            print(f"Using cached parcellation of {image}")
+        else:
+            misses.append((image, parc, key))
+    if not misses:
+        return
+
+    engine.parcellate([miss[0] for miss in misses], [miss[1] for miss in misses], stage_name=stage_name)
+    for image, parc, key in misses:
+        cache.store(key, parc, metadata={'image': os.path.abspath(image), 'config': config,
+                                         'created': time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+
+def main(args):
+    """Entry point of `lamar cache`, given the parsed arguments."""
+    cache_dir = args.cache_dir or os.environ.get('LAMAR_CACHE_DIR')
+    if not cache_dir:
+        print("No cache directory: set LAMAR_CACHE_DIR or use --cache-dir")
+        return
+    cache = ParcellationCache(cache_dir, os.environ.get('LAMAR_CACHE_SIZE', DEFAULT_MAX_SIZE))
+
+    if args.action == "stats":
+        stats = cache.stats()
+        print(f"Cache directory: {stats['cache_dir']}")
+        print(f"Entries:         {stats['entries']}")
+        print(f"Size:            {format_size(stats['size'])} / {format_size(stats['max_size'])}")
+        if stats['entries']:
+            print(f"Least recent use: {time.ctime(stats['oldest_use'])}")
+            print(f"Most recent use:  {time.ctime(stats['newest_use'])}")
+    elif args.action == "prune":
+        max_size = 0 if args.all else args.max_size
+        n_evicted = cache.prune(max_size)
+        print(f"Evicted {n_evicted} entr{'y' if n_evicted == 1 else 'ies'}, "
+              f"cache size is now {format_size(cache.stats()['size'])}")
@@ -0,0 +1,144 @@
+"""
+checkpoint - Resumable LaMAR stages with content-based staleness detection
+
+Part of the LaMAR processing pipeline.
+
+Every stage of a LaMAR run (parcellation of each image, coregistration, Dice
+QC, application of the warp) writes a small JSON manifest next to its main
+output, e.g. sub-001_dwi_parc.nii.gz.lamar.json. The manifest records:
+- the SHA-256 of every input of the stage,
+- the parameters of the stage (SynthSeg options, registration method...) and
+  the LaMAR version,
+- the path and SHA-256 of every output.
+
+When a run is started again (e.g. after it died during SyN), a stage is skipped
+only if its manifest still matches: same input contents, same parameters, and
+outputs that are still there, unchanged. Since the outputs of a stage are the
+inputs of the next ones, a stage whose inputs changed is recomputed, and so is
+everything downstream of it whose inputs end up different. A stale
+parcellation is therefore never reused for a modified image.
+
+Files are only hashed again when their size or modification time differ from
+the ones recorded in the manifest.
+
+--force-stage <stage> recomputes a stage (synthseg, coregister, dice or
+apply-warp) whatever its manifest says, and --force-stage all recomputes every
+stage.
+
+Python Usage:
+-----------
+>>> from lamar.scripts.checkpoint import Checkpoints
+>>> checkpoints = Checkpoints(force_stages=["coregister"])
+>>> inputs, outputs = ["fixed_parc.nii.gz", "moving_parc.nii.gz"], ["reg_parc.nii.gz", "affine.mat"]
+>>> if not checkpoints.is_current("coregister", inputs, outputs, {"method": "SyNRA"}):
+...     ...  # run the stage, then
+...     checkpoints.record("coregister", inputs, outputs, {"method": "SyNRA"})
+"""
+
+import os
+import json
+import time
+import tempfile
+
+STAGES = ['synthseg', 'coregister', 'dice', 'apply-warp']
+
+MANIFEST_SUFFIX = '.lamar.json'
+
+
+def get_manifest_path(output):
+    """Manifest of the stage whose main output is the given file."""
+    return output + MANIFEST_SUFFIX
+
+
+class Checkpoints:
+    """Decide which stages of a run can be skipped, and record the manifests of the stages that ran."""
+
+    def __init__(self, force_stages=(), enabled=True):
+        self.force_stages = set(force_stages or ())
+        self.enabled = enabled
+        unknown = self.force_stages - set(STAGES) - {'all'}
+        if unknown:
+            raise ValueError(f"Unknown stage(s) for --force-stage: {', '.join(sorted(unknown))} "
+                             f"(choose from {', '.join(STAGES)} or all)")
+        self._known_files = {}  # path -> (size, mtime_ns, sha256) of files hashed by this run or by a manifest
+
+    def _file_entry(self, path):
+        """Path, size, modification time and SHA-256 of a file, reusing a known hash if the file didn't change."""
+        from lamar.scripts.report import hash_file
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self._known_files.get(path)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            sha256 = known[2]
+        else:
+            sha256 = hash_file(path)
+            self._known_files[path] = (stat.st_size, stat.st_mtime_ns, sha256)
+        return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+
+    def _read_manifest(self, output):
+        try:
+            with open(get_manifest_path(output)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        for entry in manifest.get('inputs', []) + manifest.get('outputs', []):
+            self._known_files.setdefault(entry['path'], (entry['size'], entry['mtime_ns'], entry['sha256']))
+        return manifest
+
+    @staticmethod
+    def _normalise(params):
+        from lamar import __version__
+        # same representation as once written to and read back from the manifest (e.g. tuples become lists)
+        return json.loads(json.dumps(dict(params or {}, lamar_version=__version__), sort_keys=True))
+
+    def is_current(self, stage, inputs, outputs, params=None, label=""):
+        """Whether a stage can be skipped: its manifest matches the contents of its inputs, its parameters, and the
+        outputs currently on disk. outputs[0] is the main output, next to which the manifest is kept."""
+        if not self.enabled or stage in self.force_stages or 'all' in self.force_stages:
+            return False
+        manifest = self._read_manifest(outputs[0])
+        if manifest is None or manifest.get('stage') != stage or manifest.get('params') != self._normalise(params):
+            return False
+
+        # inputs are compared by content only, so that moving or renaming an unchanged input keeps the outputs valid
+        if len(manifest['inputs']) != len(inputs):
+            return False
+        for entry, path in zip(manifest['inputs'], inputs):
+            if not os.path.isfile(path) or self._file_entry(path)['sha256'] != entry['sha256']:
+                return False
+
+        # outputs must be where they are expected, unchanged since the stage wrote them
+        if [entry['path'] for entry in manifest['outputs']] != [os.path.abspath(path) for path in outputs]:
+            return False
+        for entry, path in zip(manifest['outputs'], outputs):
+            if not os.path.isfile(path) or self._file_entry(path)['sha256'] != entry['sha256']:
+                return False
+
+        print(f"Skipping {stage}{label}: outputs are up to date ({get_manifest_path(outputs[0])})")
+        return True
+
+    def record(self, stage, inputs, outputs, params=None):
+        """Write the manifest of a stage that just completed."""
+        if not self.enabled:
+            return
+        # drop what was known about the outputs before the stage rewrote them
+        for path in outputs:
+            self._known_files.pop(os.path.abspath(path), None)
+        manifest = {'stage': stage,
+                    'params': self._normalise(params),
+                    'inputs': [self._file_entry(path) for path in inputs],
+                    'outputs': [self._file_entry(path) for path in outputs],
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        manifest_path = get_manifest_path(outputs[0])
+        # write then rename, so that a crash never leaves a truncated manifest behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    def invalidate(self, outputs):
+        """Remove the manifest of a stage that is about to rewrite its outputs, so that a crash in the middle of the
+        stage can't leave a manifest that matches partially rewritten outputs."""
+        manifest_path = get_manifest_path(outputs[0])
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
@@ -44,12 +44,28 @@ Python Usage:
 """
 import ants
 import argparse
+import os
+import re
 import shutil
 import sys
+import tempfile
+import threading
+from contextlib import nullcontext
 from colorama import init, Fore, Style
 
 init()
 
+# Names of the successive stages of the ANTs registration types, used to label their timings
+REGISTRATION_STAGES = {
+    'SyNRA': ['rigid', 'affine', 'SyN'],
+    'SyN': ['affine', 'SyN'],
+    'SyNOnly': ['SyN'],
+    'ElasticSyN': ['affine', 'SyN'],
+    'Rigid': ['rigid'],
+    'Affine': ['affine'],
+    'TRSAA': ['translation', 'rigid', 'similarity', 'affine', 'affine'],
+}
+
 
 def print_help():
     """Print a help message with examples."""
@@ -108,7 +124,8 @@ def ants_linear_nonlinear_registration(
         affine_file=None,
         rev_warp_file=None,
         rev_affine_file=None,
-        registration_method="SyNRA"
+        registration_method="SyNRA",
+        timer=None
 ):
     """Perform linear (rigid + affine) and nonlinear registration using ANTsPy.
 
@@ -118,8 +135,10 @@ def ants_linear_nonlinear_registration(
     files can optionally be saved as well.
 
     Args:
-        fixed_file (str): Path to the fixed/reference image.
-        moving_file (str): Path to the moving image that will be registered.
+        fixed_file (str or ants.ANTsImage): Path to the fixed/reference image, or the
+            image itself if it has already been loaded.
+        moving_file (str or ants.ANTsImage): Path to the moving image that will be
+            registered, or the image itself if it has already been loaded.
         out_file (str, optional): Path where the registered image will be saved.
             Defaults to "registered_image.nii".
         warp_file (str, optional): Path to save the forward warp field.
@@ -130,40 +149,103 @@ def ants_linear_nonlinear_registration(
             Defaults to None.
         rev_affine_file (str, optional): Path to save the reverse affine transform.
             Defaults to None.
+        timer (pipeline.StageTimer, optional): Detailed timer of the running stage, in
+            which the registration (and each of its ANTs stages, e.g. rigid, affine and
+            SyN), the resampling of the moving image and the writing of the outputs are
+            recorded as sub-stages. Defaults to None.
 
     Returns:
-        None: The function saves the registered image and transform files to disk
-        but does not return any values.
+        tuple: The registered image (ants.ANTsImage) and the dictionary returned by
+        ants.registration. Both are also saved to disk as described above.
     """
-    # Load images
-    fixed = ants.image_read(fixed_file)
-    moving = ants.image_read(moving_file)
+    # Load images, unless they were passed in memory
+    fixed = ants.image_read(fixed_file) if isinstance(fixed_file, str) else fixed_file
+    moving = ants.image_read(moving_file) if isinstance(moving_file, str) else moving_file
+
+    def substage(name):
+        return timer.stage(name) if timer is not None else nullcontext()
 
     # 'SyN' transform includes both linear and nonlinear registration.
-    transforms = ants.registration(fixed=fixed, moving=moving, type_of_transform=registration_method)
+    with substage("registration"):
+        if timer is not None:
+            transforms, stage_times = registration_with_stage_times(fixed, moving, registration_method)
+        else:
+            transforms = ants.registration(fixed=fixed, moving=moving, type_of_transform=registration_method)
+    if timer is not None:
+        for stage_name, duration in stage_times:
+            timer.add_substage(f"registration: {stage_name}", duration)
 
     # The result of the registration is a dictionary containing, among other keys:
-    registered = ants.apply_transforms(fixed=fixed, moving=moving, transformlist=transforms["fwdtransforms"],
-                                       interpolator="nearestNeighbor")
-
-    # Save the registered moving image
-    ants.image_write(registered, out_file)
-    print(f"Registration complete. Saved registered image as {out_file}")
-
-    # If specified, save the transform files
-    # Typically, transforms["fwdtransforms"][0] is the warp field, and [1] is the affine.
-    if warp_file:
-        shutil.copyfile(transforms["fwdtransforms"][0], warp_file)
-        print(f"Saved warp field as {warp_file}")
-    if affine_file:
-        shutil.copyfile(transforms["fwdtransforms"][1], affine_file)
-        print(f"Saved affine transform as {affine_file}")
-    if rev_warp_file:
-        shutil.copyfile(transforms["invtransforms"][1], rev_warp_file)
-        print(f"Saved reverse warp field as {rev_warp_file}")
-    if rev_affine_file:
-        shutil.copyfile(transforms["invtransforms"][0], rev_affine_file)
-        print(f"Saved reverse affine transform as {rev_affine_file}")
+    with substage("apply transforms"):
+        registered = ants.apply_transforms(fixed=fixed, moving=moving, transformlist=transforms["fwdtransforms"],
+                                           interpolator="nearestNeighbor")
+
+    with substage("write outputs"):
+        # Save the registered moving image
+        ants.image_write(registered, out_file)
+        print(f"Registration complete. Saved registered image as {out_file}")
+
+        # If specified, save the transform files
+        # Typically, transforms["fwdtransforms"][0] is the warp field, and [1] is the affine.
+        if warp_file:
+            shutil.copyfile(transforms["fwdtransforms"][0], warp_file)
+            print(f"Saved warp field as {warp_file}")
+        if affine_file:
+            shutil.copyfile(transforms["fwdtransforms"][1], affine_file)
+            print(f"Saved affine transform as {affine_file}")
+        if rev_warp_file:
+            shutil.copyfile(transforms["invtransforms"][1], rev_warp_file)
+            print(f"Saved reverse warp field as {rev_warp_file}")
+        if rev_affine_file:
+            shutil.copyfile(transforms["invtransforms"][0], rev_affine_file)
+            print(f"Saved reverse affine transform as {rev_affine_file}")
+
+    return registered, transforms
+
+
+def _can_capture_stdout():
+    """Whether file descriptor 1 can be redirected without affecting anything else: sys.stdout writes to it, and the
+    current thread is the only one running."""
+    try:
+        if sys.stdout.fileno() != 1:
+            return False
+    except (AttributeError, ValueError, OSError):  # not backed by a file descriptor, e.g. io.StringIO
+        return False
+    return threading.active_count() == 1
+
+
+def registration_with_stage_times(fixed, moving, registration_method="SyNRA"):
+    """Run ants.registration, and get the wall time of each of its stages (e.g. rigid, affine and SyN for SyNRA).
+
+    ANTs only reports these timings in its verbose output, which is written by the C++ library straight to the
+    standard output file descriptor. It is captured in a temporary file and parsed, instead of being printed.
+    As redirecting file descriptor 1 affects the whole process, this is only done when sys.stdout writes to it and no
+    other thread is running. Otherwise (e.g. when stdout is redirected to a log, or stages run in threads), the
+    registration runs without verbose output and no stage times are returned, leaving the total registration time.
+
+    Returns:
+        tuple: The dictionary returned by ants.registration, and a list of (stage name, seconds).
+    """
+    if not _can_capture_stdout():
+        return ants.registration(fixed=fixed, moving=moving, type_of_transform=registration_method), []
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    with tempfile.TemporaryFile(mode="w+") as log:
+        os.dup2(log.fileno(), 1)
+        try:
+            transforms = ants.registration(fixed=fixed, moving=moving, type_of_transform=registration_method,
+                                           verbose=True)
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved_stdout, 1)
+            os.close(saved_stdout)
+        log.seek(0)
+        times = [float(t) for t in re.findall(r"Elapsed time \(stage \d+\): ([0-9.eE+-]+)", log.read())]
+
+    names = REGISTRATION_STAGES.get(registration_method, [])
+    if len(names) != len(times):
+        names = [f"stage {n}" for n in range(len(times))]
+    return transforms, list(zip(names, times))
 
 
 def main():
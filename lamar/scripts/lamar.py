@@ -12,37 +12,404 @@ parcellation to enable registration between images of different contrasts:
 This approach is useful for registering images with very different contrasts
 (e.g., T1w to T2w, FLAIR to T1w, etc.) where direct intensity-based
 registration might fail.
+
+Several moving images (e.g. the dwi b0, func, FLAIR and T2w of a session) can
+be registered to the same fixed image in one call. The fixed image is then
+parcellated and read only once, and the registrations of the moving images can
+run in parallel. Their output paths are given either as one path per moving
+image, or as a single template in which {name} is replaced by the name of the
+moving image (without directory and extension), e.g.
+--output "out/{name}_in_T1w.nii.gz".
+
+Every stage writes a manifest of its inputs, parameters and outputs next to
+its main output (see checkpoint.py). Running the same command again, e.g.
+after a run died during SyN, skips the stages whose manifest still matches and
+recomputes the others and everything downstream of them. --force-stage
+recomputes a stage regardless.
+
+--threads N|auto replaces --synthseg-threads and --ants-threads by a single
+core budget, split between the stages by threads.plan_threads.
 """
 
 import os
 import argparse
+import multiprocessing
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from lamar.scripts.pipeline import get_engine, get_image_name, InProcessEngine, StageTimer
+from lamar.scripts.cache import get_synthseg_config, parcellate_with_cache
+from lamar.scripts.checkpoint import Checkpoints, STAGES
+from lamar.scripts.threads import parse_threads
+
+# Arguments of lamareg that take one path per moving image, with their command-line flag
+PER_MOVING_ARGS = {'output_image': '--output', 'input_parc': '--moving-parc', 'output_parc': '--registered-parc',
+                   'affine_file': '--affine', 'warp_file': '--warpfield', 'inverse_warp_file': '--inverse-warpfield',
+                   'inverse_affine_file': '--inverse-affine', 'qc_csv': '--qc-csv'}
+
+
+def expand_moving_paths(moving_images, paths, arg_name, shared=False):
+    """
+    Return one path per moving image, given either a list with one path per moving image or a single path in which
+    {name} is replaced by the name of each moving image. Unless shared is set (for inputs such as the transforms of
+    apply-warpfield), a single path without {name} is only accepted for a single moving image.
+    """
+    if paths is None:
+        return [None] * len(moving_images)
+    if isinstance(paths, (list, tuple)):
+        if len(paths) == 1:
+            paths = paths[0]
+        elif len(paths) != len(moving_images):
+            raise ValueError(f"Got {len(moving_images)} moving image(s) but {len(paths)} path(s) for {arg_name}")
+        else:
+            return list(paths)
+    if '{name}' in paths:
+        return [paths.replace('{name}', get_image_name(moving)) for moving in moving_images]
+    if len(moving_images) > 1 and not shared:
+        raise ValueError(f"{arg_name} must contain {{name}}, or give one path per moving image, "
+                         f"when registering {len(moving_images)} moving images")
+    return [paths] * len(moving_images)
+
+
+def register_moving(engine, registration, reference_image, reference_parc, registration_method="SyNRA",
+                    generate_warpfield=False, apply_warpfield=False, label="", checkpoints=None):
+    """
+    Run the stages that follow the parcellation for one moving image: coregistration of its parcellation to the
+    fixed parcellation, Dice QC, and application of the transforms to the moving image.
+
+    registration holds the paths of one moving image, keyed as the PER_MOVING_ARGS of lamareg plus 'moving'.
+    label is appended to the printed steps and stage names to tell the moving images apart.
+    Stages whose manifest matches (see checkpoint.Checkpoints) are skipped.
+    """
+    checkpoints = checkpoints if checkpoints is not None else Checkpoints(enabled=False)
+    input_image = registration['moving']
+    output_image = registration['output_image']
+    affine_file = registration['affine_file']
+    warp_file = registration['warp_file']
+    output_parc = registration['output_parc']
+
+    # WORKFLOW 1 & 2: Full registration or generate warpfield
+    if not apply_warpfield:
+        # Step 2: Register parcellations using coregister
+        print(f"\n--- Step 2: Coregistering parcellated images{label} ---")
+        coregister_inputs = [reference_parc, registration['input_parc']]
+        coregister_outputs = [path for path in [output_parc, affine_file, warp_file, registration['inverse_warp_file'],
+                                                registration['inverse_affine_file']] if path is not None]
+        coregister_params = {'registration_method': registration_method}
+        if not checkpoints.is_current('coregister', coregister_inputs, coregister_outputs, coregister_params, label):
+            checkpoints.invalidate(coregister_outputs)
+            engine.coregister(reference_parc, registration['input_parc'], output_parc,
+                              registration_method=registration_method,
+                              affine_file=affine_file,
+                              warp_file=warp_file,
+                              inverse_warp_file=registration['inverse_warp_file'],
+                              inverse_affine_file=registration['inverse_affine_file'],
+                              stage_name="coregister" + label)
+            checkpoints.record('coregister', coregister_inputs, coregister_outputs, coregister_params)
+
+        # Run Dice evaluation after coregistration
+        if output_parc is not None and reference_parc is not None:
+            # If qc_csv is not provided, generate a default path based on output_parc
+            qc_csv = registration['qc_csv']
+            dice_output = qc_csv if qc_csv else os.path.splitext(output_parc)[0] + "_dice_scores.csv"
+
+            print(f"\n--- Step 2.1: Calculating Dice scores to evaluate registration quality{label} ---")
+            try:
+                if not checkpoints.is_current('dice', [reference_parc, output_parc], [dice_output], label=label):
+                    checkpoints.invalidate([dice_output])
+                    engine.dice(reference_parc, output_parc, dice_output, stage_name="dice" + label)
+                    checkpoints.record('dice', [reference_parc, output_parc], [dice_output])
+                print(f"Quality control metrics saved to: {dice_output}")
+            except FileNotFoundError as e:
+                print(f"Warning: Could not calculate Dice scores - file not found: {e}", file=sys.stderr)
+            except PermissionError as e:
+                print(f"Warning: Could not calculate Dice scores - permission error: {e}", file=sys.stderr)
+            except ImportError as e:
+                print(f"Warning: Could not calculate Dice scores - dice_compare module not found", file=sys.stderr)
+            except Exception as e:
+                print(f"Warning: Could not calculate Dice scores: {e}", file=sys.stderr)
+
+    # WORKFLOW 1 & 3: Apply transformation to the original input image
+    if not generate_warpfield and output_image is not None:
+        print(f"\n--- Step 3: Applying transformation to original input image{label} ---")
+        apply_inputs = [path for path in [input_image, reference_image, affine_file, warp_file] if path is not None]
+        if not checkpoints.is_current('apply-warp', apply_inputs, [output_image], label=label):
+            checkpoints.invalidate([output_image])
+            engine.apply_warp(input_image, reference_image, output_image,
+                              affine_file=affine_file,
+                              warp_file=warp_file,
+                              stage_name="apply-warp" + label)
+            checkpoints.record('apply-warp', apply_inputs, [output_image])
+
+        print(f"\nSuccess! Registered image saved to: {output_image}")
+    elif generate_warpfield:
+        success_msg = "\nSuccess! "
+        if warp_file:
+            success_msg += f"Warp field generated at: {warp_file}"
+        if affine_file:
+            success_msg += f"\nAffine transformation saved at: {affine_file}"
+        print(success_msg)
+
+
+# Engine of a worker process registering moving images in parallel, holding the fixed images it has already read
+_worker_engine = None
+
+
+def _init_registration_worker(ants_threads, fixed_images, detailed):
+    global _worker_engine
+    _worker_engine = get_engine(ants_threads=ants_threads, timer=StageTimer(detailed=detailed))
+    for path in fixed_images:
+        _worker_engine.read_image(path)
+
+
+def _register_in_worker(registration, *args):
+    _worker_engine.timer.stages.clear()
+    _worker_engine.timer.records.clear()
+    try:
+        register_moving(_worker_engine, registration, *args)
+    finally:
+        # keep the fixed images for the next moving image, but not the moving ones
+        for key in ['moving', 'input_parc', 'output_parc']:
+            if registration.get(key):
+                _worker_engine.forget_image(registration[key])
+    return list(_worker_engine.timer.stages), list(_worker_engine.timer.records)
+
+
+def register_all_moving(engine, registrations, reference_image, reference_parc, registration_method="SyNRA",
+                        generate_warpfield=False, apply_warpfield=False, parallel=1, checkpoints=None):
+    """
+    Run register_moving for every moving image, up to `parallel` of them at the same time.
+
+    In-process registrations run in worker processes, each reading the fixed images once and keeping them for all
+    the moving images it registers. Subprocess registrations run in threads, as the work happens in the children.
+    """
+    many = len(registrations) > 1
+    labels = [f" [{get_image_name(registration['moving'])}]" if many else "" for registration in registrations]
+    args = [reference_image, reference_parc, registration_method, generate_warpfield, apply_warpfield]
+    n_workers = min(parallel, len(registrations))
+    if n_workers <= 1:
+        for registration, label in zip(registrations, labels):
+            register_moving(engine, registration, *args, label, checkpoints)
+        return
+
+    print(f"\nRegistering {len(registrations)} moving images, {n_workers} at a time")
+    with engine.timer.stage(f"registrations ({len(registrations)} moving, {n_workers} in parallel)"):
+        if isinstance(engine, InProcessEngine):
+            fixed_images = [reference_image] if not generate_warpfield else []
+            if not apply_warpfield:
+                fixed_images.append(reference_parc)
+            # spawned workers don't inherit TensorFlow/ITK thread pools from this process
+            executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=_init_registration_worker,
+                                           initargs=(engine.ants_threads, fixed_images, engine.timer.detailed))
+            submit = lambda registration, label: executor.submit(_register_in_worker, registration, *args, label,
+                                                                     checkpoints)
+        else:
+            executor = ThreadPoolExecutor(max_workers=n_workers)
+
+            def run(registration, label):
+                thread_engine = get_engine(use_subprocess=True, ants_threads=engine.ants_threads,
+                                           timer=StageTimer(detailed=engine.timer.detailed))
+                register_moving(thread_engine, registration, *args, label, checkpoints)
+                return thread_engine.timer.stages, thread_engine.timer.records
+            submit = lambda registration, label: executor.submit(run, registration, label)
+
+        with executor:
+            futures = [submit(registration, label) for registration, label in zip(registrations, labels)]
+            errors = []
+            for registration, future in zip(registrations, futures):
+                try:
+                    engine.timer.add_parallel(*future.result())
+                except Exception as e:
+                    print(f"Error while registering {registration['moving']}: {e}", file=sys.stderr)
+                    errors.append(e)
+    if errors:
+        raise errors[0]
 
 
 def lamareg(input_image, reference_image, output_image=None, input_parc=None,
             reference_parc=None, output_parc=None, generate_warpfield=False, apply_warpfield=False,
             registration_method="SyNRA", affine_file=None, warp_file=None,
             inverse_warp_file=None, inverse_affine_file=None, 
-            synthseg_threads=1, ants_threads=1, qc_csv=None):
+            synthseg_threads=1, ants_threads=1, qc_csv=None, use_subprocess=False, parallel=1, report=None,
+            force_stages=None, threads=None):
     """
     Perform contrast-agnostic registration using SynthSeg parcellation.
+
+    By default every stage runs in the current process, so TensorFlow and ANTsPy
+    are only imported once. Set use_subprocess to run each stage in its own
+    `lamar` subprocess instead.
+
+    input_image can be a list of moving images, all registered to reference_image.
+    The per-moving-image paths (output_image, input_parc, output_parc, transforms
+    and qc_csv) are then lists with one path per moving image, or templates
+    containing {name}. The fixed image is parcellated once, and up to `parallel`
+    moving images are registered at the same time.
+
+    If report is a path, a JSON report of the wall time, CPU time and peak memory
+    of every stage and sub-stage, with the inputs (shapes and hashes) and thread
+    settings of the run, is written to it (see report.py).
+
+    Stages whose outputs are up to date with their inputs and parameters (as
+    recorded in the manifests written next to their outputs, see checkpoint.py)
+    are skipped. force_stages lists stages to recompute anyway (synthseg,
+    coregister, dice, apply-warp, or all).
+
+    threads is a core budget (a number, or 'auto' for all the available cores)
+    that overrides synthseg_threads and ants_threads: SynthSeg gets all of it,
+    and it is shared by the registrations running in parallel.
     """
     # Validate arguments based on the selected workflow
     if generate_warpfield and apply_warpfield:
         raise ValueError("Cannot use both --generate-warpfield and --apply-warpfield at the same time")
-    
-    # Validate input files exist
-    for input_file in [f for f in [input_image, reference_image] if f is not None]:
-        if not os.path.isfile(input_file):
-            raise FileNotFoundError(f"Input file not found: {input_file}")
-    
+
+    moving_images = [input_image] if input_image is None or isinstance(input_image, str) else list(input_image)
+    if not moving_images:
+        raise ValueError("--moving is required")
+    paths = dict(output_image=output_image, input_parc=input_parc, output_parc=output_parc,
+                 affine_file=affine_file, warp_file=warp_file, inverse_warp_file=inverse_warp_file,
+                 inverse_affine_file=inverse_affine_file, qc_csv=qc_csv)
+    # apply-warpfield can apply the same transforms to all the moving images
+    shared = ['affine_file', 'warp_file'] if apply_warpfield else []
+    paths = {arg: expand_moving_paths(moving_images, paths[arg], flag, shared=arg in shared)
+             for arg, flag in PER_MOVING_ARGS.items()}
+    registrations = [dict(moving=moving, **{arg: paths[arg][n] for arg in PER_MOVING_ARGS})
+                     for n, moving in enumerate(moving_images)]
+    for arg, flag in PER_MOVING_ARGS.items():
+        if arg not in shared and len(moving_images) > 1:
+            given = [path for path in paths[arg] if path is not None]
+            if len(set(given)) != len(given):
+                raise ValueError(f"The moving images must have different {flag} paths (moving images with the same "
+                                 f"name in different directories need one path per image)")
+
+    thread_plan = None
+    if threads is not None:
+        from lamar.scripts.threads import plan_threads
+        thread_plan = plan_threads(threads, parallel=min(parallel, len(moving_images)),
+                                   n_images=len(moving_images) + 1)
+        synthseg_threads, ants_threads = thread_plan['synthseg_threads'], thread_plan['ants_threads']
+
     # Validate thread counts
     if synthseg_threads < 1:
         raise ValueError(f"Invalid thread count for SynthSeg: {synthseg_threads}. Must be >= 1")
     if ants_threads < 1:
         raise ValueError(f"Invalid thread count for ANTs: {ants_threads}. Must be >= 1")
-        
+    if parallel < 1:
+        raise ValueError(f"Invalid number of parallel registrations: {parallel}. Must be >= 1")
+    checkpoints = Checkpoints(force_stages)
+
+    for registration in registrations:
+        _validate_registration(registration, reference_image, reference_parc, generate_warpfield, apply_warpfield)
+
+    # Create directories for all output files
+    output_paths = [reference_parc] + [registration[arg] for registration in registrations for arg in PER_MOVING_ARGS
+                                       if arg not in shared]
+    for file_path in output_paths:
+        if file_path is not None:
+            output_dir = os.path.dirname(file_path)
+            if output_dir:  # Only try to create if there's a directory part
+                try:
+                    os.makedirs(output_dir, exist_ok=True)
+                except PermissionError:
+                    raise PermissionError(f"Cannot create output directory: {output_dir}. Check permissions.")
+
+    for moving in moving_images:
+        print(f"Processing input image: {moving}")
+    print(f"Reference image: {reference_image}")
+    if thread_plan is not None:
+        print(f"Core budget: {thread_plan['cores']} (requested: {thread_plan['requested']}, "
+              f"available: {thread_plan['cpu_budget']['available_cores']})")
+    print(f"Using {synthseg_threads} thread(s) for SynthSeg and {ants_threads} thread(s) for ANTs")
+
+    # Print warnings for transform files that won't be saved
+    if not apply_warpfield:
+        if affine_file is None:
+            print("Warning: No affine transform file path provided - affine transform will not be saved")
+        if warp_file is None:
+            print("Warning: No warp field file path provided - warp field will not be saved")
+        if inverse_warp_file is None:
+            print("Warning: No inverse warp field file path provided - inverse warp field will not be saved")
+        if inverse_affine_file is None:
+            print("Warning: No inverse affine transform file path provided - inverse affine transform will not be saved")
+
+    # Stages run in this process unless subprocess isolation was requested
+    engine = get_engine(use_subprocess=use_subprocess,
+                        synthseg_threads=synthseg_threads,
+                        ants_threads=ants_threads,
+                        timer=StageTimer(detailed=report is not None))
+
+    status = 'failed'
+    try:
+        if not apply_warpfield:
+            # Step 1: Generate parcellations of the moving and reference images with SynthSeg. All images go through
+            # the same network, which is only built once, and the pre/postprocessing of one image overlaps with
+            # inference on the next. The reference image is only parcellated once, whatever the number of moving images.
+            print("\n--- Step 1: Generating parcellations for input and reference images ---")
+            # Parcellations that are up to date with their image are kept, and parcellations found in the cache
+            # (LAMAR_CACHE_DIR) are reused instead.
+            from lamar.scripts.synthseg import get_default_args
+            synthseg_config = get_synthseg_config(dict(get_default_args(), parc=True))
+            pending = [(image, parc) for image, parc in zip(moving_images + [reference_image],
+                                                            paths['input_parc'] + [reference_parc])
+                       if not checkpoints.is_current('synthseg', [image], [parc], synthseg_config,
+                                                     f" [{get_image_name(image)}]")]
+            if pending:
+                n_moving = len(pending) - (pending[-1][1] == reference_parc)
+                names = ["moving" if len(moving_images) == 1 else f"{n_moving} moving"] if n_moving else []
+                names += ["fixed"] if n_moving < len(pending) else []
+                stage_name = f"synthseg ({' + '.join(names)})"
+                for image, parc in pending:
+                    checkpoints.invalidate([parc])
+                parcellate_with_cache(engine, [image for image, parc in pending], [parc for image, parc in pending],
+                                      stage_name=stage_name)
+                for image, parc in pending:
+                    checkpoints.record('synthseg', [image], [parc], synthseg_config)
+
+        # Steps 2 and 3, for every moving image
+        register_all_moving(engine, registrations, reference_image, reference_parc,
+                            registration_method=registration_method,
+                            generate_warpfield=generate_warpfield,
+                            apply_warpfield=apply_warpfield,
+                            parallel=parallel,
+                            checkpoints=checkpoints)
+        status = 'ok'
+
+    except subprocess.CalledProcessError as e:
+        print(f"Error during processing: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        engine.timer.print_summary()
+        if report is not None:
+            from lamar.scripts.report import write_report, get_thread_settings
+            inputs = moving_images + [reference_image]
+            if apply_warpfield:
+                inputs += sorted(set(paths['affine_file'] + paths['warp_file']))
+            workflow = 'apply-warpfield' if apply_warpfield else 'generate-warpfield' if generate_warpfield \
+                else 'register'
+            write_report(report, engine.timer, inputs=inputs, status=status,
+                         settings=dict(get_thread_settings(synthseg_threads=synthseg_threads,
+                                                           ants_threads=ants_threads, parallel=parallel),
+                                       workflow=workflow, registration_method=registration_method,
+                                       subprocess=use_subprocess, force_stages=sorted(checkpoints.force_stages),
+                                       thread_plan=thread_plan))
+
+
+def _validate_registration(registration, reference_image, reference_parc, generate_warpfield, apply_warpfield):
+    """Check the paths of the registration of one moving image, see lamareg."""
+    input_image = registration['moving']
+    output_image = registration['output_image']
+    input_parc = registration['input_parc']
+    output_parc = registration['output_parc']
+    affine_file = registration['affine_file']
+    warp_file = registration['warp_file']
+    qc_csv = registration['qc_csv']
+
+    # Validate input files exist
+    for input_file in [f for f in [input_image, reference_image] if f is not None]:
+        if not os.path.isfile(input_file):
+            raise FileNotFoundError(f"Input file not found: {input_file}")
+
     # Workflow-specific validation
     if not apply_warpfield:
         # Registration or Generate-warpfield workflow
@@ -60,16 +427,6 @@ def lamareg(input_image, reference_image, output_image=None, input_parc=None,
         # For normal registration (not generate-warpfield), output image is required
         if not generate_warpfield and output_image is None:
             raise ValueError("--output is required for registration")
-            
-        # If generating warpfield, warn if transform files not specified
-        if affine_file is None:
-            print("Warning: No affine transform file path provided - affine transform will not be saved")
-        if warp_file is None:
-            print("Warning: No warp field file path provided - warp field will not be saved")
-        if inverse_warp_file is None:
-            print("Warning: No inverse warp field file path provided - inverse warp field will not be saved")
-        if inverse_affine_file is None:
-            print("Warning: No inverse affine transform file path provided - inverse affine transform will not be saved")
     else:
         # Apply-warpfield workflow
         if input_image is None:
@@ -109,163 +466,35 @@ def lamareg(input_image, reference_image, output_image=None, input_parc=None,
                     except Exception as e:
                         raise PermissionError(f"Cannot create QC CSV directory: {qc_dir}. Error: {e}")
 
-    # Create directories for all output files
-    for file_path in [output_image, input_parc, reference_parc, output_parc, 
-                     affine_file, warp_file, inverse_warp_file, inverse_affine_file, qc_csv]:
-        if file_path is not None:
-            output_dir = os.path.dirname(file_path)
-            if output_dir:  # Only try to create if there's a directory part
-                try:
-                    os.makedirs(output_dir, exist_ok=True)
-                except PermissionError:
-                    raise PermissionError(f"Cannot create output directory: {output_dir}. Check permissions.")
-                
-    print(f"Processing input image: {input_image}")
-    print(f"Reference image: {reference_image}")
-    print(f"Using {synthseg_threads} thread(s) for SynthSeg and {ants_threads} thread(s) for ANTs")
-
-    # Create environment with suppressed TensorFlow warnings
-    env = os.environ.copy()
-    env['TF_CPP_MIN_LOG_LEVEL'] = '3'  # 0=ALL, 1=INFO, 2=WARNING, 3=ERROR
-    env['PYTHONWARNINGS'] = 'ignore'
-    
-    # Set ANTs/ITK thread count
-    env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(ants_threads)
-    env['OMP_NUM_THREADS'] = str(ants_threads)  # OpenMP threads for ANTs
-    
-    # Print warnings for transform files that won't be saved
-    if not apply_warpfield:
-        if affine_file is None:
-            print("Warning: No affine transform file path provided - affine transform will not be saved")
-        if warp_file is None:
-            print("Warning: No warp field file path provided - warp field will not be saved")
-        if inverse_warp_file is None:
-            print("Warning: No inverse warp field file path provided - inverse warp field will not be saved")
-        if inverse_affine_file is None:
-            print("Warning: No inverse affine transform file path provided - inverse affine transform will not be saved")
-
-    try:
-        # WORKFLOW 1 & 2: Full registration or generate warpfield
-        if not apply_warpfield:
-            # Step 1: Generate parcellations with SynthSeg if needed
-            if input_image is not None:
-                print("\n--- Step 1.1: Generating parcellation for input image ---")
-                subprocess.run([
-                    "lamar", "synthseg",
-                    "--i", input_image,
-                    "--o", input_parc,
-                    "--parc",
-                    "--cpu",
-                    "--threads", str(synthseg_threads)  # Use SynthSeg threads
-                ], check=True, env=env)
-                
-            if reference_image is not None:
-                print("\n--- Step 1.2: Generating parcellation for reference image ---")
-                subprocess.run([
-                    "lamar", "synthseg",
-                    "--i", reference_image,
-                    "--o", reference_parc,
-                    "--parc",
-                    "--cpu",
-                    "--threads", str(synthseg_threads)  # Use SynthSeg threads
-                ], check=True, env=env)
-
-            # Step 2: Register parcellations using coregister
-            print("\n--- Step 2: Coregistering parcellated images ---")
-            cmd = [
-                "lamar", "coregister",
-                "--fixed-file", reference_parc,
-                "--moving-file", input_parc,
-                "--output", output_parc,
-                "--registration-method", registration_method,
-            ]
-            
-            # Only include transform file flags if paths were provided
-            if affine_file:
-                cmd.extend(["--affine-file", affine_file])
-            
-            if warp_file:
-                cmd.extend(["--warp-file", warp_file])
-            
-            if inverse_warp_file:
-                cmd.extend(["--rev-warp-file", inverse_warp_file])
-                
-            if inverse_affine_file:
-                cmd.extend(["--rev-affine-file", inverse_affine_file])
-                
-            subprocess.run(cmd, check=True, env=env)
-            
-            # Run Dice evaluation after coregistration
-            if output_parc is not None and reference_parc is not None:
-                # If qc_csv is not provided, generate a default path based on output_parc
-                dice_output = qc_csv if qc_csv else os.path.splitext(output_parc)[0] + "_dice_scores.csv"
-                
-                print("\n--- Step 2.1: Calculating Dice scores to evaluate registration quality ---")
-                try:
-                    from lamar.scripts.dice_compare import compare_parcellations_dice
-                    compare_parcellations_dice(reference_parc, output_parc, dice_output)
-                    print(f"Quality control metrics saved to: {dice_output}")
-                except FileNotFoundError as e:
-                    print(f"Warning: Could not calculate Dice scores - file not found: {e}", file=sys.stderr)
-                except PermissionError as e:
-                    print(f"Warning: Could not calculate Dice scores - permission error: {e}", file=sys.stderr)
-                except ImportError as e:
-                    print(f"Warning: Could not calculate Dice scores - dice_compare module not found", file=sys.stderr)
-                except Exception as e:
-                    print(f"Warning: Could not calculate Dice scores: {e}", file=sys.stderr)
-
-        # WORKFLOW 1 & 3: Apply transformation to the original input image
-        if not generate_warpfield and output_image is not None:
-            print("\n--- Step 3: Applying transformation to original input image ---")
-            apply_cmd = [
-                "lamar", "apply-warp",  # Use hyphen instead of underscore
-                "--moving", input_image,
-                "--reference", reference_image,
-                "--output", output_image
-            ]
-            
-            # Only include transform flags if files were provided
-            if affine_file:
-                apply_cmd.extend(["--affine", affine_file])
-            
-            if warp_file:
-                apply_cmd.extend(["--warp", warp_file])
-                
-            subprocess.run(apply_cmd, check=True, env=env)
-
-            print(f"\nSuccess! Registered image saved to: {output_image}")
-        elif generate_warpfield:
-            success_msg = "\nSuccess! "
-            if warp_file:
-                success_msg += f"Warp field generated at: {warp_file}"
-            if affine_file:
-                success_msg += f"\nAffine transformation saved at: {affine_file}"
-            print(success_msg)
-
-    except subprocess.CalledProcessError as e:
-        print(f"Error during processing: {e}", file=sys.stderr)
-        sys.exit(1)
-
 
 def main():
     """Entry point for command-line use"""
     parser = argparse.ArgumentParser(description="Contrast-agnostic registration using SynthSeg")
-    parser.add_argument("--moving", required=True, help="Input moving image to be registered")
+    parser.add_argument("--moving", required=True, nargs="+", help="Input moving image(s) to be registered")
     parser.add_argument("--fixed", required=True, help="Reference fixed image (target space)")
-    parser.add_argument("--output", help="Output registered image")
-    parser.add_argument("--moving-parc", required=True, help="Path for moving image parcellation")
+    parser.add_argument("--output", nargs="+", help="Output registered image (one per moving image, or a {name} template)")
+    parser.add_argument("--moving-parc", required=True, nargs="+", help="Path for moving image parcellation (one per moving image, or a {name} template)")
     parser.add_argument("--fixed-parc", required=True, help="Path for fixed image parcellation")
-    parser.add_argument("--registered-parc", required=True, help="Path for registered parcellation")
-    parser.add_argument("--affine", required=True, help="Path for affine transformation")
-    parser.add_argument("--warpfield", required=True, help="Path for warp field")
-    parser.add_argument("--inverse-warpfield", help="Path for inverse warp field")
-    parser.add_argument("--inverse-affine", help="Path for inverse affine transformation")
+    parser.add_argument("--registered-parc", required=True, nargs="+", help="Path for registered parcellation (one per moving image, or a {name} template)")
+    parser.add_argument("--affine", required=True, nargs="+", help="Path for affine transformation (one per moving image, or a {name} template)")
+    parser.add_argument("--warpfield", required=True, nargs="+", help="Path for warp field (one per moving image, or a {name} template)")
+    parser.add_argument("--inverse-warpfield", nargs="+", help="Path for inverse warp field (one per moving image, or a {name} template)")
+    parser.add_argument("--inverse-affine", nargs="+", help="Path for inverse affine transformation (one per moving image, or a {name} template)")
     parser.add_argument("--generate-warpfield", action="store_true", help="Generate warp field without applying it")
     parser.add_argument("--apply-warpfield", action="store_true", help="Apply existing warp field to moving image")
     parser.add_argument("--registration-method", default="SyNRA", help="Registration method")
     parser.add_argument("--synthseg-threads", type=int, default=1, help="Number of threads to use for SynthSeg segmentation")
     parser.add_argument("--ants-threads", type=int, default=1, help="Number of threads to use for ANTs registration")
-    parser.add_argument("--qc-csv", help="Path for quality control Dice score CSV file")
+    parser.add_argument("--threads", type=parse_threads,
+                        help="Core budget shared by all stages, or auto (overrides --synthseg-threads/--ants-threads)")
+    parser.add_argument("--qc-csv", nargs="+", help="Path for quality control Dice score CSV file (one per moving image, or a {name} template)")
+    parser.add_argument("--subprocess", action="store_true",
+                        help="Run each stage in a separate lamar subprocess instead of in-process")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="Number of moving images registered at the same time (default: 1)")
+    parser.add_argument("--report", help="Path for a JSON report of the time and memory used by every stage")
+    parser.add_argument("--force-stage", action="append", choices=STAGES + ["all"],
+                        help="Recompute this stage even if its outputs are up to date (can be repeated)")
     
     args = parser.parse_args()
     
@@ -295,7 +524,12 @@ def main():
         inverse_affine_file=args.inverse_affine,
         synthseg_threads=args.synthseg_threads,
         ants_threads=args.ants_threads,
-        qc_csv=args.qc_csv
+        qc_csv=args.qc_csv,
+        use_subprocess=args.subprocess,
+        parallel=args.parallel,
+        report=args.report,
+        force_stages=args.force_stage,
+        threads=args.threads
     )
 
 
@@ -0,0 +1,352 @@
+"""
+pipeline - Stage execution engines for the LaMAR workflows
+
+Part of the LaMAR processing pipeline.
+
+A LaMAR registration is made of a handful of stages: SynthSeg parcellation of
+the moving and fixed images, ANTs coregistration of the two parcellations,
+application of the resulting transforms to the original moving image, and a
+Dice comparison of the registered parcellations for quality control.
+
+This module provides two interchangeable engines to run these stages:
+
+- InProcessEngine (default): calls predict_synthseg.predict,
+  coregister.ants_linear_nonlinear_registration and apply_warp.apply_warp
+  directly. TensorFlow, Keras and ANTsPy are imported once per process,
+  SynthSeg networks are built once per engine, and images that are needed by
+  several stages are only read once. Parcellations are delegated to the
+  SynthSeg daemon (lamar serve) when one is running.
+- SubprocessEngine: shells out to the `lamar` command for every stage. This is
+  slower (every stage starts a new interpreter and re-imports its dependencies)
+  but fully isolates the stages from each other.
+
+Both engines time every stage they run with a StageTimer, so that a summary of
+where the wall time went can be printed at the end of the run.
+
+Python Usage:
+-----------
+>>> from lamar.scripts.pipeline import InProcessEngine
+>>> engine = InProcessEngine(synthseg_threads=4, ants_threads=8)
+>>> engine.parcellate(["sub-001_dwi.nii.gz", "sub-001_T1w.nii.gz"],
+...                   ["sub-001_dwi_parc.nii.gz", "sub-001_T1w_parc.nii.gz"])
+>>> engine.coregister("sub-001_T1w_parc.nii.gz", "sub-001_dwi_parc.nii.gz",
+...                   "sub-001_dwi_reg_parc.nii.gz", affine_file="affine.mat",
+...                   warp_file="warp.nii.gz")
+>>> engine.apply_warp("sub-001_dwi.nii.gz", "sub-001_T1w.nii.gz",
+...                   "sub-001_dwi_in_T1w.nii.gz", "affine.mat", "warp.nii.gz")
+>>> engine.timer.print_summary()
+"""
+
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """Record the wall time spent in each stage of a pipeline run.
+
+    Stages opened while another stage is running (e.g. the preprocessing of an image within the SynthSeg stage) are
+    recorded as sub-stages of the running one. Stages that ran concurrently with each other (e.g. the registrations of
+    several moving images) are kept apart in parallel_stages: they are listed in the summary, but not counted in the
+    total wall time.
+
+    A detailed timer also measures the CPU time and peak memory of every stage and sub-stage, and keeps them in
+    records, together with the information given to stage() or annotate() (input shapes, thread settings...), for
+    the --report of a run (see report.py).
+    """
+
+    def __init__(self, detailed=False):
+        self.stages = []
+        self.parallel_stages = []
+        self.detailed = detailed
+        self.records = []
+        self.parallel_records = []
+        self._current = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Context manager timing the enclosed block under the given stage name. Yields the record of the stage, to
+        which information can be added."""
+        with self._lock:
+            parent = self._current
+            record = dict(name=name, **info)
+            if parent is None:
+                self._current = record
+        meter = None
+        if self.detailed:
+            from lamar.scripts.report import ResourceMeter
+            meter = ResourceMeter(top_level=parent is None).start()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            duration = time.perf_counter() - start
+            record['wall_time'] = round(duration, 3)
+            if meter is not None:
+                record.update(meter.stop())
+            with self._lock:
+                if parent is None:
+                    self._current = None
+                    self.stages.append((name, duration))
+                    if self.detailed:
+                        self.records.append(record)
+                else:
+                    parent.setdefault('substages', []).append(record)
+
+    def add_substage(self, name, duration, **info):
+        """Record a sub-stage of the running stage that was timed by someone else (e.g. ANTs' own stage timings)."""
+        with self._lock:
+            if self._current is not None:
+                self._current.setdefault('substages', []).append(dict(name=name, wall_time=round(duration, 3), **info))
+
+    def annotate(self, **info):
+        """Add information (e.g. thread settings) to the record of the running stage."""
+        with self._lock:
+            if self._current is not None:
+                self._current.update(info)
+
+    def add_parallel(self, stages, records=()):
+        """Record (name, duration) pairs, and detailed records, of stages that ran concurrently, e.g. in workers."""
+        self.parallel_stages.extend(stages)
+        self.parallel_records.extend(records)
+
+    @property
+    def total(self):
+        return sum(duration for _, duration in self.stages)
+
+    def print_summary(self):
+        """Print the duration of every recorded stage, in the order they were run."""
+        if not self.stages:
+            return
+        width = max(len(name) for name, _ in self.stages + self.parallel_stages) + 2
+        print("\nStage timings:")
+        for n, (name, duration) in enumerate(self.stages):
+            line = f"  {name:<{width}}{duration:8.2f} s"
+            if self.detailed:
+                record = self.records[n]
+                line += f"   cpu {record['cpu_time']:8.2f} s   peak memory {record['peak_rss'] / 1024 ** 2:8.0f} MB"
+            print(line)
+        print(f"  {'total':<{width}}{self.total:8.2f} s")
+        if self.parallel_stages:
+            print("Concurrent stages (included in the timings above):")
+            for name, duration in self.parallel_stages:
+                print(f"  {name:<{width}}{duration:8.2f} s")
+
+
+def get_stage_env(ants_threads):
+    """Environment for stage subprocesses: quiet TensorFlow and pin the ITK/OpenMP thread count."""
+    env = os.environ.copy()
+    env['TF_CPP_MIN_LOG_LEVEL'] = '3'  # 0=ALL, 1=INFO, 2=WARNING, 3=ERROR
+    env['PYTHONWARNINGS'] = 'ignore'
+    env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(ants_threads)
+    env['OMP_NUM_THREADS'] = str(ants_threads)  # OpenMP threads for ANTs
+    return env
+
+
+def get_image_name(path):
+    """File name of an image without its directory and extension(s), e.g. sub-001_dwi for /data/sub-001_dwi.nii.gz."""
+    name = os.path.basename(path)
+    for ext in ['.nii.gz', '.nii', '.mgz', '.npz']:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def as_path_lists(images, outputs):
+    """Turn a single input/output path pair into one-element lists, and check that lists have matching lengths."""
+    if isinstance(images, str):
+        images = [images]
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    if len(images) != len(outputs):
+        raise ValueError(f"Got {len(images)} input image(s) but {len(outputs)} output path(s)")
+    return list(images), list(outputs)
+
+
+def _stage_info(timer, inputs, **settings):
+    """Information recorded with a stage by detailed timers: description of its inputs, and thread settings."""
+    if not timer.detailed:
+        return {}
+    from lamar.scripts.report import describe_image
+    return dict(inputs=[describe_image(path) for path in inputs if path is not None], **settings)
+
+
+class InProcessEngine:
+    """Run the LaMAR stages in the current process.
+
+    Heavy dependencies are imported lazily, on first use, so that a workflow that
+    never parcellates (e.g. apply-warpfield) never pays for importing TensorFlow.
+    ANTs images are cached by absolute path, so an image used by several stages
+    (e.g. the fixed image) is only read from disk once.
+    """
+
+    def __init__(self, synthseg_threads=1, ants_threads=1, timer=None):
+        self.synthseg_threads = synthseg_threads
+        self.ants_threads = ants_threads
+        self.timer = timer if timer is not None else StageTimer()
+        self.images = {}
+        self.model_cache = None
+
+        # these have to be set before TensorFlow/ITK are first imported to take effect
+        os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(ants_threads)
+        os.environ['OMP_NUM_THREADS'] = str(ants_threads)
+
+    def read_image(self, path):
+        """Read an image with ANTs, or return the copy already loaded by a previous stage."""
+        import ants
+        key = os.path.abspath(path)
+        if key not in self.images:
+            self.images[key] = ants.image_read(path)
+        return self.images[key]
+
+    def forget_image(self, path):
+        """Drop a cached image, e.g. because the file it was read from has been rewritten."""
+        self.images.pop(os.path.abspath(path), None)
+
+    def parcellate(self, images, parcs, stage_name="synthseg"):
+        """Parcellate one image, or several images with a single SynthSeg network (given as lists of paths).
+        The job goes to the SynthSeg daemon if one is running, otherwise the networks built here are kept for later
+        calls on the same engine. Detailed timers need the sub-stages to run here, so they never use the daemon."""
+        from lamar.scripts import synthseg, serve
+        images, parcs = as_path_lists(images, parcs)
+        args = synthseg.get_default_args()
+        args.update({'i': images, 'o': parcs, 'parc': True, 'cpu': True, 'threads': self.synthseg_threads})
+        with self.timer.stage(stage_name, **_stage_info(self.timer, images, synthseg_threads=self.synthseg_threads)):
+            if self.timer.detailed:
+                if self.model_cache is None:
+                    from lamar.SynthSeg.predict_synthseg import ModelCache
+                    self.model_cache = ModelCache()
+                synthseg.main(args, model_cache=self.model_cache, timer=self.timer)
+            else:
+                if self.model_cache is None and not serve.daemon_available():
+                    from lamar.SynthSeg.predict_synthseg import ModelCache
+                    self.model_cache = ModelCache()
+                serve.run_synthseg(args, model_cache=self.model_cache)
+        for parc in parcs:
+            self.forget_image(parc)
+
+    def coregister(self, fixed_parc, moving_parc, output_parc, registration_method="SyNRA",
+                   affine_file=None, warp_file=None, inverse_warp_file=None, inverse_affine_file=None,
+                   stage_name="coregister"):
+        from lamar.scripts.coregister import ants_linear_nonlinear_registration
+        info = _stage_info(self.timer, [fixed_parc, moving_parc], ants_threads=self.ants_threads,
+                           registration_method=registration_method)
+        with self.timer.stage(stage_name, **info):
+            registered, transforms = ants_linear_nonlinear_registration(
+                fixed_file=self.read_image(fixed_parc),
+                moving_file=self.read_image(moving_parc),
+                out_file=output_parc,
+                warp_file=warp_file,
+                affine_file=affine_file,
+                rev_warp_file=inverse_warp_file,
+                rev_affine_file=inverse_affine_file,
+                registration_method=registration_method,
+                timer=self.timer if self.timer.detailed else None
+            )
+        self.images[os.path.abspath(output_parc)] = registered
+        return transforms
+
+    def apply_warp(self, moving, reference, output, affine_file=None, warp_file=None, stage_name="apply-warp"):
+        from lamar.scripts.apply_warp import apply_warp
+        info = _stage_info(self.timer, [moving, reference, warp_file], ants_threads=self.ants_threads)
+        with self.timer.stage(stage_name, **info):
+            apply_warp(self.read_image(moving), self.read_image(reference), affine_file, warp_file, output,
+                       timer=self.timer if self.timer.detailed else None)
+
+    def dice(self, ref_parc, reg_parc, output_csv, stage_name="dice"):
+        from lamar.scripts.dice_compare import compare_parcellations_dice
+        with self.timer.stage(stage_name, **_stage_info(self.timer, [ref_parc, reg_parc])):
+            compare_parcellations_dice(ref_parc, reg_parc, output_csv)
+
+
+class SubprocessEngine:
+    """Run every LaMAR stage in its own `lamar` subprocess (opt-in fallback for full isolation)."""
+
+    def __init__(self, synthseg_threads=1, ants_threads=1, timer=None):
+        self.synthseg_threads = synthseg_threads
+        self.ants_threads = ants_threads
+        self.timer = timer if timer is not None else StageTimer()
+        self.env = get_stage_env(ants_threads)
+
+    def _run(self, cmd, stage_name, inputs=(), **settings):
+        with self.timer.stage(stage_name, **_stage_info(self.timer, inputs, subprocess=True, **settings)):
+            subprocess.run(cmd, check=True, env=self.env)
+
+    def parcellate(self, images, parcs, stage_name="synthseg"):
+        """Parcellate one image, or several images in a single `lamar synthseg` call (given as lists of paths)."""
+        images, parcs = as_path_lists(images, parcs)
+        with tempfile.TemporaryDirectory(prefix="lamar_") as tmp_dir:
+            if len(images) == 1:
+                path_images, path_parcs = images[0], parcs[0]
+            else:
+                # SynthSeg reads lists of inputs and outputs from text files
+                path_images = os.path.join(tmp_dir, "images.txt")
+                path_parcs = os.path.join(tmp_dir, "parcellations.txt")
+                for path_list, paths in [(path_images, images), (path_parcs, parcs)]:
+                    with open(path_list, "w") as f:
+                        f.write("\n".join(os.path.abspath(p) for p in paths) + "\n")
+            self._run([
+                "lamar", "synthseg",
+                "--i", path_images,
+                "--o", path_parcs,
+                "--parc",
+                "--cpu",
+                "--threads", str(self.synthseg_threads)
+            ], stage_name, images, synthseg_threads=self.synthseg_threads)
+
+    def coregister(self, fixed_parc, moving_parc, output_parc, registration_method="SyNRA",
+                   affine_file=None, warp_file=None, inverse_warp_file=None, inverse_affine_file=None,
+                   stage_name="coregister"):
+        cmd = [
+            "lamar", "coregister",
+            "--fixed-file", fixed_parc,
+            "--moving-file", moving_parc,
+            "--output", output_parc,
+            "--registration-method", registration_method,
+        ]
+
+        # Only include transform file flags if paths were provided
+        if affine_file:
+            cmd.extend(["--affine-file", affine_file])
+        if warp_file:
+            cmd.extend(["--warp-file", warp_file])
+        if inverse_warp_file:
+            cmd.extend(["--rev-warp-file", inverse_warp_file])
+        if inverse_affine_file:
+            cmd.extend(["--rev-affine-file", inverse_affine_file])
+
+        self._run(cmd, stage_name, [fixed_parc, moving_parc], ants_threads=self.ants_threads,
+                  registration_method=registration_method)
+
+    def apply_warp(self, moving, reference, output, affine_file=None, warp_file=None, stage_name="apply-warp"):
+        cmd = [
+            "lamar", "apply-warp",
+            "--moving", moving,
+            "--reference", reference,
+            "--output", output
+        ]
+
+        # Only include transform flags if files were provided
+        if affine_file:
+            cmd.extend(["--affine", affine_file])
+        if warp_file:
+            cmd.extend(["--warp", warp_file])
+
+        self._run(cmd, stage_name, [moving, reference, warp_file], ants_threads=self.ants_threads)
+
+    def dice(self, ref_parc, reg_parc, output_csv, stage_name="dice"):
+        # the Dice comparison only needs nibabel and numpy, no point isolating it
+        from lamar.scripts.dice_compare import compare_parcellations_dice
+        with self.timer.stage(stage_name, **_stage_info(self.timer, [ref_parc, reg_parc])):
+            compare_parcellations_dice(ref_parc, reg_parc, output_csv)
+
+
+def get_engine(use_subprocess=False, synthseg_threads=1, ants_threads=1, timer=None):
+    """Return the engine used to run the LaMAR stages."""
+    engine_class = SubprocessEngine if use_subprocess else InProcessEngine
+    return engine_class(synthseg_threads=synthseg_threads, ants_threads=ants_threads, timer=timer)
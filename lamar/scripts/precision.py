@@ -0,0 +1,227 @@
+"""
+precision - Reduced-precision SynthSeg inference, guarded by a validation against float32
+
+Part of the LaMAR processing pipeline.
+
+With --precision bfloat16 (or float16), `lamar synthseg` runs the UNets of the
+SynthSeg cascade in Keras mixed precision: float32 weights, half-precision
+activations. On CPUs with bfloat16 instructions (e.g. AVX512-BF16, AMX) this is
+faster, and the activations of the UNets take half the memory.
+
+Reduced precision changes the posteriors slightly, so it is only enabled for a
+SynthSeg configuration (version, parcellation) that was validated on this
+installation:
+
+    lamar synthseg validate-precision --i reference_images/ --precision bfloat16
+
+segments the reference images in float32 and in the reduced precision,
+computes the Dice score of every structure between the two label maps, and
+records the result in $LAMAR_PRECISION_RECORD (default:
+~/.cache/lamar/precision.json). The validation passes if the mean Dice of every
+structure over the reference images is at least --threshold (default: 0.9).
+`lamar synthseg --precision bfloat16` then refuses to use the reduced
+precision, and runs in float32, for configurations that have no passing
+validation. Validations are keyed by the same hash of options, weight files
+and TensorFlow/Keras versions as the networks exported by `lamar synthseg
+compile`, so upgrading TensorFlow or the weights requires a new validation.
+
+Command-line Usage:
+-----------------
+lamar synthseg validate-precision --i <image_or_folder> [<image> ...]
+    [--precision bfloat16|float16] [--threshold <dice>]
+    [--parc] [--robust] [--fast] [--v1] [--threads <num_threads>]
+
+Python Usage:
+-----------
+>>> from lamar.scripts.precision import validate
+>>> from lamar.scripts.synthseg import get_default_args
+>>> record = validate(dict(get_default_args(), parc=True, robust=False), ["ref_t1w.nii.gz"], "bfloat16")
+>>> record['passed'], record['worst_structure'], record['worst_dice']
+(True, 5, 0.962)
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+from argparse import ArgumentParser
+
+PRECISIONS = ['float32', 'bfloat16', 'float16']
+
+DEFAULT_THRESHOLD = 0.9
+
+IMAGE_EXTENSIONS = ('.nii', '.nii.gz', '.mgz')
+
+
+def get_record_path():
+    return os.environ.get('LAMAR_PRECISION_RECORD') or \
+        os.path.join(os.path.expanduser('~'), '.cache', 'lamar', 'precision.json')
+
+
+def get_record_key(args):
+    """Key of the validations of a SynthSeg configuration (see synthseg.get_default_args): the name of its exported
+    float32 network, which hashes its options, weight files and TensorFlow/Keras versions. QC doesn't change the
+    label maps, so it is not part of the key."""
+    from lamar.scripts.synthseg import get_model_config
+    from lamar.SynthSeg.predict_synthseg import get_compiled_model_path
+    model_config = get_model_config(dict(args, qc=None, precision='float32'))
+    return os.path.basename(get_compiled_model_path(model_config))
+
+
+def load_records():
+    try:
+        with open(get_record_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_record(key, record):
+    path = get_record_path()
+    records = load_records()
+    records.setdefault(key, {})[record['precision']] = record
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(records, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def check_precision(args):
+    """Precision to use for a SynthSeg run: args['precision'] if it is float32 or was validated for this
+    configuration, float32 otherwise."""
+    precision = args.get('precision') or 'float32'
+    if precision == 'float32':
+        return precision
+    record = load_records().get(get_record_key(args), {}).get(precision)
+    if record is None:
+        print(f"Refusing {precision} inference: it was never validated for this configuration. Run `lamar synthseg "
+              f"validate-precision --precision {precision}` on reference images first. Using float32.")
+        return 'float32'
+    if not record['passed']:
+        print(f"Refusing {precision} inference: its validation failed (Dice {record['worst_dice']:.3f} of label "
+              f"{record['worst_structure']} < {record['threshold']}). Using float32.")
+        return 'float32'
+    print(f"using {precision} (validated on {record['images']} image(s), lowest structure Dice "
+          f"{record['worst_dice']:.3f})")
+    return precision
+
+
+def dice_per_structure(reference, other):
+    """Dice score of every non-zero label present in either label map, as {label: dice}."""
+    labels = np.union1d(np.unique(reference), np.unique(other))
+    reference_idx = np.searchsorted(labels, reference.ravel())
+    other_idx = np.searchsorted(labels, other.ravel())
+    sizes = np.bincount(reference_idx, minlength=len(labels)) + np.bincount(other_idx, minlength=len(labels))
+    overlap = np.bincount(reference_idx[reference_idx == other_idx], minlength=len(labels))
+    return {int(label): float(2 * overlap[i] / sizes[i]) for i, label in enumerate(labels) if label != 0}
+
+
+def list_images(paths):
+    """Image files given as paths to images or to folders of images."""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(IMAGE_EXTENSIONS))
+        else:
+            images.append(path)
+    return images
+
+
+def validate(args, images, precision, threshold=DEFAULT_THRESHOLD):
+    """Segment reference images in float32 and in a reduced precision with the SynthSeg options args (see
+    synthseg.get_default_args), compare the label maps, and record the validation. Returns the record."""
+    import nibabel as nib
+    from lamar.scripts.synthseg import get_predict_kwargs
+    from lamar.scripts.pipeline import StageTimer
+    from lamar.SynthSeg.predict_synthseg import predict
+
+    tmp_dir = tempfile.mkdtemp(prefix='lamar-precision-')
+    timer = StageTimer(detailed=True)
+    segmentations = {}
+    try:
+        for run_precision in ['float32', precision]:
+            # the label maps are read back right away, so they are not compressed
+            outputs = [os.path.join(tmp_dir, run_precision, '%03d_synthseg.nii' % i) for i in range(len(images))]
+            kwargs = get_predict_kwargs(dict(args, i=images, o=outputs, post=None, resample=None, vol=None, qc=None,
+                                             precision=run_precision))
+            with timer.stage(run_precision):
+                results = predict(**kwargs, verbose=False, timer=timer)
+            segmentations[run_precision] = {result['image']: result['segmentation'] for result in results}
+
+        # Dice of every structure, averaged over the images segmented in both precisions
+        dice = {}
+        for image, path in segmentations['float32'].items():
+            if image not in segmentations[precision]:
+                continue
+            reference = np.asarray(nib.load(path).dataobj)
+            other = np.asarray(nib.load(segmentations[precision][image]).dataobj)
+            for label, score in dice_per_structure(reference, other).items():
+                dice.setdefault(label, []).append(score)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if not dice:
+        raise RuntimeError('No reference image could be segmented in both precisions')
+
+    dice = {label: round(float(np.mean(scores)), 4) for label, scores in sorted(dice.items())}
+    worst_structure = min(dice, key=dice.get)
+    runs = {record['name']: record for record in timer.records}
+    record = {'precision': precision,
+              'passed': dice[worst_structure] >= threshold,
+              'threshold': threshold,
+              'worst_structure': worst_structure,
+              'worst_dice': dice[worst_structure],
+              'mean_dice': round(float(np.mean(list(dice.values()))), 4),
+              'dice': dice,
+              'images': len(segmentations[precision]),
+              'network_time': {name: run.get('pipeline_times', {}).get('network') for name, run in runs.items()},
+              'peak_rss': {name: run.get('peak_rss') for name, run in runs.items()},
+              'validated': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    save_record(get_record_key(args), record)
+    return record
+
+
+def main(argv=None):
+    """Entry point of `lamar synthseg validate-precision`."""
+    parser = ArgumentParser(prog='lamar synthseg validate-precision',
+                            description="Validate reduced-precision SynthSeg inference against float32")
+    parser.add_argument("--i", nargs='+', required=True, help="Reference image(s), or folder(s) of images.")
+    parser.add_argument("--precision", choices=PRECISIONS[1:], default='bfloat16',
+                        help="Precision to validate (default: bfloat16).")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Lowest mean Dice accepted for any structure (default: %(default)s).")
+    parser.add_argument("--parc", action="store_true", help="Validate the configuration with cortex parcellation.")
+    parser.add_argument("--robust", action="store_true", help="Validate SynthSeg-robust.")
+    parser.add_argument("--fast", action="store_true", help="Validate the fast mode.")
+    parser.add_argument("--v1", action="store_true", help="Validate SynthSeg 1.0.")
+    parser.add_argument("--threads", default='1', help="Number of cores to be used, or auto (default: 1).")
+    options = parser.parse_args(argv)
+    if options.robust and options.v1:
+        parser.error('--v1 cannot be used with --robust since SynthSeg-robust only came out with 2.0.')
+    images = list_images(options.i)
+    if not images:
+        parser.error('no image found in ' + ' '.join(options.i))
+
+    from lamar.scripts.synthseg import get_default_args, set_tf_threads, split_threads
+    from lamar.scripts.threads import get_available_cores
+    threads = get_available_cores() if options.threads == 'auto' else int(options.threads)
+    set_tf_threads(*split_threads(threads, len(images)))
+    args = dict(get_default_args(), parc=options.parc, robust=options.robust, fast=options.fast or options.robust,
+                v1=options.v1)
+    print(f"Validating {options.precision} against float32 on {len(images)} image(s)")
+    record = validate(args, images, options.precision, options.threshold)
+
+    from lamar.scripts.dice_compare import FREESURFER_LABELS
+    print("Lowest Dice scores:")
+    for label in sorted(record['dice'], key=record['dice'].get)[:5]:
+        print(f"  {label:5d} {FREESURFER_LABELS.get(label, ''):35s} {record['dice'][label]:.4f}")
+    for name in ['float32', options.precision]:
+        network_time, peak_rss = record['network_time'].get(name), record['peak_rss'].get(name)
+        print(f"  {name:9s}: network {network_time if network_time is not None else '?'}s, "
+              f"peak memory {peak_rss / 2 ** 30 if peak_rss else 0:.2f} GiB")
+    status = 'passed' if record['passed'] else 'FAILED'
+    print(f"Validation {status}: lowest structure Dice {record['worst_dice']:.4f} (label {record['worst_structure']}), "
+          f"threshold {record['threshold']}, saved to {get_record_path()}")
+    return record
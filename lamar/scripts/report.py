@@ -0,0 +1,224 @@
+"""
+report - Resource reports of LaMAR runs
+
+Part of the LaMAR processing pipeline.
+
+With --report <path.json>, `lamar register`, `generate-warpfield`,
+`apply-warpfield` and `synthseg` write a JSON report of where the time and
+memory of the run went. For every stage (SynthSeg, coregistration, Dice,
+apply-warp) and sub-stage (SynthSeg preprocessing, network and postprocessing
+of every image; ANTs rigid, affine and SyN stages; writing of the outputs), the
+report gives:
+- the wall time and the CPU time of the process (and of its children, for
+  stages run with --subprocess),
+- the peak resident memory of the process during the stage,
+- the shapes, voxel sizes and voxel counts of the stage inputs,
+- the thread settings (SynthSeg/TensorFlow, ANTs/ITK).
+
+The report also lists the SHA-256 of every input file together with the
+LaMAR, Python and library versions and the machine it ran on, so that runs can
+be compared across versions and machines.
+
+Peak memory of top-level stages is exact on Linux (the kernel high-water mark
+is reset at the start of each stage). Sub-stages, which may overlap with each
+other, are sampled every 20 ms.
+
+Python Usage:
+-----------
+>>> from lamar.scripts.pipeline import StageTimer
+>>> from lamar.scripts.report import describe_image, write_report
+>>> timer = StageTimer(detailed=True)
+>>> with timer.stage("dice", inputs=[describe_image("ref_parc.nii.gz")]):
+...     compare_parcellations_dice("ref_parc.nii.gz", "reg_parc.nii.gz", "dice.csv")
+>>> write_report("report.json", timer, inputs=["ref_parc.nii.gz", "reg_parc.nii.gz"])
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import platform
+import resource
+import threading
+
+# libraries whose version is recorded in the report, when they have been imported by the run
+LIBRARY_VERSIONS = ['numpy', 'scipy', 'nibabel', 'tensorflow', 'keras', 'ants']
+
+
+def get_rss():
+    """Current resident memory of the process, in bytes (None if it can't be read)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss():
+    """Peak resident memory of the process since the last reset_peak_rss, in bytes."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS, and can't be reset
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def reset_peak_rss():
+    """Reset the kernel high-water mark of resident memory (Linux only). Returns whether it worked."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class _RssSampler:
+    """Background thread recording the highest resident memory seen while each open measurement is running."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.meters = set()
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.thread = None
+
+    def add(self, meter):
+        with self.lock:
+            self.meters.add(meter)
+            self.active.set()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def remove(self, meter):
+        with self.lock:
+            self.meters.discard(meter)
+            if not self.meters:
+                self.active.clear()
+
+    def _run(self):
+        while True:
+            self.active.wait()
+            rss = get_rss()
+            if rss is not None:
+                with self.lock:
+                    for meter in self.meters:
+                        meter.peak_rss = max(meter.peak_rss, rss)
+            time.sleep(self.interval)
+
+
+_sampler = _RssSampler()
+
+
+class ResourceMeter:
+    """Measure the CPU time and the peak resident memory of the process (and of its children) over a block of code.
+    Top-level meters reset the kernel high-water mark of resident memory, nested ones rely on sampling."""
+
+    def __init__(self, top_level=True):
+        self.top_level = top_level
+        self.peak_rss = 0
+        self.exact_peak = False
+
+    def start(self):
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if self.top_level:
+            self.exact_peak = reset_peak_rss()
+        self.peak_rss = get_rss() or 0
+        _sampler.add(self)
+        return self
+
+    def stop(self):
+        """Return the measurements as a dictionary."""
+        _sampler.remove(self)
+        self.peak_rss = max(self.peak_rss, get_rss() or 0)
+        if self.exact_peak:
+            self.peak_rss = max(self.peak_rss, get_peak_rss())
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_self = (self_usage.ru_utime - self.self_usage.ru_utime) + (self_usage.ru_stime - self.self_usage.ru_stime)
+        cpu_children = (children_usage.ru_utime - self.children_usage.ru_utime) + \
+                       (children_usage.ru_stime - self.children_usage.ru_stime)
+        measures = {'cpu_time': round(cpu_self + cpu_children, 3),
+                    'peak_rss': self.peak_rss}
+        if cpu_children > 0:
+            # stages run in subprocesses: the children's own peak (over all children so far) is the relevant one
+            max_rss = children_usage.ru_maxrss
+            measures['cpu_time_children'] = round(cpu_children, 3)
+            measures['peak_rss_children'] = max_rss if sys.platform == 'darwin' else max_rss * 1024
+        return measures
+
+
+def describe_image(path):
+    """Shape, voxel size, voxel count and data type of an image, read from its header only."""
+    description = {'path': os.path.abspath(path)}
+    try:
+        import numpy as np
+        import nibabel as nib
+        header = nib.load(path).header
+        shape = [int(s) for s in header.get_data_shape()]
+        description.update({'shape': shape,
+                            'voxel_size': [round(float(z), 4) for z in header.get_zooms()[:3]],
+                            'voxels': int(np.prod(shape)),
+                            'dtype': str(header.get_data_dtype())})
+    except Exception:  # not an image (e.g. an affine .mat file), or not readable yet
+        pass
+    return description
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """SHA-256 of the content of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_thread_settings(**threads):
+    """Thread settings of the run: the given LaMAR settings, plus the relevant environment and the available cores."""
+    settings = dict(threads)
+    for variable in ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS']:
+        if variable in os.environ:
+            settings[variable] = os.environ[variable]
+    from lamar.scripts.threads import describe_cpu_budget
+    settings.update(describe_cpu_budget())  # CPU count, affinity, cgroup quota and resulting available cores
+    return settings
+
+
+def write_report(path, timer, inputs=(), settings=None, status='ok'):
+    """Write the JSON report of a run, given the (detailed) StageTimer that timed it and the paths of its inputs."""
+    from lamar import __version__
+    report = {'lamar_version': __version__,
+              'command': sys.argv,
+              'status': status,
+              'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': {'hostname': socket.gethostname(),
+                       'platform': platform.platform(),
+                       'processor': platform.processor() or platform.machine(),
+                       'python': platform.python_version()},
+              'versions': {name: getattr(sys.modules[name], '__version__', None)
+                           for name in LIBRARY_VERSIONS if name in sys.modules},
+              'settings': settings or {},
+              'inputs': [],
+              'wall_time': round(timer.total, 3),
+              'stages': timer.records,
+              'concurrent_stages': timer.parallel_records}
+    for input_path in inputs:
+        if input_path is not None and os.path.isfile(input_path):
+            report['inputs'].append(dict(describe_image(input_path), sha256=hash_file(input_path),
+                                         size=os.path.getsize(input_path)))
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Resource report saved to: {path}")
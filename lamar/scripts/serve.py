@@ -0,0 +1,314 @@
+"""
+serve - Persistent SynthSeg inference daemon
+
+Part of the LaMAR processing pipeline.
+
+Building the cascaded SynthSeg networks (segmentation UNet, robust denoiser,
+parcellation and QC heads) and loading their weights takes a large share of
+every `lamar synthseg` call on CPU. `lamar serve` starts a daemon that keeps
+the built networks resident in memory, keyed by their configuration (robust,
+parc, qc, v1), and accepts segmentation jobs over a Unix domain socket.
+
+`lamar synthseg` and `lamar register` automatically send their parcellation
+jobs to the daemon when one is listening on the socket, and fall back to
+running SynthSeg locally otherwise (or when the daemon is busy). Set
+LAMAR_NO_DAEMON=1 to never use the daemon.
+
+The daemon has a bounded job queue: when it is full, new jobs are refused and
+the clients run SynthSeg themselves. Up to --max-jobs jobs run at the same time,
+as long as the sum of their thread requests fits in the daemon's thread budget.
+The thread request of a job only gates its admission and bounds its pre- and
+postprocessing threads: TensorFlow's thread pools are shared by all the jobs
+and sized once, when the daemon starts, to --threads intra-op threads and one
+inter-op thread per concurrent job.
+On SIGINT/SIGTERM or `lamar serve --stop`, the daemon stops accepting jobs,
+finishes the queued ones, and removes its socket.
+
+Protocol:
+--------
+Each connection carries one JSON request followed by a newline, and receives
+one JSON response followed by a newline. Requests have an "op" field:
+- {"op": "ping"}: check that the daemon is alive.
+- {"op": "status"}: loaded models, queue length and thread budget.
+- {"op": "segment", "args": {...}}: run SynthSeg with the given options (same
+  keys as lamar.scripts.synthseg.get_default_args). The response lists the
+  output paths, volumes and QC scores of every segmented image.
+- {"op": "shutdown"}: graceful shutdown.
+
+API Usage:
+---------
+lamar serve
+    [--socket <path/to/socket>]
+    [--threads <num_threads>]
+    [--max-jobs <num_jobs>]
+    [--queue-size <num_jobs>]
+lamar serve --status
+lamar serve --stop
+
+Python Usage:
+-----------
+>>> from lamar.scripts.serve import daemon_available, submit
+>>> if daemon_available():
+...     results = submit({'i': 't1w.nii.gz', 'o': 't1w_parc.nii.gz', 'parc': True, 'threads': 4})
+"""
+
+import os
+import sys
+import json
+import queue
+import signal
+import socket
+import tempfile
+import threading
+import socketserver
+
+# SynthSeg options holding paths, which are made absolute before being sent to the daemon
+PATH_ARGS = ['i', 'o', 'post', 'resample', 'vol', 'qc']
+
+
+class DaemonUnavailable(Exception):
+    """Raised when the daemon cannot take a job (not running, queue full, or shutting down)."""
+
+
+def get_socket_path():
+    """Socket of the SynthSeg daemon: $LAMAR_SOCKET, or a per-user socket in the temporary directory."""
+    default = os.path.join(tempfile.gettempdir(), 'lamar-synthseg-%d.sock' % os.getuid())
+    return os.environ.get('LAMAR_SOCKET') or default
+
+
+def send_request(request, socket_path=None, timeout=None):
+    """Send one JSON request to the daemon and return its decoded response."""
+    socket_path = socket_path or get_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode())
+        with sock.makefile('r') as f:
+            response = f.readline()
+    if not response:
+        raise DaemonUnavailable('the SynthSeg daemon closed the connection without answering')
+    return json.loads(response)
+
+
+def daemon_available(socket_path=None):
+    """Whether a SynthSeg daemon is answering on the socket."""
+    if os.environ.get('LAMAR_NO_DAEMON'):
+        return False
+    socket_path = socket_path or get_socket_path()
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        return send_request({'op': 'ping'}, socket_path, timeout=2).get('status') == 'ok'
+    except (OSError, ValueError, DaemonUnavailable):
+        return False
+
+
+def _absolute_paths(args):
+    args = dict(args)
+    for key in PATH_ARGS:
+        value = args.get(key)
+        if isinstance(value, str):
+            args[key] = os.path.abspath(value)
+        elif isinstance(value, (list, tuple)):
+            args[key] = [os.path.abspath(v) for v in value]
+    return args
+
+
+def submit(args, socket_path=None):
+    """Run a SynthSeg job on the daemon and return its results (one dictionary per segmented image).
+    Raises DaemonUnavailable if the daemon can't take the job, and RuntimeError if the job failed."""
+    try:
+        response = send_request({'op': 'segment', 'args': _absolute_paths(args)}, socket_path)
+    except OSError as e:
+        raise DaemonUnavailable(str(e))
+    if response['status'] == 'ok':
+        return response['results']
+    if response['status'] in ['busy', 'stopping']:
+        raise DaemonUnavailable(response['error'])
+    raise RuntimeError('SynthSeg daemon error: %s' % response['error'])
+
+
+def run_synthseg(args, model_cache=None, socket_path=None):
+    """Run SynthSeg on the daemon if one is running, and locally (with the given ModelCache, if any) otherwise."""
+    if daemon_available(socket_path):
+        print('Sending SynthSeg job to the daemon at %s' % (socket_path or get_socket_path()))
+        try:
+            results = submit(args, socket_path)
+            for result in results:
+                print('segmentation saved in: %s' % result['segmentation'])
+            return results
+        except DaemonUnavailable as e:
+            print('SynthSeg daemon unavailable (%s), running locally' % e)
+    from lamar.scripts import synthseg
+    return synthseg.main(args, model_cache=model_cache)
+
+
+class ThreadBudget:
+    """Admit jobs only while the sum of their thread requests fits in a fixed budget."""
+
+    def __init__(self, total):
+        self.total = total
+        self.available = total
+        self.condition = threading.Condition()
+
+    def acquire(self, n_threads):
+        n_threads = min(max(1, n_threads), self.total)
+        with self.condition:
+            while self.available < n_threads:
+                self.condition.wait()
+            self.available -= n_threads
+        return n_threads
+
+    def release(self, n_threads):
+        with self.condition:
+            self.available += n_threads
+            self.condition.notify_all()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.daemon.handle(request)
+        except Exception as e:
+            response = {'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class SynthSegDaemon:
+    """Keep SynthSeg networks in memory and run segmentation jobs received over a Unix socket."""
+
+    def __init__(self, socket_path=None, threads=1, max_jobs=1, queue_size=8):
+        self.socket_path = socket_path or get_socket_path()
+        self.threads = ThreadBudget(threads)
+        self.max_jobs = max_jobs
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.model_cache = None
+        self.server = None
+        self.workers = list()
+
+    def handle(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'status': 'ok'}
+        if op == 'status':
+            return {'status': 'ok',
+                    'models': [list(key[1:]) for key in self.model_cache.keys()],
+                    'queued_jobs': self.jobs.qsize(),
+                    'threads_available': self.threads.available,
+                    'threads_total': self.threads.total}
+        if op == 'shutdown':
+            self.stop()
+            return {'status': 'ok'}
+        if op == 'segment':
+            return self.run_job(request['args'])
+        return {'status': 'error', 'error': 'unknown op: %s' % op}
+
+    def run_job(self, args):
+        if self.stopping.is_set():
+            return {'status': 'stopping', 'error': 'the daemon is shutting down'}
+        job = {'args': args, 'done': threading.Event(), 'response': None}
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            return {'status': 'busy', 'error': 'job queue is full (%s jobs)' % self.jobs.maxsize}
+        job['done'].wait()
+        return job['response']
+
+    def _worker(self):
+        from lamar.scripts import synthseg
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            n_threads = 0
+            try:
+                args = synthseg.get_default_args()
+                args.update(job['args'])
+                if args['threads'] == 'auto':
+                    from lamar.scripts.threads import get_available_cores
+                    args['threads'] = get_available_cores()
+                n_threads = self.threads.acquire(int(args['threads']))
+                args['threads'] = n_threads
+                results = synthseg.main(args, model_cache=self.model_cache)
+                job['response'] = {'status': 'ok', 'results': results}
+            except BaseException as e:  # malformed jobs, and predict exiting when some inputs failed, must not kill the
+                # worker, and the client must always get an answer
+                job['response'] = {'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)}
+            finally:
+                self.threads.release(n_threads)
+                job['done'].set()
+
+    def stop(self):
+        """Stop accepting jobs. serve_forever then finishes the queued jobs and returns."""
+        if not self.stopping.is_set():
+            self.stopping.set()
+            # shutdown blocks until serve_forever returns, so it can't run in the thread serving requests
+            threading.Thread(target=self.server.shutdown).start()
+
+    def serve_forever(self):
+        from lamar.scripts import synthseg
+        from lamar.SynthSeg.predict_synthseg import ModelCache
+
+        # TensorFlow's thread pools are shared by all jobs, and sized once for the whole budget: the intra-op pool gets
+        # the budget, and each concurrent job an inter-op thread
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+        synthseg.set_tf_threads(self.threads.total, self.max_jobs)
+        self.model_cache = ModelCache()
+
+        if os.path.exists(self.socket_path):
+            if daemon_available(self.socket_path):
+                raise RuntimeError('a SynthSeg daemon is already running on %s' % self.socket_path)
+            os.remove(self.socket_path)  # stale socket left by a daemon that was killed
+        # only the user can connect: the socket is created without permissions for group and others
+        umask = os.umask(0o177)
+        try:
+            self.server = _UnixServer(self.socket_path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+
+        for _ in range(self.max_jobs):
+            worker = threading.Thread(target=self._worker, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(sig, lambda *_: self.stop())
+
+        print('SynthSeg daemon listening on %s (%s thread(s), %s concurrent job(s), queue of %s)'
+              % (self.socket_path, self.threads.total, self.max_jobs, self.jobs.maxsize))
+        try:
+            self.server.serve_forever()
+        finally:
+            print('shutting down, finishing %s queued job(s)' % self.jobs.qsize())
+            for _ in self.workers:
+                self.jobs.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            print('SynthSeg daemon stopped')
+
+
+def main(args):
+    """Start, stop or query the daemon, given the parsed `lamar serve` arguments."""
+    socket_path = args.socket or get_socket_path()
+    if args.stop or args.status:
+        try:
+            response = send_request({'op': 'shutdown' if args.stop else 'status'}, socket_path, timeout=10)
+        except OSError:
+            print('No SynthSeg daemon running on %s' % socket_path)
+            sys.exit(1)
+        print(json.dumps(response, indent=2))
+        return
+    SynthSegDaemon(socket_path=socket_path,
+                   threads=args.threads,
+                   max_jobs=args.max_jobs,
+                   queue_size=args.queue_size).serve_forever()
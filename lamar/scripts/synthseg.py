@@ -29,6 +29,21 @@ micaflow synthseg
     [--vol <path/to/volumes.csv>]
     [--qc <path/to/qc_scores.csv>]
     [--threads <num_threads>]
+    [--batch-size <num_images>]
+    [--queue-depth <num_images>]
+    [--tiling auto|off] [--tile-memory <size>] [--tile-blending gaussian|linear]
+    [--jit] [--shape-buckets <sizes>] [--jit-warmup <shape> [<shape> ...]]
+    [--precision float32|bfloat16|float16]
+    [--backend tensorflow|onnxruntime]
+    [--crop auto|<size> [<size> <size>]]
+    [--compression <level>]
+
+lamar synthseg compile [--parc] [--robust] [--fast] [--v1] [--qc] [--all]
+    [--precision float32|bfloat16|float16] [--backend tensorflow|onnxruntime]
+    [--model-dir <path>] [--force] [--benchmark] [--check <image>]
+
+lamar synthseg validate-precision --i <reference_images> [--precision bfloat16]
+    [--threshold <dice>] [--parc] [--robust] [--fast] [--v1]
 
 Python Usage:
 -----------
@@ -43,6 +58,56 @@ Python Usage:
 ...     'threads': 4
 ... })
 
+'i' and 'o' can also be lists of paths of the same length, in which case all
+images are segmented with a single network, built once. With 'batch_size'
+(--batch-size), images with the same padded shape go through the network
+together, in batches capped by the available memory. Loading, inference and
+postprocessing/saving run in a pipeline of three threads, with up to
+'queue_depth' (--queue-depth) images waiting between two stages. Images too
+large for the memory budget ('tile_memory', default: 80% of the available
+memory, cgroup limits included) are run through the network in overlapping
+tiles, stitched with Gaussian or linear blending weights, when 'tiling' is
+'auto' (--tiling auto, off by default since the footprint of the network is
+only estimated).
+
+With 'jit' (--jit), the network runs in an XLA-compiled function, compiled
+once per input shape. Padded shapes are snapped to a few sizes per axis
+('shape_buckets', --shape-buckets, default: 160,192,224,256), so that images
+of similar sizes reuse the same compiled network. The padded shapes given to
+'jit_warmup' (--jit-warmup, e.g. 192x224x192) are compiled while the first
+images load. The number of traces and the compiled shapes are printed and
+recorded in the report.
+
+'crop' (--crop) runs the network on a centred patch of the given size, or
+with 'auto' on the bounding box of the head (plus a margin), found on a
+decimated image. This skips the empty or non-brain parts of large fields of
+view (e.g. neck or shoulders), and the segmentation is pasted back into the
+full field of view.
+
+'precision' (--precision bfloat16 or float16) runs the UNets in mixed
+precision, only for configurations validated against float32 with `lamar
+synthseg validate-precision` (see precision.py). Others run in float32.
+
+'compression' (--compression 0 to 9) is the gzip level of the .nii.gz and .mgz
+outputs. With a single image, they are compressed in blocks on all --threads
+threads, and still written as standard gzip files (see utils.write_gzip).
+Lower levels write larger files faster.
+
+`lamar synthseg compile` builds the network of a configuration (or of every
+version x parc x qc configuration with --all) once, loads its weights, and
+exports it as a single SavedModel in $LAMAR_MODEL_DIR (default:
+~/.cache/lamar/models). SynthSeg then loads that network directly instead of
+wiring the UNets and loading every .h5 file again. --benchmark compares the
+time to the first prediction of both, each in a fresh process, and measures
+the peak memory of that prediction per input voxel (to compare with the
+estimate used for tiling, NETWORK_BYTES_PER_VOXEL).
+
+With --backend onnxruntime, `lamar synthseg compile` exports the networks as
+ONNX graphs instead, and 'backend': 'onnxruntime' (--backend onnxruntime) runs
+them with ONNX Runtime, without importing TensorFlow (see
+SynthSeg/predict_onnx.py). --check <image> compares the outputs of both
+backends on an image after the export.
+
 """
 
 # python imports
@@ -83,13 +148,24 @@ def print_extended_help():
       {YELLOW}--parc{RESET}         : Enable cortical parcellation
       {YELLOW}--robust{RESET}       : Use robust mode (slower but better quality)
       {YELLOW}--fast{RESET}         : Faster processing (less postprocessing)
-      {YELLOW}--threads{RESET} N    : Set number of CPU threads (default: 1)
+      {YELLOW}--threads{RESET} N    : Set number of CPU threads, or auto (default: 1)
+      {YELLOW}--batch-size{RESET} N : Images of the same shape run through the network together (default: 1)
+      {YELLOW}--queue-depth{RESET} N: Images waiting between load, network and save stages (default: 2)
+      {YELLOW}--tiling{RESET} MODE  : auto (tile images too large for memory) or off (default: off)
+      {YELLOW}--tile-memory{RESET} S: Memory budget of the network, e.g. 4G (default: 80% of available)
+      {YELLOW}--tile-blending{RESET} B: Stitching weights of the tiles, gaussian or linear (default: gaussian)
+      {YELLOW}--jit{RESET}          : Run the network in an XLA-compiled function
+      {YELLOW}--shape-buckets{RESET} L: Sizes padded shapes are snapped to (default with --jit: 160,192,224,256)
+      {YELLOW}--jit-warmup{RESET} S : Padded shapes to compile before the first image, e.g. 192x224x192
+      {YELLOW}--precision{RESET} P  : float32, or bfloat16/float16 once validated (default: float32)
+      {YELLOW}--backend{RESET} B    : tensorflow, or onnxruntime once exported (default: tensorflow)
       {YELLOW}--cpu{RESET}          : Force CPU processing (instead of GPU)
       {YELLOW}--vol{RESET} PATH     : Output volumetric CSV file
       {YELLOW}--qc{RESET} PATH      : Output quality control scores CSV file
       {YELLOW}--post{RESET} PATH    : Output posterior probability maps
       {YELLOW}--resample{RESET} PATH: Output resampled images
-      {YELLOW}--crop{RESET} N [N ...]: Size of 3D patches to analyze (default: 192)
+      {YELLOW}--crop{RESET} N [N ...]: Size of 3D patches to analyze, or auto for the bounding box of the head
+      {YELLOW}--compression{RESET} L: gzip level of .nii.gz/.mgz outputs, 0 (fastest) to 9 (default: nibabel's)
       {YELLOW}--ct{RESET}           : Clip intensities for CT scans [0,80]
       {YELLOW}--v1{RESET}           : Use SynthSeg 1.0 instead of 2.0
     
@@ -110,7 +186,8 @@ def print_extended_help():
     micaflow synthseg \\
       {YELLOW}--i{RESET} input_folder/ \\
       {YELLOW}--o{RESET} output_folder/ \\
-      {YELLOW}--vol{RESET} volumes.csv
+      {YELLOW}--vol{RESET} volumes.csv \\
+      {YELLOW}--batch-size{RESET} 4
     
     {CYAN}{BOLD}────────────────────────── NOTES ───────────────────────{RESET}
     {MAGENTA}•{RESET} SynthSeg works with any MRI contrast without retraining
@@ -119,39 +196,95 @@ def print_extended_help():
     {MAGENTA}•{RESET} For batch processing, input and output paths must be folders
     """
     print(help_text)
-    
-def main(args):
+
+
+def get_default_args():
+  """Return the full set of SynthSeg options with their default values."""
+  return {'parc': True,
+          'cpu': True,
+          'robust': True,
+          'v1': False,
+          'fast': False,
+          'post': None,
+          'resample': None,
+          'ct': None,
+          'vol': None,
+          'qc': None,
+          'device': None,
+          'crop': None,
+          'threads': '1',
+          'batch_size': 1,
+          'queue_depth': 2,
+          'tiling': 'off',
+          'tile_memory': None,
+          'tile_blending': 'gaussian',
+          'jit': False,
+          'shape_buckets': None,
+          'jit_warmup': None,
+          'precision': 'float32',
+          'backend': 'tensorflow',
+          'compression': None}
+
+
+def parse_shape(value):
+  """Parse a shape given as '192x224x192' (or a single size for a cube) into a list of 3 sizes."""
+  if isinstance(value, (list, tuple)):
+      return [int(v) for v in value]
+  sizes = [int(v) for v in str(value).lower().split('x')]
+  return sizes * 3 if len(sizes) == 1 else sizes
+
+
+def parse_crop(value):
+  """Parse a cropping given as 'auto', as a size ('192' or '160x192x160'), or as a list of sizes. None means no
+  cropping."""
+  if value is None:
+      return None
+  if isinstance(value, (list, tuple)):
+      return parse_crop(value[0]) if len(value) == 1 else [int(v) for v in value]
+  if str(value).lower() == 'auto':
+      return 'auto'
+  return parse_shape(value)
+
+
+def parse_shape_buckets(value):
+  """Parse bucket sizes given as '160,192,224,256' (or as a list) into a list of sizes."""
+  if isinstance(value, (list, tuple)):
+      return [int(v) for v in value]
+  return [int(v) for v in str(value).split(',') if v.strip()]
+
+
+def split_threads(threads, n_images):
+  """Split the thread budget of a SynthSeg run between TensorFlow's intra-op and inter-op pools, using the split
+  calibrated for this machine by `lamar threads calibrate` if there is one (see threads.get_tf_split).
+  Returns (intra_op_threads, inter_op_threads)."""
+  from lamar.scripts.threads import get_tf_split
+  return get_tf_split(threads, n_images)
+
+
+def set_tf_threads(intra_op_threads, inter_op_threads=None):
+  """Limit the TensorFlow thread pools. This can only be done once per process, before TensorFlow is initialised,
+  so later calls (e.g. a second parcellation run in the same process) keep the pools that are already running."""
+  import tensorflow as tf
+  if inter_op_threads is None:
+      inter_op_threads = intra_op_threads
+  try:
+      tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+      tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+  except RuntimeError:
+      print('TensorFlow is already initialised, keeping %s intra-op thread(s)'
+            % tf.config.threading.get_intra_op_parallelism_threads())
+
+
+def get_predict_kwargs(args):
+  """Translate SynthSeg options (see get_default_args) into keyword arguments for predict_synthseg.predict, i.e. find
+  the model weights and label lists corresponding to the requested version."""
+  from lamar.scripts.cache import parse_size
   synthseg_home = os.path.dirname(os.path.abspath(__file__))
-  sys.path.append(synthseg_home)
   model_dir = os.path.join(synthseg_home, 'models')
   labels_dir = os.path.join(synthseg_home, 'data/labels_classes_priors')
-  # The rest of your code remains unchanged
-  # print SynthSeg version and checks boolean params for SynthSeg-robust
+  args = dict(args)
   if args['robust']:
       args['fast'] = True
-      assert not args['v1'], 'The flag --v1 cannot be used with --robust since SynthSeg-robust only came out with 2.0.'
-      version = 'SynthSeg-robust 2.0'
-  else:
-      version = 'SynthSeg 1.0' if args['v1'] else 'SynthSeg 2.0'
-      if args['fast']:
-          version += ' (fast)'
-  print('\n' + version + '\n')
-
-  # enforce CPU processing if necessary
-  if args['cpu']:
-      print('using CPU, hiding all CUDA_VISIBLE_DEVICES')
-      os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-
-  # limit the number of threads to be used if running on CPU
-  import tensorflow as tf
-  args['threads'] = int(args['threads'])
-  if args['threads'] == 1:
-      print('using 1 thread')
-  else:
-      print('using %s threads' % args['threads'])
-  tf.config.threading.set_inter_op_parallelism_threads(args['threads'])
-  tf.config.threading.set_intra_op_parallelism_threads(args['threads'])
-
 
   # path models
   if args['robust']:
@@ -182,32 +315,235 @@ def main(args):
       args['topology_classes'] = args['topology_classes'].replace('_2.0.npy', '.npy')
       args['n_neutral_labels'] = 18
 
+  return dict(path_images=args['i'],
+              path_segmentations=args['o'],
+              path_model_segmentation=args['path_model_segmentation'],
+              labels_segmentation=args['labels_segmentation'],
+              robust=args['robust'],
+              fast=args['fast'],
+              v1=args['v1'],
+              do_parcellation=args['parc'],
+              n_neutral_labels=args['n_neutral_labels'],
+              names_segmentation=args['names_segmentation_labels'],
+              labels_denoiser=args['labels_denoiser'],
+              path_posteriors=args['post'],
+              path_resampled=args['resample'],
+              path_volumes=args['vol'],
+              path_model_parcellation=args['path_model_parcellation'],
+              labels_parcellation=args['labels_parcellation'],
+              names_parcellation=args['names_parcellation_labels'],
+              path_model_qc=args['path_model_qc'],
+              labels_qc=args['labels_qc'],
+              path_qc_scores=args['qc'],
+              names_qc=args['names_qc_labels'],
+              cropping=parse_crop(args['crop']),
+              topology_classes=args['topology_classes'],
+              ct=args['ct'],
+              batch_size=int(args.get('batch_size') or 1),
+              queue_depth=int(args.get('queue_depth') or 2),
+              tiling=args.get('tiling') or 'off',
+              tile_memory=parse_size(args['tile_memory']) if args.get('tile_memory') else None,
+              tile_blending=args.get('tile_blending') or 'gaussian',
+              jit=bool(args.get('jit')),
+              shape_buckets=parse_shape_buckets(args['shape_buckets']) if args.get('shape_buckets') else None,
+              jit_warmup=[parse_shape(shape) for shape in args['jit_warmup']] if args.get('jit_warmup') else None,
+              precision=args.get('precision') or 'float32',
+              backend=args.get('backend') or 'tensorflow',
+              compression=int(args['compression']) if args.get('compression') is not None else None)
+
+
+def main(args, model_cache=None, timer=None):
+  """Run SynthSeg with the given options (see get_default_args), and return the results of predict_synthseg.predict.
+  A predict_synthseg.ModelCache can be given to reuse networks across calls in the same process, and a detailed
+  pipeline.StageTimer to record the thread settings and the sub-stages of every image."""
+  # print SynthSeg version and checks boolean params for SynthSeg-robust
+  if args['robust']:
+      args['fast'] = True
+      assert not args['v1'], 'The flag --v1 cannot be used with --robust since SynthSeg-robust only came out with 2.0.'
+      version = 'SynthSeg-robust 2.0'
+  else:
+      version = 'SynthSeg 1.0' if args['v1'] else 'SynthSeg 2.0'
+      if args['fast']:
+          version += ' (fast)'
+  print('\n' + version + '\n')
+
+  # enforce CPU processing if necessary
+  if args['cpu']:
+      print('using CPU, hiding all CUDA_VISIBLE_DEVICES')
+      os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+  # limit the number of threads to be used if running on CPU
+  if args['threads'] == 'auto':
+      from lamar.scripts.threads import get_available_cores
+      args['threads'] = get_available_cores()
+  args['threads'] = int(args['threads'])
+  if args['threads'] == 1:
+      print('using 1 thread')
+  else:
+      print('using %s threads' % args['threads'])
+  n_images = len(args['i']) if isinstance(args['i'], (list, tuple)) else 1
+  intra_op_threads, inter_op_threads = split_threads(args['threads'], n_images)
+  onnxruntime = args.get('backend') == 'onnxruntime'
+  if onnxruntime:
+      # ONNX Runtime runs one operation at a time, on the intra-op threads
+      print('using ONNX Runtime')
+      if timer is not None:
+          timer.annotate(ort_intra_op_threads=intra_op_threads)
+  else:
+      set_tf_threads(intra_op_threads, inter_op_threads)
+      if timer is not None:
+          timer.annotate(tf_intra_op_threads=intra_op_threads, tf_inter_op_threads=inter_op_threads)
+
+  # reduced precision is only used for configurations validated against float32
+  if (args.get('precision') or 'float32') != 'float32':
+      if onnxruntime:
+          print('The ONNX Runtime backend runs in float32, ignoring --precision %s' % args['precision'])
+          args['precision'] = 'float32'
+      else:
+          from lamar.scripts.precision import check_precision
+          args['precision'] = check_precision(args)
+
   from lamar.SynthSeg.predict_synthseg import predict
   # run prediction
-  predict(path_images=args['i'],
-          path_segmentations=args['o'],
-          path_model_segmentation=args['path_model_segmentation'],
-          labels_segmentation=args['labels_segmentation'],
-          robust=args['robust'],
-          fast=args['fast'],
-          v1=args['v1'],
-          do_parcellation=args['parc'],
-          n_neutral_labels=args['n_neutral_labels'],
-          names_segmentation=args['names_segmentation_labels'],
-          labels_denoiser=args['labels_denoiser'],
-          path_posteriors=args['post'],
-          path_resampled=args['resample'],
-          path_volumes=args['vol'],
-          path_model_parcellation=args['path_model_parcellation'],
-          labels_parcellation=args['labels_parcellation'],
-          names_parcellation=args['names_parcellation_labels'],
-          path_model_qc=args['path_model_qc'],
-          labels_qc=args['labels_qc'],
-          path_qc_scores=args['qc'],
-          names_qc=args['names_qc_labels'],
-          cropping=args['crop'],
-          topology_classes=args['topology_classes'],
-          ct=args['ct'])
+  return predict(**get_predict_kwargs(args), threads=intra_op_threads, model_cache=model_cache, timer=timer)
+
+# (robust, fast, v1) of the SynthSeg versions whose networks differ: 2.0, 2.0 fast (no left/right flip averaging),
+# robust 2.0, 1.0 and 1.0 fast
+VERSIONS = [(False, False, False), (False, True, False), (True, True, False), (False, False, True), (False, True, True)]
+
+
+def get_model_config(args):
+  """build_model keyword arguments of the network used with the given SynthSeg options (see get_default_args), where
+  args['qc'] only needs to be truthy for the network to include the QC regressor."""
+  from lamar.SynthSeg.predict_synthseg import get_model_config as get_config
+  kwargs = get_predict_kwargs(dict(args, i=None, o=None))
+  return get_config(path_model_segmentation=kwargs['path_model_segmentation'],
+                    labels_segmentation=kwargs['labels_segmentation'],
+                    robust=kwargs['robust'],
+                    fast=kwargs['fast'],
+                    n_neutral_labels=kwargs['n_neutral_labels'],
+                    labels_denoiser=kwargs['labels_denoiser'],
+                    do_parcellation=kwargs['do_parcellation'],
+                    path_model_parcellation=kwargs['path_model_parcellation'],
+                    labels_parcellation=kwargs['labels_parcellation'],
+                    do_qc=bool(args['qc']),
+                    path_model_qc=kwargs['path_model_qc'],
+                    labels_qc=kwargs['labels_qc'],
+                    precision=kwargs['precision'])[0]
+
+
+def get_compile_configurations(args, all_configurations=False):
+  """SynthSeg options of the networks exported by `lamar synthseg compile`: the ones given by args, or every version
+  with and without parcellation and QC."""
+  if not all_configurations:
+      return [dict(args)]
+  return [dict(args, robust=robust, fast=fast, v1=v1, parc=parc, qc=qc)
+          for robust, fast, v1 in VERSIONS for parc in [False, True] for qc in [False, True]]
+
+
+def describe_configuration(args):
+  version = 'SynthSeg-robust 2.0' if args['robust'] else ('SynthSeg 1.0' if args['v1'] else 'SynthSeg 2.0')
+  if args['fast'] and not args['robust']:
+      version += ' (fast)'
+  return version + (' +parc' if args['parc'] else '') + (' +qc' if args['qc'] else '')
+
+
+def _time_first_prediction(model_config, compiled_path=None, size=160, backend='tensorflow'):
+  """Seconds to get the network of a configuration (built from its .h5 weights, or loaded from its exported
+  directory), seconds of its first prediction on a random image, and peak memory of that prediction (increase of the
+  peak resident set size) per input voxel. Runs in a fresh process, so that nothing is reused from a previous network
+  and the peak resident set size is that of this prediction."""
+  os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+  import time
+  import resource
+  import numpy as np
+  from lamar.SynthSeg import predict_synthseg
+  start = time.perf_counter()
+  if compiled_path is not None and backend == 'onnxruntime':
+      from lamar.SynthSeg.predict_onnx import load_onnx_model
+      net = load_onnx_model(compiled_path)
+  elif compiled_path is not None:
+      net = predict_synthseg.load_compiled_model(compiled_path)
+  else:
+      net = predict_synthseg.build_model(**model_config)
+  image = np.random.default_rng(0).random((1, size, size, size, 1), dtype=np.float32)
+  ready = time.perf_counter()
+  rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+  predict_synthseg.run_network(net, image, model_config['do_parcellation'], model_config['do_qc'])
+  done = time.perf_counter()
+  peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+  return ready - start, done - ready, peak / size ** 3
+
+
+def benchmark_first_prediction(model_config, compiled_path, size=160, backend='tensorflow'):
+  """Time to the first prediction of a configuration, with the network built from the .h5 weights and with the
+  exported one, and peak memory of that prediction. Returns {'build': (get, predict, bytes_per_voxel), 'compiled':
+  (get, predict, bytes_per_voxel)}, with times in seconds."""
+  import multiprocessing
+  context = multiprocessing.get_context('spawn')
+  timings = dict()
+  for name, path in [('build', None), ('compiled', compiled_path)]:
+      with context.Pool(1) as pool:
+          timings[name] = pool.apply(_time_first_prediction, (model_config, path), {'size': size, 'backend': backend})
+  return timings
+
+
+def compile_main(argv=None):
+  """Entry point of `lamar synthseg compile`: export the networks of one or every SynthSeg configuration, so that
+  SynthSeg loads them instead of building them."""
+  parser = ArgumentParser(prog='lamar synthseg compile',
+                          description="Export SynthSeg networks as ready-to-run SavedModels (or ONNX graphs)")
+  parser.add_argument("--parc", action="store_true", help="Network with cortex parcellation.")
+  parser.add_argument("--robust", action="store_true", help="Network of SynthSeg-robust.")
+  parser.add_argument("--fast", action="store_true", help="Network of the fast mode (no left/right flip averaging).")
+  parser.add_argument("--v1", action="store_true", help="Network of SynthSeg 1.0.")
+  parser.add_argument("--qc", action="store_true", help="Network with the QC regressor.")
+  parser.add_argument("--precision", choices=['float32', 'bfloat16', 'float16'], default='float32',
+                      help="Precision of the UNets of the network (default: float32).")
+  parser.add_argument("--backend", choices=['tensorflow', 'onnxruntime'], default='tensorflow',
+                      help="Export SavedModels for TensorFlow, or ONNX graphs for ONNX Runtime (default: tensorflow).")
+  parser.add_argument("--all", action="store_true", help="Export every version with and without --parc and --qc.")
+  parser.add_argument("--model-dir", help="Directory of the exported networks (default: $LAMAR_MODEL_DIR or "
+                                          "~/.cache/lamar/models).")
+  parser.add_argument("--force", action="store_true", help="Export networks again even if they already exist.")
+  parser.add_argument("--benchmark", action="store_true",
+                      help="Compare the time to the first prediction of built and exported networks, and measure "
+                           "its peak memory per voxel.")
+  parser.add_argument("--check", metavar="IMAGE",
+                      help="Compare the outputs of the exported ONNX graphs and of TensorFlow on this image.")
+  options = parser.parse_args(argv)
+  if options.robust and options.v1:
+      parser.error('--v1 cannot be used with --robust since SynthSeg-robust only came out with 2.0.')
+  if options.backend == 'onnxruntime' and options.precision != 'float32':
+      parser.error('ONNX graphs are exported in float32, --precision cannot be used with --backend onnxruntime.')
+  if options.check and options.backend != 'onnxruntime':
+      parser.error('--check compares the ONNX graphs to TensorFlow, it requires --backend onnxruntime.')
+
+  os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+  import keras
+  from lamar.SynthSeg.predict_synthseg import export_model
+  from lamar.SynthSeg.predict_onnx import export_onnx_model, compare_backends
+  args = dict(get_default_args(), parc=options.parc, robust=options.robust, fast=options.fast or options.robust,
+              v1=options.v1, qc=options.qc, precision=options.precision)
+  for configuration in get_compile_configurations(args, options.all):
+      model_config = get_model_config(configuration)
+      if options.backend == 'onnxruntime':
+          path = export_onnx_model(model_config, options.model_dir, overwrite=options.force)
+      else:
+          path = export_model(model_config, options.model_dir, overwrite=options.force)
+      keras.backend.clear_session()
+      print(f"{describe_configuration(configuration)}: {path}")
+      if options.check:
+          for output, (difference, agreement) in compare_backends(model_config, path, options.check).items():
+              print(f"  {output:12s}: max absolute difference {difference:.2e}" +
+                    (f", same label in {100 * agreement:.3f}% of voxels" if agreement is not None else ""))
+          keras.backend.clear_session()
+      if options.benchmark:
+          timings = benchmark_first_prediction(model_config, path, backend=options.backend)
+          for name, (get_seconds, predict_seconds, bytes_per_voxel) in timings.items():
+              print(f"  {name:8s}: network ready in {get_seconds:.2f}s, first prediction in {predict_seconds:.2f}s "
+                    f"(total {get_seconds + predict_seconds:.2f}s), peak memory {bytes_per_voxel:.0f} bytes/voxel")
+
 
 if __name__ == '__main__':
     # Check if help flags are provided or no arguments
@@ -233,8 +569,33 @@ if __name__ == '__main__':
   parser.add_argument("--qc", help="(optional) Path to output CSV file with qc scores for all subjects.")
   parser.add_argument("--post", help="(optional) Posteriors output(s). Must be a folder if --i designates a folder.")
   parser.add_argument("--resample", help="(optional) Resampled image(s). Must be a folder if --i designates a folder.")
-  parser.add_argument("--crop", nargs='+', type=int, help="(optional) Size of 3D patches to analyse. Default is 192.")
-  parser.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1.")
+  parser.add_argument("--crop", nargs='+', help="(optional) Size of 3D patches to analyse, or auto to only analyse "
+                                                 "the bounding box of the head. Default is the whole image.")
+  parser.add_argument("--compression", type=int, choices=range(10), metavar='{0..9}',
+                      help="(optional) gzip level of .nii.gz and .mgz outputs, compressed on --threads threads. "
+                           "Default is nibabel's level.")
+  parser.add_argument("--threads", default=1, help="(optional) Number of cores to be used, or auto. Default is 1.")
+  parser.add_argument("--batch-size", type=int, default=1,
+                      help="(optional) Number of images of the same shape run through the network together.")
+  parser.add_argument("--queue-depth", type=int, default=2,
+                      help="(optional) Number of images waiting between the load, network and save stages.")
+  parser.add_argument("--tiling", choices=['auto', 'off'], default='off',
+                      help="(optional) Run images too large for the memory budget through the network in tiles "
+                           "(default: off).")
+  parser.add_argument("--tile-memory", help="(optional) Memory budget of the network, e.g. 4G. Default is 80%% of the "
+                                            "available memory.")
+  parser.add_argument("--tile-blending", choices=['gaussian', 'linear'], default='gaussian',
+                      help="(optional) Weights used to stitch overlapping tiles.")
+  parser.add_argument("--jit", action="store_true", help="(optional) Run the network in an XLA-compiled function.")
+  parser.add_argument("--shape-buckets", help="(optional) Sizes padded shapes are snapped to, e.g. 160,192,224,256 "
+                                              "(default with --jit).")
+  parser.add_argument("--jit-warmup", nargs='+', help="(optional) Padded shapes compiled before the first image, "
+                                                      "e.g. 192x224x192.")
+  parser.add_argument("--precision", choices=['float32', 'bfloat16', 'float16'], default='float32',
+                      help="(optional) Precision of the UNets, reduced ones only once validated. Default is float32.")
+  parser.add_argument("--backend", choices=['tensorflow', 'onnxruntime'], default='tensorflow',
+                      help="(optional) Run the networks with TensorFlow, or with ONNX Runtime once exported by "
+                           "`lamar synthseg compile --backend onnxruntime`. Default is tensorflow.")
   parser.add_argument("--cpu", action="store_true", help="(optional) Enforce running with CPU rather than GPU.")
   parser.add_argument("--v1", action="store_true", help="(optional) Use SynthSeg 1.0 (updated 25/06/22).")
 
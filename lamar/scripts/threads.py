@@ -0,0 +1,300 @@
+"""
+threads - Core budget of LaMAR runs, shared between TensorFlow and ITK
+
+Part of the LaMAR processing pipeline.
+
+With --threads N (or --threads auto, which uses every core the process may
+actually run on), `lamar register`, `generate-warpfield` and `apply-warpfield`
+split one core budget between their stages instead of relying on
+--synthseg-threads and --ants-threads:
+- SynthSeg gets the whole budget, split between the TensorFlow intra-op pool
+  (threads of one operation, e.g. a convolution) and inter-op pool
+  (operations run concurrently), keeping one core for the background thread
+  that pre/postprocesses the other images,
+- ANTs/ITK registrations get the whole budget, divided by the number of
+  registrations run at the same time (--parallel).
+
+The available cores are the intersection of the CPU affinity of the process
+(taskset, Slurm/cpusets) and of its cgroup CPU quota (Docker --cpus, Kubernetes
+limits, cgroup v1 and v2).
+
+The best intra/inter-op split depends on the machine. `lamar threads
+calibrate` times a small 3D convolutional network with the candidate splits of
+the network's share of a core budget (the budget minus the background thread's
+core when several images are parcellated) and stores the fastest one in
+$LAMAR_CALIBRATION (default: ~/.cache/lamar/threads.json), keyed by that share.
+SynthSeg then uses the calibrated split whenever one exists for its network
+budget, and falls back to the built-in heuristic otherwise. Both keep the sum
+of the intra-op and inter-op threads within the network budget, except for a
+budget of 1, which still needs one thread in each pool (TensorFlow reads 0 as
+one thread per core).
+
+Command-line Usage:
+-----------------
+lamar threads show
+lamar threads calibrate [--threads <num_threads>] [--images <n>] [--repeats <n>]
+
+Python Usage:
+-----------
+>>> from lamar.scripts.threads import plan_threads
+>>> plan = plan_threads("auto", parallel=2, n_images=3)
+>>> plan['synthseg_threads'], plan['ants_threads']
+(16, 8)
+"""
+
+import os
+import json
+import math
+import time
+import socket
+import tempfile
+import argparse
+import multiprocessing
+
+
+def parse_threads(value):
+    """argparse type of --threads: a positive number of threads, or 'auto'."""
+    if value == 'auto':
+        return value
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if threads < 1:
+        raise argparse.ArgumentTypeError(f"invalid thread count: {value!r} (expected a positive integer or 'auto')")
+    return threads
+
+
+def _read_cpu_max(path):
+    """Number of CPUs allowed by a cgroup v2 cpu.max file, or None if unlimited or unreadable."""
+    try:
+        with open(path) as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _read_cfs_quota(directory):
+    """Number of CPUs allowed by a cgroup v1 CFS quota, or None if unlimited or unreadable."""
+    try:
+        with open(os.path.join(directory, 'cpu.cfs_quota_us')) as f:
+            quota = int(f.read())
+        with open(os.path.join(directory, 'cpu.cfs_period_us')) as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def get_cgroup_cpu_limit(root='/'):
+    """CPU quota of the cgroup of the process (and of its parents), as a number of CPUs, or None if unlimited. root is
+    where /proc and /sys are looked up."""
+    cgroup_root = os.path.join(root, 'sys', 'fs', 'cgroup')
+    try:
+        with open(os.path.join(root, 'proc', 'self', 'cgroup')) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    limits = []
+    for line in lines:
+        hierarchy, controllers, path = line.split(':', 2)
+        if hierarchy == '0' and not controllers:
+            # cgroup v2: every level of the hierarchy may set a quota
+            directory = os.path.join(cgroup_root, path.lstrip('/'))
+            while True:
+                limits.append(_read_cpu_max(os.path.join(directory, 'cpu.max')))
+                if os.path.normpath(directory) == os.path.normpath(cgroup_root):
+                    break
+                directory = os.path.dirname(directory)
+        elif 'cpu' in controllers.split(','):
+            # cgroup v1: the hierarchy is mounted under the name of its controllers, and containers only see their
+            # own cgroup at the root of the mount
+            for mount in [os.path.join(cgroup_root, 'cpu'), os.path.join(cgroup_root, controllers)]:
+                limits.append(_read_cfs_quota(os.path.join(mount, path.lstrip('/'))))
+                limits.append(_read_cfs_quota(mount))
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
+
+
+def describe_cpu_budget():
+    """Where the number of available cores comes from: CPU count, affinity, cgroup quota, and the resulting budget."""
+    description = {'cpu_count': os.cpu_count() or 1}
+    if hasattr(os, 'sched_getaffinity'):
+        description['affinity'] = len(os.sched_getaffinity(0))
+    quota = get_cgroup_cpu_limit()
+    if quota is not None:
+        description['cgroup_quota'] = round(quota, 2)
+    candidates = [description.get('affinity', description['cpu_count'])]
+    if quota is not None:
+        # a fractional quota still lets every thread make progress, so it is rounded up
+        candidates.append(max(1, math.ceil(quota)))
+    description['available_cores'] = min(candidates)
+    return description
+
+
+def get_available_cores():
+    """Number of cores the process can actually use, given its CPU affinity and cgroup CPU quota."""
+    return describe_cpu_budget()['available_cores']
+
+
+def get_calibration_path():
+    return os.environ.get('LAMAR_CALIBRATION') or \
+        os.path.join(os.path.expanduser('~'), '.cache', 'lamar', 'threads.json')
+
+
+def _get_machine_key():
+    return f"{socket.gethostname()}/{os.cpu_count()}cpu"
+
+
+def load_calibration():
+    """Calibrated TensorFlow splits of this machine, as {network_threads: (intra_op_threads, inter_op_threads)}."""
+    try:
+        with open(get_calibration_path()) as f:
+            splits = json.load(f).get(_get_machine_key(), {}).get('splits', {})
+    except (OSError, ValueError):
+        return {}
+    return {int(threads): (split['intra_op_threads'], split['inter_op_threads']) for threads, split in splits.items()}
+
+
+def _get_network_threads(threads, n_images):
+    # with several images, one core is kept for the background pre/postprocessing thread
+    return threads - 1 if n_images >= 2 and threads >= 3 else threads
+
+
+def get_tf_split(threads, n_images=1):
+    """Split a SynthSeg thread budget between TensorFlow's intra-op and inter-op pools.
+    With several images, one core is left to the background thread that preprocesses the next image and postprocesses
+    the previous one while the network runs. The calibrated split of the remaining budget is used if there is one,
+    otherwise a couple of inter-op threads are enough, and the intra-op pool gets the rest of the budget. A budget of 1
+    is the only one exceeded: it gets a thread in each pool.
+    Returns (intra_op_threads, inter_op_threads)."""
+    network_threads = _get_network_threads(threads, n_images)
+    if network_threads <= 1:
+        # both pools need a thread (0 would let TensorFlow use every core)
+        return 1, 1
+    calibrated = load_calibration().get(network_threads)
+    if calibrated is not None:
+        return calibrated
+    inter_op_threads = 2 if network_threads >= 4 else 1
+    return max(1, network_threads - inter_op_threads), inter_op_threads
+
+
+def plan_threads(threads='auto', parallel=1, n_images=2):
+    """Split a core budget ('auto' for all the available cores) between the stages of a LaMAR run, given the number
+    of registrations run at the same time and the number of images parcellated together."""
+    budget = describe_cpu_budget()
+    total = budget['available_cores'] if threads in (None, 'auto') else int(threads)
+    intra_op_threads, inter_op_threads = get_tf_split(total, n_images)
+    return {'requested': threads if threads is not None else 'auto',
+            'cores': total,
+            'cpu_budget': budget,
+            'synthseg_threads': total,
+            'tf_intra_op_threads': intra_op_threads,
+            'tf_inter_op_threads': inter_op_threads,
+            'tf_split_calibrated': _get_network_threads(total, n_images) in load_calibration(),
+            'ants_threads': max(1, total // max(1, parallel)),
+            'parallel_registrations': parallel}
+
+
+def get_candidate_splits(threads):
+    """(intra_op_threads, inter_op_threads) splits tried by the calibration for a thread budget. The two pools of a
+    candidate never use more threads than the budget, except for a budget of 1, which still needs one of each."""
+    splits = {(max(1, threads - 1), 1)}
+    for inter in {1, 2, min(threads, 4)}:
+        for intra in {threads - inter, threads // 2, threads // 4}:
+            if intra >= 1 and intra + inter <= threads:
+                splits.add((intra, inter))
+    return sorted(splits, reverse=True)
+
+
+def _benchmark_split(intra_op_threads, inter_op_threads, size=64, repeats=3):
+    """Median time of a forward pass of a small 3D U-Net-like network (SynthSeg-like layers) with the given pools.
+    Runs in a fresh process, since TensorFlow pools can only be set before TensorFlow is initialised."""
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '3')
+    import numpy as np
+    import tensorflow as tf
+    from tensorflow import keras
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+    inputs = keras.Input(shape=(None, None, None, 1))
+    conv1 = keras.layers.Conv3D(24, 3, padding='same', activation='elu')(inputs)
+    conv1 = keras.layers.Conv3D(24, 3, padding='same', activation='elu')(conv1)
+    conv2 = keras.layers.Conv3D(48, 3, padding='same', activation='elu')(keras.layers.MaxPooling3D(2)(conv1))
+    up = keras.layers.UpSampling3D(2)(conv2)
+    merged = keras.layers.Concatenate()([conv1, up])
+    outputs = keras.layers.Conv3D(32, 1, activation='softmax')(merged)
+    model = keras.Model(inputs, outputs)
+
+    volume = np.random.default_rng(0).random((1, size, size, size, 1), dtype=np.float32)
+    model.predict(volume, verbose=0)  # warm-up
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict(volume, verbose=0)
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2]
+
+
+def calibrate(threads=None, n_images=2, repeats=3):
+    """Time the candidate TensorFlow splits of the network budget of a SynthSeg run parcellating n_images with a thread
+    budget (default: all the available cores), each in a fresh process, and store the fastest one in the calibration
+    file under that network budget, where get_tf_split looks it up. Returns {(intra, inter): seconds}."""
+    threads = threads or get_available_cores()
+    network_threads = _get_network_threads(threads, n_images)
+    timings = {}
+    context = multiprocessing.get_context('spawn')
+    for intra_op_threads, inter_op_threads in get_candidate_splits(network_threads):
+        with context.Pool(1) as pool:
+            seconds = pool.apply(_benchmark_split, (intra_op_threads, inter_op_threads), {'repeats': repeats})
+        timings[(intra_op_threads, inter_op_threads)] = seconds
+        print(f"  intra-op {intra_op_threads:3d}, inter-op {inter_op_threads:3d}: {seconds:.3f}s")
+    best = min(timings, key=timings.get)
+
+    path = get_calibration_path()
+    try:
+        with open(path) as f:
+            calibration = json.load(f)
+    except (OSError, ValueError):
+        calibration = {}
+    machine = calibration.setdefault(_get_machine_key(), {'splits': {}})
+    machine['splits'][str(network_threads)] = {'intra_op_threads': best[0], 'inter_op_threads': best[1],
+                                               'seconds': round(timings[best], 4),
+                                               'calibrated': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(tmp_path, path)
+    print(f"Best split for {network_threads} network thread(s): {best[0]} intra-op, {best[1]} inter-op "
+          f"({timings[best]:.3f}s), saved to {path}")
+    return timings
+
+
+def main(args):
+    """Entry point of `lamar threads`, given the parsed arguments."""
+    if args.action == "show":
+        budget = describe_cpu_budget()
+        print(f"CPU count:       {budget['cpu_count']}")
+        if 'affinity' in budget:
+            print(f"CPU affinity:    {budget['affinity']}")
+        print(f"cgroup quota:    {budget.get('cgroup_quota', 'none')}")
+        print(f"Available cores: {budget['available_cores']}")
+        splits = load_calibration()
+        if splits:
+            print(f"Calibrated TensorFlow splits ({get_calibration_path()}):")
+            for threads, (intra_op_threads, inter_op_threads) in sorted(splits.items()):
+                print(f"  {threads} network thread(s): {intra_op_threads} intra-op, {inter_op_threads} inter-op")
+        else:
+            print("No calibrated TensorFlow splits (run `lamar threads calibrate`)")
+    elif args.action == "calibrate":
+        threads = args.threads if args.threads not in (None, 'auto') else get_available_cores()
+        network_threads = _get_network_threads(threads, args.images)
+        print(f"Calibrating TensorFlow thread pools for {threads} thread(s) and {args.images} image(s) "
+              f"({network_threads} network thread(s))")
+        calibrate(threads, n_images=args.images, repeats=args.repeats)
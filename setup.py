@@ -23,6 +23,9 @@ setup(
     ],
     python_requires=">=3.8",
     install_requires=requirements,
+    extras_require={
+        'onnx': ['onnxruntime>=1.17', 'tf2onnx>=1.16'],
+    },
     entry_points={
         'console_scripts': [
             'lamar=lamar.cli:main'
@@ -0,0 +1,72 @@
+"""BatchScheduler, with threads standing in for the worker processes."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from lamar.scripts import batch
+
+
+class FakePool(ThreadPoolExecutor):
+    """Pool running the stages in threads. With crash, the first stage to start kills its worker once the other
+    stages have started: like in a process pool, every stage on the pool then raises BrokenProcessPool."""
+
+    def __init__(self, runs, crash=False):
+        super().__init__(max_workers=4)
+        self.runs = runs
+        self.crash = crash
+        self.started = threading.Lock()
+        self.broken = threading.Event()
+
+    def submit(self, fn, stage, subject, registration_method, log_file):
+        return super().submit(self.run_stage, stage, subject['id'])
+
+    def run_stage(self, stage, subject_id):
+        if self.crash:
+            if self.started.acquire(blocking=False):
+                time.sleep(0.05)
+                self.broken.set()
+            self.broken.wait()
+            raise BrokenProcessPool('A process in the process pool was terminated abruptly')
+        self.runs.append((subject_id, stage))
+        return 0.1
+
+
+def make_scheduler(tmp_path, n_subjects, n_crashes):
+    subjects = [{'id': f'sub-{n}', 'moving': 'moving.nii.gz', 'fixed': 'fixed.nii.gz'} for n in range(n_subjects)]
+    scheduler = batch.BatchScheduler(subjects, cores=4, memory='64G', log_dir=str(tmp_path))
+    runs = []
+    pools = []
+
+    def new_pool():
+        pools.append(FakePool(runs, crash=len(pools) < n_crashes))
+        return pools[-1]
+
+    scheduler._new_pool = new_pool
+    return scheduler, runs, pools
+
+
+def test_all_stages_run(tmp_path):
+    scheduler, runs, pools = make_scheduler(tmp_path, 3, 0)
+    assert scheduler.run() == 0
+    assert sorted(runs) == sorted((f'sub-{n}', stage) for n in range(3) for stage in ['synthseg', 'coregister', 'dice'])
+    assert len(pools) == 1
+
+
+@pytest.mark.parametrize('n_crashes', [1, 2, 3])
+def test_dead_worker_only_fails_one_stage(tmp_path, n_crashes):
+    # the 4 synthseg stages are on the pool when it breaks
+    scheduler, runs, pools = make_scheduler(tmp_path, 4, n_crashes)
+    assert scheduler.run() == n_crashes
+    assert len(pools) == n_crashes + 1
+    failed = [subject_id for subject_id, status in scheduler.status.items() if status == 'failed']
+    assert len(failed) == n_crashes
+    for subject_id in failed:
+        assert scheduler.errors[subject_id].startswith('synthseg: worker process died')
+    # the other stages that were on the broken pools ran again on a new one
+    for subject_id in scheduler.status:
+        expected = [] if subject_id in failed else ['coregister', 'dice', 'synthseg']
+        assert sorted(stage for sid, stage in runs if sid == subject_id) == expected
@@ -0,0 +1,141 @@
+"""cache.ParcellationCache and parcellate_with_cache."""
+
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from lamar.scripts import cache as cache_module
+from lamar.scripts.cache import ParcellationCache, parcellate_with_cache
+
+CONFIG = {'robust': True, 'fast': True, 'parc': True}
+
+
+def save_image(path, data=None, aff=None, compression=None):
+    data = np.arange(6 * 7 * 5, dtype='int16').reshape(6, 7, 5) if data is None else data
+    image = nib.Nifti1Image(data, np.diag([1., 1.2, 0.9, 1.]) if aff is None else aff)
+    if compression is None:
+        nib.save(image, str(path))
+    else:
+        import gzip
+        with gzip.open(str(path), 'wb', compresslevel=compression) as f:
+            f.write(image.to_bytes())
+    return str(path)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ParcellationCache(str(tmp_path / 'cache'), max_size='1G')
+
+
+def test_key_is_independent_of_name_and_compression(tmp_path, cache):
+    key = cache.get_key(save_image(tmp_path / 'sub-001_T1w.nii'), CONFIG)
+    assert cache.get_key(save_image(tmp_path / 'renamed.nii.gz', compression=1), CONFIG) == key
+    assert cache.get_key(save_image(tmp_path / 'recompressed.nii.gz', compression=9), CONFIG) == key
+
+
+def test_key_depends_on_voxels_affine_and_config(tmp_path, cache):
+    key = cache.get_key(save_image(tmp_path / 'image.nii'), CONFIG)
+    data = np.arange(6 * 7 * 5, dtype='int16').reshape(6, 7, 5)
+    data[3, 3, 3] += 1
+    assert cache.get_key(save_image(tmp_path / 'voxel.nii', data=data), CONFIG) != key
+    assert cache.get_key(save_image(tmp_path / 'affine.nii', aff=np.diag([1., 1.2, 1., 1.])), CONFIG) != key
+    assert cache.get_key(save_image(tmp_path / 'image.nii'), dict(CONFIG, parc=False)) != key
+
+
+def test_fetch_links_the_entry(tmp_path, cache):
+    parc = save_image(tmp_path / 'parc.nii.gz')
+    assert not cache.fetch('ab' * 32, str(tmp_path / 'miss.nii.gz'))
+    cache.store('ab' * 32, parc)
+    output = str(tmp_path / 'out' / 'parc.nii.gz')
+    assert cache.fetch('ab' * 32, output)
+    assert os.path.samefile(output, cache._entry('ab' * 32))
+
+
+def test_fetch_copies_when_links_fail(tmp_path, cache, monkeypatch):
+    cache.store('ab' * 32, save_image(tmp_path / 'parc.nii.gz'))
+
+    def link(source, destination):
+        raise OSError('Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'link', link)
+    output = str(tmp_path / 'parc_copy.nii.gz')
+    assert cache.fetch('ab' * 32, output)
+    assert not os.path.samefile(output, cache._entry('ab' * 32))
+    with open(output, 'rb') as f, open(cache._entry('ab' * 32), 'rb') as g:
+        assert f.read() == g.read()
+
+
+def test_fetch_does_not_touch_linked_outputs(tmp_path, cache):
+    cache.store('ab' * 32, save_image(tmp_path / 'parc.nii.gz'))
+    output = str(tmp_path / 'first.nii.gz')
+    cache.fetch('ab' * 32, output)
+    os.utime(output, (1e9, 1e9))
+    cache.fetch('ab' * 32, str(tmp_path / 'second.nii.gz'))
+    assert os.stat(output).st_mtime == 1e9
+
+
+def test_prune_evicts_least_recently_used(tmp_path, cache):
+    parc = save_image(tmp_path / 'parc.nii.gz')
+    keys = [str(n) * 64 for n in range(4)]
+    for n, key in enumerate(keys):
+        cache.store(key, parc, metadata={'n': n})
+        os.utime(cache._entry(key), (1e9 + n, 1e9 + n))
+    # the oldest entry was used last
+    cache.fetch(keys[0], str(tmp_path / 'out.nii.gz'))
+    size = os.path.getsize(cache._entry(keys[0]))
+
+    assert cache.prune(max_size=2 * size) == 2
+    assert [os.path.isfile(cache._entry(key)) for key in keys] == [True, False, False, True]
+    assert not os.path.exists(cache._entry(keys[1]).replace('.nii.gz', '.json'))
+    assert cache.stats()['entries'] == 2
+    assert cache.prune(max_size=0) == 2
+    assert os.listdir(os.path.dirname(cache._entry(keys[0]))) == []
+
+
+def test_store_evicts_beyond_max_size(tmp_path):
+    parc = save_image(tmp_path / 'parc.nii.gz')
+    cache = ParcellationCache(str(tmp_path / 'cache'), max_size=os.path.getsize(parc))
+    cache.store('1' * 64, parc)
+    os.utime(cache._entry('1' * 64), (1e9, 1e9))
+    cache.store('2' * 64, parc)
+    assert [os.path.basename(path) for path, _, _ in cache.entries()] == ['2' * 64 + '.nii.gz']
+
+
+class FakeEngine:
+    """Pipeline engine whose parcellation of an image is a copy of it."""
+
+    def __init__(self):
+        self.parcellated = []
+
+    def parcellate(self, images, parcs, stage_name='synthseg'):
+        for image, parc in zip(images, parcs):
+            nib.save(nib.load(image), parc)
+        self.parcellated.extend(images)
+
+
+def test_parcellate_with_cache(tmp_path, cache):
+    images = [save_image(tmp_path / 'a.nii'),
+              save_image(tmp_path / 'b.nii', data=np.ones((6, 7, 5), dtype='int16'))]
+    engine = FakeEngine()
+    parcellate_with_cache(engine, images, [str(tmp_path / 'a_parc.nii.gz'), str(tmp_path / 'b_parc.nii.gz')],
+                          cache=cache)
+    assert engine.parcellated == images
+
+    # a renamed copy of an image hits the cache, a new image misses it
+    renamed = save_image(tmp_path / 'a_renamed.nii.gz', compression=1)
+    new = save_image(tmp_path / 'c.nii', data=np.zeros((6, 7, 5), dtype='int16'))
+    parcellate_with_cache(engine, [renamed, new], [str(tmp_path / 'a2.nii.gz'), str(tmp_path / 'c.nii.gz')],
+                          cache=cache)
+    assert engine.parcellated == images + [new]
+    np.testing.assert_array_equal(nib.load(str(tmp_path / 'a2.nii.gz')).get_fdata(),
+                                  nib.load(images[0]).get_fdata())
+
+
+def test_parcellate_without_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv('LAMAR_CACHE_DIR', raising=False)
+    engine = FakeEngine()
+    parcellate_with_cache(engine, [save_image(tmp_path / 'a.nii')], [str(tmp_path / 'a_parc.nii.gz')])
+    assert engine.parcellated == [str(tmp_path / 'a.nii')]
+    assert cache_module.ParcellationCache.from_env() is None
@@ -0,0 +1,137 @@
+"""checkpoint.Checkpoints on a two-stage pipeline of real files."""
+
+import os
+import shutil
+
+import pytest
+
+from lamar.scripts import report
+from lamar.scripts.checkpoint import Checkpoints, get_manifest_path
+
+
+def run_pipeline(checkpoints, directory, params=None):
+    """Parcellate an image (keeping its first line) then register the parcellation, as lamar.py does. Returns the
+    stages that ran."""
+    image, parc, registered = [os.path.join(directory, name) for name in ['image.txt', 'parc.txt', 'registered.txt']]
+    ran = []
+    if not checkpoints.is_current('synthseg', [image], [parc], params):
+        checkpoints.invalidate([parc])
+        with open(image) as f, open(parc, 'w') as out:
+            out.write(f.readline().upper())
+        checkpoints.record('synthseg', [image], [parc], params)
+        ran.append('synthseg')
+    if not checkpoints.is_current('coregister', [parc], [registered]):
+        checkpoints.invalidate([registered])
+        with open(parc) as f, open(registered, 'w') as out:
+            out.write(f.read()[::-1])
+        checkpoints.record('coregister', [parc], [registered])
+        ran.append('coregister')
+    return ran
+
+
+@pytest.fixture
+def directory(tmp_path):
+    (tmp_path / 'image.txt').write_text('first line\nsecond line\n')
+    return str(tmp_path)
+
+
+def test_unchanged_run_is_skipped(directory):
+    assert run_pipeline(Checkpoints(), directory) == ['synthseg', 'coregister']
+    assert run_pipeline(Checkpoints(), directory) == []
+
+
+def test_modified_input_recomputes_downstream(directory):
+    run_pipeline(Checkpoints(), directory)
+    with open(os.path.join(directory, 'image.txt'), 'w') as f:
+        f.write('other first line\nsecond line\n')
+    assert run_pipeline(Checkpoints(), directory) == ['synthseg', 'coregister']
+
+
+def test_downstream_is_kept_when_its_inputs_are_the_same(directory):
+    run_pipeline(Checkpoints(), directory)
+    # the parcellation is recomputed, but identical: its registration is still current
+    with open(os.path.join(directory, 'image.txt'), 'w') as f:
+        f.write('first line\nanother second line\n')
+    assert run_pipeline(Checkpoints(), directory) == ['synthseg']
+
+
+def test_modified_output_is_not_current(directory):
+    run_pipeline(Checkpoints(), directory)
+    with open(os.path.join(directory, 'registered.txt'), 'a') as f:
+        f.write('edited')
+    assert run_pipeline(Checkpoints(), directory) == ['coregister']
+
+
+def test_moved_outputs_are_not_current(directory, tmp_path_factory):
+    run_pipeline(Checkpoints(), directory)
+    # outputs and manifests moved together to another directory: the manifests point to the old outputs
+    moved = str(tmp_path_factory.mktemp('moved') / 'run')
+    shutil.copytree(directory, moved)
+    shutil.rmtree(directory)
+    assert run_pipeline(Checkpoints(), moved) == ['synthseg', 'coregister']
+
+
+def test_missing_output_is_not_current(directory):
+    run_pipeline(Checkpoints(), directory)
+    os.remove(os.path.join(directory, 'registered.txt'))
+    assert run_pipeline(Checkpoints(), directory) == ['coregister']
+
+
+@pytest.mark.parametrize('force_stages, expected', [(['coregister'], ['coregister']),
+                                                     (['synthseg'], ['synthseg']),
+                                                     (['all'], ['synthseg', 'coregister'])])
+def test_force_stage(directory, force_stages, expected):
+    run_pipeline(Checkpoints(), directory)
+    assert run_pipeline(Checkpoints(force_stages), directory) == expected
+
+
+def test_unknown_force_stage():
+    with pytest.raises(ValueError, match='register'):
+        Checkpoints(['register'])
+
+
+def test_disabled(directory):
+    assert run_pipeline(Checkpoints(enabled=False), directory) == ['synthseg', 'coregister']
+    assert not os.path.exists(get_manifest_path(os.path.join(directory, 'parc.txt')))
+    assert run_pipeline(Checkpoints(enabled=False), directory) == ['synthseg', 'coregister']
+
+
+def test_truncated_manifest_is_ignored(directory):
+    run_pipeline(Checkpoints(), directory)
+    manifest_path = get_manifest_path(os.path.join(directory, 'parc.txt'))
+    with open(manifest_path) as f:
+        manifest = f.read()
+    with open(manifest_path, 'w') as f:
+        f.write(manifest[:len(manifest) // 2])
+    assert run_pipeline(Checkpoints(), directory) == ['synthseg']
+
+
+def test_params(directory):
+    run_pipeline(Checkpoints(), directory, params={'shape': (1, 2), 'parc': True})
+    # tuples are stored as lists
+    assert run_pipeline(Checkpoints(), directory, params={'parc': True, 'shape': [1, 2]}) == []
+    assert run_pipeline(Checkpoints(), directory, params={'parc': False, 'shape': [1, 2]}) == ['synthseg']
+
+
+def test_invalidate(directory):
+    run_pipeline(Checkpoints(), directory)
+    checkpoints = Checkpoints()
+    checkpoints.invalidate([os.path.join(directory, 'parc.txt')])
+    assert not os.path.exists(get_manifest_path(os.path.join(directory, 'parc.txt')))
+    checkpoints.invalidate([os.path.join(directory, 'parc.txt')])  # no manifest left
+    assert run_pipeline(checkpoints, directory) == ['synthseg']
+
+
+def test_files_are_only_hashed_again_when_their_size_or_mtime_change(directory, monkeypatch):
+    run_pipeline(Checkpoints(), directory)
+    hashed = []
+    hash_file = report.hash_file
+    monkeypatch.setattr(report, 'hash_file', lambda path: hashed.append(os.path.basename(path)) or hash_file(path))
+    assert run_pipeline(Checkpoints(), directory) == []
+    assert hashed == []
+
+    image = os.path.join(directory, 'image.txt')
+    stat = os.stat(image)
+    os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert run_pipeline(Checkpoints(), directory) == []
+    assert hashed == ['image.txt']
@@ -0,0 +1,30 @@
+"""Start-up of the lamar command."""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# records every top-level module the import of lamar.cli tries to load, whether or not it is installed
+IMPORT_CLI = """
+import sys
+attempted = set()
+
+class Recorder:
+    def find_spec(self, name, path=None, target=None):
+        attempted.add(name.split('.')[0])
+        return None
+
+sys.meta_path.insert(0, Recorder())
+import lamar.cli
+heavy = {'tensorflow', 'ants', 'keras'}
+print(sorted(heavy & attempted), sorted(heavy & {name.split('.')[0] for name in sys.modules}))
+"""
+
+
+def test_cli_import_is_lightweight():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.run([sys.executable, '-c', IMPORT_CLI], cwd=ROOT, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    assert output.strip() == '[] []'
@@ -0,0 +1,57 @@
+"""Automatic head region of interest of SynthSeg (get_head_roi, get_otsu_threshold)."""
+
+import numpy as np
+import pytest
+
+from lamar.SynthSeg.predict_synthseg import get_head_roi, get_otsu_threshold
+
+
+def make_head(shape=(60, 70, 150), head=((15, 45), (12, 58), (70, 130)), neck=((24, 36), (26, 44), (0, 70)),
+              seed=0):
+    """RAS image of a bright box (the head) on top of a narrower one (the neck), on a noisy dark background."""
+    rng = np.random.default_rng(seed)
+    im = rng.normal(5, 2, size=shape).astype('float32')
+    for box, intensity in [(neck, 80), (head, 100)]:
+        im[tuple(slice(*bounds) for bounds in box)] = rng.normal(intensity, 10, size=[b - a for a, b in box])
+    return im
+
+
+@pytest.mark.parametrize('im', [np.zeros((40, 40, 40), dtype='float32'), np.full((40, 40, 40), 7, dtype='float32')])
+def test_empty_image(im):
+    assert get_head_roi(im) is None
+
+
+def test_otsu_threshold():
+    rng = np.random.default_rng(1)
+    low, high = rng.normal(10, 2, 5000), rng.normal(100, 5, 2000)
+    threshold = get_otsu_threshold(np.concatenate([low, high]))
+    assert np.mean(low > threshold) < 0.001 and np.all(high > threshold)
+
+
+def test_head_and_neck():
+    roi = get_head_roi(make_head(), voxel_size=1., resolution=3., max_height=1000., margin=0.)
+    # the bounds are found on the image decimated by 3
+    np.testing.assert_allclose(roi, [15, 12, 0, 45, 58, 130], atol=3)
+
+
+def test_neck_is_cut_at_max_height():
+    roi = get_head_roi(make_head(), voxel_size=1., resolution=3., max_height=80., margin=0.)
+    np.testing.assert_allclose(roi, [15, 12, 130 - 80, 45, 58, 130], atol=3)
+    # in mm: the same image with 2 mm voxels keeps 40 voxels
+    roi = get_head_roi(make_head(), voxel_size=2., resolution=3., max_height=80., margin=0.)
+    assert roi[5] - roi[2] == 40
+
+
+def test_margin_is_clamped_to_the_field_of_view():
+    im = make_head()
+    roi = get_head_roi(im, voxel_size=1., resolution=3., max_height=80., margin=10.)
+    np.testing.assert_allclose(roi, [5, 2, 40, 55, 68, 140], atol=3)
+    roi = get_head_roi(im, voxel_size=1., resolution=3., max_height=1000., margin=40.)
+    np.testing.assert_array_equal(roi, [0, 0, 0, *im.shape])
+
+
+def test_largest_component():
+    im = make_head()
+    im[50:56, 60:66, 135:141] = 100  # bright blob outside the head
+    roi = get_head_roi(im, voxel_size=1., resolution=3., max_height=1000., margin=0.)
+    np.testing.assert_allclose(roi, [15, 12, 0, 45, 58, 130], atol=3)
@@ -0,0 +1,23 @@
+"""Lazy submodules of the SynthSeg, lab2im and neuron packages (lamar.lazy)."""
+
+import importlib
+import sys
+
+import pytest
+
+from lamar import lazy
+
+
+@pytest.mark.parametrize('package', ['lamar.SynthSeg', 'lamar.ext.lab2im', 'lamar.ext.neuron'])
+def test_submodules_are_listed(package):
+    module = importlib.import_module(package)
+    assert module.__getattr__.__module__ == lazy.__name__
+    with pytest.raises(AttributeError):
+        getattr(module, 'not_a_submodule')
+
+
+def test_submodule_imported_on_first_access():
+    import lamar.SynthSeg
+    assert 'predict_onnx' in lamar.SynthSeg._SUBMODULES and 'predict_synthseg' in lamar.SynthSeg._SUBMODULES
+    assert lamar.SynthSeg.predict_onnx is sys.modules['lamar.SynthSeg.predict_onnx']
+    assert lamar.SynthSeg.predict_synthseg is sys.modules['lamar.SynthSeg.predict_synthseg']
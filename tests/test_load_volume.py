@@ -0,0 +1,40 @@
+"""utils.load_volume modes."""
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from lamar.ext.lab2im import utils
+
+
+@pytest.fixture
+def path_volume(tmp_path):
+    volume = np.arange(4 * 5 * 6, dtype='int16').reshape(4, 5, 6)
+    path = str(tmp_path / 'volume.nii')
+    nib.save(nib.Nifti1Image(volume, np.diag([2., 1., 1.5, 1.])), path)
+    return path
+
+
+def test_native_is_read_into_memory(path_volume):
+    volume = utils.load_volume(path_volume, mode='native')
+    assert not isinstance(volume, np.memmap) and volume.dtype == np.int16
+    np.testing.assert_array_equal(volume, np.arange(120).reshape(4, 5, 6))
+
+
+def test_mmap_maps_the_file_copy_on_write(path_volume):
+    volume = utils.load_volume(path_volume, mode='mmap')
+    assert isinstance(volume, np.memmap) and volume.mode == 'c'
+    volume[0, 0, 0] = 99
+    np.testing.assert_array_equal(utils.load_volume(path_volume, mode='native'), np.arange(120).reshape(4, 5, 6))
+
+
+@pytest.mark.parametrize('mode', ['float64', 'float32'])
+def test_float_modes(path_volume, mode):
+    volume, aff, _ = utils.load_volume(path_volume, im_only=False, mode=mode)
+    assert volume.dtype == mode
+    np.testing.assert_allclose(aff, np.diag([2., 1., 1.5, 1.]))
+
+
+def test_proxy_reads_slabs(path_volume):
+    proxy = utils.load_volume(path_volume, mode='proxy')
+    np.testing.assert_array_equal(proxy[1:3], np.arange(120).reshape(4, 5, 6)[1:3])
@@ -0,0 +1,166 @@
+"""predict_synthseg.postprocess (in place, float32, slabs) against the version that copied the posteriors."""
+
+import tracemalloc
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from lamar.ext.lab2im import edit_volumes
+from lamar.SynthSeg.predict_synthseg import postprocess
+
+LABELS_SEGMENTATION = np.array([0, 2, 3, 4, 17, 41, 42, 43, 53])
+TOPOLOGY_CLASSES = np.array([0, 1, 1, 2, 3, 4, 4, 5, 6])
+LABELS_PARCELLATION = np.array([0, 1001, 1002, 1003, 2001, 2002, 2003])
+
+
+def reference_postprocess(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
+                          labels_segmentation, labels_parcellation, aff, im_res, fast, topology_classes, v1):
+    """postprocess before it was made to work in place, in float32, and on slabs."""
+    post_patch_seg = np.squeeze(post_patch_seg)
+    if fast | (topology_classes is None):
+        post_patch_seg = edit_volumes.crop_volume_with_idx(post_patch_seg, pad_idx, n_dims=3, return_copy=False)
+
+    tmp_post_patch_seg = post_patch_seg[..., 1:]
+    post_patch_seg_mask = np.sum(tmp_post_patch_seg, axis=-1) > 0.25
+    post_patch_seg_mask = edit_volumes.get_largest_connected_component(post_patch_seg_mask)
+    post_patch_seg_mask = np.stack([post_patch_seg_mask] * tmp_post_patch_seg.shape[-1], axis=-1)
+    tmp_post_patch_seg = edit_volumes.mask_volume(tmp_post_patch_seg, mask=post_patch_seg_mask, return_copy=False)
+    post_patch_seg[..., 1:] = tmp_post_patch_seg
+
+    if (not fast) & (topology_classes is not None):
+        post_patch_seg_mask = post_patch_seg > 0.25
+        for topology_class in np.unique(topology_classes)[1:]:
+            tmp_topology_indices = np.where(topology_classes == topology_class)[0]
+            tmp_mask = np.any(post_patch_seg_mask[..., tmp_topology_indices], axis=-1)
+            tmp_mask = edit_volumes.get_largest_connected_component(tmp_mask)
+            for idx in tmp_topology_indices:
+                post_patch_seg[..., idx] *= tmp_mask
+        post_patch_seg = edit_volumes.crop_volume_with_idx(post_patch_seg, pad_idx, n_dims=3, return_copy=False)
+    else:
+        post_patch_seg_mask = post_patch_seg > 0.2
+        post_patch_seg[..., 1:] *= post_patch_seg_mask[..., 1:]
+
+    post_patch_seg /= np.sum(post_patch_seg, axis=-1)[..., np.newaxis]
+    seg_patch = labels_segmentation[post_patch_seg.argmax(-1).astype('int32')].astype('int32')
+
+    if post_patch_parc is not None:
+        post_patch_parc = np.squeeze(post_patch_parc)
+        post_patch_parc = edit_volumes.crop_volume_with_idx(post_patch_parc, pad_idx, n_dims=3, return_copy=False)
+        mask = (seg_patch == 3) | (seg_patch == 42)
+        post_patch_parc[..., 0] = np.ones_like(post_patch_parc[..., 0])
+        post_patch_parc[..., 0] = edit_volumes.mask_volume(post_patch_parc[..., 0], mask=mask < 0.1,
+                                                           return_copy=False)
+        post_patch_parc /= np.sum(post_patch_parc, axis=-1)[..., np.newaxis]
+        parc_patch = labels_parcellation[post_patch_parc.argmax(-1).astype('int32')].astype('int32')
+        seg_patch[mask] = parc_patch[mask]
+
+    if crop_idx is not None:
+        seg = np.zeros(shape=shape, dtype='int32')
+        posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]])
+        posteriors[..., 0] = np.ones(shape)
+        seg[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5]] = seg_patch
+        posteriors[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5], :] = post_patch_seg
+    else:
+        seg = seg_patch
+        posteriors = post_patch_seg
+
+    seg = edit_volumes.align_volume_to_ref(seg, aff=np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
+    posteriors = edit_volumes.align_volume_to_ref(posteriors, np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
+
+    volumes = np.sum(posteriors[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)))
+    total_volume_cortex_left = np.sum(volumes[np.where(labels_segmentation == 3)[0] - 1])
+    total_volume_cortex_right = np.sum(volumes[np.where(labels_segmentation == 42)[0] - 1])
+    if not v1:
+        volumes = np.concatenate([np.array([np.sum(volumes)]), volumes])
+    if post_patch_parc is not None:
+        volumes_parc = np.sum(post_patch_parc[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)))
+        volumes_parc_left = volumes_parc[:int(len(volumes_parc) / 2)]
+        volumes_parc_right = volumes_parc[int(len(volumes_parc) / 2):]
+        volumes_parc_left = volumes_parc_left / np.sum(volumes_parc_left) * total_volume_cortex_left
+        volumes_parc_right = volumes_parc_right / np.sum(volumes_parc_right) * total_volume_cortex_right
+        volumes = np.concatenate([volumes, volumes_parc_left, volumes_parc_right])
+    volumes = np.around(volumes * np.prod(im_res), 3)
+
+    return seg, posteriors, volumes
+
+
+def random_posteriors(rng, shape, n_labels, background=0.):
+    """Smooth float32 softmax posteriors of a batch of one volume, as output by the network."""
+    logits = gaussian_filter(rng.normal(size=(*shape, n_labels)), sigma=(2, 2, 2, 0)) * 12
+    logits[..., 0] += background
+    posteriors = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return (posteriors / posteriors.sum(axis=-1, keepdims=True))[np.newaxis].astype('float32')
+
+
+@pytest.mark.parametrize('fast', [False, True])
+@pytest.mark.parametrize('parcellation', [False, True])
+@pytest.mark.parametrize('crop', [False, True])
+@pytest.mark.parametrize('v1', [False, True])
+def test_postprocess(fast, parcellation, crop, v1):
+    rng = np.random.default_rng(int(fast) + 2 * int(parcellation) + 4 * int(crop) + 8 * int(v1))
+    patch_shape = (24, 28, 20)
+    pad_idx = np.array([2, 3, 1, 22, 26, 19])
+    cropped_shape = tuple(pad_idx[3:] - pad_idx[:3])
+    if crop:
+        shape = [30, 31, 25]
+        crop_idx = np.array([4, 5, 3, *(np.array([4, 5, 3]) + cropped_shape)])
+    else:
+        shape, crop_idx = list(cropped_shape), None
+    aff = np.diag([-1., 1., -1., 1.])
+    im_res = np.array([1., 1.2, 0.9])
+
+    post_seg = random_posteriors(rng, patch_shape, len(LABELS_SEGMENTATION), background=1.)
+    post_parc = random_posteriors(rng, patch_shape, len(LABELS_PARCELLATION)) if parcellation else None
+    args = (shape, pad_idx, crop_idx, LABELS_SEGMENTATION, LABELS_PARCELLATION if parcellation else None, aff,
+            im_res, fast, TOPOLOGY_CLASSES, v1)
+    expected = reference_postprocess(post_seg.copy(), None if post_parc is None else post_parc.copy(), *args)
+    seg, posteriors, volumes = postprocess(post_seg.copy(), None if post_parc is None else post_parc.copy(), *args,
+                                           slab_size=5, threads=2)
+
+    np.testing.assert_array_equal(seg, expected[0])
+    np.testing.assert_array_equal(posteriors, expected[1])
+    # volumes are summed in float64. The previous version summed the parcellation volumes, and the segmentation volumes
+    # when crop_idx was None, in float32, so these can differ in the last of their 3 decimals
+    np.testing.assert_allclose(volumes, expected[2], rtol=1e-5, atol=1.001e-3)
+    if crop:
+        n_volumes_seg = len(LABELS_SEGMENTATION) - (1 if v1 else 0)
+        np.testing.assert_array_equal(volumes[:n_volumes_seg], expected[2][:n_volumes_seg])
+
+    _, no_posteriors, same_volumes = postprocess(post_seg.copy(), None if post_parc is None else post_parc.copy(),
+                                                 *args, keep_posteriors=False)
+    assert no_posteriors is None
+    np.testing.assert_array_equal(same_volumes, volumes)
+
+
+def traced_peak(function, post_seg, post_parc, *args, **kwargs):
+    """Peak memory traced by tracemalloc (in bytes) while running a postprocessing function, on copies of the
+    posteriors made before tracing starts."""
+    post_seg = post_seg.copy()
+    post_parc = None if post_parc is None else post_parc.copy()
+    tracemalloc.start()
+    try:
+        function(post_seg, post_parc, *args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('fast', [False, True])
+@pytest.mark.parametrize('parcellation', [False, True])
+def test_postprocess_peak_memory(fast, parcellation):
+    rng = np.random.default_rng(0)
+    patch_shape = (40, 44, 36)
+    pad_idx = np.array([2, 2, 2, 38, 42, 34])
+    crop_idx = np.array([5, 4, 6, 41, 44, 38])
+    post_seg = random_posteriors(rng, patch_shape, len(LABELS_SEGMENTATION), background=1.)
+    post_parc = random_posteriors(rng, patch_shape, len(LABELS_PARCELLATION)) if parcellation else None
+    args = ([46, 50, 42], pad_idx, crop_idx, LABELS_SEGMENTATION, LABELS_PARCELLATION if parcellation else None,
+            np.diag([-1., 1., 1., 1.]), np.ones(3), fast, TOPOLOGY_CLASSES, False)
+
+    old = traced_peak(reference_postprocess, post_seg, post_parc, *args)
+    new = traced_peak(postprocess, post_seg, post_parc, *args, slab_size=None)
+    slabs = traced_peak(postprocess, post_seg, post_parc, *args, keep_posteriors=False, slab_size=8)
+    # see benchmarks/postprocess_memory.py for the sizes of SynthSeg
+    assert new < 0.6 * old
+    assert slabs < 0.25 * old
@@ -0,0 +1,174 @@
+"""NumPy re-implementations of the SynthSeg layers used by the ONNX backend (SynthSeg/predict_onnx.py)."""
+
+import os
+
+import numpy as np
+import pytest
+from scipy.ndimage import convolve
+
+from lamar.SynthSeg import predict_onnx
+from lamar.SynthSeg.predict_onnx import OnnxModel, gaussian_blur, make_shape, one_hot
+
+
+def reference_blur(posteriors, sigma):
+    """Channel-wise convolution with the full (non-separable) normalised Gaussian kernel of layers.GaussianBlur."""
+    window_size = int(np.int32(np.ceil(2.5 * sigma) / 2) * 2 + 1)
+    locations = np.arange(window_size) - (window_size - 1) / 2
+    kernel_1d = np.exp(-locations ** 2 / (2 * sigma ** 2))
+    kernel = np.einsum('i,j,k->ijk', kernel_1d, kernel_1d, kernel_1d)
+    kernel /= kernel.sum()
+    blurred = np.zeros_like(posteriors, dtype='float64')
+    for b in range(posteriors.shape[0]):
+        for c in range(posteriors.shape[-1]):
+            blurred[b, ..., c] = convolve(posteriors[b, ..., c].astype('float64'), kernel, mode='constant', cval=0.)
+    return blurred
+
+
+def random_label_map(rng, shape, box_min, box_max):
+    """Label map of network output indices (0 and 24 are background), with foreground in the given box."""
+    label_map = np.where(rng.random(shape) < 0.5, 0, 24).astype('int32')
+    box = tuple(slice(a, b) for a, b in zip(box_min, box_max))
+    label_map[box] = rng.integers(1, 33, size=label_map[box].shape)
+    return label_map
+
+
+def test_one_hot():
+    indices = np.array([[0, 2], [3, 1]])
+    encoded = one_hot(indices, 3)
+    assert encoded.shape == (2, 2, 3) and encoded.dtype == np.float32
+    np.testing.assert_array_equal(encoded[0, 1], [0, 0, 1])
+    np.testing.assert_array_equal(encoded[1, 0], [0, 0, 0])  # out of range
+
+
+@pytest.mark.parametrize('sigma', [0.5, 1., 2.])
+def test_gaussian_blur_matches_full_kernel(sigma):
+    posteriors = np.random.default_rng(0).random((2, 11, 9, 13, 3), dtype=np.float32)
+    blurred = gaussian_blur(posteriors, sigma)
+    assert blurred.shape == posteriors.shape and blurred.dtype == np.float32
+    np.testing.assert_allclose(blurred, reference_blur(posteriors, sigma), atol=1e-5)
+
+
+def test_gaussian_blur_zero_sigma_is_identity():
+    posteriors = np.random.default_rng(1).random((1, 5, 6, 7, 2), dtype=np.float32)
+    np.testing.assert_array_equal(gaussian_blur(posteriors, 0), posteriors)
+
+
+@pytest.mark.parametrize('target_shape', [8, 16, [6, 20, 11]])
+def test_make_shape_centres_foreground(target_shape):
+    rng = np.random.default_rng(2)
+    shape = (14, 17, 12)
+    box_min, box_max = np.array([3, 5, 2]), np.array([11, 12, 9])
+    label_map = random_label_map(rng, shape, box_min, box_max)
+    cropped = make_shape(label_map, shape, target_shape)
+
+    target = np.array(target_shape if isinstance(target_shape, list) else [target_shape] * 3)
+    assert cropped.shape == tuple(target)
+    size = box_max - box_min
+    # the foreground box is centred, with the extra voxel (if any) before it, and cropped symmetrically if too big
+    offset = np.ceil((target - size) / 2).astype(int)
+    src = tuple(slice(a + max(-o, 0), a + max(-o, 0) + min(s, t)) for a, o, s, t in zip(box_min, offset, size, target))
+    dst = tuple(slice(max(o, 0), max(o, 0) + min(s, t)) for o, s, t in zip(offset, size, target))
+    np.testing.assert_array_equal(cropped[dst], label_map[src])
+
+
+def test_make_shape_without_foreground():
+    label_map = np.full((10, 12, 8), 24, dtype='int32')
+    cropped = make_shape(label_map, label_map.shape, 9)
+    assert cropped.shape == (9, 9, 9)
+    # the first target_shape voxels are kept, and centred (with the extra voxel before them) when too small
+    np.testing.assert_array_equal(cropped[:, :, 1:], label_map[:9, :9, :8])
+    assert not cropped[:, :, 0].any()
+
+
+@pytest.mark.parametrize('target_shape', [8, 16, [6, 20, 11]])
+def test_make_shape_matches_layer(target_shape):
+    pytest.importorskip('tensorflow')
+    from lamar.ext.lab2im.layers import MakeShape
+    rng = np.random.default_rng(3)
+    shape = (14, 17, 12)
+    label_maps = np.stack([random_label_map(rng, shape, [3, 5, 2], [11, 12, 9]),
+                           random_label_map(rng, shape, [0, 0, 6], [14, 4, 12]),
+                           np.zeros(shape, dtype='int32')])
+    shapes = np.array([shape] * len(label_maps), dtype='int32')
+    expected = MakeShape(target_shape)([label_maps, shapes]).numpy()
+    for n in range(len(label_maps)):
+        np.testing.assert_array_equal(make_shape(label_maps[n], shapes[n], target_shape), expected[n])
+
+
+def test_gaussian_blur_matches_layer():
+    pytest.importorskip('tensorflow')
+    from lamar.ext.lab2im.layers import GaussianBlur
+    posteriors = np.random.default_rng(4).random((1, 12, 10, 9, 4), dtype=np.float32)
+    expected = GaussianBlur(sigma=0.5)(posteriors).numpy()
+    np.testing.assert_allclose(gaussian_blur(posteriors, 0.5), expected, atol=1e-5)
+
+
+def make_flip_model(n_labels=4, sigma_smoothing=0.5):
+    """OnnxModel linking a fake segmentation UNet with left/right flip averaging, as in build_model."""
+    rng = np.random.default_rng(5)
+    weights, biases = rng.normal(size=n_labels), rng.normal(size=n_labels)
+    model = object.__new__(OnnxModel)
+    model.robust = False
+    model.do_parcellation = False
+    model.do_qc = False
+    model.sigma_smoothing = sigma_smoothing
+    model.flip_indices = np.array([0, 2, 1, 3])[:n_labels]
+    model.run = lambda name, inputs: np.tanh(inputs * weights + biases).astype('float32')
+    return model
+
+
+@pytest.mark.parametrize('sigma_smoothing', [0, 0.5])
+def test_flip_averaging(sigma_smoothing):
+    model = make_flip_model(sigma_smoothing=sigma_smoothing)
+    image = np.random.default_rng(6).random((2, 9, 8, 7, 1), dtype=np.float32)
+
+    def segment(volume):
+        posteriors = model.run('unet', volume)
+        return gaussian_blur(posteriors, sigma_smoothing) if sigma_smoothing > 0 else posteriors
+
+    flipped = np.flip(segment(np.flip(image, axis=1)), axis=1)[..., model.flip_indices]
+    expected = 0.5 * (segment(image) + flipped)
+    np.testing.assert_allclose(model.predict(image), expected, atol=1e-6)
+
+
+def test_qc_without_parcellation():
+    # as in build_model: the segmentation output is the UNet prediction, the QC input is made from the smoothed one
+    model = make_flip_model()
+    model.flip_indices = None
+    model.do_qc = True
+    model.labels_qc = np.arange(4)
+    model.n_labels_qc = 4
+    model.input_shape_qc = 6
+    qc_inputs = list()
+    unet = model.run
+    model.run = lambda name, inputs: unet(name, inputs) if name == 'unet' else qc_inputs.append(inputs) or inputs
+    image = np.random.default_rng(7).random((2, 9, 8, 7, 1), dtype=np.float32)
+    shapes = np.array([[9, 8, 7]] * 2)
+    segmentation, _ = model.predict([image, shapes])
+
+    np.testing.assert_array_equal(segmentation, unet('unet', image))
+    indices = np.argmax(gaussian_blur(unet('unet', image), 0.5), axis=-1)
+    expected = np.stack([one_hot(make_shape(indices[n], shapes[n], 6), 4) for n in range(2)])
+    np.testing.assert_array_equal(qc_inputs[0], expected)
+
+
+@pytest.mark.parametrize('options', [dict(parc=True, qc=True),
+                                     dict(robust=False, fast=True, parc=False, qc=True),
+                                     dict(robust=False, fast=True, parc=True, qc=True)])
+def test_compare_backends(tmp_path, options):
+    pytest.importorskip('onnxruntime')
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('tf2onnx')
+    from lamar.scripts import synthseg
+    model_config = synthseg.get_model_config(dict(synthseg.get_default_args(), **options))
+    for name in ['path_model_segmentation', 'path_model_parcellation', 'path_model_qc']:
+        if model_config[name] is not None and not os.path.isfile(model_config[name]):
+            pytest.skip('SynthSeg weights are not available')
+    path_image = os.path.join(os.path.dirname(__file__), '..', 'testdata',
+                              'sub-HC001_ses-02_space-dwi_desc-b0_ds_3.2mm.nii.gz')
+    onnx_path = predict_onnx.export_onnx_model(model_config, str(tmp_path))
+    comparison = predict_onnx.compare_backends(model_config, onnx_path, path_image)
+    assert set(comparison) == {'segmentation', 'qc'} | ({'parcellation'} if options['parc'] else set())
+    for name, (difference, agreement) in comparison.items():
+        assert difference < 1e-3, name
+        assert agreement is None or agreement > 0.999, name
@@ -0,0 +1,139 @@
+"""Separable resampling of edit_volumes (resample_volume, resample_volume_like, interpolate_axis) against
+scipy's RegularGridInterpolator, which they replace."""
+
+import numpy as np
+import pytest
+from scipy.interpolate import RegularGridInterpolator
+from scipy.ndimage import gaussian_filter
+
+from lamar.ext.lab2im import edit_volumes
+
+
+def reference_resample_volume(volume, aff, new_vox_size, interpolation='linear', blur=True):
+    """resample_volume before the separable interpolation, applied to each channel."""
+    if volume.ndim > 3:
+        channels = [reference_resample_volume(volume[..., c], aff, new_vox_size, interpolation, blur)
+                    for c in range(volume.shape[-1])]
+        return np.stack([channel[0] for channel in channels], axis=-1), channels[0][1]
+    pixdim = np.sqrt(np.sum(aff * aff, axis=0))[:-1]
+    factor = pixdim / np.array(new_vox_size)
+    sigmas = 0.25 / factor
+    sigmas[factor > 1] = 0
+    volume_filt = gaussian_filter(volume, sigmas) if blur else volume
+    interpolator = RegularGridInterpolator([np.arange(s) for s in volume_filt.shape], volume_filt,
+                                           method=interpolation)
+    start = - (factor - 1) / (2 * factor)
+    step = 1.0 / factor
+    stop = start + step * np.ceil(volume_filt.shape * factor)
+    coords = [np.clip(np.arange(start=start[i], stop=stop[i], step=step[i]), 0, volume_filt.shape[i] - 1)
+              for i in range(3)]
+    volume2 = interpolator(tuple(np.meshgrid(*coords, indexing='ij', sparse=True)))
+    aff2 = aff.copy()
+    for c in range(3):
+        aff2[:-1, c] = aff2[:-1, c] / factor[c]
+    aff2[:-1, -1] = aff2[:-1, -1] - np.matmul(aff2[:-1, :-1], 0.5 * (factor - 1))
+    return volume2, aff2
+
+
+def reference_resample_volume_like(shape_ref, aff_ref, vol_flo, aff_flo, interpolation='linear'):
+    """resample_volume_like before the separable interpolation, applied to each channel."""
+    if vol_flo.ndim > 3:
+        return np.stack([reference_resample_volume_like(shape_ref, aff_ref, vol_flo[..., c], aff_flo, interpolation)
+                         for c in range(vol_flo.shape[-1])], axis=-1)
+    T = np.matmul(np.linalg.inv(aff_flo), aff_ref)
+    interpolator = RegularGridInterpolator([np.arange(s) for s in vol_flo.shape], vol_flo, bounds_error=False,
+                                           fill_value=0.0, method=interpolation)
+    grid = np.meshgrid(*[np.arange(s) for s in shape_ref], indexing='ij')
+    coords = np.stack([g.ravel() for g in grid] + [np.ones(grid[0].size)])
+    coords = np.matmul(T, coords)[:-1]
+    return interpolator(tuple(coords)).reshape(shape_ref)
+
+
+def rotation(angles):
+    rotations = []
+    for axis, angle in enumerate(angles):
+        c, s = np.cos(angle), np.sin(angle)
+        i, j = [a for a in range(3) if a != axis]
+        matrix = np.eye(3)
+        matrix[i, i], matrix[i, j], matrix[j, i], matrix[j, j] = c, -s, s, c
+        rotations.append(matrix)
+    return rotations[0] @ rotations[1] @ rotations[2]
+
+
+def affine(matrix, translation):
+    aff = np.eye(4)
+    aff[:3, :3] = matrix
+    aff[:3, 3] = translation
+    return aff
+
+
+@pytest.fixture
+def volume():
+    return np.random.default_rng(0).random((17, 23, 12)) * 100
+
+
+def assert_matches(resampled, expected, interpolation, volume):
+    # linear interpolation is computed in float32, nearest neighbour copies the (float32) voxels exactly
+    if interpolation == 'linear':
+        np.testing.assert_allclose(resampled, expected, rtol=0, atol=1e-5 * np.abs(volume).max())
+    else:
+        np.testing.assert_array_equal(resampled, expected.astype('float32'))
+
+
+@pytest.mark.parametrize('interpolation', ['linear', 'nearest'])
+@pytest.mark.parametrize('blur', [False, True])
+@pytest.mark.parametrize('new_vox_size', [[1., 1., 1.], [1.3, 0.6, 2.5], [0.5, 0.5, 0.5]])
+def test_resample_volume(volume, interpolation, blur, new_vox_size):
+    aff = affine(np.diag([0.8, 1.2, 2.]), [10., -4., 3.])
+    expected, expected_aff = reference_resample_volume(volume, aff, new_vox_size, interpolation, blur)
+    resampled, resampled_aff = edit_volumes.resample_volume(volume, aff, new_vox_size, interpolation, blur, threads=3)
+    assert resampled.dtype == np.float32 and resampled.shape == expected.shape
+    assert_matches(resampled, expected, interpolation, volume)
+    np.testing.assert_allclose(resampled_aff, expected_aff)
+
+
+@pytest.mark.parametrize('interpolation', ['linear', 'nearest'])
+def test_resample_volume_channels(volume, interpolation):
+    volume = np.stack([volume, volume[::-1] * 0.5], axis=-1)
+    aff = affine(np.diag([0.8, 1.2, 2.]), [0., 0., 0.])
+    expected, _ = reference_resample_volume(volume, aff, [1.1, 1.5, 1.], interpolation)
+    resampled, _ = edit_volumes.resample_volume(volume, aff, [1.1, 1.5, 1.], interpolation)
+    assert_matches(resampled, expected, interpolation, volume)
+
+
+AFFINES_REF = {
+    'anisotropic': affine(np.diag([0.7, 1.9, 1.3]), [2.3, -1.1, 0.4]),
+    'permuted_flipped': affine(np.array([[0, 0, -1.1], [0.9, 0, 0], [0, 1.6, 0]]), [14., 1.5, -2.2]),
+    'rotated': affine(rotation([0.3, -0.2, 0.5]) @ np.diag([1.1, 0.9, 1.4]), [1.2, -3., 2.5]),
+}
+
+
+@pytest.mark.parametrize('interpolation', ['linear', 'nearest'])
+@pytest.mark.parametrize('case', list(AFFINES_REF))
+@pytest.mark.parametrize('n_channels', [0, 2])
+def test_resample_volume_like(volume, interpolation, case, n_channels):
+    if n_channels:
+        volume = np.stack([volume * (c + 1) for c in range(n_channels)], axis=-1)
+    aff_flo = affine(np.diag([1., 1.2, 1.5]), [0.5, -2., 1.])
+    aff_ref = AFFINES_REF[case]
+    shape_ref = (19, 14, 16)
+    expected = reference_resample_volume_like(shape_ref, aff_ref, volume, aff_flo, interpolation)
+    # small chunks, so that the volume is split between threads
+    resampled = edit_volumes.resample_volume_like(np.zeros(shape_ref), aff_ref, volume, aff_flo, interpolation,
+                                                  threads=3, chunk_size=500)
+    assert resampled.dtype == np.float32 and resampled.shape == expected.shape
+    assert_matches(resampled, expected, interpolation, volume)
+
+
+@pytest.mark.parametrize('interpolation', ['linear', 'nearest'])
+@pytest.mark.parametrize('axis', [0, 1, 2])
+def test_interpolate_axis(volume, interpolation, axis):
+    coords = np.random.default_rng(1).uniform(-2, volume.shape[axis] + 1, size=9)
+    taps = edit_volumes.get_interpolation_taps(coords, volume.shape[axis], interpolation, fill_outside=True)
+    interpolated = edit_volumes.interpolate_axis(volume, taps, axis, threads=2, chunk_size=100)
+
+    grid = [np.arange(s) for s in volume.shape]
+    interpolator = RegularGridInterpolator(grid, volume, bounds_error=False, fill_value=0., method=interpolation)
+    points = list(np.meshgrid(*[coords if a == axis else grid[a] for a in range(3)], indexing='ij'))
+    expected = interpolator(tuple(points))
+    assert_matches(interpolated, expected, interpolation, volume)
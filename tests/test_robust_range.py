@@ -0,0 +1,81 @@
+"""edit_volumes.get_robust_range against np.percentile."""
+
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from lamar.ext.lab2im import edit_volumes
+
+
+def make_volume(dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    volume = rng.gamma(2., 30., size=(23, 19, 17)) - 10
+    volume[:4] = 0
+    return volume.astype(dtype)
+
+
+def expected_range(volume, min_percentile, max_percentile, use_positive_only, stride=1):
+    intensities = volume.reshape(-1)[::stride]
+    if use_positive_only:
+        intensities = intensities[intensities > 0]
+    return np.percentile(intensities, min_percentile), np.percentile(intensities, max_percentile)
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64', 'int16'])
+@pytest.mark.parametrize('percentiles', [(2, 98), (0, 100), (0.5, 99.5), (25, 75)])
+@pytest.mark.parametrize('use_positive_only', [False, True])
+@pytest.mark.parametrize('stride', [1, 3])
+def test_exact(dtype, percentiles, use_positive_only, stride):
+    volume = make_volume(dtype)
+    original = volume.copy()
+    robust_range = edit_volumes.get_robust_range(volume, *percentiles, use_positive_only, method='exact', stride=stride)
+    expected = expected_range(volume, *percentiles, use_positive_only, stride)
+    np.testing.assert_allclose(robust_range, expected, rtol=1e-6 if dtype == 'float32' else 1e-12)
+    # the volume is not partitioned in place
+    np.testing.assert_array_equal(volume, original)
+
+
+@pytest.mark.parametrize('percentiles', [(2, 98), (0, 100), (0.5, 99.5), (25, 75)])
+@pytest.mark.parametrize('use_positive_only', [False, True])
+@pytest.mark.parametrize('n_bins', [16, 256, 4096])
+def test_histogram(percentiles, use_positive_only, n_bins):
+    volume = make_volume('float32')
+    robust_range = edit_volumes.get_robust_range(volume, *percentiles, use_positive_only, method='histogram',
+                                                 n_bins=n_bins)
+    intensities = volume[volume > 0] if use_positive_only else volume
+    bin_width = (float(intensities.max()) - float(intensities.min())) / n_bins
+    expected = expected_range(volume, *percentiles, use_positive_only)
+    assert np.all(np.abs(np.array(robust_range, dtype='float64') - expected) <= bin_width * (1 + 1e-6))
+
+
+def test_non_contiguous_volume():
+    volume = make_volume('float32')
+    transposed = volume.transpose(2, 0, 1)
+    expected = expected_range(transposed, 2, 98, False)
+    np.testing.assert_allclose(edit_volumes.get_robust_range(transposed, 2, 98), expected, rtol=1e-6)
+    np.testing.assert_array_equal(volume, make_volume('float32'))
+
+
+def test_uniform_volume():
+    volume = np.full((5, 6, 7), 3., dtype='float32')
+    assert edit_volumes.get_robust_range(volume, method='histogram') == (3., 3.)
+    assert edit_volumes.get_robust_range(volume, method='exact') == (3., 3.)
+
+
+@pytest.mark.parametrize('method, contiguous, use_positive_only, max_copies', [
+    ('exact', True, False, 1), ('exact', False, False, 1), ('exact', True, True, 1), ('exact', False, True, 1),
+    ('histogram', True, False, 0), ('histogram', False, False, 1), ('histogram', True, True, 1),
+    ('histogram', False, True, 1)])
+def test_copies(method, contiguous, use_positive_only, max_copies):
+    volume = np.random.default_rng(2).random((128, 128, 128), dtype=np.float32) + 0.5
+    volume = volume if contiguous else volume.transpose(2, 0, 1)
+    tracemalloc.start()
+    try:
+        edit_volumes.get_robust_range(volume, use_positive_only=use_positive_only, method=method)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # the intensities are copied at most max_copies times (the boolean mask of use_positive_only is a quarter of them,
+    # and the histogram bins chunks of RESCALE_HISTOGRAM_CHUNK_SIZE intensities)
+    assert peak < (max_copies + 0.35 + 0.25 * use_positive_only) * volume.nbytes
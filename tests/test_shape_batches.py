@@ -0,0 +1,110 @@
+"""Grouping of the images of predict_synthseg.predict into batches of the same shape."""
+
+import numpy as np
+import pytest
+
+from lamar.SynthSeg import predict_synthseg
+from lamar.SynthSeg.predict_synthseg import ShapeBatches
+
+SHAPES = [(32, 32, 32), (64, 32, 32), (32, 32, 32), (32, 64, 64), (64, 32, 32), (32, 32, 32), (32, 64, 64),
+          (32, 32, 32), (64, 32, 32), (32, 64, 64), (96, 96, 96)]
+
+
+def run_batches(shapes, batch_size, max_waiting, available_memory=2 ** 40):
+    """Add images of the given shapes one by one, and return the batches in the order they are ready, with the most
+    images waiting at any time."""
+    batches = ShapeBatches(batch_size, max_waiting, available_memory)
+    ready, max_waiting_seen = [], 0
+    for i, shape in enumerate(shapes):
+        ready.extend(batches.add(i, shape))
+        max_waiting_seen = max(max_waiting_seen, batches.n_waiting())
+    return ready + batches.flush(), max_waiting_seen
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 3, 8])
+@pytest.mark.parametrize('max_waiting', [1, 2, 5, 100])
+def test_batches(batch_size, max_waiting):
+    batches, max_waiting_seen = run_batches(SHAPES, batch_size, max_waiting)
+    # every image runs once, with images of its shape only, in batches of at most batch_size
+    assert sorted(i for batch in batches for i in batch) == list(range(len(SHAPES)))
+    for batch in batches:
+        assert len({SHAPES[i] for i in batch}) == 1
+        assert 1 <= len(batch) <= batch_size
+    # images waiting for a batch are bounded like the queues of predict
+    assert max_waiting_seen <= max_waiting
+
+
+def test_full_batches_without_pressure():
+    batches, _ = run_batches(SHAPES, 3, 100)
+    assert batches[:3] == [[0, 2, 5], [1, 4, 8], [3, 6, 9]]
+
+
+def test_largest_batch_is_flushed():
+    batches = ShapeBatches(4, 3, 2 ** 40)
+    assert batches.add(0, (32, 32, 32)) == []
+    assert batches.add(1, (32, 32, 32)) == []
+    assert batches.add(2, (64, 64, 64)) == []
+    # 2 images of 32^3 voxels against 1 image of 64^3 voxels
+    assert batches.add(3, (16, 16, 16)) == [[2]]
+    assert batches.flush() == [[0, 1], [3]]
+
+
+def test_batch_size_is_capped_by_memory():
+    shape = (64, 64, 64)
+    image_memory = np.prod(shape) * predict_synthseg.NETWORK_BYTES_PER_VOXEL
+    assert predict_synthseg.get_max_batch_size(shape, 8, available_memory=10 * image_memory) == 8
+    assert predict_synthseg.get_max_batch_size(shape, 8, available_memory=3 * image_memory) == 2
+    assert predict_synthseg.get_max_batch_size(shape, 8, available_memory=image_memory // 2) == 1
+    batches, _ = run_batches([shape] * 5, 8, 100, available_memory=3 * image_memory)
+    assert batches == [[0, 1], [2, 3], [4]]
+
+
+class FakeNet:
+    """Stand-in for the SynthSeg network: every output of an image depends on the whole image (and on its shape for
+    QC), never on the other images of the batch."""
+
+    def __init__(self, do_parcellation, do_qc, n_labels=5):
+        rng = np.random.default_rng(0)
+        self.weights, self.biases = rng.normal(size=n_labels), rng.normal(size=n_labels)
+        self.do_parcellation, self.do_qc = do_parcellation, do_qc
+
+    def predict(self, inputs):
+        image, shapes = inputs if self.do_qc else (inputs, None)
+        means = image.mean(axis=(1, 2, 3), keepdims=True)
+        logits = np.tanh(image * self.weights + self.biases) + means
+        segmentation = np.exp(logits) / np.exp(logits).sum(axis=-1, keepdims=True)
+        outputs = [segmentation.astype('float16')]
+        if self.do_parcellation:
+            outputs.append(np.cumsum(segmentation, axis=1).astype('float32'))
+        if self.do_qc:
+            outputs.append(segmentation.max(axis=(1, 2, 3)) * shapes.sum(axis=-1, keepdims=True))
+        return outputs if len(outputs) > 1 else outputs[0]
+
+
+@pytest.mark.parametrize('do_parcellation', [False, True])
+@pytest.mark.parametrize('do_qc', [False, True])
+def test_batched_predictions_equal_unbatched(do_parcellation, do_qc):
+    rng = np.random.default_rng(1)
+    shapes = [(8, 8, 8), (16, 8, 8), (8, 8, 8), (8, 8, 8), (16, 8, 8), (8, 16, 8), (8, 8, 8)]
+    images = [rng.random((1, *shape, 1), dtype=np.float32) for shape in shapes]
+    net = FakeNet(do_parcellation, do_qc)
+
+    batches = ShapeBatches(3, 3, available_memory=2 ** 40)
+    ready = [batch for i, shape in enumerate(shapes) for batch in batches.add(i, shape)] + batches.flush()
+    assert max(len(batch) for batch in ready) == 3
+    predictions = dict()
+    for batch in ready:
+        outputs = predict_synthseg.run_network(net, np.concatenate([images[i] for i in batch]), do_parcellation,
+                                               do_qc)
+        predictions.update(zip(batch, predict_synthseg.split_predictions(outputs, len(batch))))
+
+    assert sorted(predictions) == list(range(len(shapes)))
+    for i, image in enumerate(images):
+        expected = predict_synthseg.run_network(net, image, do_parcellation, do_qc)
+        for output, expected_output in zip(predictions[i], expected):
+            if expected_output is None:
+                assert output is None
+            else:
+                assert output.shape == expected_output.shape
+                np.testing.assert_array_equal(output, expected_output)
+        assert predictions[i][0].dtype == np.float32
@@ -0,0 +1,60 @@
+"""edit_volumes.smooth_label_map against the per-label convolution it replaces."""
+
+import numpy as np
+import pytest
+from scipy.ndimage import convolve
+
+from lamar.ext.lab2im import edit_volumes
+
+
+def reference_smooth_label_map(labels, kernel, labels_list=None):
+    """smooth_label_map before it only counted the neighbours of boundary voxels."""
+    unique_labels = np.unique(labels).astype('int32')
+    if labels_list is None:
+        labels_list = unique_labels
+        new_labels = mask_new_labels = None
+    else:
+        labels_to_keep = [lab for lab in unique_labels if lab not in labels_list]
+        new_labels, mask_new_labels = edit_volumes.mask_label_map(labels, labels_to_keep, return_mask=True)
+    count = np.zeros(labels.shape)
+    labels_smoothed = np.zeros(labels.shape, dtype='int32')
+    for label in labels_list:
+        n_neighbours = convolve((labels == label) * 1, kernel)
+        idx = n_neighbours > count
+        count[idx] = n_neighbours[idx]
+        labels_smoothed[idx] = label
+    return labels_smoothed if new_labels is None else np.where(mask_new_labels, new_labels, labels_smoothed)
+
+
+def random_label_map(rng, shape, values):
+    """Blocky random label map, so that it has both uniform regions and boundaries."""
+    coarse = rng.choice(values, size=tuple(s // 3 + 1 for s in shape))
+    labels = np.kron(coarse, np.ones((3,) * len(shape), dtype=coarse.dtype))[tuple(slice(s) for s in shape)]
+    noise = rng.random(shape) < 0.1
+    labels[noise] = rng.choice(values, size=noise.sum())
+    return labels.astype('int32')
+
+
+KERNELS = {
+    'cube': np.ones((3, 3, 3)),
+    'cross': np.array([[[0, 0, 0], [0, 1, 0], [0, 0, 0]],
+                       [[0, 1, 0], [1, 1, 1], [0, 1, 0]],
+                       [[0, 0, 0], [0, 1, 0], [0, 0, 0]]]),
+    'anisotropic': np.ones((5, 3, 1)),
+    'even': np.ones((2, 4, 3)),
+}
+
+
+@pytest.mark.parametrize('kernel', list(KERNELS))
+@pytest.mark.parametrize('labels_list', [None, [0, 2, 3, 17], [17, 3], [3, 2, 99]])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_smooth_label_map(kernel, labels_list, seed):
+    labels = random_label_map(np.random.default_rng(seed), (21, 18, 15), [0, 2, 3, 5, 17])
+    expected = reference_smooth_label_map(labels, KERNELS[kernel], labels_list)
+    smoothed = edit_volumes.smooth_label_map(labels, KERNELS[kernel], labels_list, threads=3, chunk_size=300)
+    np.testing.assert_array_equal(smoothed, expected)
+
+
+def test_smooth_label_map_uniform():
+    labels = np.full((6, 7, 8), 4, dtype='int32')
+    np.testing.assert_array_equal(edit_volumes.smooth_label_map(labels, KERNELS['cube']), labels)
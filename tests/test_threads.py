@@ -0,0 +1,80 @@
+"""Core budget of threads.py: cgroup CPU quotas and TensorFlow thread splits."""
+
+import json
+import os
+
+import pytest
+
+from lamar.scripts import threads
+
+
+def make_tree(root, cgroup, files):
+    """Fake / with the given /proc/self/cgroup content and files (relative to /sys/fs/cgroup)."""
+    os.makedirs(root / 'proc' / 'self')
+    (root / 'proc' / 'self' / 'cgroup').write_text(cgroup)
+    for path, content in files.items():
+        path = root / 'sys' / 'fs' / 'cgroup' / path
+        os.makedirs(path.parent, exist_ok=True)
+        path.write_text(content)
+    return str(root)
+
+
+@pytest.mark.parametrize('files, expected', [
+    ({}, None),
+    ({'cpu.max': 'max 100000\n'}, None),
+    ({'user.slice/job/cpu.max': '250000 100000\n'}, 2.5),
+    # every level of the hierarchy may set a quota, the smallest applies
+    ({'cpu.max': '800000 100000\n', 'user.slice/cpu.max': '150000 100000\n', 'user.slice/job/cpu.max': 'max 100000'},
+     1.5),
+    ({'user.slice/job/cpu.max': 'garbage\n'}, None),
+])
+def test_cgroup_v2(tmp_path, files, expected):
+    root = make_tree(tmp_path, '0::/user.slice/job\n', files)
+    assert threads.get_cgroup_cpu_limit(root) == expected
+
+
+@pytest.mark.parametrize('files, expected', [
+    ({}, None),
+    ({'cpu,cpuacct/docker/abc/cpu.cfs_quota_us': '-1\n', 'cpu,cpuacct/docker/abc/cpu.cfs_period_us': '100000\n'},
+     None),
+    ({'cpu,cpuacct/docker/abc/cpu.cfs_quota_us': '300000\n', 'cpu,cpuacct/docker/abc/cpu.cfs_period_us': '100000\n'},
+     3.),
+    # inside a container, the cgroup of the process is at the root of the mount
+    ({'cpu/cpu.cfs_quota_us': '50000\n', 'cpu/cpu.cfs_period_us': '100000\n'}, 0.5),
+])
+def test_cgroup_v1(tmp_path, files, expected):
+    root = make_tree(tmp_path, '12:memory:/docker/abc\n4:cpu,cpuacct:/docker/abc\n1:name=systemd:/docker/abc\n',
+                     files)
+    assert threads.get_cgroup_cpu_limit(root) == expected
+
+
+def test_cgroup_unreadable(tmp_path):
+    assert threads.get_cgroup_cpu_limit(str(tmp_path)) is None
+
+
+@pytest.fixture
+def calibration(tmp_path, monkeypatch):
+    path = tmp_path / 'threads.json'
+    monkeypatch.setenv('LAMAR_CALIBRATION', str(path))
+    return path
+
+
+@pytest.mark.parametrize('budget', range(1, 34))
+@pytest.mark.parametrize('n_images', [1, 2])
+def test_tf_split_within_budget(calibration, budget, n_images):
+    intra, inter = threads.get_tf_split(budget, n_images)
+    assert intra >= 1 and inter >= 1
+    network_threads = threads._get_network_threads(budget, n_images)
+    assert intra + inter <= network_threads or (network_threads == 1 and (intra, inter) == (1, 1))
+    for intra, inter in threads.get_candidate_splits(network_threads):
+        assert intra >= 1 and inter >= 1
+        assert intra + inter <= network_threads or (network_threads == 1 and (intra, inter) == (1, 1))
+
+
+def test_tf_split_uses_calibration(calibration):
+    key = threads._get_machine_key()
+    calibration.write_text(json.dumps({key: {'splits': {'7': {'intra_op_threads': 4, 'inter_op_threads': 3}}}}))
+    # with several images, the budget of the network is one less
+    assert threads.get_tf_split(8, n_images=2) == (4, 3)
+    assert threads.get_tf_split(7, n_images=1) == (4, 3)
+    assert threads.get_tf_split(8, n_images=1) == (6, 2)
@@ -0,0 +1,51 @@
+"""utils.write_gzip, and save_volume with a compression level."""
+
+import gzip
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from lamar.ext.lab2im import utils
+
+
+def compressible_bytes(size, seed=0):
+    rng = np.random.default_rng(seed)
+    return (np.cumsum(rng.integers(-2, 3, size=size)) % 7).astype('uint8').tobytes()
+
+
+@pytest.mark.parametrize('compression', [0, 1, 6, 9])
+@pytest.mark.parametrize('threads', [1, 4])
+@pytest.mark.parametrize('size', [0, 1, 999, 4096, 10000])
+def test_write_gzip_round_trip(tmp_path, compression, threads, size):
+    data = compressible_bytes(size)
+    path = tmp_path / 'data.gz'
+    # small blocks, so that the data is split in several blocks, compressed in parallel
+    utils.write_gzip(data, str(path), compression=compression, threads=threads, block_size=1000)
+    with open(path, 'rb') as f:
+        assert gzip.decompress(f.read()) == data
+
+
+def test_write_gzip_compresses_like_a_single_stream(tmp_path):
+    data = compressible_bytes(200000)
+    utils.write_gzip(data, str(tmp_path / 'blocks.gz'), compression=6, threads=4, block_size=2 ** 14)
+    size = (tmp_path / 'blocks.gz').stat().st_size
+    assert size < 1.05 * len(gzip.compress(data, compresslevel=6))
+
+
+def test_write_gzip_memoryview(tmp_path):
+    array = np.arange(5000, dtype='float32').reshape(50, 100)
+    utils.write_gzip(array, str(tmp_path / 'array.gz'), threads=2, block_size=3000)
+    with open(tmp_path / 'array.gz', 'rb') as f:
+        assert gzip.decompress(f.read()) == array.tobytes()
+
+
+@pytest.mark.parametrize('compression', [None, 1, 9])
+def test_save_volume_compression(tmp_path, compression):
+    volume = np.random.default_rng(1).integers(0, 50, size=(20, 30, 10)).astype('int32')
+    aff = np.diag([1.5, 1., 2., 1.])
+    path = str(tmp_path / 'volume.nii.gz')
+    utils.save_volume(volume, aff, None, path, compression=compression, threads=2)
+    image = nib.load(path)
+    np.testing.assert_array_equal(np.asarray(image.dataobj), volume)
+    np.testing.assert_allclose(image.affine, aff)